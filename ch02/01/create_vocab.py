@@ -3,20 +3,56 @@
 功能: 从 tokens 创建词汇表映射
 """
 
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 
-def create_vocab(tokens: List[str]) -> Dict[str, int]:
+def extend_vocab(vocab: Dict[str, int], tokens: List[str]) -> List[str]:
+    """
+    追加模式：把 tokens 中的新单词加到词汇表末尾，已有单词的 id 保持不变
+
+    按字母顺序重新编号时，加入一个新单词会让它后面所有单词的 id 都加 1，
+    已经编码好的语料和训练过的嵌入行全部对不上；追加模式只给新单词分配新 id。
+
+    参数:
+        vocab: {token: id} 字典，id 为 0..len(vocab)-1，会被原地修改
+        tokens: 新数据分词后的列表
+
+    返回:
+        list[str]: 新加入的单词（按字母顺序），id 从原词汇表大小开始依次递增
+
+    注意:
+        - 只遍历新数据，耗时与新数据的大小成正比，与词汇表大小无关
+    """
+    new_words = sorted({token for token in tokens if token not in vocab})
+    start = len(vocab)
+    for offset, token in enumerate(new_words):
+        vocab[token] = start + offset
+    return new_words
+
+
+def create_vocab(tokens: List[str], base_vocab: Optional[Dict[str, int]] = None) -> Dict[str, int]:
     """
     从 tokens 创建词汇表
 
     参数:
         tokens: 分词后的列表
+        base_vocab: 已有的词汇表。提供时使用追加模式（见 extend_vocab）：
+                    原地把新单词加到末尾并返回它，已有单词的 id 不变
 
     返回:
         vocab: {token: id} 字典
     """
 
+    if base_vocab is not None:
+        print("正在扩展词汇表（追加模式）...")
+        old_size = len(base_vocab)
+        new_words = extend_vocab(base_vocab, tokens)
+        print(f"✓ 词汇表扩展成功！")
+        print(f"  词汇表大小: {old_size} -> {len(base_vocab)}，新增 {len(new_words)} 个 tokens")
+        for idx, token in enumerate(new_words[:5], start=old_size):
+            print(f"    {idx:4d}: {repr(token)}")
+        return base_vocab
+
     print("正在创建词汇表...")
 
     # 1. 去重：使用 set 去掉重复单词
@@ -32,13 +68,14 @@ def create_vocab(tokens: List[str]) -> Dict[str, int]:
     vocab = {token: integer for integer, token in enumerate(all_words)}
 
     # 打印前 15 个词汇表条目
+    # id 就是 all_words 中的下标，直接切片，不需要把整个字典复制成列表
     print(f"\n  词汇表前 15 个条目:")
-    for i, (token, idx) in enumerate(list(vocab.items())[:15]):
+    for idx, token in enumerate(all_words[:15]):
         print(f"    {idx:4d}: {repr(token)}")
 
     # 打印后 5 个词汇表条目
     print(f"\n  词汇表后 5 个条目:")
-    for i, (token, idx) in enumerate(list(vocab.items())[-5:]):
+    for idx, token in enumerate(all_words[-5:], start=max(vocab_size - 5, 0)):
         print(f"    {idx:4d}: {repr(token)}")
 
     return vocab
@@ -64,6 +101,10 @@ if __name__ == "__main__":
     # 创建词汇表
     vocab = create_vocab(tokens)
 
+    # 追加模式：加入一段新文本，已有 token 的 id 不变
+    print()
+    create_vocab(tokenize("The quokka painted a velociraptor."), base_vocab=vocab)
+
     print("\n" + "=" * 60)
     print("步骤 4 完成！")
     print("=" * 60)
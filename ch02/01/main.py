@@ -6,6 +6,10 @@
 import os
 import sys
 
+# corpus_stats 位于 ch02/main
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main"))
+from corpus_stats import CorpusStats, length_table
+
 
 def print_separator(title: str = "") -> None:
     """打印分隔线"""
@@ -98,10 +102,13 @@ def main():
     print("\n[测试 3] 词汇表统计")
     print("-" * 70)
 
-    # 统计信息
-    total_tokens = len(tokens)
-    unique_tokens = len(vocab)
-    avg_token_length = sum(len(t) for t in tokens) / len(tokens)
+    # 统计信息：在 token ID 上用 NumPy 计算（ch02/main/corpus_stats.py），
+    # 不需要在字符串列表上逐个循环，大语料可以直接扫描内存映射的 token 分片；
+    # 步骤 3 的 tokens 已经分好词，直接查表得到 ID，不再用分词器把全文重新编码一遍
+    stats = CorpusStats.from_ids([vocab[t] for t in tokens], len(vocab))
+    total_tokens = stats.n_tokens
+    unique_tokens = stats.n_unique
+    avg_token_length = stats.chars_per_token(length_table(vocab))
 
     print(f"  总 token 数: {total_tokens}")
     print(f"  唯一 token 数: {unique_tokens}")
@@ -6,6 +6,8 @@
 import re
 from typing import List, Dict
 
+from create_vocab import extend_vocab
+
 
 class SimpleTokenizerV1:
     """
@@ -21,6 +23,7 @@ class SimpleTokenizerV1:
         参数:
             vocab (dict): 词汇表字典，格式为 {token_string: token_id}
                          例如: {"hello": 0, "world": 1, ",": 2}
+                         也可以是 ch02/main/blob_vocab.py 的 BlobVocab（大词汇表更省内存）
 
         属性:
             self.str_to_int: 字符串到整数的映射（编码用）
@@ -32,7 +35,11 @@ class SimpleTokenizerV1:
         # 创建反向映射：整数 ID -> 字符串
         # 使用字典推导式，将 vocab 的键值对反转
         # 例如: {"hello": 0, "world": 1} -> {0: "hello", 1: "world"}
-        self.int_to_str = {i: s for s, i in vocab.items()}
+        # BlobVocab 自带 id -> 字符串的视图（从字节串切片），不需要再建一个字典
+        if hasattr(vocab, "inverse"):
+            self.int_to_str = vocab.inverse
+        else:
+            self.int_to_str = {i: s for s, i in vocab.items()}
 
         print(f"✓ 分词器初始化完成")
         print(f"  词汇表大小: {len(vocab)}")
@@ -70,9 +77,34 @@ class SimpleTokenizerV1:
 
         # 将清理后的 token 转换为词汇表中的整数 ID
         # 如果 token 不在词汇表中，这里会报 KeyError (V1 版本暂不处理未知单词)
+        # BlobVocab 提供向量化的批量查找，比逐个 token 查找快
+        if hasattr(self.str_to_int, "lookup"):
+            return self.str_to_int.lookup(preprocessed).tolist()
         ids = [self.str_to_int[token] for token in preprocessed]
         return ids
 
+    def extend(self, tokens: List[str]) -> List[str]:
+        """
+        追加模式扩展词汇表：新单词的 id 接在末尾，已编码的 ID 序列仍然有效
+
+        参数:
+            tokens (list[str]): 新数据分词后的列表
+
+        返回:
+            list[str]: 新加入的单词（id 依次为原词汇表大小, 原词汇表大小 + 1, ...）
+
+        注意:
+            - 只更新新单词的两个方向的映射，不重建反向字典
+            - BlobVocab 是只读的紧凑结构，不支持追加
+        """
+        if hasattr(self.str_to_int, "lookup"):
+            raise TypeError("BlobVocab 不支持追加，请用字典词汇表扩展后再重新构建 BlobVocab")
+        start = len(self.str_to_int)
+        new_words = extend_vocab(self.str_to_int, tokens)
+        for offset, token in enumerate(new_words):
+            self.int_to_str[start + offset] = token
+        return new_words
+
     def decode(self, ids: List[int]) -> str:
         """
         解码方法：将整数 ID 序列还原为文本
@@ -91,7 +123,11 @@ class SimpleTokenizerV1:
         # 将整数 ID 列表转换为字符串列表，然后用空格连接
         # 例如: [0, 1, 2] -> ["hello", "world", ","] -> "hello world ,"
         # 对比 JavaScript → ["hello", "world", ","].join(" ")
-        text = ' '.join([self.int_to_str[i] for i in ids])
+        if hasattr(self.str_to_int, "tokens"):
+            # BlobVocab：批量从字节串中切出所有 token
+            text = ' '.join(self.str_to_int.tokens(ids))
+        else:
+            text = ' '.join([self.int_to_str[i] for i in ids])
 
         # 去除标点符号前的多余空格
         # 正则表达式说明:
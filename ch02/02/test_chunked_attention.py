@@ -0,0 +1,160 @@
+"""
+分块注意力（ch03/main/chunked_attention.py）的回归测试
+
+与 PyTorch 自带的 F.scaled_dot_product_attention 对比输出以及 Q、K、V 的梯度，覆盖：
+    - 标准因果掩码
+    - 滑动窗口
+    - 块大小不能整除序列长度（最后一个块较小）
+    - KV 缓存场景：key 比 query 多，query 对应最后 T_q 个位置
+    - dropout=0 时走自定义 autograd Function 的反向传播
+另外用 gradcheck 检查 dropout > 0 时反向传播按块重新生成的掩码与前向完全一致。
+
+运行方式：
+    python ch02/02/test_chunked_attention.py
+    python -m pytest ch02/02/test_chunked_attention.py
+"""
+
+import os
+import sys
+
+import torch
+import torch.nn.functional as F
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch03.main.chunked_attention import chunked_causal_attention
+
+# 用 float64 对比，误差只来自求和顺序，容差可以设得很严
+DTYPE = torch.float64
+ATOL = 1e-10
+
+
+def reference_attention(queries, keys, values, window=None):
+    """
+    参考实现：F.scaled_dot_product_attention + 显式的可见性掩码
+
+    参数:
+        queries (Tensor): (b, H, T_q, head_dim)
+        keys, values (Tensor): (b, H, T_k, head_dim)，query 对应最后 T_q 个位置
+        window (int): 滑动窗口大小（包括自身），None 表示标准因果注意力
+
+    返回:
+        Tensor: (b, H, T_q, head_dim)
+    """
+    num_queries, num_keys = queries.shape[-2], keys.shape[-2]
+    q_pos = torch.arange(num_keys - num_queries, num_keys)
+    k_pos = torch.arange(num_keys)
+    visible = k_pos[None, :] <= q_pos[:, None]
+    if window is not None:
+        visible &= k_pos[None, :] > q_pos[:, None] - window
+    return F.scaled_dot_product_attention(queries, keys, values, attn_mask=visible)
+
+
+def compare_with_reference(num_queries, num_keys, chunk_size, window=None, seed=123):
+    """
+    对比分块注意力与参考实现的输出和梯度
+
+    参数:
+        num_queries (int): query 数量
+        num_keys (int): key 数量（>= num_queries）
+        chunk_size (int): 分块大小
+        window (int): 滑动窗口大小
+        seed (int): 随机种子
+
+    返回:
+        dict: {"out" / "grad_q" / "grad_k" / "grad_v": 最大绝对误差}
+    """
+    generator = torch.Generator().manual_seed(seed)
+    q = torch.randn(2, 3, num_queries, 16, dtype=DTYPE, generator=generator)
+    k = torch.randn(2, 3, num_keys, 16, dtype=DTYPE, generator=generator)
+    v = torch.randn(2, 3, num_keys, 16, dtype=DTYPE, generator=generator)
+    # 随机的上游梯度，避免 sum() 的全 1 梯度掩盖行列错位
+    grad_out = torch.randn(2, 3, num_queries, 16, dtype=DTYPE, generator=generator)
+
+    results = []
+    for attention in (lambda *t: chunked_causal_attention(*t, chunk_size=chunk_size, window=window,
+                                                          dropout_p=0.0),
+                      lambda *t: reference_attention(*t, window=window)):
+        inputs = [t.clone().requires_grad_() for t in (q, k, v)]
+        out = attention(*inputs)
+        out.backward(grad_out)
+        results.append([out.detach()] + [t.grad for t in inputs])
+
+    names = ("out", "grad_q", "grad_k", "grad_v")
+    return {name: (a - b).abs().max().item() for name, a, b in zip(names, *results)}
+
+
+def check(num_queries, num_keys, chunk_size, window=None) -> None:
+    """断言输出和三个梯度都与参考实现一致"""
+    errors = compare_with_reference(num_queries, num_keys, chunk_size, window)
+    bad = {name: err for name, err in errors.items() if not err < ATOL}
+    assert not bad, f"T_q={num_queries} T_k={num_keys} chunk={chunk_size} window={window}: {bad}"
+
+
+def test_causal():
+    """标准因果掩码，序列长度是块大小的整数倍"""
+    check(64, 64, chunk_size=16)
+
+
+def test_causal_ragged_chunks():
+    """块大小不能整除序列长度，以及块大小大于序列长度"""
+    check(50, 50, chunk_size=16)
+    check(37, 37, chunk_size=7)
+    check(20, 20, chunk_size=64)
+
+
+def test_sliding_window():
+    """滑动窗口：窗口小于、等于、大于块大小，以及窗口大于序列长度"""
+    for window in (5, 16, 23, 100):
+        check(50, 50, chunk_size=16, window=window)
+
+
+def test_kv_cache_offset():
+    """key 比 query 多（例如预填充之后的分块解码），有无滑动窗口"""
+    check(10, 45, chunk_size=8)
+    check(10, 45, chunk_size=8, window=12)
+    check(1, 45, chunk_size=8, window=12)
+
+
+def test_dropout_backward_matches_forward():
+    """
+    dropout > 0：反向传播按块用种子重新生成掩码，必须与前向用的掩码完全相同
+
+    gradcheck 用有限差分检验解析梯度；每次调用前固定全局种子，
+    使前向的基础种子相同（否则有限差分在不同的掩码之间做差，没有意义）
+    """
+    generator = torch.Generator().manual_seed(0)
+    inputs = [torch.randn(1, 2, 13, 4, dtype=DTYPE, generator=generator, requires_grad=True)
+              for _ in range(3)]
+
+    def attention(q, k, v):
+        """固定全局种子后调用分块注意力，使每次前向的 dropout 掩码相同"""
+        torch.manual_seed(42)
+        return chunked_causal_attention(q, k, v, chunk_size=4, window=6, dropout_p=0.3)
+
+    assert torch.autograd.gradcheck(attention, inputs)
+
+
+if __name__ == "__main__":
+    cases = [
+        ("因果掩码", 64, 64, 16, None),
+        ("块大小不整除", 50, 50, 16, None),
+        ("块大小 > 序列长度", 20, 20, 64, None),
+        ("滑动窗口 5", 50, 50, 16, 5),
+        ("滑动窗口 23", 50, 50, 16, 23),
+        ("KV 缓存偏移", 10, 45, 8, None),
+        ("KV 缓存偏移 + 窗口", 10, 45, 8, 12),
+    ]
+    print("与 F.scaled_dot_product_attention 对比（float64，输出 / dQ / dK / dV 的最大绝对误差）:")
+    for name, num_queries, num_keys, chunk_size, window in cases:
+        errors = compare_with_reference(num_queries, num_keys, chunk_size, window)
+        status = "✅" if all(err < ATOL for err in errors.values()) else "❌"
+        print(f"  {status} {name}: " + ", ".join(f"{k}={v:.1e}" for k, v in errors.items()))
+
+    try:
+        test_dropout_backward_matches_forward()
+        print("✅ dropout=0.3：gradcheck 通过，反向重新生成的掩码与前向一致")
+    except (AssertionError, RuntimeError) as e:
+        print(f"❌ dropout=0.3：gradcheck 失败: {e}")
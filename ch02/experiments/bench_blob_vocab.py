@@ -0,0 +1,154 @@
+"""
+实验：两个 Python 字典 vs BlobVocab（排序字节串 + 偏移数组）
+
+词汇表：the-verdict.txt 的全部 token 加上随机生成的单词，凑够 --vocab-size 个条目。
+两种词汇表都从磁盘加载（字典从 JSON，BlobVocab 从 .npz），这是每个进程实际付出的内存。
+
+报告：
+    - 加载后的内存（tracemalloc）和加载耗时
+    - 不建哈希索引（二分查找）时的内存
+    - 单个 token 查找、批量查找、id → token 的平均耗时
+    - SimpleTokenizerV1 分别使用两种词汇表时的 encode / decode 耗时，以及结果是否一致
+
+运行方式：
+    python ch02/experiments/bench_blob_vocab.py
+    python ch02/experiments/bench_blob_vocab.py --vocab-size 100000 --n-tokens 50000
+"""
+
+import argparse
+import gc
+import json
+import os
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "ch02", "01"))
+
+from ch02.main.blob_vocab import BlobVocab
+from tokenizer_class import SimpleTokenizerV1
+
+SPLIT_PATTERN = r'([,.:;?_!"()\']|--|\s)'
+
+
+def build_tokens(vocab_size: int, seed: int = 0) -> list:
+    """书中的 token 加上随机单词（长度 2~12 的小写字母），去重后共 vocab_size 个"""
+    with open(os.path.join(ROOT_DIR, "ch02", "main", "the-verdict.txt"), "r", encoding="utf-8") as f:
+        tokens = {t.strip() for t in re.split(SPLIT_PATTERN, f.read()) if t.strip()}
+    rng = np.random.default_rng(seed)
+    letters = np.frombuffer(b"abcdefghijklmnopqrstuvwxyz", dtype=np.uint8)
+    while len(tokens) < vocab_size:
+        n = vocab_size - len(tokens)
+        lengths = rng.integers(2, 13, size=n)
+        chars = letters[rng.integers(0, 26, size=int(lengths.sum()))].tobytes().decode("ascii")
+        starts = np.concatenate([[0], np.cumsum(lengths)])
+        tokens.update(chars[a:b] for a, b in zip(starts[:-1], starts[1:]))
+    return sorted(tokens)[:vocab_size]
+
+
+def measure_load(load) -> tuple:
+    """返回 (加载后常驻的 MB, 加载耗时 s, 加载结果)"""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = load()
+    seconds = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current / 1e6, seconds, result
+
+
+def ns_per_item(fn, n_items: int, repeats: int) -> float:
+    """预热一次后调用 fn repeats 次，返回耗时中位数平均到每个元素的纳秒数"""
+    fn()
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) / n_items * 1e9
+
+
+def main():
+    """对比两个字典和 BlobVocab（哈希索引 / 二分查找）的加载内存、加载耗时，以及查找和编码解码的每 token 耗时"""
+    parser = argparse.ArgumentParser(description="词汇表内存与查找耗时：两个字典 vs BlobVocab")
+    parser.add_argument("--vocab-size", type=int, default=500_000)
+    parser.add_argument("--n-tokens", type=int, default=200_000, help="编码测试文本的 token 数")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    tokens = build_tokens(args.vocab_size)
+    tmp = tempfile.mkdtemp()
+    try:
+        json_path = os.path.join(tmp, "vocab.json")
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump({token: i for i, token in enumerate(tokens)}, f, ensure_ascii=False)
+        blob_path = os.path.join(tmp, "vocab.npz")
+        start = time.perf_counter()
+        BlobVocab.from_tokens(tokens).save(blob_path)
+        build_s = time.perf_counter() - start
+
+        def load_dicts():
+            """从 JSON 读入 str_to_int，再构建反向的 int_to_str"""
+            with open(json_path, "r", encoding="utf-8") as f:
+                str_to_int = json.load(f)
+            return str_to_int, {i: s for s, i in str_to_int.items()}
+
+        dict_mb, dict_s, (str_to_int, int_to_str) = measure_load(load_dicts)
+        blob_mb, blob_s, vocab = measure_load(lambda: BlobVocab.load(blob_path))
+        bisect_mb, bisect_s, bisect_vocab = measure_load(lambda: BlobVocab.load(blob_path, index=False))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"词汇表 {len(tokens):,} 个 token，平均 {np.mean([len(t) for t in tokens]):.1f} 个字符"
+          f"（BlobVocab 从头构建 {build_s:.2f} s）")
+    print(f"\n{'词汇表':<22} {'内存 MB':>9} {'每条字节':>9} {'加载 s':>8}")
+    print(f"{'str_to_int + int_to_str':<22} {dict_mb:>9.1f} {dict_mb * 1e6 / len(tokens):>9.0f} {dict_s:>8.2f}")
+    print(f"{'BlobVocab':<22} {blob_mb:>9.1f} {blob_mb * 1e6 / len(tokens):>9.0f} {blob_s:>8.2f}"
+          f"（{dict_mb / blob_mb:.0f}x 更小）")
+    print(f"{'BlobVocab（二分查找）':<22} {bisect_mb:>9.1f} {bisect_mb * 1e6 / len(tokens):>9.0f} {bisect_s:>8.2f}"
+          f"（{dict_mb / bisect_mb:.0f}x 更小）")
+
+    # 测试文本：按 Zipf 分布从词汇表中抽取，常用词出现得多，与真实文本类似
+    rng = np.random.default_rng(1)
+    ranks = np.minimum(rng.zipf(1.2, size=args.n_tokens), len(tokens)) - 1
+    order = rng.permutation(len(tokens))
+    sample = [tokens[i] for i in order[ranks]]
+    ids = [str_to_int[t] for t in sample]
+    text = " ".join(sample)
+
+    tokenizers = {"dict": SimpleTokenizerV1(str_to_int), "blob": SimpleTokenizerV1(vocab)}
+
+    print(f"\n{'操作（{:,} 个 token）'.format(len(sample)):<24} {'字典 ns/token':>14} {'BlobVocab ns/token':>19}")
+    # 二分查找每个 token 要比较约 log2(n) 次，只测前 10% 的 token
+    head = sample[:len(sample) // 10]
+    rows = (
+        ("vocab[token]（二分查找）", len(head),
+         lambda: [str_to_int[t] for t in head], lambda: [bisect_vocab[t] for t in head]),
+        ("vocab[token]", len(sample), lambda: [str_to_int[t] for t in sample], lambda: [vocab[t] for t in sample]),
+        ("批量查找", len(sample), lambda: [str_to_int[t] for t in sample], lambda: vocab.lookup(sample)),
+        ("id → token", len(sample), lambda: [int_to_str[i] for i in ids], lambda: vocab.tokens(ids)),
+    )
+    for label, n, dict_fn, blob_fn in rows:
+        print(f"{label:<24} {ns_per_item(dict_fn, n, args.repeats):>14.0f}"
+              f" {ns_per_item(blob_fn, n, args.repeats):>19.0f}")
+    for label, fn in (("encode", lambda tok: tok.encode(text)), ("decode", lambda tok: tok.decode(ids))):
+        times = [ns_per_item(lambda: fn(tokenizers[name]), len(sample), args.repeats) for name in ("dict", "blob")]
+        print(f"{'SimpleTokenizerV1.' + label:<24} {times[0]:>14.0f} {times[1]:>19.0f}")
+
+    same = (tokenizers["blob"].encode(text) == ids
+            and tokenizers["blob"].decode(ids) == tokenizers["dict"].decode(ids))
+    print(f"{'✅' if same else '❌'} 两种词汇表的编码 / 解码结果完全一致")
+
+
+if __name__ == "__main__":
+    main()
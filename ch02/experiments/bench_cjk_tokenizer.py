@@ -0,0 +1,130 @@
+"""
+实验：基础分词器 vs CJK 分词器在中英混合文本上的序列长度
+
+语料：本仓库的 .md 和 .py 文件（中文文档和中文注释 + 英文代码，正是中英混合的数据）。
+每 5 个文件取 1 个作为评估集，其余用来训练中文合并表。
+
+报告：
+    - 训练耗时、中文符号数、词表增长（以及嵌入层 / 输出层增加的参数量）
+    - ch02/main/example_01_tokenizer.py main() 中的示例文本和评估集上的 token/字符
+    - 评估集上的序列长度比例，以及由此估算的注意力计算量比例（与长度平方成正比）
+    - 编码速度，以及所有评估文本解码后是否与原文一致
+
+运行方式：
+    python ch02/experiments/bench_cjk_tokenizer.py
+    python ch02/experiments/bench_cjk_tokenizer.py --n-merges 8000 --emb-dim 768
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch02.main.cjk_tokenizer import CJK_PATTERN, CJKTokenizer, tokens_per_char
+
+# ch02/main/example_01_tokenizer.py main() 中的示例
+EXAMPLES = [
+    "Hello, world!",
+    "Learning LLM is fun! 学习 LLM 很有趣！",
+    "Artificial intelligence is transforming the world.\n"
+    "    Large language models like GPT can understand and generate human-like text.",
+]
+
+
+class ByteTokenizer:
+    """没有 GPT-2 分词器文件时使用：UTF-8 字节作为 token"""
+
+    name = "utf8-bytes"
+    n_vocab = 256
+
+    def encode(self, text, **kwargs):
+        """文本的 UTF-8 字节即 token ID（忽略 allowed_special 等参数）"""
+        return list(text.encode("utf-8"))
+
+    def decode(self, ids):
+        """按 UTF-8 解码，不完整的字节用替换字符"""
+        return bytes(ids).decode("utf-8", errors="replace")
+
+
+def load_tokenizer():
+    """GPT-2 分词器；离线无法加载时退回到 ByteTokenizer"""
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("gpt2")
+    except Exception as exc:  # 离线环境下 tiktoken 下载词表会失败
+        print(f"⚠️  无法加载 GPT-2 分词器（{type(exc).__name__}），改用 UTF-8 字节作为基础分词器")
+        return ByteTokenizer()
+
+
+def load_corpus() -> tuple:
+    """
+    本仓库的 .md 和 .py 文件（中英混合）
+
+    返回:
+        tuple[list, list]: (训练文本, 评估文本)，按文件序号每 5 个取 1 个作为评估集
+    """
+    paths = sorted(p for pattern in ("**/*.md", "**/*.py")
+                   for p in glob.glob(os.path.join(ROOT_DIR, pattern), recursive=True))
+    texts = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            texts.append(f.read())
+    return [t for i, t in enumerate(texts) if i % 5], [t for i, t in enumerate(texts) if i % 5 == 0]
+
+
+def main():
+    """在仓库文档上训练 CJK 分词器，对比基础分词器与它的 token/字符、序列长度和编码速度，并检查解码还原原文"""
+    parser = argparse.ArgumentParser(description="中英混合文本：基础分词器 vs CJK 分词器的 token/字符")
+    parser.add_argument("--n-merges", type=int, default=4000)
+    parser.add_argument("--min-frequency", type=int, default=2)
+    parser.add_argument("--emb-dim", type=int, default=768, help="用于估算嵌入层 + 输出层增加的参数量")
+    args = parser.parse_args()
+
+    base = load_tokenizer()
+    train_texts, eval_texts = load_corpus()
+    cjk_chars = sum(len(run) for t in train_texts for run in CJK_PATTERN.findall(t))
+    print(f"训练 {len(train_texts)} 个文件（{sum(map(len, train_texts)):,} 字符，其中 CJK {cjk_chars:,}），"
+          f"评估 {len(eval_texts)} 个文件")
+
+    start = time.perf_counter()
+    tokenizer = CJKTokenizer.train(base, train_texts, args.n_merges, args.min_frequency)
+    train_s = time.perf_counter() - start
+    extra = tokenizer.n_vocab - base.n_vocab
+    print(f"训练 {train_s:.1f} s：{len(tokenizer.merges)} 条合并，{extra} 个中文符号，"
+          f"词表 {base.n_vocab:,} → {tokenizer.n_vocab:,}"
+          f"（嵌入层 + 输出层增加 {2 * extra * args.emb_dim / 1e6:.1f}M 参数）")
+
+    print(f"\n{'文本':<44} {'基础 token/字符':>15} {'CJK token/字符':>15}")
+    for text in EXAMPLES:
+        label = text.splitlines()[0][:40]
+        print(f"{label:<44} {tokens_per_char(base, [text]):>15.3f} {tokens_per_char(tokenizer, [text]):>15.3f}")
+    eval_cjk = ["".join(CJK_PATTERN.findall(t)) for t in eval_texts]
+    for label, texts in (("评估集（完整文件）", eval_texts), ("评估集（只取 CJK 片段）", eval_cjk)):
+        print(f"{label:<44} {tokens_per_char(base, texts):>15.3f} {tokens_per_char(tokenizer, texts):>15.3f}")
+
+    start = time.perf_counter()
+    base_tokens = sum(len(base.encode(t)) for t in eval_texts)
+    base_s = time.perf_counter() - start
+    tokenizer._cache.clear()
+    start = time.perf_counter()
+    encoded = [tokenizer.encode(t) for t in eval_texts]
+    cjk_s = time.perf_counter() - start
+    cjk_tokens = sum(map(len, encoded))
+    ratio = cjk_tokens / base_tokens
+    n_chars = sum(map(len, eval_texts))
+    print(f"\n评估集序列长度: {base_tokens:,} → {cjk_tokens:,} token（{ratio:.1%}）")
+    print(f"按 token 数线性增长的计算（嵌入、前馈层）约为原来的 {ratio:.1%}，"
+          f"注意力（长度平方）约为 {ratio ** 2:.1%}")
+    print(f"编码速度: 基础 {n_chars / base_s / 1e6:.2f}M 字符/s，CJK {n_chars / cjk_s / 1e6:.2f}M 字符/s")
+    same = all(tokenizer.decode(ids) == text for ids, text in zip(encoded, eval_texts))
+    print(f"{'✅' if same else '❌'} 所有评估文本解码后与原文一致")
+
+
+if __name__ == "__main__":
+    main()
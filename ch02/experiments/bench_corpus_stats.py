@@ -0,0 +1,137 @@
+"""
+实验：在 Python 字符串列表上统计 vs 在内存映射的 token 分片上向量化统计
+
+语料：按 Zipf-Mandelbrot 分布随机生成的 token ID（词表大小与 GPT-2 相同），分成若干个 uint16 分片写入临时目录；
+每个 id 对应一个随机的小写字母串作为 token 文本。
+
+报告：
+    - 书中的写法（ch02/01/main.py 测试 3）：把 token 变成字符串列表，len(set(...))、
+      sum(len(t) for t in tokens)、Counter.most_common；只在前 --python-tokens 个 token 上测，再按比例外推
+    - scan_token_files：一次流式扫描所有分片，得到同样的统计和完整报告
+    - 两者在相同前缀上的结果是否一致，以及 10 亿 token 的预计耗时
+
+运行方式：
+    python ch02/experiments/bench_corpus_stats.py
+    python ch02/experiments/bench_corpus_stats.py --n-tokens 500000000 --n-shards 16
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import numpy as np
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch02.main.corpus_stats import CorpusStats, length_table, print_report, scan_token_files
+from ch02.main.dataloader import write_token_file
+
+
+def random_vocab(vocab_size: int, rng: np.random.Generator) -> list:
+    """每个 id 一个长度 1~12 的小写字母串（不要求唯一，只用来计算长度和打印）"""
+    lengths = rng.integers(1, 13, size=vocab_size)
+    letters = np.frombuffer(b"abcdefghijklmnopqrstuvwxyz", dtype=np.uint8)
+    chars = letters[rng.integers(0, 26, size=int(lengths.sum()))].tobytes().decode("ascii")
+    ends = np.cumsum(lengths)
+    return [chars[b - n:b] for b, n in zip(ends.tolist(), lengths.tolist())]
+
+
+def write_shards(directory: str, n_tokens: int, n_shards: int, vocab_size: int,
+                 rng: np.random.Generator) -> list:
+    """
+    按 Zipf-Mandelbrot 分布生成 n_tokens 个随机 token，平均写入 n_shards 个 uint16 分片文件
+
+    返回:
+        list[str]: 分片文件路径
+    """
+    paths = []
+    per_shard = -(-n_tokens // n_shards)
+    # Zipf-Mandelbrot 分布（p ∝ 1 / (秩 + 2.7)，接近自然语言的词频），逆 CDF 采样；
+    # 秩随机映射到 id，常用 token 不集中在小 id 上
+    cdf = np.cumsum(1.0 / (np.arange(vocab_size) + 2.7))
+    cdf /= cdf[-1]
+    order = rng.permutation(vocab_size)
+    for i in range(n_shards):
+        n = min(per_shard, n_tokens - i * per_shard)
+        ranks = np.minimum(np.searchsorted(cdf, rng.random(n)), vocab_size - 1)
+        path = os.path.join(directory, f"shard{i:03d}.bin")
+        write_token_file(order[ranks], path)
+        paths.append(path)
+    return paths
+
+
+def python_stats(tokens: list) -> tuple:
+    """ch02/01/main.py 测试 3 的写法，外加 Counter 求 top-10"""
+    total = len(tokens)
+    unique = len(set(tokens))
+    avg_length = sum(len(t) for t in tokens) / len(tokens)
+    top = Counter(tokens).most_common(10)
+    return total, unique, avg_length, top
+
+
+def main():
+    """对比 Python 字符串列表上的统计与 CorpusStats 在内存映射分片上的 bincount 统计的耗时，并检查结果一致"""
+    parser = argparse.ArgumentParser(description="语料统计：Python 字符串列表 vs 内存映射分片上的 bincount")
+    parser.add_argument("--n-tokens", type=int, default=100_000_000)
+    parser.add_argument("--n-shards", type=int, default=8)
+    parser.add_argument("--vocab-size", type=int, default=50257)
+    parser.add_argument("--python-tokens", type=int, default=2_000_000, help="Python 写法只测前这么多个 token")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vocab = random_vocab(args.vocab_size, rng)
+    lengths = length_table(vocab)
+    tmp = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        paths = write_shards(tmp, args.n_tokens, args.n_shards, args.vocab_size, rng)
+        print(f"生成 {args.n_tokens:,} 个 token，{args.n_shards} 个分片，"
+              f"{sum(os.path.getsize(p) for p in paths) / 1e6:.0f} MB（{time.perf_counter() - start:.1f} s）")
+
+        # 书中的写法：先把 id 变成字符串列表
+        prefix = np.memmap(paths[0], dtype=np.uint16, mode="r")[:args.python_tokens]
+        start = time.perf_counter()
+        tokens = [vocab[i] for i in prefix.tolist()]
+        total, unique, avg_length, top = python_stats(tokens)
+        python_s = time.perf_counter() - start
+        del tokens
+
+        start = time.perf_counter()
+        prefix_stats = CorpusStats.from_ids(prefix, args.vocab_size)
+        numpy_prefix_s = time.perf_counter() - start
+        _, top_counts = prefix_stats.top_k(10)
+        n_prefix = len(prefix)
+        del prefix
+        # 不同 id 可能对应同一个随机字符串，字符串上的唯一数和 top-10 按字符串合并，所以只比较 id 唯一的情况
+        same = (total == prefix_stats.n_tokens
+                and abs(avg_length - prefix_stats.chars_per_token(lengths)) < 1e-9
+                and (len(set(vocab)) < len(vocab) or unique == prefix_stats.n_unique)
+                and top[0][1] == top_counts[0])
+
+        stats = scan_token_files(paths, args.vocab_size)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print()
+    print_report(stats, lengths, vocab.__getitem__, top_k=10, vocab_size=args.vocab_size)
+
+    python_rate = n_prefix / python_s
+    numpy_rate = stats.n_tokens / stats.seconds
+    print(f"\n{'方法':<28} {'tokens/s':>14} {'10 亿 token 预计':>16}")
+    print(f"{'Python 字符串列表（外推）':<28} {python_rate:>14,.0f} {1e9 / python_rate:>14.0f} s")
+    print(f"{'bincount（同一前缀）':<28} {n_prefix / numpy_prefix_s:>14,.0f}"
+          f" {1e9 * numpy_prefix_s / n_prefix:>14.1f} s")
+    print(f"{'scan_token_files（全部分片）':<28} {numpy_rate:>14,.0f} {1e9 / numpy_rate:>14.1f} s"
+          f"（{numpy_rate / python_rate:.0f}x）")
+    print(f"{'✅' if same else '❌'} 前 {n_prefix:,} 个 token 上两种写法的统计一致")
+    print("注意：分片刚写入，位于页缓存中；冷启动时的扫描速度受磁盘读取带宽限制")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+实验：语料增长时，按字母顺序重建词汇表 vs 追加模式
+
+语料：本仓库的 .md 和 .py 文件，每个文件是一篇文档，用 SimpleTokenizerV1 的正则分词。
+先用前 --initial 比例的文档建词汇表并编码，再把剩下的文档一篇一篇加进来。
+
+每加入一篇文档：
+    - 重建：create_vocab 的做法 sorted(set(全部 token)) 重新编号，所有文档重新编码，
+      统计已有 token 中 id 发生变化的比例（这些嵌入行和已编码的语料全部作废）
+    - 追加：extend_vocab 只处理新文档，只编码新文档，
+      resize_token_embeddings 原地扩大嵌入层和输出层（连同 AdamW 状态）
+
+报告：两种方式的累计耗时（词汇表 / 编码 / 扩大模型分开计时）、id 变化比例，
+以及追加模式的编码结果解码回 token 后是否与原文一致。
+
+运行方式：
+    python ch02/experiments/bench_vocab_growth.py
+    python ch02/experiments/bench_vocab_growth.py --initial 0.5 --emb-dim 768
+"""
+
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "ch02", "01"))
+
+from create_vocab import extend_vocab
+from ch02.main.vocab_growth import resize_token_embeddings
+
+SPLIT_PATTERN = re.compile(r'([,.:;?_!"()\']|--|\s)')
+
+
+class VocabProbe(nn.Module):
+    """只有 token 嵌入和输出层：与词表大小有关的参数都在这里"""
+
+    def __init__(self, vocab_size: int, emb_dim: int):
+        """vocab_size 行的 token 嵌入和 vocab_size 维的输出层（不含偏置）"""
+        super().__init__()
+        self.tok_emb = nn.Embedding(vocab_size, emb_dim)
+        self.out_head = nn.Linear(emb_dim, vocab_size, bias=False)
+
+    def forward(self, token_ids: torch.Tensor) -> torch.Tensor:
+        """token ID → 嵌入 → logits，形状 (batch, T, vocab_size)"""
+        return self.out_head(self.tok_emb(token_ids))
+
+
+def load_documents() -> list:
+    """本仓库的 .md 和 .py 文件，每篇按 SPLIT_PATTERN 切分成 token 列表（跳过空文件）"""
+    paths = sorted(p for pattern in ("**/*.md", "**/*.py")
+                   for p in glob.glob(os.path.join(ROOT_DIR, pattern), recursive=True))
+    documents = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            tokens = [t.strip() for t in SPLIT_PATTERN.split(f.read()) if t.strip()]
+        if tokens:
+            documents.append(tokens)
+    return documents
+
+
+def encode(vocab: dict, tokens: list) -> list:
+    """用词汇表把 token 列表转换成 ID"""
+    return [vocab[t] for t in tokens]
+
+
+def train_step(model: nn.Module, optimizer, vocab_size: int) -> None:
+    """让 AdamW 建立状态，扩大时需要同步扩大"""
+    ids = torch.randint(0, vocab_size, (1, 33))
+    optimizer.zero_grad()
+    nn.functional.cross_entropy(model(ids[:, :-1]).flatten(0, 1), ids[0, 1:]).backward()
+    optimizer.step()
+
+
+def main():
+    """新文档逐篇加入时，对比每次重建词汇表并重新编码全部语料与追加模式（extend_vocab + 原地扩大模型）的耗时以及已有 id 的变化"""
+    parser = argparse.ArgumentParser(description="语料增长：重建词汇表 vs 追加模式")
+    parser.add_argument("--initial", type=float, default=0.8, help="初始语料占全部文档的比例")
+    parser.add_argument("--emb-dim", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=123)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    documents = load_documents()
+    n_initial = int(len(documents) * args.initial)
+    initial, incoming = documents[:n_initial], documents[n_initial:]
+    n_tokens = sum(map(len, documents))
+    print(f"{len(documents)} 篇文档，{n_tokens:,} 个 token；初始 {len(initial)} 篇，之后逐篇加入 {len(incoming)} 篇")
+
+    # 两种方式的起点相同：初始语料按字母顺序建词汇表
+    all_tokens = [t for doc in initial for t in doc]
+    base_vocab = {token: i for i, token in enumerate(sorted(set(all_tokens)))}
+    print(f"初始词汇表 {len(base_vocab):,}，嵌入层 + 输出层 {2 * len(base_vocab) * args.emb_dim / 1e6:.1f}M 参数")
+
+    # 重建：每来一篇都重新排序编号、重新编码全部文档
+    vocab = dict(base_vocab)
+    rebuild = {"vocab": 0.0, "encode": 0.0}
+    shifted, existing = 0, 0
+    for doc in incoming:
+        all_tokens.extend(doc)
+        start = time.perf_counter()
+        new_vocab = {token: i for i, token in enumerate(sorted(set(all_tokens)))}
+        rebuild["vocab"] += time.perf_counter() - start
+        start = time.perf_counter()
+        encoded = [encode(new_vocab, d) for d in initial]
+        encoded.append(encode(new_vocab, doc))
+        rebuild["encode"] += time.perf_counter() - start
+        shifted += sum(new_vocab[t] != i for t, i in vocab.items())
+        existing += len(vocab)
+        initial = initial + [doc]
+        vocab = new_vocab
+    rebuild_vocab_size = len(vocab)
+
+    # 追加：只处理新文档，模型原地扩大
+    vocab = dict(base_vocab)
+    corpus = [encode(vocab, d) for d in documents[:n_initial]]
+    model = VocabProbe(len(vocab), args.emb_dim)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    train_step(model, optimizer, len(vocab))
+    append = {"vocab": 0.0, "encode": 0.0, "resize": 0.0}
+    for doc in incoming:
+        start = time.perf_counter()
+        new_words = extend_vocab(vocab, doc)
+        append["vocab"] += time.perf_counter() - start
+        start = time.perf_counter()
+        corpus.append(encode(vocab, doc))
+        append["encode"] += time.perf_counter() - start
+        if new_words:
+            start = time.perf_counter()
+            resize_token_embeddings(model, len(vocab), optimizer)
+            append["resize"] += time.perf_counter() - start
+    train_step(model, optimizer, len(vocab))
+
+    rebuild_total = sum(rebuild.values())
+    append_total = sum(append.values())
+    print(f"\n{'方式':<10} {'词汇表 ms':>10} {'编码 ms':>10} {'扩大模型 ms':>12} {'合计 ms':>10} {'已有 id 变化':>12}")
+    print(f"{'重建':<10} {rebuild['vocab'] * 1e3:>10.1f} {rebuild['encode'] * 1e3:>10.1f} {'-':>12} "
+          f"{rebuild_total * 1e3:>10.1f} {shifted / max(existing, 1):>12.1%}")
+    print(f"{'追加':<10} {append['vocab'] * 1e3:>10.1f} {append['encode'] * 1e3:>10.1f} "
+          f"{append['resize'] * 1e3:>12.1f} {append_total * 1e3:>10.1f} {0:>12.1%}")
+    print(f"\n追加模式快 {rebuild_total / append_total:.0f}x（重建还没有算上作废的嵌入行需要重新训练的代价）")
+    print(f"词汇表 {len(base_vocab):,} -> {len(vocab):,}，模型 tok_emb {tuple(model.tok_emb.weight.shape)}")
+
+    id_to_token = {i: t for t, i in vocab.items()}
+    same = (len(vocab) == rebuild_vocab_size
+            and all([id_to_token[i] for i in ids] == doc for ids, doc in zip(corpus, documents)))
+    print(f"{'✅' if same else '❌'} 追加模式的词汇表大小与重建相同，所有文档解码后与原 token 一致")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+"""
+第2章：紧凑词汇表（排序后的 UTF-8 字节串 + 偏移数组）
+
+书中的分词器用两个 Python 字典保存词汇表：str_to_int 和 int_to_str。每个条目都要一个 str 对象、
+一个 int 对象和两个字典槽位，约 200 字节；几十万个 token 的词汇表在每个进程里就要几十 MB。
+
+核心概念：
+    - 字节串（blob）：所有 token 按 UTF-8 字节序排序后首尾相接，存成一个 bytes 对象
+    - 偏移数组（offsets）：第 i 个 token 是 blob[offsets[i]:offsets[i+1]]，id → 字符串只需要一次切片
+    - 哈希索引：开放寻址表（线性探测，装载率约 0.7），槽位里存 token 在排序中的位置；
+      哈希函数是 zlib.crc32，结果与进程无关，索引可以和词汇表一起保存
+    - 批量查找：每个 token 只在 Python 中做编码和 crc32，探测和逐字节比较都用 NumPy 一次完成
+    - 二分查找：不建哈希索引时在排好序的 blob 上二分，内存最少，查找慢一些
+    - id 排列：create_vocab 的 id 就是排序位置，不需要额外数组；
+      其他词汇表（例如末尾追加了特殊 token）额外保存排序位置 ↔ id 两个 int32 数组
+
+    每个条目约为 token 字节数 + 4（偏移）+ 6（哈希槽位），比两个字典小一个数量级。
+
+依赖：
+    - numpy: 偏移、哈希表和 id 数组
+"""
+
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+EMPTY = -1
+LOAD_FACTOR = 0.7
+
+
+class BlobVocab:
+    """
+    只读词汇表：token ↔ id，接口与 {token: id} 字典兼容（vocab[token]、in、len、items）
+
+    属性:
+        blob (bytes): 按 UTF-8 字节序排序、首尾相接的所有 token
+        offsets (ndarray): 形状 (n + 1,) 的 uint32 / int64，第 i 个 token 的起止位置
+        ids (ndarray | None): 排序位置 → id；None 表示 id 就是排序位置
+        inverse: id → token 的只读视图，可以代替 int_to_str 字典
+
+    示例:
+        >>> vocab = BlobVocab.from_tokens(tokens)           # 与 create_vocab(tokens) 的 id 相同
+        >>> vocab["Gisburn"], vocab.inverse[vocab["Gisburn"]]
+        >>> tokenizer = SimpleTokenizerV1(vocab)
+    """
+
+    def __init__(self, blob: bytes, offsets: np.ndarray, ids: Optional[np.ndarray] = None,
+                 table: Optional[np.ndarray] = None, index: bool = True):
+        """
+        参数:
+            blob (bytes): 排序后的 token 字节串
+            offsets (ndarray): token 的起止位置
+            ids (ndarray): 排序位置 → id，None 表示相同
+            table (ndarray): 已经建好的哈希表（load 时传入），None 时按需构建
+            index (bool): 是否使用哈希索引；False 时用二分查找
+        """
+        self.blob = bytes(blob)
+        self.offsets = np.ascontiguousarray(offsets)
+        self.ids = None if ids is None else np.ascontiguousarray(ids, dtype=np.int32)
+        self.positions = None
+        if self.ids is not None:
+            self.positions = np.empty_like(self.ids)
+            self.positions[self.ids] = np.arange(len(self.ids), dtype=np.int32)
+        # memoryview 按下标取值直接得到 Python int，比 numpy 标量快得多
+        self._off = memoryview(self.offsets)
+        self._blob = np.frombuffer(self.blob, dtype=np.uint8)
+        self._ids = None if self.ids is None else memoryview(self.ids)
+        self._pos = None if self.positions is None else memoryview(self.positions)
+        self.table = None
+        if index:
+            self.table = table if table is not None else self._build_table()
+            self._table = memoryview(self.table)
+            self._size = len(self.table)
+        self.inverse = _InverseView(self)
+
+    # ------------------------------------------------------------------ 构建
+
+    @classmethod
+    def from_tokens(cls, tokens: Iterable[str], index: bool = True) -> "BlobVocab":
+        """
+        与 create_vocab 相同：去重、排序，id 是排序位置
+
+        参数:
+            tokens: 分词结果（可以有重复）
+            index (bool): 是否建哈希索引
+        """
+        encoded = sorted({token.encode("utf-8") for token in tokens})
+        return cls(b"".join(encoded), _offsets([len(b) for b in encoded]), index=index)
+
+    @classmethod
+    def from_dict(cls, vocab: Dict[str, int], index: bool = True) -> "BlobVocab":
+        """
+        从已有的 {token: id} 字典构建；id 必须是 0..n-1 的一个排列
+
+        参数:
+            vocab (dict): 词汇表字典
+            index (bool): 是否建哈希索引
+        """
+        entries = sorted((token.encode("utf-8"), i) for token, i in vocab.items())
+        ids = np.fromiter((i for _, i in entries), dtype=np.int64, count=len(entries))
+        if len(ids) and not np.array_equal(np.sort(ids), np.arange(len(ids))):
+            raise ValueError("词汇表的 id 必须是 0..n-1 的一个排列")
+        identity = np.array_equal(ids, np.arange(len(ids)))
+        return cls(b"".join(b for b, _ in entries), _offsets([len(b) for b, _ in entries]),
+                   ids=None if identity else ids, index=index)
+
+    def _build_table(self) -> np.ndarray:
+        """
+        向量化构建线性探测哈希表：每一轮把还没放下的条目放进各自的当前槽位，
+        同一槽位只放第一个，其余条目（以及槽位已被占用的条目）向后移一格进入下一轮
+        """
+        n = len(self)
+        size = int(n / LOAD_FACTOR) + 1
+        blob, off = self.blob, self._off
+        slots = np.fromiter((zlib.crc32(blob[off[i]:off[i + 1]]) for i in range(n)),
+                            dtype=np.int64, count=n) % size
+        table = np.full(size, EMPTY, dtype=np.int32)
+        pending = np.arange(n)
+        while pending.size:
+            current = slots[pending]
+            free = table[current] == EMPTY
+            candidates = pending[free]
+            winners_slot, first = np.unique(current[free], return_index=True)
+            table[winners_slot] = candidates[first]
+            placed = np.zeros(n, dtype=bool)
+            placed[candidates[first]] = True
+            pending = pending[~placed[pending]]
+            slots[pending] = (slots[pending] + 1) % size
+        return table
+
+    # ------------------------------------------------------------------ 查找
+
+    def _find(self, key: bytes) -> int:
+        """返回 token 的排序位置，不存在时返回 -1"""
+        blob, off = self.blob, self._off
+        if self.table is None:
+            lo, hi = 0, len(off) - 1
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if blob[off[mid]:off[mid + 1]] < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo if lo < len(off) - 1 and blob[off[lo]:off[lo + 1]] == key else EMPTY
+        table, size = self._table, self._size
+        slot = zlib.crc32(key) % size
+        while True:
+            pos = table[slot]
+            if pos == EMPTY or blob[off[pos]:off[pos + 1]] == key:
+                return pos
+            slot = (slot + 1) % size
+
+    def get(self, token: str, default=None):
+        """
+        与 dict.get 相同：token → id
+
+        参数:
+            token (str): 要查找的 token
+            default: token 不在词汇表中时的返回值
+
+        返回:
+            int: token 的 id；不在词汇表中时返回 default（默认 None），不抛出异常
+        """
+        pos = self._find(token.encode("utf-8"))
+        if pos == EMPTY:
+            return default
+        return pos if self._ids is None else self._ids[pos]
+
+    def __getitem__(self, token: str) -> int:
+        """vocab[token] → id；不在词汇表中时抛出 KeyError（与字典相同，SimpleTokenizerV1 依赖这一点）"""
+        pos = self._find(token.encode("utf-8"))
+        if pos == EMPTY:
+            raise KeyError(token)
+        return pos if self._ids is None else self._ids[pos]
+
+    def __contains__(self, token) -> bool:
+        """token in vocab；不是 str 的对象一律返回 False"""
+        return isinstance(token, str) and self._find(token.encode("utf-8")) != EMPTY
+
+    def lookup(self, tokens: Sequence[str], unk_id: Optional[int] = None) -> np.ndarray:
+        """
+        批量查找（编码的热点路径）
+
+        每个 token 在 Python 中只做 UTF-8 编码、crc32 和取长度；之后按轮次向量化探测：
+        每一轮取出所有未决 token 当前槽位中的候选，长度相同的逐字节比较（np.repeat 展开成
+        一维下标后一次比较，np.logical_and.reduceat 按 token 汇总），未命中的移到下一个槽位
+
+        参数:
+            tokens: token 列表
+            unk_id (int): 不在词汇表中的 token 用这个 id；None 表示抛出 KeyError
+
+        返回:
+            ndarray: 形状 (len(tokens),) 的 int64
+        """
+        if self.table is None:
+            return np.array([self[t] if unk_id is None else self.get(t, unk_id) for t in tokens], dtype=np.int64)
+        keys = [t.encode("utf-8") for t in tokens]
+        lengths = np.fromiter(map(len, keys), dtype=np.int64, count=len(keys))
+        query = np.frombuffer(b"".join(keys), dtype=np.uint8)
+        q_starts = np.cumsum(lengths) - lengths
+        slots = np.fromiter(map(zlib.crc32, keys), dtype=np.int64, count=len(keys)) % self._size
+
+        result = np.full(len(keys), EMPTY, dtype=np.int64)
+        pending = np.arange(len(keys))
+        while pending.size:
+            candidates = self.table[slots[pending]].astype(np.int64)
+            missing = candidates == EMPTY
+            starts = self.offsets[candidates].astype(np.int64)
+            same_length = ~missing & (self.offsets[candidates + 1] - starts == lengths[pending])
+            matched = np.zeros(len(pending), dtype=bool)
+            check = np.flatnonzero(same_length & (lengths[pending] > 0))
+            if check.size:
+                n_bytes = lengths[pending[check]]
+                shift = np.repeat(starts[check] - q_starts[pending[check]], n_bytes)
+                q_index = np.repeat(q_starts[pending[check]], n_bytes) + _ranges(n_bytes)
+                equal = self._blob[q_index + shift] == query[q_index]
+                matched[check] = np.logical_and.reduceat(equal, np.cumsum(n_bytes) - n_bytes)
+            matched |= same_length & (lengths[pending] == 0)
+            result[pending[matched]] = candidates[matched]
+            if unk_id is None and missing.any():
+                raise KeyError(tokens[pending[missing][0]])
+            pending = pending[~matched & ~missing]
+            slots[pending] = (slots[pending] + 1) % self._size
+
+        found = result != EMPTY
+        if self.ids is not None:
+            result[found] = self.ids[result[found]]
+        if unk_id is not None:
+            result[~found] = unk_id
+        return result
+
+    def token(self, token_id: int) -> str:
+        """id → token：从 blob 中切出一段再解码"""
+        if not 0 <= token_id < len(self):
+            raise KeyError(token_id)
+        pos = token_id if self._pos is None else self._pos[token_id]
+        return self.blob[self._off[pos]:self._off[pos + 1]].decode("utf-8")
+
+    def tokens(self, token_ids: Sequence[int]) -> List[str]:
+        """批量 id → token：起止位置用 NumPy 一次取出，再逐段切片解码"""
+        token_ids = np.asarray(token_ids, dtype=np.int64)
+        bad = (token_ids < 0) | (token_ids >= len(self))
+        if bad.any():
+            raise KeyError(int(token_ids[bad][0]))
+        pos = token_ids if self.positions is None else self.positions[token_ids]
+        blob = self.blob
+        return [blob[a:b].decode("utf-8")
+                for a, b in zip(self.offsets[pos].tolist(), self.offsets[pos + 1].tolist())]
+
+    # ------------------------------------------------------------------ 字典接口
+
+    def __len__(self) -> int:
+        """词汇表大小（token 个数）"""
+        return len(self.offsets) - 1
+
+    def __iter__(self) -> Iterator[str]:
+        """按 UTF-8 字节序（与 sorted 的顺序相同）遍历 token"""
+        blob, off = self.blob, self._off
+        for pos in range(len(self)):
+            yield blob[off[pos]:off[pos + 1]].decode("utf-8")
+
+    def keys(self) -> Iterator[str]:
+        """
+        与 dict.keys 相同的用法
+
+        返回:
+            Iterator[str]: 按 UTF-8 字节序遍历 token 的迭代器（不是视图，只能遍历一次）
+        """
+        return iter(self)
+
+    def items(self) -> Iterator[tuple]:
+        """
+        与 dict.items 相同的用法
+
+        返回:
+            Iterator[tuple]: (token, id)，按 token 的 UTF-8 字节序（不是按 id）
+        """
+        for pos, token in enumerate(self):
+            yield token, pos if self._ids is None else self._ids[pos]
+
+    def to_dict(self) -> Dict[str, int]:
+        """
+        转回普通的 {token: id} 字典（例如交给只接受 dict 的代码，或用于比较）
+
+        返回:
+            dict: 新建的字典，占用的内存与书中的 str_to_int 相同
+        """
+        return dict(self.items())
+
+    def nbytes(self) -> int:
+        """blob、偏移、id 数组和哈希表占用的字节数"""
+        arrays = (self.offsets, self.ids, self.positions, self.table)
+        return len(self.blob) + sum(a.nbytes for a in arrays if a is not None)
+
+    # ------------------------------------------------------------------ 保存 / 加载
+
+    def save(self, path: str) -> None:
+        """保存为未压缩的 .npz（哈希表一起保存，加载时不需要重建）"""
+        arrays = {"blob": np.frombuffer(self.blob, dtype=np.uint8), "offsets": self.offsets}
+        if self.ids is not None:
+            arrays["ids"] = self.ids
+        if self.table is not None:
+            arrays["table"] = self.table
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path: str, index: bool = True) -> "BlobVocab":
+        """
+        加载 save 保存的 .npz
+
+        参数:
+            path (str): 文件路径
+            index (bool): 是否使用哈希索引；文件中有保存的哈希表时直接使用，没有时重建
+
+        返回:
+            BlobVocab: 与保存时相同的词汇表
+        """
+        with np.load(path) as data:
+            table = data["table"] if index and "table" in data else None
+            return cls(data["blob"].tobytes(), data["offsets"], data["ids"] if "ids" in data else None,
+                       table=table, index=index)
+
+
+class _InverseView:
+    """id → token 的只读视图（vocab.inverse[i]），代替 int_to_str 字典"""
+
+    def __init__(self, vocab: BlobVocab):
+        """
+        参数:
+            vocab: 被查看的词汇表（只保存引用，不复制数据）
+        """
+        self._vocab = vocab
+
+    def __getitem__(self, token_id: int) -> str:
+        """inverse[id] → token；id 越界时抛出 KeyError"""
+        return self._vocab.token(token_id)
+
+    def __contains__(self, token_id) -> bool:
+        """id in inverse：0 <= id < len(vocab) 的整数"""
+        return isinstance(token_id, int) and 0 <= token_id < len(self._vocab)
+
+    def __len__(self) -> int:
+        """与词汇表大小相同"""
+        return len(self._vocab)
+
+
+def _ranges(lengths: np.ndarray) -> np.ndarray:
+    """把每段长度展开成段内下标：[2, 3] -> [0, 1, 0, 1, 2]"""
+    ends = np.cumsum(lengths)
+    return np.arange(ends[-1]) - np.repeat(ends - lengths, lengths)
+
+
+def _offsets(lengths: Sequence[int]) -> np.ndarray:
+    """长度 → 起止位置；blob 小于 4 GB 时用 uint32"""
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets.astype(np.uint32) if offsets[-1] < 2 ** 32 else offsets
+
+
+if __name__ == "__main__":
+    import os
+    import re
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "the-verdict.txt"), "r",
+              encoding="utf-8") as f:
+        raw_text = f.read()
+    tokens = [t.strip() for t in re.split(r'([,.:;?_!"()\']|--|\s)', raw_text) if t.strip()]
+
+    vocab = BlobVocab.from_tokens(tokens)
+    expected = {token: i for i, token in enumerate(sorted(set(tokens)))}
+    print(f"词汇表大小: {len(vocab)}，占用 {vocab.nbytes() / 1e3:.1f} KB")
+    print(f"{'✅' if vocab.to_dict() == expected else '❌'} 与 create_vocab 的 id 完全一致")
+    ids = vocab.lookup(tokens[:12]).tolist()
+    print(f"前 12 个 token: {ids}")
+    print(f"还原: {vocab.tokens(ids)}")
+    print(f"{'✅' if np.array_equal(BlobVocab.from_tokens(tokens, index=False).lookup(tokens), vocab.lookup(tokens)) else '❌'}"
+          " 二分查找与哈希索引结果一致")
@@ -0,0 +1,354 @@
+"""
+第2章：中文感知的分词器（CJK 预分词 + 可训练的中文合并表）
+
+GPT-2 的 BPE 词表几乎没有中文：大多数汉字会退回到 UTF-8 字节，一个汉字要 1~3 个 token。
+在中英混合的数据上，序列长度因此成倍增加，注意力的计算量随长度平方增长。
+
+核心概念：
+    - 预分词：用正则把文本切成"连续的 CJK 字符（含全角标点）"和"其他文本"两类片段；
+      其他文本原样交给基础分词器（例如 GPT-2），英文部分的 token 与原来完全相同
+    - 中文合并表：在中文片段上训练 BPE。初始符号是出现次数足够多的单个汉字，
+      每一步把出现最多的相邻符号对合并成一个新符号（例如 "学" + "习" → "学习"）
+    - 扩展 id：中文符号的 id 接在基础词表之后（base.n_vocab, base.n_vocab + 1, ...），
+      基础词表的 id 不变，已有模型只需要扩大嵌入层和输出层
+    - 回退：合并表中没有的汉字仍由基础分词器按字节编码，任何文本都能无损还原
+    - 可扩展：add_words 把领域词（例如 "分词器"）直接加入合并表，不需要重新训练
+
+依赖：
+    - 基础分词器：有 encode / decode / n_vocab 的对象（tiktoken 的 GPT-2 分词器，或字节分词器）
+"""
+
+import heapq
+import json
+import re
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+# 中日韩统一表意文字（含扩展 A、兼容字符）、CJK 标点、全角字符
+CJK_PATTERN = re.compile(r"[㐀-䶿一-鿿豈-﫿　-〿＀-￯]+")
+
+
+def split_cjk(text: str) -> List[Tuple[str, bool]]:
+    """
+    预分词：切成 (片段, 是否为 CJK) 的列表，片段按顺序拼接后等于原文
+
+    示例:
+        >>> split_cjk("学习 LLM 很有趣！")
+        [('学习', True), (' LLM ', False), ('很有趣！', True)]
+    """
+    segments = []
+    pos = 0
+    for match in CJK_PATTERN.finditer(text):
+        if match.start() > pos:
+            segments.append((text[pos:match.start()], False))
+        segments.append((match.group(), True))
+        pos = match.end()
+    if pos < len(text):
+        segments.append((text[pos:], False))
+    return segments
+
+
+def train_cjk_merges(texts: Iterable[str], n_merges: int, min_frequency: int = 2) -> Tuple[List[str], List[tuple]]:
+    """
+    在文本的中文片段上训练 BPE 合并表
+
+    参数:
+        texts: 训练文本（可以是中英混合）
+        n_merges (int): 最多学习的合并次数
+        min_frequency (int): 汉字出现少于这个次数时不进入初始符号表；符号对少于这个次数时停止合并
+
+    返回:
+        tuple: (初始符号表：单个字符列表, 合并列表 [(左符号, 右符号), ...]，按学习顺序)
+
+    注意:
+        - 每个中文片段作为一个"词"，相同的片段只保存一次并记录出现次数
+        - 合并后只更新包含这个符号对的词（倒排索引），最大值用带惰性删除的堆维护
+    """
+    run_counts = Counter(run for text in texts for run in CJK_PATTERN.findall(text))
+    char_counts = Counter()
+    for run, count in run_counts.items():
+        for ch in run:
+            char_counts[ch] += count
+    alphabet = sorted(ch for ch, count in char_counts.items() if count >= min_frequency)
+    known = set(alphabet)
+
+    # 不在符号表中的字符用 None 占位：它把词切断，两侧的符号不会被合并到一起
+    words = [[ch if ch in known else None for ch in run] for run in run_counts]
+    freqs = list(run_counts.values())
+    pair_counts = Counter()
+    where = defaultdict(set)
+
+    def count_pairs(wi: int, sign: int) -> None:
+        """
+        把第 wi 个词中相邻符号对的计数加上（sign=+1）或减去（sign=-1）该词的出现次数
+
+        加上时同时登记到倒排索引 where；减到 0 的符号对从 pair_counts 中删除。None 占位符两侧的对跳过
+        """
+        word = words[wi]
+        for pair in zip(word, word[1:]):
+            if pair[0] is None or pair[1] is None:
+                continue
+            pair_counts[pair] += sign * freqs[wi]
+            if sign > 0:
+                where[pair].add(wi)
+            elif pair_counts[pair] <= 0:
+                del pair_counts[pair]
+
+    for wi in range(len(words)):
+        count_pairs(wi, +1)
+    heap = [(-count, pair) for pair, count in pair_counts.items()]
+    heapq.heapify(heap)
+
+    merges = []
+    while heap and len(merges) < n_merges:
+        neg_count, pair = heapq.heappop(heap)
+        if pair_counts.get(pair, 0) != -neg_count:
+            continue  # 过期的堆条目
+        if -neg_count < min_frequency:
+            break
+        merges.append(pair)
+        merged = pair[0] + pair[1]
+        touched = set()
+        for wi in where.pop(pair, ()):
+            word = words[wi]
+            if not any(a == pair[0] and b == pair[1] for a, b in zip(word, word[1:])):
+                continue
+            count_pairs(wi, -1)
+            words[wi] = _merge_pair(word, pair, merged)
+            count_pairs(wi, +1)
+            # 计数变化的符号对（旧词中减少的、新词中新增的）都要以新的计数重新入堆
+            touched.update(zip(word, word[1:]))
+            touched.update(zip(words[wi], words[wi][1:]))
+        for p in touched:
+            if p in pair_counts:
+                heapq.heappush(heap, (-pair_counts[p], p))
+    return alphabet, merges
+
+
+def _merge_pair(symbols: list, pair: tuple, merged: str) -> list:
+    """把 symbols 中所有相邻的 pair 从左到右合并成 merged"""
+    out = []
+    i = 0
+    while i < len(symbols):
+        if i + 1 < len(symbols) and symbols[i] == pair[0] and symbols[i + 1] == pair[1]:
+            out.append(merged)
+            i += 2
+        else:
+            out.append(symbols[i])
+            i += 1
+    return out
+
+
+class CJKTokenizer:
+    """
+    基础分词器 + 中文合并表
+
+    属性:
+        base: 基础分词器（处理非中文片段，以及合并表中没有的汉字）
+        pieces (list[str]): 中文符号，第 k 个的 id 是 base.n_vocab + k
+        merges (list[tuple]): 合并表，下标越小优先级越高
+
+    示例:
+        >>> tokenizer = CJKTokenizer.train(tiktoken.get_encoding("gpt2"), corpus, n_merges=4000)
+        >>> ids = tokenizer.encode("学习 LLM 很有趣！")
+        >>> tokenizer.decode(ids)
+        '学习 LLM 很有趣！'
+        >>> tokenizer.n_vocab        # 模型的 vocab_size 需要相应扩大
+    """
+
+    def __init__(self, base, pieces: Sequence[str] = (), merges: Sequence[tuple] = ()):
+        """
+        参数:
+            base: 基础分词器
+            pieces: 初始符号（按 id 顺序），训练时是单个汉字
+            merges: 合并表，合并结果自动加入符号表
+        """
+        self.base = base
+        self.base_vocab = base.n_vocab
+        self.pieces: List[str] = []
+        self.piece_to_id: Dict[str, int] = {}
+        self.merges: List[tuple] = []
+        self.ranks: Dict[tuple, int] = {}
+        self._cache: Dict[str, List[int]] = {}
+        for piece in pieces:
+            self._add_piece(piece)
+        for left, right in merges:
+            self.add_merge(left, right)
+
+    @classmethod
+    def train(cls, base, texts: Iterable[str], n_merges: int, min_frequency: int = 2) -> "CJKTokenizer":
+        """在 texts 的中文片段上训练合并表（见 train_cjk_merges）"""
+        alphabet, merges = train_cjk_merges(texts, n_merges, min_frequency)
+        return cls(base, alphabet, merges)
+
+    @property
+    def n_vocab(self) -> int:
+        """词表大小：基础分词器的词表加上新增的中文符号"""
+        return self.base_vocab + len(self.pieces)
+
+    # ------------------------------------------------------------------ 扩展
+
+    def _add_piece(self, piece: str) -> int:
+        """把符号加入词表（已存在时不变），返回它的 id"""
+        if piece not in self.piece_to_id:
+            self.piece_to_id[piece] = self.base_vocab + len(self.pieces)
+            self.pieces.append(piece)
+        return self.piece_to_id[piece]
+
+    def add_merge(self, left: str, right: str) -> None:
+        """在合并表末尾追加一条合并（优先级最低），左右符号不存在时先加入"""
+        if (left, right) in self.ranks:
+            return
+        for piece in (left, right):
+            if len(piece) == 1:
+                self._add_piece(piece)
+            elif piece not in self.piece_to_id:
+                raise ValueError(f"符号 {piece!r} 不在合并表中，无法作为合并的一侧")
+        self.ranks[(left, right)] = len(self.merges)
+        self.merges.append((left, right))
+        self._add_piece(left + right)
+        self._cache.clear()
+
+    def add_words(self, words: Iterable[str]) -> None:
+        """
+        把词直接加入合并表：按字从左到右依次合并（"分词器" → "分" + "词"，"分词" + "器"）
+
+        参数:
+            words: 只包含 CJK 字符的词
+        """
+        for word in words:
+            if not CJK_PATTERN.fullmatch(word):
+                raise ValueError(f"{word!r} 包含非 CJK 字符")
+            for i in range(1, len(word)):
+                self.add_merge(word[:i], word[i])
+
+    # ------------------------------------------------------------------ 编码 / 解码
+
+    def _encode_cjk(self, run: str) -> List[int]:
+        """对一个中文片段应用合并表（结果缓存，常见片段只计算一次）"""
+        cached = self._cache.get(run)
+        if cached is not None:
+            return cached
+        symbols = [ch if ch in self.piece_to_id else None for ch in run]
+        while len(symbols) > 1:
+            best = None
+            for pair in zip(symbols, symbols[1:]):
+                rank = self.ranks.get(pair)
+                if rank is not None and (best is None or rank < self.ranks[best]):
+                    best = pair
+            if best is None:
+                break
+            symbols = _merge_pair(symbols, best, best[0] + best[1])
+        ids = []
+        for ch, symbol in zip(_positions(symbols, run), symbols):
+            if symbol is None:
+                ids.extend(self.base.encode(ch))
+            else:
+                ids.append(self.piece_to_id[symbol])
+        if len(self._cache) < 100_000:
+            self._cache[run] = ids
+        return ids
+
+    def encode(self, text: str, **kwargs) -> List[int]:
+        """
+        参数:
+            text (str): 待编码文本
+            **kwargs: 传给基础分词器的参数（例如 allowed_special）
+        """
+        ids = []
+        for segment, is_cjk in split_cjk(text):
+            ids.extend(self._encode_cjk(segment) if is_cjk else self.base.encode(segment, **kwargs))
+        return ids
+
+    def decode(self, ids: Sequence[int]) -> str:
+        """连续的基础 id 一起交给基础分词器解码（一个汉字的多个字节 token 必须一起解码）"""
+        parts = []
+        run = []
+        for i in ids:
+            if i < self.base_vocab:
+                run.append(i)
+                continue
+            if run:
+                parts.append(self.base.decode(run))
+                run = []
+            parts.append(self.pieces[i - self.base_vocab])
+        if run:
+            parts.append(self.base.decode(run))
+        return "".join(parts)
+
+    # ------------------------------------------------------------------ 保存 / 加载
+
+    def save(self, path: str) -> None:
+        """符号按 id 顺序保存，加载后 id 不变"""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"base_vocab": self.base_vocab, "pieces": self.pieces,
+                       "merges": [list(m) for m in self.merges]}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str, base) -> "CJKTokenizer":
+        """基础分词器的词表大小必须与保存时一致"""
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data["base_vocab"] != base.n_vocab:
+            raise ValueError(f"基础词表大小 {base.n_vocab} 与保存时的 {data['base_vocab']} 不一致")
+        return cls(base, data["pieces"], [tuple(m) for m in data["merges"]])
+
+
+def _positions(symbols: list, run: str) -> List[str]:
+    """每个符号对应的原文（None 符号对应一个未知字符）"""
+    out = []
+    pos = 0
+    for symbol in symbols:
+        n = 1 if symbol is None else len(symbol)
+        out.append(run[pos:pos + n])
+        pos += n
+    return out
+
+
+def tokens_per_char(tokenizer, texts: Sequence[str]) -> float:
+    """每个字符平均需要的 token 数（越小越好）"""
+    n_chars = sum(len(t) for t in texts)
+    return sum(len(tokenizer.encode(t)) for t in texts) / max(n_chars, 1)
+
+
+if __name__ == "__main__":
+    import glob
+    import os
+
+    class ByteTokenizer:
+        """没有 GPT-2 分词器文件时使用：UTF-8 字节作为 token"""
+
+        n_vocab = 256
+
+        def encode(self, text, **kwargs):
+            """文本的 UTF-8 字节即 token ID（忽略 allowed_special 等参数）"""
+            return list(text.encode("utf-8"))
+
+        def decode(self, ids):
+            """按 UTF-8 解码，不完整的字节用替换字符"""
+            return bytes(ids).decode("utf-8", errors="replace")
+
+    try:
+        import tiktoken
+
+        base = tiktoken.get_encoding("gpt2")
+    except Exception as exc:  # 离线环境下 tiktoken 下载词表会失败
+        print(f"⚠️  无法加载 GPT-2 分词器（{type(exc).__name__}），改用 UTF-8 字节作为基础分词器")
+        base = ByteTokenizer()
+
+    # 训练语料：本仓库的中文文档（中英混合）
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(root, "**", "*.md"), recursive=True)):
+        with open(path, "r", encoding="utf-8") as f:
+            corpus.append(f.read())
+    tokenizer = CJKTokenizer.train(base, corpus, n_merges=2000)
+    tokenizer.add_words(["分词器"])
+    print(f"中文符号 {len(tokenizer.pieces)} 个，词表 {base.n_vocab} → {tokenizer.n_vocab}")
+
+    for text in ("Learning LLM is fun! 学习 LLM 很有趣！", "分词器将文本转换为 token 序列"):
+        ids = tokenizer.encode(text)
+        print(f"\n{text}")
+        print(f"  基础分词器 {len(base.encode(text))} 个 token，CJK 分词器 {len(ids)} 个 token")
+        print(f"  {[tokenizer.decode([i]) if i >= tokenizer.base_vocab else i for i in ids]}")
+        print(f"  {'✅' if tokenizer.decode(ids) == text else '❌'} 解码后与原文一致")
@@ -0,0 +1,243 @@
+"""
+第2章：语料统计（在 token ID 上向量化计算）
+
+书中的统计方式是在 Python 字符串列表上逐个循环：sum(len(t) for t in tokens) 求平均长度，
+len(set(tokens)) 求唯一 token 数。语料一大，光是把所有 token 变成 Python 字符串就放不进内存。
+
+核心概念：
+    - 一切统计都从词频推出：对已编码的 token ID 做 np.bincount 得到每个 id 出现的次数，
+      总 token 数、唯一 token 数、top-k、未知词比例都只依赖这个长度为词表大小的数组
+    - 长度查找表：lengths[id] = 该 token 的字符数，只在词表上算一次；
+      总字符数 = counts @ lengths，token 长度直方图 = np.bincount(lengths, weights=counts)
+    - 流式扫描：write_token_file 写出的分片用 np.memmap 打开，按固定大小的块做 bincount，
+      内存占用与语料大小无关；不同分片（或不同进程）的结果可以直接相加合并
+
+依赖：
+    - numpy: 内存映射和 bincount
+"""
+
+import os
+import time
+from dataclasses import dataclass
+from typing import Callable, Mapping, Optional, Sequence, Union
+
+import numpy as np
+
+# 每块 50 万个 token：bincount 内部转换出的 intp 临时数组约 4 MB，能留在缓存里，比大块更快
+CHUNK_TOKENS = 1 << 19
+
+
+def length_table(vocab: Union[Mapping[str, int], Sequence[str]], size: Optional[int] = None) -> np.ndarray:
+    """
+    每个 id 对应 token 的字符数
+
+    参数:
+        vocab: {token: id}（字典或 BlobVocab），或按 id 排列的 token 列表
+        size (int): 表的长度，默认为词表大小；词表中不存在的 id 长度为 0
+
+    返回:
+        ndarray: 形状 (size,) 的 int32
+    """
+    if isinstance(vocab, Mapping) or hasattr(vocab, "items"):
+        pairs = [(i, len(token)) for token, i in vocab.items()]
+    else:
+        pairs = [(i, len(token)) for i, token in enumerate(vocab)]
+    table = np.zeros(size or (max((i for i, _ in pairs), default=-1) + 1), dtype=np.int32)
+    if pairs:
+        ids, lengths = np.array(pairs, dtype=np.int64).T
+        table[ids] = lengths
+    return table
+
+
+@dataclass
+class CorpusStats:
+    """
+    语料的词频，以及由词频推出的各项统计
+
+    属性:
+        counts (ndarray): 形状 (vocab_size,) 的 int64，每个 id 的出现次数
+        n_files (int): 扫描过的分片数
+        seconds (float): 扫描耗时
+
+    示例:
+        >>> stats = scan_token_files(["shard0.bin", "shard1.bin"], vocab_size=50257)
+        >>> print_report(stats, length_table(vocab), top_k=10)
+    """
+
+    counts: np.ndarray
+    n_files: int = 0
+    seconds: float = 0.0
+
+    @classmethod
+    def empty(cls, vocab_size: int) -> "CorpusStats":
+        """全零计数（词表大小为 vocab_size），之后用 add 逐段累加"""
+        return cls(np.zeros(vocab_size, dtype=np.int64))
+
+    @classmethod
+    def from_ids(cls, token_ids, vocab_size: int) -> "CorpusStats":
+        """一次性统计一段 token ID（列表、数组或 memmap）"""
+        stats = cls.empty(vocab_size)
+        stats.add(token_ids)
+        return stats
+
+    def add(self, token_ids, chunk_tokens: int = CHUNK_TOKENS) -> None:
+        """累加一段 token ID（可以是 memmap），按块做 bincount，避免一次性转换成 int64"""
+        token_ids = np.asarray(token_ids)
+        for lo in range(0, len(token_ids), chunk_tokens):
+            chunk = np.bincount(token_ids[lo:lo + chunk_tokens], minlength=len(self.counts))
+            if len(chunk) > len(self.counts):
+                # 出现超出词表的 id：扩大 counts，不丢弃数据
+                self.counts = np.concatenate([self.counts, np.zeros(len(chunk) - len(self.counts), np.int64)])
+            self.counts += chunk
+
+    def merge(self, other: "CorpusStats") -> "CorpusStats":
+        """合并两份统计（例如多个进程各扫描一部分分片）"""
+        size = max(len(self.counts), len(other.counts))
+        counts = np.zeros(size, dtype=np.int64)
+        counts[:len(self.counts)] += self.counts
+        counts[:len(other.counts)] += other.counts
+        return CorpusStats(counts, self.n_files + other.n_files, self.seconds + other.seconds)
+
+    @property
+    def n_tokens(self) -> int:
+        """token 总数"""
+        return int(self.counts.sum())
+
+    @property
+    def n_unique(self) -> int:
+        """至少出现一次的不同 id 个数"""
+        return int(np.count_nonzero(self.counts))
+
+    def top_k(self, k: int) -> tuple:
+        """出现次数最多的 k 个 id（按次数降序）及其次数；argpartition 只做部分排序"""
+        k = min(k, len(self.counts))
+        ids = np.argpartition(-self.counts, k - 1)[:k] if k else np.array([], dtype=np.int64)
+        ids = ids[np.argsort(-self.counts[ids], kind="stable")]
+        return ids, self.counts[ids]
+
+    def n_chars(self, lengths: np.ndarray) -> int:
+        """总字符数 = 词频与长度表的点积"""
+        return int(self.counts[:len(lengths)] @ lengths[:len(self.counts)].astype(np.int64))
+
+    def chars_per_token(self, lengths: np.ndarray) -> float:
+        """
+        平均每个 token 的字符数（按出现次数加权）
+
+        参数:
+            lengths (ndarray): 每个 id 的字符长度（见 length_table）
+        """
+        return self.n_chars(lengths) / max(self.n_tokens, 1)
+
+    def length_histogram(self, lengths: np.ndarray) -> np.ndarray:
+        """hist[L] = 长度为 L 的 token 在语料中出现的总次数"""
+        n = min(len(lengths), len(self.counts))
+        return np.bincount(lengths[:n], weights=self.counts[:n]).astype(np.int64)
+
+    def oov_rate(self, unk_id: Optional[int] = None, vocab_size: Optional[int] = None) -> float:
+        """
+        未知词比例：<|unk|> 的出现次数，加上 id ≥ vocab_size 的 token 数，占总数的比例
+
+        参数:
+            unk_id (int): 未知词 token 的 id（SimpleTokenizerV2 的 <|unk|>）
+            vocab_size (int): 有效词表大小，超出的 id 都算未知词
+        """
+        n_oov = 0
+        if unk_id is not None and unk_id < len(self.counts):
+            n_oov += int(self.counts[unk_id])
+        if vocab_size is not None:
+            n_oov += int(self.counts[vocab_size:].sum())
+        return n_oov / max(self.n_tokens, 1)
+
+
+def scan_token_files(paths: Sequence[str], vocab_size: int, dtype=np.uint16,
+                     chunk_tokens: int = CHUNK_TOKENS,
+                     progress: Optional[Callable[[str, int], None]] = None) -> CorpusStats:
+    """
+    一次流式扫描所有分片
+
+    参数:
+        paths: write_token_file 写出的 .bin 文件
+        vocab_size (int): 词表大小（counts 的长度）
+        dtype: 文件中的存储类型，需与写入时一致
+        chunk_tokens (int): 每块的 token 数，决定临时内存（bincount 内部会转成 intp）
+        progress: 每个分片扫描完后调用 progress(path, n_tokens)
+
+    返回:
+        CorpusStats
+    """
+    stats = CorpusStats.empty(vocab_size)
+    start = time.perf_counter()
+    for path in paths:
+        if os.path.getsize(path) == 0:
+            tokens = np.empty(0, dtype=dtype)
+        else:
+            tokens = np.memmap(path, dtype=dtype, mode="r")
+        stats.add(tokens, chunk_tokens)
+        stats.n_files += 1
+        if progress is not None:
+            progress(path, len(tokens))
+        del tokens
+    stats.seconds = time.perf_counter() - start
+    return stats
+
+
+def print_report(stats: CorpusStats, lengths: Optional[np.ndarray] = None,
+                 id_to_token: Optional[Callable[[int], str]] = None, top_k: int = 10,
+                 unk_id: Optional[int] = None, vocab_size: Optional[int] = None) -> None:
+    """
+    打印语料报告
+
+    参数:
+        stats: 扫描结果
+        lengths: length_table 的结果，None 时不打印字符相关的统计
+        id_to_token: id → token，用于打印 top-k，None 时只打印 id
+        top_k (int): 打印出现次数最多的前几个 token
+        unk_id (int) / vocab_size (int): 见 CorpusStats.oov_rate
+    """
+    n_tokens = stats.n_tokens
+    print(f"总 token 数: {n_tokens:,}（{stats.n_files} 个分片，{stats.seconds:.2f} s，"
+          f"{n_tokens / max(stats.seconds, 1e-9) / 1e6:.0f}M tokens/s）")
+    print(f"唯一 token 数: {stats.n_unique:,} / {len(stats.counts):,}")
+    if unk_id is not None or vocab_size is not None:
+        print(f"未知词比例: {stats.oov_rate(unk_id, vocab_size):.4%}")
+    if lengths is not None:
+        print(f"总字符数: {stats.n_chars(lengths):,}，平均 {stats.chars_per_token(lengths):.2f} 字符/token")
+        hist = stats.length_histogram(lengths)
+        print("token 长度分布:")
+        for length in np.flatnonzero(hist)[:16]:
+            share = hist[length] / max(n_tokens, 1)
+            print(f"  {length:>3} 字符 {hist[length]:>14,} {share:>7.2%} {'█' * int(round(share * 50))}")
+    ids, counts = stats.top_k(top_k)
+    print(f"出现最多的 {len(ids)} 个 token:")
+    for i, count in zip(ids.tolist(), counts.tolist()):
+        label = repr(id_to_token(i)) if id_to_token is not None else ""
+        print(f"  {i:>6} {label:<16} {count:>14,} {count / max(n_tokens, 1):>7.2%}")
+
+
+if __name__ == "__main__":
+    import re
+    import tempfile
+
+    # 作为脚本运行时本目录在 sys.path 最前面（ch02/main/ch02.py 会遮住 ch02 包），直接导入同目录的模块
+    from blob_vocab import BlobVocab
+    from dataloader import write_token_file
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "the-verdict.txt"), "r",
+              encoding="utf-8") as f:
+        raw_text = f.read()
+    tokens = [t.strip() for t in re.split(r'([,.:;?_!"()\']|--|\s)', raw_text) if t.strip()]
+    vocab = BlobVocab.from_tokens(tokens)
+    ids = vocab.lookup(tokens)
+
+    # 写成两个分片再扫描，结果应与在字符串列表上直接统计相同
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, f"shard{i}.bin") for i in range(2)]
+        for path, part in zip(paths, np.array_split(ids, 2)):
+            write_token_file(part, path)
+        stats = scan_token_files(paths, len(vocab))
+    lengths = length_table(vocab)
+    print_report(stats, lengths, vocab.token, top_k=5)
+    expected = sum(len(t) for t in tokens) / len(tokens)
+    same = (stats.n_tokens == len(tokens) and stats.n_unique == len(set(tokens))
+            and abs(stats.chars_per_token(lengths) - expected) < 1e-12)
+    print(f"{'✅' if same else '❌'} 与在字符串列表上逐个统计的结果一致")
@@ -0,0 +1,236 @@
+"""
+第2章：数据加载器（滑动窗口采样）
+
+GPT 的训练目标是"预测下一个 token"：输入是一段 token，目标是同一段 token 向右移动一位。
+数据加载器用一个固定长度的滑动窗口在整个 token 序列上采样输入-目标对。
+
+核心概念：
+    - max_length：每个样本的 token 数（即模型的上下文长度）
+    - stride：相邻两个窗口起点之间的距离；stride == max_length 时窗口不重叠，
+      stride 更小时样本重叠更多（数据更多，但也更容易过拟合）
+    - 输入/目标错开一位：input = ids[i : i+L]，target = ids[i+1 : i+L+1]
+
+实现要点：
+    - 整篇文本只分词一次，保存为一个一维 LongTensor；
+      每个样本在 __getitem__ 时再切片（切片是视图，不复制数据），
+      而不是像书中那样预先为每个窗口保存两份张量
+    - 大语料预先分词写成 uint16 二进制文件（GPT-2 词表 < 65536），训练时用 np.memmap 打开，
+      只有被访问到的页才会读入内存；多个进程打开同一个文件时共享操作系统的页缓存
+
+依赖：
+    - torch: PyTorch 深度学习框架
+    - numpy: 内存映射的 token 文件
+    - tiktoken: GPT-2 分词器
+"""
+
+from typing import Optional
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+
+class TokenWindowDataset(Dataset):
+    """
+    在一维 token 序列上按滑动窗口取样的数据集
+
+    属性:
+        token_ids (Tensor): 形状 (n_tokens,) 的 LongTensor
+        max_length (int): 每个样本的长度
+        stride (int): 窗口步长
+    """
+
+    def __init__(self, token_ids, max_length: int, stride: int):
+        """
+        参数:
+            token_ids: token ID 序列（list 或一维张量）
+            max_length (int): 每个样本的长度
+            stride (int): 窗口步长
+        """
+        self.token_ids = torch.as_tensor(token_ids, dtype=torch.long)
+        self.max_length = max_length
+        self.stride = stride
+        # 最后一个窗口还需要多 1 个 token 作为目标
+        n_windows = (len(self.token_ids) - max_length - 1) // stride + 1
+        self.n_windows = max(0, n_windows)
+
+    def __len__(self) -> int:
+        """窗口个数"""
+        return self.n_windows
+
+    def __getitem__(self, index: int):
+        """
+        第 index 个窗口
+
+        参数:
+            index (int): 窗口下标，起点为 index * stride
+
+        返回:
+            tuple[Tensor, Tensor]: (输入, 目标)，形状都是 (max_length,)，目标是输入右移一位
+        """
+        start = index * self.stride
+        chunk = self.token_ids[start:start + self.max_length + 1]
+        return chunk[:-1], chunk[1:]
+
+
+class GPTDatasetV1(TokenWindowDataset):
+    """
+    书中的 GPTDatasetV1：对原始文本分词后按滑动窗口取样
+
+    示例:
+        >>> dataset = GPTDatasetV1(raw_text, tiktoken.get_encoding("gpt2"), max_length=256, stride=128)
+        >>> inputs, targets = dataset[0]
+    """
+
+    def __init__(self, txt: str, tokenizer, max_length: int, stride: int):
+        """
+        参数:
+            txt (str): 原始文本
+            tokenizer: 分词器（<|endoftext|> 按特殊 token 编码）
+            max_length (int): 每个样本的长度
+            stride (int): 窗口步长
+        """
+        token_ids = tokenizer.encode(txt, allowed_special={"<|endoftext|>"})
+        super().__init__(token_ids, max_length, stride)
+
+
+def write_token_file(token_ids, path: str, dtype=np.uint16) -> int:
+    """
+    把 token ID 序列写成扁平的二进制文件（供 MemmapTokenDataset 读取）
+
+    参数:
+        token_ids: token ID 序列
+        path (str): 输出路径，约定使用 .bin 后缀
+        dtype: 存储类型，词表小于 65536 时用 uint16，否则用 uint32
+
+    返回:
+        int: 写入的 token 数
+    """
+    array = np.asarray(token_ids)
+    if array.size and array.max() > np.iinfo(dtype).max:
+        raise ValueError(f"token ID {array.max()} 超出 {np.dtype(dtype).name} 的范围")
+    array.astype(dtype).tofile(path)
+    return int(array.size)
+
+
+class MemmapTokenDataset(Dataset):
+    """
+    在内存映射的 token 文件上按滑动窗口取样
+
+    与 TokenWindowDataset 的窗口划分相同，但 token 不需要全部读入内存，
+    适合远大于内存的预分词语料，以及多个训练进程共享同一份数据
+
+    示例:
+        >>> write_token_file(tokenizer.encode(text), "corpus.bin")
+        >>> dataset = MemmapTokenDataset("corpus.bin", max_length=256)
+    """
+
+    def __init__(self, path: str, max_length: int, stride: Optional[int] = None, dtype=np.uint16):
+        """
+        参数:
+            path (str): write_token_file 写出的文件
+            max_length (int): 每个样本的长度
+            stride (int): 窗口步长，默认等于 max_length
+            dtype: 文件中的存储类型，需与写入时一致
+        """
+        self.path = path
+        self.dtype = dtype
+        self.max_length = max_length
+        self.stride = stride or max_length
+        self.tokens = np.memmap(path, dtype=dtype, mode="r")
+        n_windows = (len(self.tokens) - max_length - 1) // self.stride + 1
+        self.n_windows = max(0, n_windows)
+
+    def __len__(self) -> int:
+        """窗口个数"""
+        return self.n_windows
+
+    def __getitem__(self, index: int):
+        """
+        第 index 个窗口，从内存映射中切片后复制成 int64
+
+        参数:
+            index (int): 窗口下标，起点为 index * stride
+
+        返回:
+            tuple[Tensor, Tensor]: (输入, 目标)，形状都是 (max_length,)，目标是输入右移一位
+        """
+        start = index * self.stride
+        # astype 会复制出一份 int64 数组，不会保留对 memmap 的引用
+        chunk = torch.from_numpy(self.tokens[start:start + self.max_length + 1].astype(np.int64))
+        return chunk[:-1], chunk[1:]
+
+    def __getstate__(self):
+        """pickle 时去掉内存映射本身，只保留文件路径等元数据"""
+        # DataLoader 子进程中重新打开文件，而不是 pickle 整个映射
+        state = self.__dict__.copy()
+        del state["tokens"]
+        return state
+
+    def __setstate__(self, state):
+        """反序列化（例如在 DataLoader 子进程中）后按路径重新打开只读内存映射"""
+        self.__dict__.update(state)
+        self.tokens = np.memmap(self.path, dtype=self.dtype, mode="r")
+
+
+def create_dataloader_v1(txt: str, batch_size: int = 4, max_length: int = 256, stride: int = 128,
+                         shuffle: bool = True, drop_last: bool = True, num_workers: int = 0,
+                         tokenizer=None, generator: Optional[torch.Generator] = None) -> DataLoader:
+    """
+    创建 GPT 训练用的数据加载器
+
+    参数:
+        txt (str): 原始文本
+        batch_size (int): 每个 batch 的样本数
+        max_length (int): 每个样本的 token 数
+        stride (int): 窗口步长
+        shuffle (bool): 是否打乱样本顺序
+        drop_last (bool): 丢弃最后一个不完整的 batch（避免训练时损失突然跳动）
+        num_workers (int): 数据加载子进程数
+        tokenizer: 分词器，默认使用 GPT-2 的 BPE 分词器
+        generator: 可选，控制打乱顺序的随机数生成器
+
+    返回:
+        DataLoader: 每次产出 (inputs, targets)，形状都是 (batch_size, max_length)
+    """
+    if tokenizer is None:
+        import tiktoken
+
+        tokenizer = tiktoken.get_encoding("gpt2")
+    dataset = GPTDatasetV1(txt, tokenizer, max_length, stride)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last,
+                      num_workers=num_workers, generator=generator)
+
+
+def create_token_dataloader(token_ids, batch_size: int = 4, max_length: int = 256,
+                            stride: Optional[int] = None, shuffle: bool = True,
+                            drop_last: bool = True,
+                            generator: Optional[torch.Generator] = None) -> DataLoader:
+    """
+    直接在已分词的 token 序列上创建数据加载器（跳过分词）
+
+    参数:
+        token_ids: token ID 序列
+        stride (int): 窗口步长，默认等于 max_length（窗口不重叠）
+        其余参数同 create_dataloader_v1
+
+    返回:
+        DataLoader
+    """
+    dataset = TokenWindowDataset(token_ids, max_length, stride or max_length)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last,
+                      generator=generator)
+
+
+if __name__ == "__main__":
+    import os
+
+    curr_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(curr_dir, "the-verdict.txt"), "r", encoding="utf-8") as f:
+        raw_text = f.read()
+
+    loader = create_dataloader_v1(raw_text, batch_size=8, max_length=4, stride=4, shuffle=False)
+    inputs, targets = next(iter(loader))
+    print(f"样本数: {len(loader.dataset)}")
+    print(f"输入:\n{inputs}")
+    print(f"目标（向右错开一位）:\n{targets}")
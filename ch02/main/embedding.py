@@ -0,0 +1,214 @@
+"""
+第2章：token 嵌入 + 绝对位置嵌入（可选稀疏梯度）
+
+第2章的最后一步：token ID 查表得到 token 嵌入，再加上可学习的绝对位置嵌入，作为 GPT 的输入。
+
+核心概念：
+    - 位置嵌入按长度切片：位置总是 0..T-1，所以位置嵌入就是 pos_emb.weight[:T]。
+      切片是视图，不需要每步构造 arange 索引再查表，反向时梯度直接累加到前 T 行
+    - 稀疏梯度：词表有 5 万行，一个 batch 只用到其中几千个 id。稠密梯度每步都要分配并清零
+      整张 (vocab_size, emb_dim) 的梯度，AdamW 也要更新每一行；nn.Embedding(sparse=True)
+      的梯度只包含用到的行（稀疏 COO 张量）
+    - 稀疏感知的优化器：稀疏梯度的参数交给 torch.optim.SparseAdam（只更新出现的行），
+      其余参数仍用 AdamW；两者包装成一个优化器对象，训练循环不需要改动
+
+注意：
+    - SparseAdam 是"惰性" Adam：没出现的行不更新，它们的一阶/二阶矩也不衰减，
+      与稠密 AdamW 的轨迹不完全相同；嵌入行也不做权重衰减
+    - SparseAdam 的矩估计仍是稠密张量，省下的是稠密梯度以及每步对全表的更新
+
+依赖：
+    - torch: PyTorch 深度学习框架
+"""
+
+from typing import Iterable, List, Optional
+
+import torch
+import torch.nn as nn
+
+
+class GPTEmbedding(nn.Module):
+    """
+    token 嵌入 + 绝对位置嵌入
+
+    属性:
+        tok_emb: (vocab_size, emb_dim)，sparse=True 时产生稀疏梯度
+        pos_emb: (ctx_len, emb_dim)，只有 ctx_len 行，保持稠密
+
+    GPTModel（ch04/main/gpt_model.py）的输入层就是它。
+
+    示例:
+        >>> emb = GPTEmbedding(50257, 768, ctx_len=1024, sparse=True)
+        >>> x = emb(token_ids)                     # (batch, T, 768)
+        >>> optimizer = SparseAwareOptimizer(emb.parameters(), sparse_parameters(emb), lr=4e-4)
+    """
+
+    def __init__(self, vocab_size: int, emb_dim: int, ctx_len: int, sparse: bool = False):
+        """
+        参数:
+            vocab_size (int): 词表大小，即 token 嵌入表的行数
+            emb_dim (int): 嵌入维度
+            ctx_len (int): 最大上下文长度，即位置嵌入表的行数
+            sparse (bool): token 嵌入是否产生稀疏梯度（需要配合 SparseAwareOptimizer）
+        """
+        super().__init__()
+        self.ctx_len = ctx_len
+        self.tok_emb = nn.Embedding(vocab_size, emb_dim, sparse=sparse)
+        self.pos_emb = nn.Embedding(ctx_len, emb_dim)
+
+    def positional(self, seq_len: int, offset: int = 0) -> torch.Tensor:
+        """位置 offset..offset+seq_len-1 的位置嵌入：pos_emb.weight 的连续切片（视图）"""
+        if offset + seq_len > self.ctx_len:
+            raise ValueError(f"序列长度 {offset + seq_len} 超过上下文长度 {self.ctx_len}")
+        return self.pos_emb.weight[offset:offset + seq_len]
+
+    def forward(self, token_ids: torch.Tensor, positions: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """
+        参数:
+            token_ids (Tensor): 形状 (batch_size, seq_len)
+            positions (Tensor): 可选，每个 token 的绝对位置，形状 (batch_size, seq_len)；
+                                None 表示位置为 0..seq_len-1，直接用 positional 切片
+                                （KV 缓存中各行的位置不同时才需要按位置查表）
+
+        返回:
+            Tensor: 形状 (batch_size, seq_len, emb_dim)
+        """
+        if positions is None:
+            return self.tok_emb(token_ids) + self.positional(token_ids.shape[1])
+        return self.tok_emb(token_ids) + self.pos_emb(positions)
+
+
+def sparse_parameters(model: nn.Module) -> List[nn.Parameter]:
+    """模型中所有 sparse=True 的 nn.Embedding 的权重（它们的梯度是稀疏张量）"""
+    return [m.weight for m in model.modules()
+            if isinstance(m, nn.Embedding) and m.sparse and m.weight.requires_grad]
+
+
+class SparseAwareOptimizer:
+    """
+    稀疏梯度参数用 SparseAdam，其余参数用稠密优化器（默认 AdamW）
+
+    接口与 torch.optim.Optimizer 相同的部分：param_groups、state、zero_grad、step、
+    state_dict、load_state_dict，可以直接交给 Trainer 和学习率调度逻辑使用。
+
+    属性:
+        dense: 稠密参数的优化器
+        sparse: 稀疏参数的 SparseAdam（没有稀疏参数时为 None）
+    """
+
+    def __init__(self, params: Iterable[nn.Parameter], sparse_params: Iterable[nn.Parameter],
+                 optimizer_cls=torch.optim.AdamW, lr: float = 1e-3, weight_decay: float = 0.0,
+                 betas=(0.9, 0.999), eps: float = 1e-8, **kwargs):
+        """
+        按是否在 sparse_params 中把参数分给两个优化器（requires_grad=False 的参数直接跳过）
+
+        参数:
+            params: 全部需要优化的参数（可以包含稀疏参数）
+            sparse_params: 梯度是稀疏张量的参数（见 sparse_parameters）
+            optimizer_cls: 稠密参数的优化器类
+            lr / betas / eps: 两个优化器共用
+            weight_decay: 只作用于稠密参数
+            **kwargs: 传给稠密优化器的其他参数
+        """
+        sparse_ids = {id(p) for p in sparse_params}
+        params = [p for p in params if p.requires_grad]
+        dense = [p for p in params if id(p) not in sparse_ids]
+        sparse = [p for p in params if id(p) in sparse_ids]
+        self.dense = optimizer_cls(dense, lr=lr, weight_decay=weight_decay, betas=betas, eps=eps, **kwargs)
+        self.sparse = torch.optim.SparseAdam(sparse, lr=lr, betas=betas, eps=eps) if sparse else None
+
+    @property
+    def optimizers(self) -> list:
+        """
+        实际工作的优化器
+
+        返回:
+            list: [dense] 或 [dense, sparse]，zero_grad / step 等按这个顺序转发
+        """
+        return [opt for opt in (self.dense, self.sparse) if opt is not None]
+
+    @property
+    def param_groups(self) -> list:
+        """
+        两个优化器的参数组拼在一起
+
+        返回:
+            list[dict]: 稠密优化器的参数组在前，SparseAdam 的在后；
+                        这些 dict 就是各优化器自己的参数组，修改其中的 lr 会作用到对应的优化器
+        """
+        return [group for opt in self.optimizers for group in opt.param_groups]
+
+    @property
+    def state(self) -> dict:
+        """
+        两个优化器的状态合并成一个字典（例如 vocab_growth 扩大词表时按参数查找并扩大动量）
+
+        返回:
+            dict: {参数: 该参数的状态 dict}；每次调用新建外层字典，但内层状态 dict 与优化器共享
+        """
+        return {p: s for opt in self.optimizers for p, s in opt.state.items()}
+
+    def zero_grad(self, set_to_none: bool = True) -> None:
+        """
+        清空两个优化器管理的全部梯度
+
+        参数:
+            set_to_none (bool): True 时把梯度设为 None（稀疏梯度只能这样释放），False 时原地清零
+        """
+        for opt in self.optimizers:
+            opt.zero_grad(set_to_none=set_to_none)
+
+    def step(self) -> None:
+        """
+        先用稠密优化器更新稠密参数，再用 SparseAdam 只更新稀疏梯度中出现的行
+
+        两组参数互不重叠，先后顺序不影响结果
+        """
+        for opt in self.optimizers:
+            opt.step()
+
+    def state_dict(self) -> dict:
+        """
+        两个优化器各自的状态
+
+        返回:
+            dict: {"dense": 稠密优化器的 state_dict, "sparse": SparseAdam 的 state_dict 或 None}
+        """
+        return {"dense": self.dense.state_dict(),
+                "sparse": self.sparse.state_dict() if self.sparse is not None else None}
+
+    def load_state_dict(self, state: dict) -> None:
+        """
+        恢复 state_dict 保存的状态
+
+        参数:
+            state (dict): state_dict 的返回值；构造时的参数划分（稠密 / 稀疏）必须与保存时相同
+
+        注意:
+            - 当前没有稀疏参数时忽略 state["sparse"]
+        """
+        self.dense.load_state_dict(state["dense"])
+        if self.sparse is not None:
+            self.sparse.load_state_dict(state["sparse"])
+
+
+if __name__ == "__main__":
+    torch.manual_seed(123)
+    token_ids = torch.randint(0, 50257, (8, 256))
+
+    emb = GPTEmbedding(50257, 768, ctx_len=1024, sparse=True)
+    head = nn.Linear(768, 10)
+    optimizer = SparseAwareOptimizer(list(emb.parameters()) + list(head.parameters()),
+                                     sparse_parameters(emb), lr=1e-3)
+    loss = head(emb(token_ids)).pow(2).mean()
+    loss.backward()
+    grad = emb.tok_emb.weight.grad
+    print(f"输入 {tuple(token_ids.shape)}，输出 {tuple(emb(token_ids).shape)}")
+    print(f"token 嵌入梯度: {grad.layout}，包含 {grad.coalesce().indices().shape[1]:,} 行"
+          f"（稠密梯度为 {emb.tok_emb.weight.shape[0]:,} 行）")
+    before = emb.tok_emb.weight.detach().clone()
+    optimizer.step()
+    changed = (emb.tok_emb.weight != before).any(dim=1)
+    used = torch.zeros(50257, dtype=torch.bool)
+    used[token_ids.unique()] = True
+    print(f"{'✅' if torch.equal(changed, used) else '❌'} 只有 batch 中出现的 {int(used.sum()):,} 行被更新")
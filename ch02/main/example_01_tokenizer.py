@@ -166,6 +166,7 @@ def main():
     print("说明:")
     print("  - 英文平均 1 个 Token ≈ 4 个字符")
     print("  - 中文平均 1 个 Token ≈ 2-3 个汉字（取决于分词器）")
+    print("  - 中英混合数据可以用 cjk_tokenizer.py 的 CJKTokenizer：中文片段使用训练出的合并表，token 数明显减少")
     print("  - GPT-2 的上下文长度是 1024 个 tokens")
 
 
@@ -0,0 +1,200 @@
+"""
+第2章：词汇表追加后原地扩大嵌入层和输出层
+
+create_vocab 的追加模式（ch02/01/create_vocab.py 的 extend_vocab）只给新单词分配新 id，
+已编码的语料和已训练的嵌入行都不用动。模型这一侧只需要在 token 嵌入表和输出层末尾补上新行。
+
+核心概念：
+    - 原地扩大：参数对象不变，只替换 param.data（旧行保留，新行接在后面），
+      所以优化器、学习率调度器和其他持有参数引用的代码都不用重建
+    - 新行初始化为已有行的均值：新 token 的嵌入落在已有嵌入的中心，
+      输出层上新 token 的 logit 约等于平均水平，不会一开始就抢走概率
+    - 优化器状态同步扩大：AdamW 的一阶/二阶矩（SparseAdam、SGD 动量同理）在新行补 0，
+      纯 bf16 训练时 fp32 主权重也一起扩大
+    - 预留容量：和 Python list 一样，重新分配时多留 GROWTH_FACTOR 倍的行，
+      之后的扩展只要还在容量内就直接 resize_（不复制旧行，只写新行），
+      语料一篇一篇增长时，均摊到每个新 token 的复制开销是常数
+
+注意：
+    - 只能扩大不能缩小：缩小会让已编码语料中的 id 失效
+    - 参数是预留存储的前 num_rows 行，torch.save 会把整块存储（包括预留行）一起保存；
+      需要紧凑的检查点时先 .clone()
+
+依赖：
+    - torch: PyTorch 深度学习框架
+"""
+
+import dataclasses
+import math
+from typing import Optional
+
+import torch
+import torch.nn as nn
+
+# 容量不够时按当前行数的 1.25 倍重新分配：多占最多 25% 的内存，换来均摊常数的复制开销
+GROWTH_FACTOR = 1.25
+
+
+def _capacity(tensor: torch.Tensor) -> int:
+    """tensor 的存储空间最多能容纳多少行（不是从存储开头连续存放时只算当前行数）"""
+    if not tensor.is_contiguous() or tensor.storage_offset() != 0:
+        return tensor.shape[0]
+    row_bytes = math.prod(tensor.shape[1:]) * tensor.element_size()
+    return tensor.untyped_storage().nbytes() // max(row_bytes, 1)
+
+
+def _grow_rows(tensor: torch.Tensor, num_rows: int, fill: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    把 tensor 扩大到 num_rows 行，前 len(tensor) 行不变，新行为 fill（默认 0）
+
+    容量足够时原地 resize_ 并返回 tensor 本身；否则分配 GROWTH_FACTOR 倍容量的新存储，
+    返回其前 num_rows 行
+    """
+    old_rows = tensor.shape[0]
+    if num_rows <= _capacity(tensor):
+        grown = tensor.resize_((num_rows,) + tuple(tensor.shape[1:]))
+    else:
+        capacity = max(num_rows, int(old_rows * GROWTH_FACTOR))
+        grown = tensor.new_empty((capacity,) + tuple(tensor.shape[1:]))[:num_rows]
+        grown[:old_rows] = tensor
+    grown[old_rows:] = 0 if fill is None else fill
+    return grown
+
+
+def _grow_optimizer_state(optimizer, param: nn.Parameter, old_rows: int, num_rows: int) -> None:
+    """把优化器中与 param 形状相同的状态张量（动量、二阶矩等）补 0 扩大"""
+    if optimizer is None:
+        return
+    if hasattr(optimizer, "master_params"):
+        # MasterWeightOptimizer：真正被更新的是 fp32 主权重，状态也挂在主权重上
+        for model_p, master_p in zip(optimizer.model_params, optimizer.master_params):
+            if model_p is param:
+                _grow_param(master_p, num_rows, optimizer.optimizer, fill=param.data[old_rows:].float())
+        return
+    state = optimizer.state.get(param)
+    if not state:
+        return
+    for key, value in state.items():
+        if torch.is_tensor(value) and value.dim() > 0 and value.shape[0] == old_rows:
+            state[key] = _grow_rows(value, num_rows)
+
+
+@torch.no_grad()
+def _grow_param(param: nn.Parameter, num_rows: int, optimizer=None,
+                fill: Optional[torch.Tensor] = None) -> None:
+    """原地把参数扩大到 num_rows 行（第 0 维），新行默认取已有行的均值"""
+    old_rows = param.shape[0]
+    if num_rows < old_rows:
+        raise ValueError(f"只能扩大：{old_rows} -> {num_rows}")
+    if num_rows == old_rows:
+        return
+    if fill is None:
+        # 只读一遍已有的行求均值，不分配与词表同样大小的临时张量
+        fill = param.data.mean(dim=0, dtype=torch.float32).to(param.dtype)
+    param.data = _grow_rows(param.data, num_rows, fill)
+    # 旧梯度的形状已经不对，丢掉（扩展应发生在两步之间）
+    param.grad = None
+    _grow_optimizer_state(optimizer, param, old_rows, num_rows)
+
+
+def resize_embedding(embedding: nn.Embedding, num_embeddings: int, optimizer=None) -> None:
+    """原地把 nn.Embedding 扩大到 num_embeddings 行，新行为已有行的均值"""
+    _grow_param(embedding.weight, num_embeddings, optimizer)
+    embedding.num_embeddings = num_embeddings
+
+
+def resize_output_head(head: nn.Linear, out_features: int, optimizer=None) -> None:
+    """原地把输出层 (emb_dim -> vocab_size) 扩大到 out_features 个输出，偏置的新项同样取均值"""
+    _grow_param(head.weight, out_features, optimizer)
+    if head.bias is not None:
+        _grow_param(head.bias, out_features, optimizer)
+    head.out_features = out_features
+
+
+def resize_token_embeddings(model: nn.Module, vocab_size: int, optimizer=None) -> nn.Module:
+    """
+    词汇表追加新 token 后，原地扩大模型的 token 嵌入表和输出层
+
+    参数:
+        model: GPTModel（tok_emb + out_head）或 GPTEmbedding（只有 tok_emb）
+        vocab_size (int): 扩展后的词汇表大小，不能小于当前大小
+        optimizer: 可选。已经创建的优化器（AdamW、SparseAwareOptimizer、MasterWeightOptimizer 等），
+                   其中对应参数的状态会同步扩大
+
+    返回:
+        原模型（方便链式调用）
+
+    示例:
+        >>> new_words = tokenizer.extend(tokenize(new_text))
+        >>> resize_token_embeddings(model, len(tokenizer.str_to_int), optimizer)
+    """
+    resize_embedding(model.tok_emb, vocab_size, optimizer)
+    head = getattr(model, "out_head", None)
+    # 输出层与嵌入层共享权重时只扩大一次
+    if isinstance(head, nn.Linear) and head.weight is not model.tok_emb.weight:
+        resize_output_head(head, vocab_size, optimizer)
+    elif isinstance(head, nn.Linear):
+        head.out_features = vocab_size
+    if dataclasses.is_dataclass(getattr(model, "cfg", None)) and hasattr(model.cfg, "vocab_size"):
+        # 配置可能被多个模型共享（例如模块级默认配置、草稿模型和目标模型），换成新对象而不是原地修改
+        model.cfg = dataclasses.replace(model.cfg, vocab_size=vocab_size)
+    return model
+
+
+if __name__ == "__main__":
+    import os
+    import re
+    import sys
+
+    MAIN_DIR = os.path.dirname(os.path.abspath(__file__))
+    CH02_DIR = os.path.dirname(MAIN_DIR)
+    ROOT_DIR = os.path.dirname(CH02_DIR)
+    # 作为脚本运行时本目录在 sys.path 最前面，ch02/main/ch02.py 会遮住 ch02 包
+    # （gpt_model 要导入 ch02.main.embedding）；普通模块优先于命名空间包，所以把本目录从 sys.path 去掉
+    sys.path[:] = [p for p in sys.path if os.path.abspath(p or os.curdir) != MAIN_DIR]
+    sys.path.insert(0, ROOT_DIR)
+    sys.path.insert(0, os.path.join(CH02_DIR, "01"))
+    from create_vocab import extend_vocab
+    from ch04.main.gpt_model import GPTConfig, GPTModel
+
+    with open(os.path.join(CH02_DIR, "main", "the-verdict.txt"), "r", encoding="utf-8") as f:
+        raw_text = f.read()
+    tokens = [t.strip() for t in re.split(r'([,.:;?_!"()\']|--|\s)', raw_text) if t.strip()]
+    old_tokens, new_tokens = tokens[:len(tokens) // 2], tokens[len(tokens) // 2:]
+
+    # 前半篇建词汇表、编码、训练一步
+    vocab = {}
+    extend_vocab(vocab, old_tokens)
+    old_ids = torch.tensor([vocab[t] for t in old_tokens[:65]]).unsqueeze(0)
+    torch.manual_seed(123)
+    model = GPTModel(GPTConfig(vocab_size=len(vocab), ctx_len=64, emb_dim=64, n_layers=2, n_heads=4,
+                               drop_prob=0.0))
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    nn.functional.cross_entropy(model(old_ids[:, :-1]).flatten(0, 1), old_ids[0, 1:]).backward()
+    optimizer.step()
+    model.eval()
+    with torch.no_grad():
+        before = model(old_ids[:, :-1])
+
+    # 后半篇：追加新单词，扩大模型
+    old_vocab = dict(vocab)
+    new_words = extend_vocab(vocab, new_tokens)
+    resize_token_embeddings(model, len(vocab), optimizer)
+    print(f"词汇表 {len(old_vocab)} -> {len(vocab)}（新增 {len(new_words)} 个，例如 {new_words[:3]}）")
+    print(f"tok_emb {tuple(model.tok_emb.weight.shape)}，out_head {tuple(model.out_head.weight.shape)}，"
+          f"AdamW exp_avg {tuple(optimizer.state[model.out_head.weight]['exp_avg'].shape)}")
+
+    with torch.no_grad():
+        after = model(old_ids[:, :-1])
+    stable = all(vocab[t] == i for t, i in old_vocab.items())
+    same = torch.equal(before, after[..., :len(old_vocab)])
+    print(f"{'✅' if stable else '❌'} 已有 token 的 id 不变，前半篇的编码结果无需重新计算")
+    print(f"{'✅' if same else '❌'} 已有 token 的 logits 与扩展前完全一致")
+
+    # 扩展后可以继续训练（优化器不需要重建）
+    model.train()
+    new_ids = torch.tensor([vocab[t] for t in new_tokens[:65]]).unsqueeze(0)
+    loss = nn.functional.cross_entropy(model(new_ids[:, :-1]).flatten(0, 1), new_ids[0, 1:])
+    loss.backward()
+    optimizer.step()
+    print(f"✅ 在后半篇上继续训练一步，损失 {loss.item():.3f}")
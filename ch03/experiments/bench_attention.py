@@ -0,0 +1,80 @@
+"""
+实验：多头因果注意力的 CPU 性能基准
+
+比较三种实现在不同序列长度下的前向耗时和内存峰值：
+    - naive：逐头计算，每次前向重新构造掩码（参考实现）
+    - fused：融合 QKV 投影 + 缓存掩码，仍显式计算 T×T 注意力矩阵
+    - sdpa：融合 QKV 投影 + scaled_dot_product_attention 融合内核
+
+运行方式：
+    python ch03/experiments/bench_attention.py
+    python ch03/experiments/bench_attention.py --seq-lens 256 1024 4096 --batch-size 1
+"""
+
+import argparse
+import os
+import statistics
+import sys
+
+import torch
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch03.main.attention import MultiHeadAttention, NaiveMultiHeadAttention
+from setup.benchmark import measure_peak_memory_mb, time_fn
+
+# GPT-2 small 的注意力配置
+EMB_DIM = 768
+NUM_HEADS = 12
+
+
+def build_attention(impl: str, context_length: int) -> torch.nn.Module:
+    """按名称构造注意力模块（eval 模式，关闭 dropout）"""
+    if impl == "naive":
+        module = NaiveMultiHeadAttention(EMB_DIM, EMB_DIM, context_length, 0.0, NUM_HEADS)
+    else:
+        module = MultiHeadAttention(EMB_DIM, EMB_DIM, context_length, 0.0, NUM_HEADS,
+                                    use_sdpa=(impl == "sdpa"))
+    return module.eval()
+
+
+def run_forward(impl: str, batch_size: int, seq_len: int) -> None:
+    """在子进程中执行一次前向，用于测量内存峰值（必须是顶层函数才能被 pickle）"""
+    torch.manual_seed(0)
+    module = build_attention(impl, seq_len)
+    x = torch.randn(batch_size, seq_len, EMB_DIM)
+    with torch.inference_mode():
+        module(x)
+
+
+def main():
+    """对每个序列长度和实现测量前向的中位耗时和内存峰值增量（独立子进程），打印对比表"""
+    parser = argparse.ArgumentParser(description="多头因果注意力 CPU 基准")
+    parser.add_argument("--seq-lens", type=int, nargs="+", default=[128, 256, 512, 1024, 2048])
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--impls", nargs="+", default=["naive", "fused", "sdpa"])
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    cpu = torch.device("cpu")
+    print(f"batch_size={args.batch_size}, emb_dim={EMB_DIM}, num_heads={NUM_HEADS}, "
+          f"threads={torch.get_num_threads()}")
+    print(f"{'实现':<8} {'序列长度':>8} {'中位耗时(ms)':>13} {'内存峰值增量(MB)':>17}")
+    print("-" * 52)
+
+    for seq_len in args.seq_lens:
+        x = torch.randn(args.batch_size, seq_len, EMB_DIM)
+        for impl in args.impls:
+            module = build_attention(impl, seq_len)
+            with torch.inference_mode():
+                samples = time_fn(lambda: module(x), cpu, warmup=2, repeats=args.repeats)
+            median_ms = statistics.median(samples) / 1e6
+            peak_mb = measure_peak_memory_mb(run_forward, impl, args.batch_size, seq_len)
+            print(f"{impl:<8} {seq_len:>8} {median_ms:>13.2f} {peak_mb:>17.1f}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+实验：长上下文下的注意力内存和耗时
+
+在 1k~16k 的序列长度上比较四种因果注意力：
+    - dense：显式构造 T×T 分数矩阵（内存 O(T^2)）
+    - sdpa：F.scaled_dot_product_attention 融合内核
+    - chunked：分块注意力 + 在线 softmax（内存 O(T)）
+    - window：分块注意力 + 滑动窗口（计算量 O(T × window)）
+
+内存峰值在独立子进程中测量（包括输入张量），dense 在超过 --dense-max-len 时跳过，
+否则单个分数矩阵就会占用数 GB 内存。--backward 同时测量反向传播（训练场景）。
+
+运行方式：
+    python ch03/experiments/bench_long_context.py
+    python ch03/experiments/bench_long_context.py --seq-lens 4096 8192 16384 --backward
+"""
+
+import argparse
+import os
+import statistics
+import sys
+
+import torch
+import torch.nn.functional as F
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch03.main.chunked_attention import chunked_causal_attention, dense_causal_attention
+from setup.benchmark import measure_peak_memory_mb, time_fn
+
+# GPT-2 small 的注意力配置：12 个头，每个头 64 维
+NUM_HEADS = 12
+HEAD_DIM = 64
+
+
+def attention_fn(impl: str, chunk_size: int, window: int):
+    """按名称返回注意力函数 f(q, k, v)"""
+    if impl == "dense":
+        return dense_causal_attention
+    if impl == "sdpa":
+        return lambda q, k, v: F.scaled_dot_product_attention(q, k, v, is_causal=True)
+    if impl == "chunked":
+        return lambda q, k, v: chunked_causal_attention(q, k, v, chunk_size)
+    return lambda q, k, v: chunked_causal_attention(q, k, v, chunk_size, window=window)
+
+
+def make_inputs(seq_len: int, backward: bool):
+    """
+    固定种子的 Q、K、V
+
+    参数:
+        seq_len (int): 序列长度
+        backward (bool): 是否需要梯度
+
+    返回:
+        list[Tensor]: 三个 (1, NUM_HEADS, seq_len, HEAD_DIM) 的张量
+    """
+    torch.manual_seed(0)
+    return [torch.randn(1, NUM_HEADS, seq_len, HEAD_DIM, requires_grad=backward) for _ in range(3)]
+
+
+def run_once(impl: str, seq_len: int, chunk_size: int, window: int, backward: bool) -> None:
+    """在子进程中执行一次注意力（可选反向），用于测量内存峰值"""
+    q, k, v = make_inputs(seq_len, backward)
+    fn = attention_fn(impl, chunk_size, window)
+    if backward:
+        fn(q, k, v).sum().backward()
+    else:
+        with torch.inference_mode():
+            fn(q, k, v)
+
+
+def main():
+    """对每个序列长度和实现测量中位耗时、内存峰值增量（独立子进程）以及与 dense 的误差"""
+    parser = argparse.ArgumentParser(description="长上下文注意力的内存和耗时")
+    parser.add_argument("--seq-lens", type=int, nargs="+", default=[1024, 2048, 4096, 8192, 16384])
+    parser.add_argument("--impls", nargs="+", default=["dense", "sdpa", "chunked", "window"])
+    parser.add_argument("--chunk-size", type=int, default=512)
+    parser.add_argument("--window", type=int, default=1024)
+    parser.add_argument("--dense-max-len", type=int, default=4096, help="dense 只测到这个长度")
+    parser.add_argument("--backward", action="store_true", help="同时执行反向传播")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    cpu = torch.device("cpu")
+    print(f"heads={NUM_HEADS}, head_dim={HEAD_DIM}, chunk_size={args.chunk_size}, "
+          f"window={args.window}, backward={args.backward}, threads={torch.get_num_threads()}")
+    print(f"{'实现':<8} {'序列长度':>8} {'中位耗时(ms)':>13} {'内存峰值增量(MB)':>17} {'与 dense 误差':>13}")
+    print("-" * 66)
+
+    for seq_len in args.seq_lens:
+        reference = {}
+        for impl in args.impls:
+            if impl == "dense" and seq_len > args.dense_max_len:
+                continue
+            fn = attention_fn(impl, args.chunk_size, args.window)
+            q, k, v = make_inputs(seq_len, args.backward)
+
+            def step():
+                """执行一次注意力；--backward 时连同反向传播一起计时"""
+                if args.backward:
+                    fn(q, k, v).sum().backward()
+                else:
+                    with torch.inference_mode():
+                        return fn(q, k, v)
+
+            median_ms = statistics.median(time_fn(step, cpu, warmup=1, repeats=args.repeats)) / 1e6
+            peak_mb = measure_peak_memory_mb(run_once, impl, seq_len, args.chunk_size, args.window,
+                                             args.backward)
+
+            # 数值对比：window 的参考是带同样窗口的 dense
+            error = "-"
+            if seq_len <= args.dense_max_len:
+                with torch.inference_mode():
+                    out = fn(q, k, v)
+                    window = args.window if impl == "window" else None
+                    if window not in reference:
+                        reference[window] = dense_causal_attention(q, k, v, window=window)
+                    error = f"{(out - reference[window]).abs().max().item():.1e}"
+            print(f"{impl:<8} {seq_len:>8} {median_ms:>13.1f} {peak_mb:>17.1f} {error:>13}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
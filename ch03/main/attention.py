@@ -0,0 +1,316 @@
+"""
+第3章：多头因果注意力（Multi-Head Causal Attention）
+
+这个模块实现 GPT 的核心计算——带因果掩码的多头自注意力，并提供两个版本：
+    - NaiveMultiHeadAttention：按书中的思路逐个头计算，作为数值正确性的参考实现
+    - MultiHeadAttention：面向训练和推理的高效实现
+
+核心概念：
+    - Query / Key / Value：Query 表示"我在找什么"，Key 表示"我有什么"，Value 是实际内容
+    - 缩放点积注意力：softmax(Q K^T / sqrt(d_k)) V
+    - 因果掩码（causal mask）：第 t 个 token 只能看到位置 <= t 的 token，
+      保证训练时不会"偷看"答案
+    - 多头：把 d_out 维拆成 n_heads 个子空间，每个头独立计算注意力，最后拼接
+
+高效实现相对参考实现的三点优化：
+    1. QKV 融合投影：一次 (d_in -> 3*d_out) 的矩阵乘法，代替 3*n_heads 次小矩阵乘法
+    2. 缓存因果掩码：掩码在构造时创建一次并注册为 buffer，不再每次前向都重新生成 triu
+    3. scaled_dot_product_attention 快速路径：PyTorch 内置的融合内核，
+       不必显式保存完整的 T×T 注意力权重
+
+长上下文（4k~16k）时可以设置 chunk_size / window，改用分块注意力
+（见 chunked_attention.py），内存随序列长度线性增长。
+
+依赖：
+    - torch: PyTorch 深度学习框架（scaled_dot_product_attention 需要 2.0+）
+"""
+
+import math
+import os
+import sys
+from typing import Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch03.main.chunked_attention import chunked_causal_attention
+
+
+class CausalAttention(nn.Module):
+    """
+    单头因果自注意力（书中 3.5 节的写法）
+
+    每个头有自己独立的 Q/K/V 投影，每次前向重新构造上三角掩码。
+    逻辑最直观，但效率低，只作为参考实现的组成部分。
+    """
+
+    def __init__(self, d_in: int, d_out: int, dropout: float, qkv_bias: bool = False):
+        """
+        初始化单头注意力
+
+        参数:
+            d_in (int): 输入维度
+            d_out (int): 这个头的输出维度（即 head_dim）
+            dropout (float): 注意力权重上的 dropout 概率
+            qkv_bias (bool): Q/K/V 投影是否使用偏置
+        """
+        super().__init__()
+        self.W_query = nn.Linear(d_in, d_out, bias=qkv_bias)
+        self.W_key = nn.Linear(d_in, d_out, bias=qkv_bias)
+        self.W_value = nn.Linear(d_in, d_out, bias=qkv_bias)
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        参数:
+            x (Tensor): 形状 (batch_size, num_tokens, d_in)
+
+        返回:
+            Tensor: 形状 (batch_size, num_tokens, d_out)
+        """
+        num_tokens = x.shape[1]
+
+        queries = self.W_query(x)  # (b, T, d_out)
+        keys = self.W_key(x)
+        values = self.W_value(x)
+
+        # 注意力分数：每个 query 与所有 key 的点积
+        attn_scores = queries @ keys.transpose(1, 2)  # (b, T, T)
+
+        # 每次前向都新建一个上三角掩码：对角线以上（未来位置）为 True
+        mask = torch.triu(torch.ones(num_tokens, num_tokens, device=x.device), diagonal=1).bool()
+        attn_scores = attn_scores.masked_fill(mask, -torch.inf)
+
+        # 除以 sqrt(d_k) 防止点积过大，softmax 进入饱和区导致梯度消失
+        attn_weights = torch.softmax(attn_scores / math.sqrt(keys.shape[-1]), dim=-1)
+        attn_weights = self.dropout(attn_weights)
+
+        return attn_weights @ values
+
+
+class NaiveMultiHeadAttention(nn.Module):
+    """
+    参考实现：n_heads 个独立的 CausalAttention 拼接后再做输出投影
+
+    用途：
+        - 作为 MultiHeadAttention 的数值等价性参考（见 copy_weights_from_naive）
+        - 作为性能基准中的对照组
+    """
+
+    def __init__(self, d_in: int, d_out: int, context_length: int, dropout: float,
+                 num_heads: int, qkv_bias: bool = False):
+        """
+        参数:
+            d_in (int): 输入维度
+            d_out (int): 输出维度，必须能被 num_heads 整除
+            context_length (int): 最大序列长度（参考实现不需要，保留以与高效实现保持相同签名）
+            dropout (float): dropout 概率
+            num_heads (int): 注意力头数
+            qkv_bias (bool): Q/K/V 投影是否使用偏置
+        """
+        super().__init__()
+        assert d_out % num_heads == 0, "d_out 必须能被 num_heads 整除"
+        head_dim = d_out // num_heads
+        self.heads = nn.ModuleList(
+            [CausalAttention(d_in, head_dim, dropout, qkv_bias) for _ in range(num_heads)]
+        )
+        self.out_proj = nn.Linear(d_out, d_out)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        参数:
+            x (Tensor): 形状 (batch_size, num_tokens, d_in)
+
+        返回:
+            Tensor: 形状 (batch_size, num_tokens, d_out)
+        """
+        # 逐个头计算后在最后一维拼接：(b, T, head_dim) * n_heads -> (b, T, d_out)
+        context = torch.cat([head(x) for head in self.heads], dim=-1)
+        return self.out_proj(context)
+
+
+class MultiHeadAttention(nn.Module):
+    """
+    高效的多头因果自注意力
+
+    属性:
+        W_qkv: 融合的 Q/K/V 投影，d_in -> 3 * d_out
+        out_proj: 输出投影，d_out -> d_out
+        mask: 缓存的因果掩码 buffer，形状 (context_length, context_length)
+        use_sdpa: 是否使用 F.scaled_dot_product_attention 快速路径
+        chunk_size: 分块注意力的块大小，None 表示不分块
+        window: 滑动窗口大小，None 表示看到全部历史
+
+    方法:
+        forward: 计算多头因果注意力
+    """
+
+    def __init__(self, d_in: int, d_out: int, context_length: int, dropout: float,
+                 num_heads: int, qkv_bias: bool = False, use_sdpa: bool = True,
+                 chunk_size: Optional[int] = None, window: Optional[int] = None):
+        """
+        参数:
+            d_in (int): 输入维度
+            d_out (int): 输出维度，必须能被 num_heads 整除
+            context_length (int): 最大序列长度，决定缓存掩码的大小
+            dropout (float): 注意力权重上的 dropout 概率
+            num_heads (int): 注意力头数
+            qkv_bias (bool): Q/K/V 投影是否使用偏置
+            use_sdpa (bool): 是否使用 PyTorch 内置的融合注意力内核
+            chunk_size (int): 设置后使用分块注意力（在线 softmax），不构造 T×T 分数矩阵
+            window (int): 滑动窗口大小（包括自身）；设置后也走分块注意力，
+                          未设置 chunk_size 时块大小取 min(window, 512)
+        """
+        super().__init__()
+        assert d_out % num_heads == 0, "d_out 必须能被 num_heads 整除"
+
+        self.d_out = d_out
+        self.num_heads = num_heads
+        self.head_dim = d_out // num_heads
+        self.dropout_p = dropout
+        self.use_sdpa = use_sdpa
+        self.window = window
+        if window is not None and chunk_size is None:
+            chunk_size = min(window, 512)
+        self.chunk_size = chunk_size
+
+        # 一次矩阵乘法同时算出 Q、K、V：输出的前 d_out 维是 Q，中间是 K，最后是 V
+        self.W_qkv = nn.Linear(d_in, 3 * d_out, bias=qkv_bias)
+        self.out_proj = nn.Linear(d_out, d_out)
+        self.dropout = nn.Dropout(dropout)
+
+        # 因果掩码只创建一次；注册为 buffer 会随 model.to(device) 一起移动，
+        # persistent=False 表示不写入 state_dict（它可以随时重新生成）
+        # 分块模式用不到它，而且 16k 上下文时它本身就要 256MB，所以不创建
+        mask = None
+        if chunk_size is None:
+            mask = torch.triu(torch.ones(context_length, context_length, dtype=torch.bool), diagonal=1)
+        self.register_buffer("mask", mask, persistent=False)
+
+    def forward(self, x: torch.Tensor, kv_cache=None) -> torch.Tensor:
+        """
+        参数:
+            x (Tensor): 形状 (batch_size, num_tokens, d_in)
+            kv_cache: 可选，这一层的 KV 缓存视图（见 ch04/main/kv_cache.py）。
+                      提供时只需输入新 token：新的 K/V 写入缓存，
+                      注意力在"缓存中的历史 + 新 token"上计算
+
+        返回:
+            Tensor: 形状 (batch_size, num_tokens, d_out)
+        """
+        b, num_tokens, _ = x.shape
+
+        # Step 1: 融合投影后拆成 Q、K、V
+        # (b, T, 3*d_out) -> (b, T, 3, H, head_dim) -> (3, b, H, T, head_dim)
+        qkv = self.W_qkv(x).view(b, num_tokens, 3, self.num_heads, self.head_dim)
+        queries, keys, values = qkv.permute(2, 0, 3, 1, 4)
+
+        # Step 2: 缩放点积注意力
+        if kv_cache is None:
+            context = self._attend(queries, keys, values)  # (b, H, T, head_dim)
+        else:
+            # 缓存返回全部历史 K/V 以及哪些位置可以被看到（True 表示可见）
+            # 滑动窗口交给缓存一起写进掩码（缓存知道每个 query 所在的槽位）
+            keys, values, attn_mask = kv_cache.update(keys, values, window=self.window)
+            context = self._attend(queries, keys, values, attn_mask=attn_mask)
+
+        # Step 3: 合并多个头：(b, H, T, head_dim) -> (b, T, H, head_dim) -> (b, T, d_out)
+        context = context.transpose(1, 2).reshape(b, num_tokens, self.d_out)
+        return self.out_proj(context)
+
+    def _attend(self, queries: torch.Tensor, keys: torch.Tensor, values: torch.Tensor,
+                attn_mask=None) -> torch.Tensor:
+        """
+        带因果掩码的缩放点积注意力
+
+        参数:
+            queries (Tensor): 形状 (b, H, T_q, head_dim)
+            keys, values (Tensor): 形状 (b, H, T_k, head_dim)；没有 KV 缓存时 T_k == T_q
+            attn_mask (Tensor): 可选的布尔掩码，形状可广播到 (b, H, T_q, T_k)，True 表示可见。
+                                None 表示使用标准因果掩码（缓存场景下 None 表示全部可见）
+
+        返回:
+            Tensor: 形状 (b, H, T_q, head_dim)
+        """
+        num_queries, num_keys = queries.shape[-2], keys.shape[-2]
+        dropout_p = self.dropout_p if self.training else 0.0
+
+        if self.chunk_size is not None:
+            if attn_mask is None:
+                # 没有缓存或缓存各行长度相同：query 对应最后 T_q 个位置
+                return chunked_causal_attention(queries, keys, values, self.chunk_size,
+                                                window=self.window, dropout_p=dropout_p)
+            # 各行长度不同或有左填充：缓存给出的掩码已经包含因果、填充和滑动窗口，走下面的掩码路径
+
+        # 只有 query 和 key 一一对齐（没有缓存的历史）时才套用标准因果掩码
+        causal = attn_mask is None and num_queries == num_keys
+
+        if self.use_sdpa:
+            # 融合内核：内部完成缩放、掩码、softmax、dropout 和加权求和
+            # dropout 只在训练时生效
+            return F.scaled_dot_product_attention(
+                queries, keys, values,
+                attn_mask=attn_mask,
+                dropout_p=dropout_p,
+                is_causal=causal,
+            )
+
+        attn_scores = queries @ keys.transpose(2, 3)  # (b, H, T_q, T_k)
+        if causal:
+            # 直接切片使用缓存的掩码，不再每次创建
+            attn_scores = attn_scores.masked_fill(self.mask[:num_queries, :num_keys], -torch.inf)
+        elif attn_mask is not None:
+            attn_scores = attn_scores.masked_fill(~attn_mask, -torch.inf)
+        # softmax 在 fp32 下计算（bf16 输入时避免求和的舍入误差），权重再转回 values 的类型
+        attn_weights = torch.softmax(attn_scores / math.sqrt(self.head_dim), dim=-1,
+                                     dtype=torch.float32).to(values.dtype)
+        attn_weights = self.dropout(attn_weights)
+        return attn_weights @ values
+
+
+@torch.no_grad()
+def copy_weights_from_naive(fused: MultiHeadAttention, naive: NaiveMultiHeadAttention) -> None:
+    """
+    把参考实现的权重拷贝到高效实现中，用于数值等价性测试
+
+    参数:
+        fused: 目标 MultiHeadAttention
+        naive: 源 NaiveMultiHeadAttention（头数、维度需一致）
+
+    说明:
+        W_qkv 的输出维度排列是 [Q(头0..头H-1), K(头0..头H-1), V(头0..头H-1)]，
+        所以按 Q/K/V 分别把每个头的权重在输出维度（第 0 维）上依次拼接
+    """
+    for i, name in enumerate(["W_query", "W_key", "W_value"]):
+        rows = slice(i * fused.d_out, (i + 1) * fused.d_out)
+        fused.W_qkv.weight[rows] = torch.cat([getattr(h, name).weight for h in naive.heads], dim=0)
+        if fused.W_qkv.bias is not None:
+            fused.W_qkv.bias[rows] = torch.cat([getattr(h, name).bias for h in naive.heads], dim=0)
+    fused.out_proj.load_state_dict(naive.out_proj.state_dict())
+
+
+if __name__ == "__main__":
+    torch.manual_seed(123)
+
+    # GPT-2 small 的注意力配置
+    d_in = d_out = 768
+    context_length, num_heads = 1024, 12
+    x = torch.randn(2, 256, d_in)
+
+    naive = NaiveMultiHeadAttention(d_in, d_out, context_length, 0.0, num_heads, qkv_bias=True).eval()
+    reference = naive(x)
+
+    print("数值等价性检查（与逐头计算的参考实现比较）:")
+    for use_sdpa in (False, True):
+        fused = MultiHeadAttention(d_in, d_out, context_length, 0.0, num_heads,
+                                   qkv_bias=True, use_sdpa=use_sdpa).eval()
+        copy_weights_from_naive(fused, naive)
+        max_diff = (fused(x) - reference).abs().max().item()
+        name = "融合 QKV + SDPA" if use_sdpa else "融合 QKV + 缓存掩码"
+        status = "✅" if torch.allclose(fused(x), reference, atol=1e-5) else "❌"
+        print(f"  {status} {name}: 最大绝对误差 = {max_diff:.2e}")
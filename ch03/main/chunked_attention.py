@@ -0,0 +1,314 @@
+"""
+第3章扩展：分块因果注意力（Chunked Attention）与滑动窗口
+
+标准注意力要先算出完整的 T×T 分数矩阵再做 softmax。序列长度从 1024 增加到 16k 时，
+这个矩阵的大小增长 256 倍（GPT-2 small 的 12 个头、batch=1、fp32 下约 12GB），
+远远超过其余所有激活值的总和。
+
+分块注意力把 query 按块处理，每个 query 块再按块遍历 key，
+用在线 softmax（online softmax）逐块累积结果，任何时候只保存 块大小×块大小 的分数，
+完整的 T×T 矩阵从不出现，内存随序列长度线性增长。
+
+核心概念：
+    - 在线 softmax：维护每行到目前为止的最大值 m、指数和 l 以及加权和 acc，
+      遇到新的 key 块时用 exp(m_old - m_new) 修正之前的累积量，
+      最后 acc / l 与一次性计算 softmax(S) V 的结果完全相同（只差浮点舍入）
+    - 跳过被掩码的块：因果掩码下对角线右上方的 key 块整块不可见，直接不算，
+      计算量也只有稠密版本的一半左右
+    - 滑动窗口（sliding window）：每个 token 只看最近 window 个 token（包括自己），
+      窗口之外的 key 块同样整块跳过，计算量从 O(T^2) 变为 O(T × window)
+    - 训练时的内存：autograd 默认会保存每个块的中间结果，总量又回到 O(T^2)；
+      因此反向传播是手写的：前向只保存 Q/K/V、输出和每行的 logsumexp，
+      反向时逐块重新计算注意力权重（与 FlashAttention 的思路相同）
+    - bf16 输入：矩阵乘法用输入的类型，softmax 的统计量（最大值、指数和、logsumexp）
+      以及输出和梯度的累加器始终是 fp32，最后再转回输入的类型
+
+依赖：
+    - torch: PyTorch 深度学习框架
+"""
+
+import math
+from typing import Optional
+
+import torch
+
+# 默认块大小：分数块为 (batch, heads, 512, 512)，GPT-2 small 下约 12MB/batch
+DEFAULT_CHUNK_SIZE = 512
+
+
+def _accumulate_dtype(dtype: torch.dtype) -> torch.dtype:
+    """softmax 统计量和累加器的类型：bf16/fp16 升到 fp32，fp64 保持不变"""
+    return torch.promote_types(dtype, torch.float32)
+
+
+def _visible_block(q_start: int, q_end: int, k_start: int, k_end: int, window: Optional[int],
+                   device) -> Optional[torch.Tensor]:
+    """
+    一个 (query 块, key 块) 的不可见位置掩码；整块可见时返回 None
+
+    只有与对角线或窗口边界相交的块需要掩码
+    """
+    crosses_diagonal = k_end - 1 > q_start
+    crosses_window = window is not None and k_start <= q_end - 1 - window
+    if not (crosses_diagonal or crosses_window):
+        return None
+    q_pos = torch.arange(q_start, q_end, device=device)
+    k_pos = torch.arange(k_start, k_end, device=device)
+    hidden = k_pos[None, :] > q_pos[:, None]
+    if window is not None:
+        hidden |= k_pos[None, :] <= q_pos[:, None] - window
+    return hidden
+
+
+def _key_blocks(q_start: int, q_end: int, chunk_size: int, window: Optional[int]):
+    """一个 query 块需要遍历的 key 块：因果掩码右上方和窗口左侧的块整块跳过"""
+    k_lo = 0 if window is None else max(0, q_start - window + 1)
+    for k_start in range(k_lo, q_end, chunk_size):
+        yield k_start, min(k_start + chunk_size, q_end)
+
+
+def _dropout_keep(shape, dropout_p: float, seed: int, device) -> torch.Tensor:
+    """
+    按块生成 dropout 的保留掩码（已除以 1-p）
+
+    每个块用确定的种子，反向传播时可以重新生成完全相同的掩码，而不必保存它
+    """
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed)
+    keep = torch.rand(shape, generator=generator, device=device) >= dropout_p
+    return keep.to(torch.float32) / (1.0 - dropout_p)
+
+
+def _chunked_forward(queries: torch.Tensor, keys: torch.Tensor, values: torch.Tensor,
+                     chunk_size: int, window: Optional[int], dropout_p: float, seed: int):
+    """
+    分块前向：对每个 query 块用在线 softmax 遍历 key 块
+
+    返回:
+        tuple[Tensor, Tensor]: 输出 (b, H, T_q, head_dim)，
+                               以及每行的 logsumexp (b, H, T_q, 1)（反向传播时用来直接重建 softmax）
+    """
+    *batch_dims, num_queries, head_dim = queries.shape
+    num_keys = keys.shape[-2]
+    offset = num_keys - num_queries  # 第一个 query 的绝对位置
+    scale = 1.0 / math.sqrt(head_dim)
+    n_key_blocks = math.ceil(num_keys / chunk_size)
+
+    out = torch.empty_like(queries)
+    acc_dtype = _accumulate_dtype(queries.dtype)
+    lse = queries.new_empty((*batch_dims, num_queries, 1), dtype=acc_dtype)
+    for q_index, q_lo in enumerate(range(0, num_queries, chunk_size)):
+        q_block = queries[..., q_lo:q_lo + chunk_size, :]
+        q_start = offset + q_lo
+        q_end = q_start + q_block.shape[-2]  # 不含
+
+        # 累积量：行最大值、指数和、加权和
+        row_max = q_block.new_full((*batch_dims, q_block.shape[-2], 1), float("-inf"),
+                                   dtype=acc_dtype)
+        row_sum = torch.zeros_like(row_max)
+        acc = torch.zeros_like(q_block, dtype=acc_dtype)
+
+        for k_start, k_end in _key_blocks(q_start, q_end, chunk_size, window):
+            # 分数块原地修改，每个块只占用一份 块大小×块大小 的内存（fp32 输入时 .to 不复制）
+            scores = torch.matmul(q_block, keys[..., k_start:k_end, :].transpose(-1, -2)).to(acc_dtype).mul_(scale)
+            hidden = _visible_block(q_start, q_end, k_start, k_end, window, queries.device)
+            if hidden is not None:
+                scores.masked_fill_(hidden, float("-inf"))
+
+            # 在线 softmax：新的最大值，以及对旧累积量的修正系数
+            new_max = torch.maximum(row_max, scores.amax(dim=-1, keepdim=True))
+            # 某一行在这个块里完全不可见且之前也没有可见 key 时，最大值仍是 -inf，
+            # 用 0 代替避免 (-inf) - (-inf) = nan；这些位置的 exp 结果本来就是 0
+            safe_max = torch.where(torch.isinf(new_max), torch.zeros_like(new_max), new_max)
+            probs = scores.sub_(safe_max).exp_()
+            correction = torch.exp(row_max - safe_max)
+
+            row_sum = row_sum * correction + probs.sum(dim=-1, keepdim=True)
+            if dropout_p > 0.0:
+                # dropout 是逐元素缩放，作用在未归一化的权重上与作用在归一化后的权重上等价
+                block_seed = seed + q_index * n_key_blocks + k_start // chunk_size
+                probs.mul_(_dropout_keep(probs.shape, dropout_p, block_seed, queries.device))
+            acc = acc * correction + (probs.to(values.dtype) @ values[..., k_start:k_end, :]).to(acc_dtype)
+            row_max = new_max
+
+        out[..., q_lo:q_lo + chunk_size, :] = acc / row_sum
+        lse[..., q_lo:q_lo + chunk_size, :] = row_max + torch.log(row_sum)
+    return out, lse
+
+
+class _ChunkedCausalAttention(torch.autograd.Function):
+    """
+    分块注意力的自定义反向传播
+
+    如果直接让 autograd 记录分块前向，每个分数块都会被保存，总量又回到 O(T^2)。
+    这里前向只保存 Q、K、V、输出和每行的 logsumexp；反向时逐块重新计算
+    P = exp(S - logsumexp)，再按 softmax 的梯度公式累积 dQ、dK、dV：
+        dV += P^T dO
+        dP  = dO V^T
+        dS  = P * (dP - rowsum(dO * O))
+        dQ += dS K / sqrt(d)，dK += dS^T Q / sqrt(d)
+    """
+
+    @staticmethod
+    def forward(ctx, queries, keys, values, chunk_size, window, dropout_p):
+        """
+        分块前向，只保存反向需要的 Q、K、V、输出和 logsumexp
+
+        参数:
+            ctx: autograd 上下文
+            queries, keys, values (Tensor): 同 chunked_causal_attention
+            chunk_size, window, dropout_p: 同 chunked_causal_attention
+
+        返回:
+            Tensor: 注意力输出 (b, H, T_q, head_dim)
+
+        注意:
+            - dropout 的基础种子保存在 ctx.config 中，反向时按同样的公式得到每个块的种子，重新生成相同的掩码
+        """
+        # dropout 掩码的基础种子取自全局随机数生成器，torch.manual_seed 之后结果可复现
+        seed = int(torch.randint(0, 2 ** 31 - 1, (1,))) if dropout_p > 0.0 else 0
+        out, lse = _chunked_forward(queries, keys, values, chunk_size, window, dropout_p, seed)
+        ctx.save_for_backward(queries, keys, values, out, lse)
+        ctx.config = (chunk_size, window, dropout_p, seed)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        """
+        逐块重新计算注意力权重，累积 dQ、dK、dV（公式见类的说明）
+
+        参数:
+            ctx: autograd 上下文
+            grad_out (Tensor): 输出的梯度 (b, H, T_q, head_dim)
+
+        返回:
+            tuple: (dQ, dK, dV, None, None, None)；后三个对应不需要梯度的 chunk_size、window、dropout_p
+
+        注意:
+            - 与前向遍历完全相同的 (query 块, key 块) 组合，dropout 掩码由相同的块种子重新生成
+        """
+        queries, keys, values, out, lse = ctx.saved_tensors
+        chunk_size, window, dropout_p, seed = ctx.config
+        num_queries, num_keys = queries.shape[-2], keys.shape[-2]
+        offset = num_keys - num_queries
+        scale = 1.0 / math.sqrt(queries.shape[-1])
+        n_key_blocks = math.ceil(num_keys / chunk_size)
+
+        dtype = values.dtype
+        acc_dtype = _accumulate_dtype(dtype)
+        grad_q = torch.zeros_like(queries, dtype=acc_dtype)
+        grad_k = torch.zeros_like(keys, dtype=acc_dtype)
+        grad_v = torch.zeros_like(values, dtype=acc_dtype)
+        # rowsum(dO * O)：softmax 梯度公式中的 sum_j P_ij dP_ij
+        delta = (grad_out.to(acc_dtype) * out.to(acc_dtype)).sum(dim=-1, keepdim=True)
+
+        for q_index, q_lo in enumerate(range(0, num_queries, chunk_size)):
+            q_rows = slice(q_lo, q_lo + chunk_size)
+            q_block, d_out = queries[..., q_rows, :], grad_out[..., q_rows, :].to(dtype)
+            q_start = offset + q_lo
+            q_end = q_start + q_block.shape[-2]
+
+            for k_start, k_end in _key_blocks(q_start, q_end, chunk_size, window):
+                k_rows = slice(k_start, k_end)
+                k_block, v_block = keys[..., k_rows, :], values[..., k_rows, :]
+
+                scores = torch.matmul(q_block, k_block.transpose(-1, -2)).to(acc_dtype).mul_(scale)
+                hidden = _visible_block(q_start, q_end, k_start, k_end, window, queries.device)
+                if hidden is not None:
+                    scores.masked_fill_(hidden, float("-inf"))
+                probs = scores.sub_(lse[..., q_rows, :]).exp_()  # 归一化后的注意力权重
+
+                d_probs = (d_out @ v_block.transpose(-1, -2)).to(acc_dtype)
+                if dropout_p > 0.0:
+                    block_seed = seed + q_index * n_key_blocks + k_start // chunk_size
+                    keep = _dropout_keep(probs.shape, dropout_p, block_seed, queries.device)
+                    grad_v[..., k_rows, :] += ((probs * keep).to(dtype).transpose(-1, -2) @ d_out).to(acc_dtype)
+                    d_probs.mul_(keep)
+                else:
+                    grad_v[..., k_rows, :] += (probs.to(dtype).transpose(-1, -2) @ d_out).to(acc_dtype)
+
+                d_scores = probs.mul_(d_probs.sub_(delta[..., q_rows, :])).mul_(scale).to(dtype)
+                grad_q[..., q_rows, :] += (d_scores @ k_block).to(acc_dtype)
+                grad_k[..., k_rows, :] += (d_scores.transpose(-1, -2) @ q_block).to(acc_dtype)
+
+        return (grad_q.to(queries.dtype), grad_k.to(keys.dtype), grad_v.to(dtype),
+                None, None, None)
+
+
+def chunked_causal_attention(queries: torch.Tensor, keys: torch.Tensor, values: torch.Tensor,
+                             chunk_size: int = DEFAULT_CHUNK_SIZE, window: Optional[int] = None,
+                             dropout_p: float = 0.0) -> torch.Tensor:
+    """
+    分块因果注意力（可选滑动窗口），不构造完整的 T×T 分数矩阵
+
+    参数:
+        queries (Tensor): (b, H, T_q, head_dim)
+        keys, values (Tensor): (b, H, T_k, head_dim)，T_k >= T_q。
+                               T_k > T_q 时（例如使用 KV 缓存），query 对应最后 T_q 个位置
+        chunk_size (int): query 块和 key 块的大小
+        window (int): 滑动窗口大小（包括自身），None 表示标准因果注意力
+        dropout_p (float): 注意力权重上的 dropout 概率，调用方负责只在训练时传入非 0 值
+
+    返回:
+        Tensor: (b, H, T_q, head_dim)
+
+    示例:
+        >>> q = k = v = torch.randn(1, 12, 4096, 64)
+        >>> out = chunked_causal_attention(q, k, v, chunk_size=512, window=1024)
+
+    注意:
+        - 反向传播逐块重新计算注意力权重，用计算换内存
+        - dropout 掩码按块由种子重新生成，不需要保存
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size 必须是正整数")
+    if window is not None and window < 1:
+        raise ValueError("window 必须是正整数")
+    num_queries, num_keys = queries.shape[-2], keys.shape[-2]
+    if num_keys < num_queries:
+        raise ValueError(f"key 数量 {num_keys} 少于 query 数量 {num_queries}")
+
+    if torch.is_grad_enabled() and any(t.requires_grad for t in (queries, keys, values)):
+        return _ChunkedCausalAttention.apply(queries, keys, values, chunk_size, window, dropout_p)
+    seed = int(torch.randint(0, 2 ** 31 - 1, (1,))) if dropout_p > 0.0 else 0
+    return _chunked_forward(queries, keys, values, chunk_size, window, dropout_p, seed)[0]
+
+
+def dense_causal_attention(queries: torch.Tensor, keys: torch.Tensor, values: torch.Tensor,
+                           window: Optional[int] = None) -> torch.Tensor:
+    """
+    稠密参考实现：显式构造 T_q×T_k 的分数矩阵（用于数值对比）
+
+    参数与 chunked_causal_attention 相同（不支持 dropout）
+    """
+    num_queries, num_keys = queries.shape[-2], keys.shape[-2]
+    q_pos = torch.arange(num_keys - num_queries, num_keys, device=queries.device)
+    k_pos = torch.arange(num_keys, device=queries.device)
+    visible = k_pos[None, :] <= q_pos[:, None]
+    if window is not None:
+        visible &= k_pos[None, :] > q_pos[:, None] - window
+    scores = (queries @ keys.transpose(-1, -2)) / math.sqrt(queries.shape[-1])
+    weights = torch.softmax(scores.masked_fill(~visible, float("-inf")), dim=-1,
+                            dtype=_accumulate_dtype(values.dtype))
+    return weights.to(values.dtype) @ values
+
+
+if __name__ == "__main__":
+    torch.manual_seed(123)
+    q, k, v = (torch.randn(2, 4, 1000, 64) for _ in range(3))
+
+    print("与稠密注意力的数值对比:")
+    for window in (None, 128):
+        expected = dense_causal_attention(q, k, v, window=window)
+        actual = chunked_causal_attention(q, k, v, chunk_size=256, window=window)
+        max_diff = (actual - expected).abs().max().item()
+        status = "✅" if torch.allclose(actual, expected, atol=1e-5) else "❌"
+        print(f"  {status} window={window}: 最大绝对误差 = {max_diff:.2e}")
+
+    # 梯度也应一致（需要梯度时走自定义的 autograd Function：反向逐块重算注意力权重，不保存完整的权重矩阵）
+    qg, kg, vg = (t.clone().requires_grad_() for t in (q, k, v))
+    chunked_causal_attention(qg, kg, vg, chunk_size=256).sum().backward()
+    qd, kd, vd = (t.clone().requires_grad_() for t in (q, k, v))
+    dense_causal_attention(qd, kd, vd).sum().backward()
+    grad_ok = all(torch.allclose(a.grad, b.grad, atol=1e-4) for a, b in ((qg, qd), (kg, kd), (vg, vd)))
+    print(f"  {'✅' if grad_ok else '❌'} 梯度与稠密注意力一致")
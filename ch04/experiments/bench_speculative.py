@@ -0,0 +1,106 @@
+"""
+实验：投机解码在 CPU 上的加速效果
+
+比较普通逐 token 解码（sample_with_cache）和投机解码（speculative_generate）
+在贪心和采样两种模式下的耗时，并报告不同草稿长度 k 的接受率。
+
+关于模型：
+    随机初始化的大模型和草稿模型几乎不会给出相同的预测，接受率接近 0，
+    测不出投机解码的收益。没有提供 --checkpoint 时，本实验把大模型中
+    草稿之外的那些层的输出投影缩小（--residual-scale），模拟"草稿模型和大模型
+    大多数时候预测一致"的情形（相当于训练/蒸馏得比较好的草稿模型）。
+    加载真实权重时请用 --checkpoint，草稿模型取大模型的前 --draft-layers 层。
+
+关于草稿长度：
+    投机解码的前提是"验证 k+1 个 token 和生成 1 个 token 的成本差不多"。
+    CPU 核数很少时矩阵乘法接近计算瓶颈，k+1 较大时验证成本明显上升
+    （单核上输出头从 3 行到 4 行耗时几乎翻倍），这时较小的 k 反而更快；
+    另外草稿模型同样要算完整词表的输出头，这部分成本不随层数减少。
+
+运行方式：
+    python ch04/experiments/bench_speculative.py
+    python ch04/experiments/bench_speculative.py --draft-len 2 4 8 --new-tokens 128 --draft-layers 2
+    python ch04/experiments/bench_speculative.py --checkpoint gpt2.pth --draft-layers 2
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch04.main.gpt_model import GPTConfig, GPTModel
+from ch04.main.speculative import make_layer_skip_draft, sample_with_cache, speculative_generate
+
+
+def timed(fn):
+    """执行 fn 并返回 (结果, 耗时秒)"""
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+@torch.no_grad()
+def shrink_extra_layers(model: GPTModel, keep: int, scale: float) -> None:
+    """把第 keep 层之后各层写回残差流的投影缩小 scale 倍，让前 keep 层主导输出"""
+    for block in model.trf_blocks[keep:]:
+        block.att.out_proj.weight.mul_(scale)
+        block.ff.layers[2].weight.mul_(scale)
+
+
+def main():
+    """用大模型的前几层构造草稿模型，在贪心和采样两种模式下对比普通生成与不同草稿长度的投机解码（耗时、接受率、每次前向的 token 数）"""
+    parser = argparse.ArgumentParser(description="投机解码加速对比")
+    parser.add_argument("--emb-dim", type=int, default=768)
+    parser.add_argument("--n-layers", type=int, default=12)
+    parser.add_argument("--n-heads", type=int, default=12)
+    parser.add_argument("--draft-layers", type=int, default=1, help="草稿模型取大模型的前几层")
+    parser.add_argument("--draft-len", type=int, nargs="+", default=[1, 2, 3, 4])
+    parser.add_argument("--prompt-len", type=int, default=16)
+    parser.add_argument("--new-tokens", type=int, default=96)
+    parser.add_argument("--temperature", type=float, default=0.8, help="采样模式使用的温度")
+    parser.add_argument("--residual-scale", type=float, default=0.05)
+    parser.add_argument("--checkpoint", default=None, help="大模型 state_dict 路径")
+    args = parser.parse_args()
+
+    torch.manual_seed(123)
+    cfg = GPTConfig(emb_dim=args.emb_dim, n_layers=args.n_layers, n_heads=args.n_heads, drop_prob=0.0)
+    target = GPTModel(cfg).eval()
+    if args.checkpoint:
+        target.load_state_dict(torch.load(args.checkpoint, map_location="cpu"))
+    else:
+        shrink_extra_layers(target, args.draft_layers, args.residual_scale)
+    draft = make_layer_skip_draft(target, args.draft_layers)
+    prompt = torch.randint(0, cfg.vocab_size, (1, args.prompt_len))
+
+    print(f"大模型: {cfg.n_layers} 层, 草稿模型: {args.draft_layers} 层, emb_dim={cfg.emb_dim}, "
+          f"threads={torch.get_num_threads()}")
+    print(f"提示词长度={args.prompt_len}, 生成 {args.new_tokens} 个 token\n")
+
+    print(f"{'模式':<6} {'k':>3} {'耗时(s)':>9} {'加速比':>7} {'接受率':>8} {'tokens/前向':>12}")
+    print("-" * 52)
+    for mode, temperature in (("贪心", 0.0), ("采样", args.temperature)):
+        gen = torch.Generator().manual_seed(0)
+        baseline, t_base = timed(
+            lambda: sample_with_cache(target, prompt, args.new_tokens, temperature, gen)
+        )
+        print(f"{mode:<6} {'-':>3} {t_base:>9.2f} {1.0:>6.2f}x {'-':>8} {1.0:>12.2f}")
+        for k in args.draft_len:
+            gen = torch.Generator().manual_seed(0)
+            (out, stats), t_spec = timed(lambda: speculative_generate(
+                target, draft, prompt, args.new_tokens, draft_len=k,
+                temperature=temperature, generator=gen,
+            ))
+            print(f"{mode:<6} {k:>3} {t_spec:>9.2f} {t_base / t_spec:>6.2f}x "
+                  f"{stats.acceptance_rate:>8.1%} {stats.tokens_per_target_forward:>12.2f}")
+            if temperature == 0.0 and not torch.equal(out, baseline):
+                print("❌ 贪心投机解码结果与普通贪心解码不一致")
+
+
+if __name__ == "__main__":
+    main()
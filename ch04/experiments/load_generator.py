@@ -0,0 +1,138 @@
+"""
+实验：连续批处理生成服务的压测
+
+向本地运行的 generation_server 并发发送请求，
+在不同并发度下测量吞吐（tokens/sec）和延迟（首 token 延迟、端到端延迟）。
+并发度越高，每个解码步里批处理的序列越多，吞吐应明显上升，单个请求的延迟略有增加。
+
+运行方式：
+    # 终端 1：启动服务（小模型便于在 CPU 上快速压测）
+    python ch04/main/generation_server.py --emb-dim 384 --n-layers 6 --n-heads 6
+
+    # 终端 2：压测
+    python ch04/experiments/load_generator.py --concurrency 1 2 4 8 16
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+
+async def post_generate(host: str, port: int, payload: dict) -> dict:
+    """发送一次流式 /generate 请求，返回最后的 done 行（附带客户端测得的首 token 延迟）"""
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(payload).encode("utf-8")
+    writer.write(
+        f"POST /generate HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body
+    )
+    await writer.drain()
+
+    # 跳过响应头
+    while (line := await reader.readline()) not in (b"\r\n", b""):
+        pass
+
+    first_chunk_at = None
+    result = None
+    while True:
+        size = int((await reader.readline()).strip() or b"0", 16)
+        if size == 0:
+            break
+        chunk = json.loads(await reader.readexactly(size))
+        await reader.readline()  # chunk 结尾的 \r\n
+        if first_chunk_at is None:
+            first_chunk_at = time.perf_counter()
+        if chunk.get("done"):
+            result = chunk
+    writer.close()
+
+    result["client_ttft_ms"] = ((first_chunk_at or time.perf_counter()) - start) * 1000
+    return result
+
+
+async def fetch_metrics(host: str, port: int) -> dict:
+    """
+    请求服务端的 GET /metrics
+
+    返回:
+        dict: 服务指标（见 ContinuousBatchingEngine.metrics）
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(f"GET /metrics HTTP/1.1\r\nHost: {host}\r\n\r\n".encode("latin-1"))
+    await writer.drain()
+    raw = await reader.read()
+    writer.close()
+    return json.loads(raw.split(b"\r\n\r\n", 1)[1])
+
+
+async def run_level(host: str, port: int, concurrency: int, requests_per_worker: int,
+                    prompt_ids: list, max_new_tokens: int) -> dict:
+    """以固定并发度发送请求：每个 worker 串行发送 requests_per_worker 个请求"""
+    payload = {"prompt_ids": prompt_ids, "max_new_tokens": max_new_tokens, "stream": True}
+    results = []
+
+    async def worker():
+        """串行发送 requests_per_worker 个请求，结果追加到 results"""
+        for _ in range(requests_per_worker):
+            results.append(await post_generate(host, port, payload))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    tokens = sum(r["completion_tokens"] for r in results)
+    latencies = sorted(r["latency_ms"] for r in results)
+    ttfts = sorted(r["client_ttft_ms"] for r in results)
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "tokens_per_sec": tokens / elapsed,
+        "ttft_p50_ms": statistics.median(ttfts),
+        "latency_p50_ms": statistics.median(latencies),
+        "latency_p95_ms": latencies[max(0, int(len(latencies) * 0.95) - 1)],
+    }
+
+
+async def main_async(args):
+    """
+    依次测每个并发度，打印吞吐和延迟表，最后打印服务端的平均批大小
+
+    参数:
+        args: 命令行参数
+    """
+    # 固定的提示词 token，避免压测端依赖分词器
+    prompt_ids = list(range(1000, 1000 + args.prompt_len))
+    rows = []
+    for concurrency in args.concurrency:
+        rows.append(await run_level(args.host, args.port, concurrency, args.requests_per_worker,
+                                    prompt_ids, args.new_tokens))
+
+    print(f"{'并发':>4} {'请求数':>6} {'tokens/sec':>11} {'TTFT p50':>10} {'延迟 p50':>10} {'延迟 p95':>10}")
+    print("-" * 60)
+    for r in rows:
+        print(f"{r['concurrency']:>4} {r['requests']:>6} {r['tokens_per_sec']:>11.1f} "
+              f"{r['ttft_p50_ms']:>8.0f}ms {r['latency_p50_ms']:>8.0f}ms {r['latency_p95_ms']:>8.0f}ms")
+
+    metrics = await fetch_metrics(args.host, args.port)
+    print(f"\n服务端平均批大小: {metrics['avg_batch_size']:.2f}, "
+          f"已完成请求: {metrics['completed_requests']}")
+
+
+def main():
+    """解析命令行参数并运行压测（服务需要已经在 --host:--port 上启动）"""
+    parser = argparse.ArgumentParser(description="生成服务压测")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--requests-per-worker", type=int, default=2)
+    parser.add_argument("--prompt-len", type=int, default=32)
+    parser.add_argument("--new-tokens", type=int, default=64)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,619 @@
+"""
+第4章扩展：连续批处理（continuous batching）的本地生成服务
+
+一次只服务一个请求时，每步解码只为 1 个 token 做前向，矩阵乘法退化为向量乘法，
+CPU 的算力大部分被浪费。连续批处理在每个解码步都把新请求加入正在运行的批次，
+已完成的序列立即退出，让每次前向都尽量处理更多序列。
+
+核心概念：
+    - 槽位（slot）：批处理 KV 缓存中的一行，每个活跃请求占用一个槽位
+    - 准入（admission）：每个解码步开始前，把等待队列中的请求预填充后放入空闲槽位
+    - 退出（retirement）：生成结束的请求立即释放槽位；
+      把最后一个活跃槽位搬到空出来的位置，保证活跃序列总是集中在前 n 行，
+      解码时只需对前 n 行做前向（KVCache.narrow 返回的是视图，不拷贝）
+    - 增量解码：一个汉字的 UTF-8 字节可能被拆到多个 BPE token 中，
+      流式输出时只发送已经凑成完整字符的部分
+    - 指标：队列深度、活跃序列数、首 token 延迟（TTFT）、端到端延迟、吞吐
+
+接口：
+    POST /generate  {"prompt": str, "max_new_tokens": int, "temperature": float, "stream": bool}
+        stream=true 时按行返回 JSON（chunked 编码），每行一个增量文本片段
+    GET  /metrics   服务指标（JSON）
+
+依赖：
+    - torch: PyTorch 深度学习框架
+    - tiktoken: GPT-2 分词器（也可以换成项目中实现的分词器）
+"""
+
+import argparse
+import asyncio
+import codecs
+import collections
+import inspect
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
+
+import torch
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch04.main.gpt_model import GPTConfig, GPTModel
+from ch04.main.kv_cache import KVCache
+
+# GPT-2 的 <|endoftext|> token
+EOS_TOKEN_ID = 50256
+
+
+class IncrementalDetokenizer:
+    """
+    增量解码器：逐个 token 输入，只输出已经完整的字符
+
+    兼容两类分词器：
+        - tiktoken.Encoding：用 decode_single_token_bytes 拿到原始字节，
+          再用 UTF-8 增量解码器拼接，避免把半个汉字解码成乱码
+        - 项目中的分词器（只有 decode(ids) -> str）：每个 token 本身就是完整字符串
+    """
+
+    def __init__(self, tokenizer):
+        """
+        参数:
+            tokenizer: tiktoken.Encoding 或项目中实现的分词器
+        """
+        self.tokenizer = tokenizer
+        self._byte_level = hasattr(tokenizer, "decode_single_token_bytes")
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def push(self, token_id: int) -> str:
+        """输入一个 token，返回新产生的完整文本（可能为空字符串）"""
+        if self._byte_level:
+            return self._decoder.decode(self.tokenizer.decode_single_token_bytes(token_id))
+        return self.tokenizer.decode([token_id])
+
+    def flush(self) -> str:
+        """生成结束时输出剩余的不完整字节（以替换字符表示）"""
+        return self._decoder.decode(b"", final=True) if self._byte_level else ""
+
+
+@dataclass
+class GenerationRequest:
+    """
+    一个生成请求及其运行状态
+
+    属性:
+        prompt_ids: 提示词 token
+        max_new_tokens: 最多生成的 token 数
+        temperature: 采样温度，0 表示贪心
+        output: 事件队列（由事件循环线程写入），元素为 token ID，None 表示结束
+        generated: 已生成的 token
+        error: 引擎处理该请求失败时的错误信息（结束时不为 None 表示失败）
+    """
+
+    prompt_ids: list
+    max_new_tokens: int
+    temperature: float = 0.0
+    output: asyncio.Queue = field(default_factory=asyncio.Queue)
+    generated: list = field(default_factory=list)
+    arrival_time: float = field(default_factory=time.perf_counter)
+    first_token_time: Optional[float] = None
+    finish_time: Optional[float] = None
+    # 当前占用的槽位；None 表示还在等待队列中
+    slot: Optional[int] = None
+    next_token: Optional[int] = None
+    error: Optional[str] = None
+
+
+class ContinuousBatchingEngine:
+    """
+    连续批处理生成引擎
+
+    所有模型计算都在一个专用工作线程中执行，事件循环线程只负责收发请求，
+    这样前向计算期间 HTTP 连接仍能被及时处理（PyTorch 算子会释放 GIL）。
+
+    属性:
+        max_batch_size: 最多同时解码的序列数（KV 缓存的行数）
+        waiting: 等待准入的请求队列
+        active: 按槽位排列的活跃请求，总是占用前 len(active) 个槽位
+    """
+
+    def __init__(self, model: GPTModel, max_batch_size: int = 16, eos_token_id: int = EOS_TOKEN_ID):
+        """
+        参数:
+            model: GPT 模型（切换到 eval 模式）
+            max_batch_size (int): 最多同时解码的序列数，按此预分配 KV 缓存
+            eos_token_id (int): 生成这个 token 时请求结束
+        """
+        self.model = model.eval()
+        self.max_batch_size = max_batch_size
+        self.eos_token_id = eos_token_id
+        self.cache = KVCache.for_model(model, max_batch_size)
+
+        self.waiting = collections.deque()
+        self.active = []
+        self._wakeup = asyncio.Event()
+        # 单线程执行器：保证模型和 KV 缓存只在一个线程中被访问
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="engine")
+
+        # 指标
+        self.completed = 0
+        self.failed = 0
+        self.generated_tokens = 0
+        self.steps = 0
+        self.decoded_rows = 0
+        self.started_at = time.perf_counter()
+        self._ttft = collections.deque(maxlen=1000)
+        self._latency = collections.deque(maxlen=1000)
+
+    def submit(self, request: GenerationRequest) -> None:
+        """把请求放入等待队列，唤醒引擎循环（必须在事件循环线程中调用）"""
+        max_prompt = self.model.cfg.ctx_len - 1
+        if len(request.prompt_ids) > max_prompt:
+            # 只保留最后 ctx_len-1 个 token，至少留 1 个位置生成
+            request.prompt_ids = request.prompt_ids[-max_prompt:]
+        self.waiting.append(request)
+        self._wakeup.set()
+
+    async def run(self) -> None:
+        """引擎主循环：每个解码步先准入新请求，再对所有活跃序列解码一步"""
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.active and not self.waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+            # 在事件循环线程中决定准入哪些请求，工作线程只做计算
+            free = self.max_batch_size - len(self.active)
+            admitted = [self.waiting.popleft() for _ in range(min(free, len(self.waiting)))]
+
+            events = await loop.run_in_executor(self._executor, self._step, admitted)
+
+            # asyncio.Queue 不是线程安全的，所以在事件循环线程中分发结果
+            now = time.perf_counter()
+            for request, token, finished in events:
+                if token is not None:
+                    if request.first_token_time is None:
+                        request.first_token_time = now
+                        self._ttft.append(now - request.arrival_time)
+                    request.output.put_nowait(token)
+                if finished:
+                    request.finish_time = now
+                    if request.error is None:
+                        self._latency.append(now - request.arrival_time)
+                        self.completed += 1
+                    else:
+                        self.failed += 1
+                    request.output.put_nowait(None)
+
+    @torch.no_grad()
+    def _step(self, admitted: list) -> list:
+        """
+        执行一个调度步（在工作线程中运行）
+
+        参数:
+            admitted: 本步新准入的请求
+
+        返回:
+            list[tuple[GenerationRequest, Optional[int], bool]]: (请求, 新 token, 是否结束) 事件
+        """
+        events = []
+
+        # Step 1: 准入——逐个预填充新请求，结果拷贝到批次末尾的空闲槽位
+        for request in admitted:
+            prompt = torch.tensor([request.prompt_ids])
+            row_cache = KVCache.for_model(self.model, 1, max_len=len(request.prompt_ids))
+            try:
+                logits = self.model(prompt, kv_cache=row_cache)
+            except Exception as e:
+                # 预填充是逐个请求做的：失败只结束这一个请求，不影响批次和引擎循环
+                events.append(self._fail(request, e))
+                continue
+            request.slot = len(self.active)
+            self.cache.copy_row(request.slot, row_cache)
+            self.active.append(request)
+            # 预填充顺便产生了第一个新 token
+            token = self._sample(logits[:, -1, :], [request])[0]
+            events.extend(self._emit(request, token))
+
+        # 预填充的 token 也可能直接结束（例如 max_new_tokens=1）
+        self._retire_finished()
+
+        # Step 2: 对所有活跃序列解码一步（活跃序列集中在前 n 行）
+        if self.active:
+            n = len(self.active)
+            batch = self.cache.narrow(n)
+            next_ids = torch.tensor([[r.next_token] for r in self.active])
+            try:
+                logits = self.model(next_ids, kv_cache=batch)
+            except Exception as e:
+                # 批量解码失败无法归到某一行：结束当前批次的请求并清空缓存，引擎继续服务之后的请求
+                events.extend(self._fail(request, e) for request in self.active)
+                self.active = []
+                self.cache.reset()
+                return events
+            tokens = self._sample(logits[:, -1, :], self.active)
+            for request, token in zip(list(self.active), tokens):
+                events.extend(self._emit(request, token))
+            self._retire_finished()
+            self.steps += 1
+            self.decoded_rows += n
+
+        return events
+
+    def _sample(self, logits: torch.Tensor, requests: list) -> list:
+        """
+        按每个请求自己的温度选出下一个 token
+
+        参数:
+            logits (Tensor): (n, vocab_size)
+            requests: 与 logits 各行对应的请求
+
+        返回:
+            list[int]: 每行的新 token
+        """
+        temperatures = torch.tensor([r.temperature for r in requests])
+        greedy = torch.argmax(logits, dim=-1)
+        if not (temperatures > 0).any():
+            return greedy.tolist()
+        # 温度为 0 的行先截到 1e-5 避免除零，它们的采样结果随后被贪心结果覆盖
+        scaled = logits / temperatures.clamp(min=1e-5)[:, None]
+        sampled = torch.multinomial(torch.softmax(scaled, dim=-1), num_samples=1)[:, 0]
+        return torch.where(temperatures > 0, sampled, greedy).tolist()
+
+    def _fail(self, request: GenerationRequest, error: Exception) -> tuple:
+        """标记请求失败，返回结束事件"""
+        request.error = f"{type(error).__name__}: {error}"
+        return (request, None, True)
+
+    def _emit(self, request: GenerationRequest, token: int) -> list:
+        """记录新 token，返回需要分发的事件"""
+        request.generated.append(token)
+        request.next_token = token
+        self.generated_tokens += 1
+        return [(request, token, self._is_finished(request))]
+
+    def _is_finished(self, request: GenerationRequest) -> bool:
+        """达到最大长度、生成了 EOS，或者 KV 缓存（上下文）已满"""
+        total = len(request.prompt_ids) + len(request.generated)
+        return (
+            len(request.generated) >= request.max_new_tokens
+            or request.next_token == self.eos_token_id
+            or total >= self.model.cfg.ctx_len
+        )
+
+    def _retire_finished(self) -> None:
+        """
+        让已结束的序列退出批次
+
+        把最后一个活跃槽位搬到空出的槽位，保证活跃序列始终占用前 n 行
+        """
+        i = 0
+        while i < len(self.active):
+            if not self._is_finished(self.active[i]):
+                i += 1
+                continue
+            last = self.active.pop()
+            if i < len(self.active):
+                # 结束的不是最后一个：把最后一行搬过来，再检查搬来的这一行
+                self.cache.copy_row(i, self.cache, last.slot)
+                last.slot = i
+                self.active[i] = last
+
+    def metrics(self) -> dict:
+        """服务指标快照"""
+        elapsed = time.perf_counter() - self.started_at
+
+        def summary(values):
+            """
+            延迟列表的分位数
+
+            参数:
+                values: 以秒为单位的延迟
+
+            返回:
+                dict | None: {"p50_ms", "p95_ms"}；还没有数据时为 None
+            """
+            if not values:
+                return None
+            ordered = sorted(values)
+            return {
+                "p50_ms": statistics.median(ordered) * 1000,
+                "p95_ms": ordered[max(0, int(len(ordered) * 0.95) - 1)] * 1000,
+            }
+
+        return {
+            "queue_depth": len(self.waiting),
+            "active_sequences": len(self.active),
+            "max_batch_size": self.max_batch_size,
+            "completed_requests": self.completed,
+            "failed_requests": self.failed,
+            "generated_tokens": self.generated_tokens,
+            "decode_steps": self.steps,
+            "avg_batch_size": self.decoded_rows / self.steps if self.steps else 0.0,
+            "tokens_per_sec": self.generated_tokens / elapsed if elapsed > 0 else 0.0,
+            "time_to_first_token": summary(self._ttft),
+            "latency": summary(self._latency),
+        }
+
+
+# ----------------------------------------------------------------------------
+# HTTP 层：只用标准库 asyncio 实现的最小 HTTP/1.1 服务
+# ----------------------------------------------------------------------------
+
+async def _read_request(reader: asyncio.StreamReader):
+    """解析请求行、头部和 body，返回 (method, path, body_bytes)"""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    body = await reader.readexactly(length) if length else b""
+    return method, path, body
+
+
+def _response_head(status: str, content_type: str, length: Optional[int] = None) -> bytes:
+    """构造响应头；length 为 None 时使用 chunked 编码（流式输出）"""
+    lines = [f"HTTP/1.1 {status}", f"Content-Type: {content_type}", "Connection: close"]
+    lines.append(f"Content-Length: {length}" if length is not None else "Transfer-Encoding: chunked")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def _send_json(writer: asyncio.StreamWriter, payload: dict, status: str = "200 OK") -> None:
+    """
+    发送一个完整的 JSON 响应（带 Content-Length）
+
+    参数:
+        writer: 连接的写端
+        payload (dict): 响应体
+        status (str): HTTP 状态行中的状态，例如 "400 Bad Request"
+    """
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    writer.write(_response_head(status, "application/json; charset=utf-8", len(body)) + body)
+    await writer.drain()
+
+
+async def _send_chunk(writer: asyncio.StreamWriter, payload: dict) -> None:
+    """发送一行 JSON 作为一个 HTTP chunk"""
+    data = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+    writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+    await writer.drain()
+
+
+def _accepts_disallowed_special(tokenizer) -> bool:
+    """tokenizer.encode 是否接受 disallowed_special 参数（tiktoken 接受，项目中实现的分词器不接受）"""
+    try:
+        parameters = inspect.signature(tokenizer.encode).parameters.values()
+    except (TypeError, ValueError):
+        # 拿不到签名（例如 C 扩展函数）：按不接受处理
+        return False
+    return any(p.name == "disallowed_special" or p.kind is inspect.Parameter.VAR_KEYWORD for p in parameters)
+
+
+def _encode_prompt(tokenizer, text: str) -> list:
+    """编码 prompt；特殊 token 的文本按普通文本处理（tiktoken 默认会对它抛出 ValueError）"""
+    if _accepts_disallowed_special(tokenizer):
+        return tokenizer.encode(text, disallowed_special=())
+    return tokenizer.encode(text)
+
+
+def _parse_generate_params(body: bytes) -> dict:
+    """
+    解析并检查 /generate 的请求体
+
+    参数:
+        body (bytes): JSON 请求体，空表示 {}
+
+    返回:
+        dict: prompt 或 prompt_ids 之一，以及 max_new_tokens、temperature、stream（已填好默认值）
+
+    注意:
+        - 形状或类型不对、取值越界时抛出 ValueError（由 handle 转成 400），不会让错误进入引擎
+    """
+    params = json.loads(body or b"{}")
+    if not isinstance(params, dict):
+        raise ValueError("请求体必须是 JSON 对象")
+
+    def is_int(value) -> bool:
+        """JSON 整数：int 但不是 bool"""
+        # JSON 的 true/false 在 Python 中是 bool（int 的子类），不当作整数
+        return isinstance(value, int) and not isinstance(value, bool)
+
+    parsed = {}
+    if "prompt_ids" in params:
+        prompt_ids = params["prompt_ids"]
+        if not isinstance(prompt_ids, list) or not all(is_int(t) for t in prompt_ids):
+            raise ValueError("prompt_ids 必须是整数列表")
+        parsed["prompt_ids"] = prompt_ids
+    elif "prompt" in params:
+        if not isinstance(params["prompt"], str):
+            raise ValueError("prompt 必须是字符串")
+        parsed["prompt"] = params["prompt"]
+    else:
+        raise ValueError("需要 prompt 或 prompt_ids")
+
+    max_new_tokens = params.get("max_new_tokens", 64)
+    if not is_int(max_new_tokens) or max_new_tokens < 1:
+        raise ValueError(f"max_new_tokens 必须是 >= 1 的整数: {max_new_tokens!r}")
+    temperature = params.get("temperature", 0.0)
+    if not (is_int(temperature) or isinstance(temperature, float)) or not temperature >= 0:
+        raise ValueError(f"temperature 必须是 >= 0 的数: {temperature!r}")
+    stream = params.get("stream", False)
+    if not isinstance(stream, bool):
+        raise ValueError(f"stream 必须是 true 或 false: {stream!r}")
+    parsed.update(max_new_tokens=max_new_tokens, temperature=float(temperature), stream=stream)
+    return parsed
+
+
+class GenerationServer:
+    """
+    把 ContinuousBatchingEngine 暴露为 HTTP 服务
+
+    参数:
+        engine: 生成引擎
+        tokenizer: 需要提供 encode(text) 和 decode(ids)；
+                   prompt 中的 <|endoftext|> 按普通文本编码（tiktoken 传入 disallowed_special=()），
+                   需要特殊 token 时直接传 prompt_ids
+    """
+
+    def __init__(self, engine: ContinuousBatchingEngine, tokenizer):
+        """
+        参数:
+            engine: 生成引擎（由调用方启动 engine.run()）
+            tokenizer: 分词器
+        """
+        self.engine = engine
+        self.tokenizer = tokenizer
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        处理一个 HTTP 连接：路由到 /metrics 或 /generate，处理完关闭连接
+
+        注意:
+            - 请求格式错误（ValueError、KeyError、TypeError）返回 400
+            - 客户端提前断开时静默结束
+        """
+        try:
+            parsed = await _read_request(reader)
+            if parsed is None:
+                return
+            method, path, body = parsed
+            if method == "GET" and path == "/metrics":
+                await _send_json(writer, self.engine.metrics())
+            elif method == "POST" and path == "/generate":
+                await self._generate(writer, body)
+            else:
+                await _send_json(writer, {"error": f"not found: {method} {path}"}, "404 Not Found")
+        except (ValueError, KeyError, TypeError) as e:
+            await _send_json(writer, {"error": str(e)}, "400 Bad Request")
+        except ConnectionError:
+            # 客户端提前断开：请求仍会在引擎中跑完，这里只是不再发送
+            pass
+        finally:
+            writer.close()
+
+    async def _generate(self, writer: asyncio.StreamWriter, body: bytes) -> None:
+        """
+        处理 POST /generate：检查参数、提交给引擎，按 stream 返回完整 JSON 或逐 token 的 JSON 行
+
+        参数:
+            writer: 连接的写端
+            body (bytes): 请求体
+
+        注意:
+            - 生成过程中失败时返回 500（流式输出时在最后一行给出 error）
+        """
+        params = _parse_generate_params(body)
+        if "prompt_ids" in params:
+            prompt_ids = params["prompt_ids"]
+        else:
+            prompt_ids = _encode_prompt(self.tokenizer, params["prompt"])
+        if not prompt_ids:
+            raise ValueError("prompt 不能为空")
+        # 越界的 id 会在引擎的嵌入层查表时出错，在进入引擎之前就拒绝
+        vocab_size = self.engine.model.cfg.vocab_size
+        invalid = [t for t in prompt_ids if not 0 <= t < vocab_size]
+        if invalid:
+            raise ValueError(f"prompt_ids 超出词表范围 [0, {vocab_size}): {invalid[:5]}")
+
+        request = GenerationRequest(
+            prompt_ids=prompt_ids,
+            max_new_tokens=params["max_new_tokens"],
+            temperature=params["temperature"],
+        )
+        self.engine.submit(request)
+
+        stream = params["stream"]
+        detok = IncrementalDetokenizer(self.tokenizer)
+        if stream:
+            writer.write(_response_head("200 OK", "application/x-ndjson; charset=utf-8"))
+
+        pieces = []
+        while (token := await request.output.get()) is not None:
+            text = detok.push(token)
+            pieces.append(text)
+            if stream and text:
+                await _send_chunk(writer, {"token": token, "text": text})
+        pieces.append(detok.flush())
+
+        if request.error is not None:
+            if stream:
+                await _send_chunk(writer, {"done": True, "error": request.error})
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+            else:
+                await _send_json(writer, {"error": request.error}, "500 Internal Server Error")
+            return
+
+        result = {
+            "text": "".join(pieces),
+            "prompt_tokens": len(request.prompt_ids),
+            "completion_tokens": len(request.generated),
+            "ttft_ms": (request.first_token_time - request.arrival_time) * 1000,
+            "latency_ms": (request.finish_time - request.arrival_time) * 1000,
+        }
+        if stream:
+            await _send_chunk(writer, {"done": True, **result})
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        else:
+            await _send_json(writer, result)
+
+
+async def serve(model: GPTModel, tokenizer, host: str = "127.0.0.1", port: int = 8000,
+                max_batch_size: int = 16) -> None:
+    """
+    启动生成服务并一直运行
+
+    参数:
+        model: GPT 模型（应已加载权重）
+        tokenizer: 分词器
+        host, port: 监听地址
+        max_batch_size: 最多同时解码的序列数
+    """
+    engine = ContinuousBatchingEngine(model, max_batch_size=max_batch_size)
+    server = GenerationServer(engine, tokenizer)
+    engine_task = asyncio.create_task(engine.run())
+    http = await asyncio.start_server(server.handle, host, port)
+    print(f"✅ 生成服务已启动: http://{host}:{port} (max_batch_size={max_batch_size})")
+    async with http:
+        # 引擎循环异常退出时让整个服务一起退出，而不是默默挂起
+        await asyncio.gather(http.serve_forever(), engine_task)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="连续批处理的本地 GPT 生成服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch", type=int, default=16, help="最多同时解码的序列数")
+    parser.add_argument("--emb-dim", type=int, default=768)
+    parser.add_argument("--n-layers", type=int, default=12)
+    parser.add_argument("--n-heads", type=int, default=12)
+    parser.add_argument("--ctx-len", type=int, default=1024)
+    parser.add_argument("--checkpoint", default=None, help="模型 state_dict 路径（不提供则随机初始化）")
+    args = parser.parse_args()
+
+    import tiktoken
+
+    torch.manual_seed(123)
+    cfg = GPTConfig(emb_dim=args.emb_dim, n_layers=args.n_layers, n_heads=args.n_heads,
+                    ctx_len=args.ctx_len, drop_prob=0.0)
+    model = GPTModel(cfg)
+    if args.checkpoint:
+        model.load_state_dict(torch.load(args.checkpoint, map_location="cpu"))
+    else:
+        print("⚠️ 未提供 --checkpoint，使用随机初始化的模型（输出无意义，仅用于压测）")
+
+    asyncio.run(serve(model.eval(), tiktoken.get_encoding("gpt2"), args.host, args.port, args.max_batch))
@@ -0,0 +1,385 @@
+"""
+第4章：从零实现 GPT 模型
+
+把第3章的多头因果注意力与层归一化、前馈网络、残差连接组合成完整的 GPT。
+
+核心概念：
+    - Token 嵌入 + 位置嵌入：把离散的 token ID 变成带位置信息的向量
+    - Transformer Block：Pre-LN 结构，注意力子层和前馈子层各带一个残差连接
+    - 输出头：把最后的隐藏状态投影回词汇表大小，得到下一个 token 的 logits
+    - 自回归生成：每次取最后一个位置的 logits 选出新 token，拼到输入后面继续生成
+
+依赖：
+    - torch: PyTorch 深度学习框架
+"""
+
+import os
+import sys
+from dataclasses import dataclass
+from typing import Optional
+
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+# 从仓库根目录导入第3章的注意力实现
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch02.main.embedding import GPTEmbedding
+from ch03.main.attention import MultiHeadAttention
+
+
+@dataclass
+class GPTConfig:
+    """
+    GPT 模型的超参数配置
+
+    默认值对应 GPT-2 small（124M 参数）。
+    """
+
+    # 词汇表大小：GPT-2 BPE 分词器的 50257 个 token
+    vocab_size: int = 50257
+
+    # 上下文长度：模型能处理的最大序列长度，决定位置嵌入表的行数
+    ctx_len: int = 1024
+
+    # 嵌入维度：每个 token 被映射成的向量长度
+    emb_dim: int = 768
+
+    # 注意力头数：必须能整除 emb_dim（768 / 12 = 64，每个头的维度）
+    n_heads: int = 12
+
+    # 层数：Transformer Block 的数量
+    n_layers: int = 12
+
+    # Dropout 概率：嵌入层、注意力权重和残差分支上使用
+    drop_prob: float = 0.1
+
+    # QKV 偏置：加载 OpenAI 的 GPT-2 权重时需要设为 True
+    qkv_bias: bool = False
+
+    # 分块注意力的块大小：长上下文（4k~16k）时设置，避免构造 T×T 的注意力矩阵
+    attn_chunk_size: Optional[int] = None
+
+    # 滑动窗口：每个 token 只看最近 attn_window 个 token，None 表示看到全部历史
+    attn_window: Optional[int] = None
+
+    # token 嵌入使用稀疏梯度：梯度只包含 batch 中出现的行，
+    # 需要配合稀疏感知的优化器（ch02/main/embedding.py 的 SparseAwareOptimizer）
+    sparse_embedding: bool = False
+
+
+# GPT-2 small：124M 参数
+GPT_CONFIG_124M = GPTConfig()
+
+
+class LayerNorm(nn.Module):
+    """
+    层归一化：在最后一维（特征维）上把每个 token 的向量归一化为均值 0、方差 1
+
+    与 BatchNorm 不同，它不依赖 batch 内其他样本，训练和推理行为一致。
+    """
+
+    def __init__(self, emb_dim: int):
+        """
+        参数:
+            emb_dim (int): 特征维度，即 scale 和 shift 的长度
+        """
+        super().__init__()
+        # 防止除以 0 的小常数
+        self.eps = 1e-5
+        # 可学习的缩放和平移：让模型在需要时恢复原始分布
+        self.scale = nn.Parameter(torch.ones(emb_dim))
+        self.shift = nn.Parameter(torch.zeros(emb_dim))
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        参数:
+            x (Tensor): 形状 (..., emb_dim)，可以是 bf16
+
+        返回:
+            Tensor: 形状和类型与输入相同
+        """
+        # 均值和方差对精度敏感：bf16 输入也先升到 fp32 计算，结果再转回输入的类型
+        x32 = x.float()
+        mean = x32.mean(dim=-1, keepdim=True)
+        # unbiased=False：除以 n 而不是 n-1，与 GPT-2 原实现一致
+        var = x32.var(dim=-1, keepdim=True, unbiased=False)
+        norm_x = (x32 - mean) / torch.sqrt(var + self.eps)
+        return (self.scale.float() * norm_x + self.shift.float()).to(x.dtype)
+
+
+class GELU(nn.Module):
+    """
+    GELU 激活函数（GPT-2 使用的 tanh 近似）
+
+    GELU(x) ≈ 0.5 * x * (1 + tanh(sqrt(2/π) * (x + 0.044715 * x^3)))
+    与 ReLU 相比在 0 附近是平滑的，负值区也有很小的梯度
+    """
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        参数:
+            x (Tensor): 任意形状
+
+        返回:
+            Tensor: 逐元素激活后的结果，形状与输入相同
+        """
+        return 0.5 * x * (1 + torch.tanh(
+            torch.sqrt(torch.tensor(2.0 / torch.pi)) * (x + 0.044715 * torch.pow(x, 3))
+        ))
+
+
+class FeedForward(nn.Module):
+    """
+    位置级前馈网络：emb_dim -> 4*emb_dim -> emb_dim
+
+    对每个位置独立做非线性变换；先扩展到 4 倍维度，给模型更大的表达空间
+    """
+
+    def __init__(self, cfg: GPTConfig):
+        """
+        参数:
+            cfg: 模型配置，用到 emb_dim
+        """
+        super().__init__()
+        self.layers = nn.Sequential(
+            nn.Linear(cfg.emb_dim, 4 * cfg.emb_dim),
+            GELU(),
+            nn.Linear(4 * cfg.emb_dim, cfg.emb_dim),
+        )
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        参数:
+            x (Tensor): 形状 (batch_size, seq_len, emb_dim)
+
+        返回:
+            Tensor: 形状与输入相同
+        """
+        return self.layers(x)
+
+
+class TransformerBlock(nn.Module):
+    """
+    Transformer 块：GPT 模型的基本构建单元
+
+    这个块包含两个主要子层：
+    1. 多头自注意力层
+    2. 前馈神经网络层
+
+    每个子层都采用"先层归一化、后残差连接"（Pre-LN）的结构。
+    """
+
+    def __init__(self, cfg: GPTConfig):
+        """
+        参数:
+            cfg: 模型配置（emb_dim、n_heads、ctx_len、drop_prob、qkv_bias 以及注意力的分块 / 窗口设置）
+        """
+        super().__init__()
+        self.att = MultiHeadAttention(
+            d_in=cfg.emb_dim,
+            d_out=cfg.emb_dim,
+            context_length=cfg.ctx_len,
+            dropout=cfg.drop_prob,
+            num_heads=cfg.n_heads,
+            qkv_bias=cfg.qkv_bias,
+            chunk_size=cfg.attn_chunk_size,
+            window=cfg.attn_window,
+        )
+        self.ff = FeedForward(cfg)
+        self.norm1 = LayerNorm(cfg.emb_dim)
+        self.norm2 = LayerNorm(cfg.emb_dim)
+        self.drop_resid = nn.Dropout(cfg.drop_prob)
+
+    def forward(self, x: torch.Tensor, kv_cache=None) -> torch.Tensor:
+        """
+        参数:
+            x (Tensor): 形状 (batch_size, seq_len, emb_dim)
+            kv_cache: 可选，这一层的 KV 缓存视图，透传给注意力层
+
+        返回:
+            Tensor: 形状与输入相同
+        """
+        # 注意力子层 + 残差连接
+        residual = x
+        x = self.norm1(x)
+        x = self.att(x, kv_cache=kv_cache)
+        x = self.drop_resid(x)
+        x = x + residual
+
+        # 前馈网络子层 + 残差连接
+        residual = x
+        x = self.norm2(x)
+        x = self.ff(x)
+        x = self.drop_resid(x)
+        x = x + residual
+
+        return x
+
+
+def _rename_legacy_embedding_keys(module, state_dict, prefix, *args) -> None:
+    """load_state_dict 的预处理钩子：tok_emb.* / pos_emb.* -> embedding.tok_emb.* / embedding.pos_emb.*"""
+    for name in ("tok_emb", "pos_emb"):
+        for key in [k for k in state_dict if k.startswith(f"{prefix}{name}.")]:
+            state_dict[f"{prefix}embedding.{key[len(prefix):]}"] = state_dict.pop(key)
+
+
+class GPTModel(nn.Module):
+    """
+    GPT 模型
+
+    属性:
+        embedding: 输入层 GPTEmbedding（ch02/main/embedding.py），token 嵌入 + 位置嵌入
+        tok_emb: token 嵌入表 (vocab_size, emb_dim)，即 embedding.tok_emb
+        pos_emb: 可学习的绝对位置嵌入表 (ctx_len, emb_dim)，即 embedding.pos_emb
+        trf_blocks: n_layers 个 TransformerBlock
+        final_norm: 输出前的层归一化
+        out_head: 输出投影 emb_dim -> vocab_size
+    """
+
+    def __init__(self, cfg: GPTConfig):
+        """
+        参数:
+            cfg: 模型配置；保存为 self.cfg（vocab_growth 扩大词表时换成新的配置对象）
+        """
+        super().__init__()
+        self.cfg = cfg
+        self.embedding = GPTEmbedding(cfg.vocab_size, cfg.emb_dim, cfg.ctx_len, sparse=cfg.sparse_embedding)
+        self.drop_emb = nn.Dropout(cfg.drop_prob)
+
+        # 用 ModuleList 而不是 Sequential：前向时需要给每一层传入各自的 KV 缓存
+        self.trf_blocks = nn.ModuleList([TransformerBlock(cfg) for _ in range(cfg.n_layers)])
+
+        self.final_norm = LayerNorm(cfg.emb_dim)
+        self.out_head = nn.Linear(cfg.emb_dim, cfg.vocab_size, bias=False)
+
+        # 开启激活检查点的层编号（训练时生效）
+        self.checkpoint_layers = set()
+
+        # 旧检查点中的嵌入层参数名是 tok_emb.* / pos_emb.*，加载时映射到 embedding.*
+        self.register_load_state_dict_pre_hook(_rename_legacy_embedding_keys)
+
+    @property
+    def tok_emb(self) -> nn.Embedding:
+        """token 嵌入（embedding.tok_emb 的别名，兼容直接访问 model.tok_emb 的代码）"""
+        return self.embedding.tok_emb
+
+    @property
+    def pos_emb(self) -> nn.Embedding:
+        """位置嵌入（embedding.pos_emb 的别名）"""
+        return self.embedding.pos_emb
+
+    def set_activation_checkpointing(self, layers="all") -> None:
+        """
+        为指定的 Transformer Block 开启激活检查点
+
+        开启后，这些层在前向传播时不保存中间激活值，只保存层的输入；
+        反向传播时重新计算一遍这一层的前向。每层省下的激活值内存换来约 1/3 的额外计算。
+        只对一部分层开启可以在内存和速度之间折中。
+
+        参数:
+            layers: "all" 表示全部层，None 或空列表表示关闭，
+                    也可以是层编号列表，例如 range(0, n_layers, 2) 表示隔一层开启一次
+
+        示例:
+            >>> model.set_activation_checkpointing([0, 1, 2, 3])
+        """
+        if layers == "all":
+            layers = range(self.cfg.n_layers)
+        layers = set(layers or ())
+        invalid = [i for i in layers if not 0 <= i < self.cfg.n_layers]
+        if invalid:
+            raise ValueError(f"层编号超出范围 [0, {self.cfg.n_layers}): {sorted(invalid)}")
+        self.checkpoint_layers = layers
+
+    def forward(self, in_idx: torch.Tensor, kv_cache=None) -> torch.Tensor:
+        """
+        前向传播
+
+        参数:
+            in_idx (Tensor): token ID，形状 (batch_size, seq_len)
+            kv_cache (KVCache): 可选。提供时 in_idx 只包含尚未写入缓存的新 token，
+                                位置编号从缓存中已有的长度接着往后数
+
+        返回:
+            Tensor: logits，形状 (batch_size, seq_len, vocab_size)
+        """
+        return self.out_head(self.hidden_states(in_idx, kv_cache))
+
+    def hidden_states(self, in_idx: torch.Tensor, kv_cache=None) -> torch.Tensor:
+        """
+        输出头之前的隐藏状态（经过 final_norm），参数同 forward
+
+        返回:
+            Tensor: 形状 (batch_size, seq_len, emb_dim)；分类微调时取最后一个 token 或平均池化作为特征
+        """
+        batch_size, seq_len = in_idx.shape
+
+        # 没有缓存时位置就是 0..T-1（GPTEmbedding 直接切片位置嵌入表）；
+        # 有缓存时新 token 的绝对位置 = 该行已缓存的长度 + 偏移
+        positions = kv_cache.positions(seq_len) if kv_cache is not None else None
+        x = self.drop_emb(self.embedding(in_idx, positions))  # (b, T, emb_dim)
+
+        use_checkpoint = self.training and torch.is_grad_enabled() and kv_cache is None
+        for i, block in enumerate(self.trf_blocks):
+            if use_checkpoint and i in self.checkpoint_layers:
+                # 重新计算时恢复随机数状态，dropout 掩码与第一次前向相同
+                x = checkpoint(block, x, use_reentrant=False)
+                continue
+            layer_cache = kv_cache.layer(i) if kv_cache is not None else None
+            x = block(x, kv_cache=layer_cache)
+
+        if kv_cache is not None:
+            # 所有层都写入了新 token 的 K/V，缓存长度整体前移
+            kv_cache.advance(seq_len)
+
+        return self.final_norm(x)
+
+
+def generate_text_simple(model: GPTModel, idx: torch.Tensor, max_new_tokens: int,
+                         context_size: int) -> torch.Tensor:
+    """
+    最简单的贪心生成（不使用 KV 缓存）
+
+    每生成一个 token 都把完整的前缀重新跑一遍前向传播，
+    总计算量随输出长度平方增长；作为 KV 缓存版本的对照。
+
+    参数:
+        model: GPT 模型
+        idx (Tensor): 起始 token ID，形状 (batch_size, n_tokens)
+        max_new_tokens (int): 生成的新 token 数
+        context_size (int): 模型支持的上下文长度，超出时只保留最后 context_size 个 token
+
+    返回:
+        Tensor: 原始 token 加上新 token，形状 (batch_size, n_tokens + max_new_tokens)
+    """
+    for _ in range(max_new_tokens):
+        idx_cond = idx[:, -context_size:]
+        with torch.no_grad():
+            logits = model(idx_cond)
+        # 只关心最后一个位置的预测
+        logits = logits[:, -1, :]
+        idx_next = torch.argmax(logits, dim=-1, keepdim=True)  # (b, 1)
+        idx = torch.cat((idx, idx_next), dim=1)
+    return idx
+
+
+if __name__ == "__main__":
+    import tiktoken
+
+    torch.manual_seed(123)
+    model = GPTModel(GPT_CONFIG_124M).eval()
+
+    total_params = sum(p.numel() for p in model.parameters())
+    print(f"参数总量: {total_params:,}")
+    # GPT-2 的输出头与 token 嵌入共享权重，所以"124M"不计算输出头
+    print(f"去掉输出头后的参数量: {total_params - model.out_head.weight.numel():,}")
+
+    tokenizer = tiktoken.get_encoding("gpt2")
+    start = torch.tensor([tokenizer.encode("Hello, I am")])
+    out = generate_text_simple(model, start, max_new_tokens=6, context_size=GPT_CONFIG_124M.ctx_len)
+    print(f"生成的 token: {out.tolist()}")
+    print(f"解码文本（未训练，输出是随机的）: {tokenizer.decode(out[0].tolist())}")
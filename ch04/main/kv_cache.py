@@ -0,0 +1,433 @@
+"""
+第4章：KV 缓存（Key/Value Cache）加速自回归生成
+
+不使用缓存时，每生成一个 token 都要把整个前缀重新做一遍前向传播，
+而前缀里每个 token 的 Key / Value 其实每次都一样。
+KV 缓存把它们存下来，之后每一步只需要为新 token 计算 K/V。
+
+核心概念：
+    - 预分配：为每一层一次性分配 (batch, heads, max_len, head_dim) 的缓冲区，
+      生成过程中只往里写，不做 torch.cat，避免反复分配和拷贝
+    - 位置偏移：新 token 的位置编号 = 该行已缓存的长度，
+      位置嵌入必须用这个绝对位置而不是从 0 开始
+    - 每行独立的长度：lengths[b] 记录第 b 行已缓存的 token 数，
+      回退（例如投机解码拒绝了一些 token）只需要把长度改小
+    - 前缀复用：多次调用共享同一个前缀（例如系统提示词）时，
+      把前缀的 K/V 存起来，下次直接拷贝进缓存，跳过这部分的预填充（prefill）
+    - 左填充：长度不同的提示词在左侧补齐后一起预填充，starts[b] 记录第 b 行真实内容开始的槽位，
+      位置编号从真实内容开始算，填充的槽位对所有 query 不可见
+
+复杂度：
+    - 无缓存：生成 n 个 token 需要处理 O(n^2) 个 token 的前向
+    - 有缓存：每步只处理 1 个 token，总共 O(n)（注意力本身仍需读取全部历史 K/V）
+
+依赖：
+    - torch: PyTorch 深度学习框架
+"""
+
+import os
+import sys
+from collections import OrderedDict
+from typing import Optional
+
+import torch
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch04.main.gpt_model import GPTModel
+
+
+class KVCache:
+    """
+    预分配的多层 KV 缓存
+
+    属性:
+        keys, values: 形状 (n_layers, batch_size, n_heads, max_len, head_dim) 的缓冲区
+        lengths: 形状 (batch_size,) 的 LongTensor，每行已缓存的 token 数（包括左填充）
+        starts: 形状 (batch_size,) 的 LongTensor，每行左填充的 token 数（默认全 0）
+
+    方法:
+        layer: 返回某一层的缓存视图，交给注意力层读写
+        positions: 新 token 的绝对位置（用于位置嵌入）
+        advance: 所有层写完后把缓存长度前移
+        truncate: 把缓存长度回退到指定值
+    """
+
+    def __init__(self, n_layers: int, batch_size: int, n_heads: int, max_len: int,
+                 head_dim: int, dtype=torch.float32, device=None):
+        """
+        参数:
+            n_layers (int): Transformer 层数
+            batch_size (int): 同时生成的序列数
+            n_heads (int): 注意力头数
+            max_len (int): 每行最多缓存的 token 数（不能超过模型的 ctx_len）
+            head_dim (int): 每个头的维度
+            dtype: 缓存的数据类型，应与模型一致
+            device: 缓存所在设备
+        """
+        shape = (n_layers, batch_size, n_heads, max_len, head_dim)
+        self.keys = torch.zeros(shape, dtype=dtype, device=device)
+        self.values = torch.zeros(shape, dtype=dtype, device=device)
+        self.lengths = torch.zeros(batch_size, dtype=torch.long, device=device)
+        self.starts = torch.zeros(batch_size, dtype=torch.long, device=device)
+        self.max_len = max_len
+
+    @classmethod
+    def for_model(cls, model: GPTModel, batch_size: int, max_len: Optional[int] = None) -> "KVCache":
+        """
+        按模型配置创建缓存
+
+        参数:
+            model: GPT 模型
+            batch_size (int): 同时生成的序列数
+            max_len (int): 最大缓存长度，默认等于模型的上下文长度
+        """
+        cfg = model.cfg
+        max_len = cfg.ctx_len if max_len is None else max_len
+        if max_len > cfg.ctx_len:
+            raise ValueError(f"max_len={max_len} 超过了模型的上下文长度 {cfg.ctx_len}")
+        param = next(model.parameters())
+        return cls(cfg.n_layers, batch_size, cfg.n_heads, max_len,
+                   cfg.emb_dim // cfg.n_heads, dtype=param.dtype, device=param.device)
+
+    @property
+    def batch_size(self) -> int:
+        """缓存的行数（同时生成的序列数）"""
+        return self.lengths.shape[0]
+
+    def layer(self, index: int) -> "LayerKVCache":
+        """返回第 index 层的缓存视图"""
+        return LayerKVCache(self, index)
+
+    def set_left_padding(self, pad_lengths: torch.Tensor) -> None:
+        """
+        声明每行左侧有 pad_lengths[b] 个填充 token（在预填充之前调用）
+
+        填充的槽位仍然写入缓存，但对所有 query 不可见；真实 token 的位置编号从 0 开始
+        """
+        self.starts.copy_(pad_lengths)
+
+    def slots(self, num_new: int) -> torch.Tensor:
+        """
+        新 token 写入的槽位
+
+        返回:
+            Tensor: 形状 (batch_size, num_new)，第 b 行为 lengths[b], lengths[b]+1, ...
+        """
+        offsets = torch.arange(num_new, device=self.lengths.device)
+        return self.lengths[:, None] + offsets
+
+    def positions(self, num_new: int) -> torch.Tensor:
+        """
+        新 token 的绝对位置（用于位置嵌入）：槽位减去左填充的长度
+
+        返回:
+            Tensor: 形状 (batch_size, num_new)；填充 token 的位置记为 0（它们的输出不会被使用）
+        """
+        return (self.slots(num_new) - self.starts[:, None]).clamp(min=0)
+
+    def advance(self, num_new: int) -> None:
+        """所有层都写入了 num_new 个新 token 后调用"""
+        self.lengths += num_new
+
+    def truncate(self, lengths) -> None:
+        """
+        把每行的缓存长度回退到 lengths（int 或形状 (batch_size,) 的张量）
+
+        只改长度、不清数据：超出长度的旧 K/V 会被注意力掩码屏蔽，之后被新数据覆盖
+        """
+        if isinstance(lengths, int):
+            self.lengths.fill_(lengths)
+        else:
+            self.lengths.copy_(lengths)
+
+    def reset(self) -> None:
+        """清空缓存（长度和左填充归零）"""
+        self.lengths.zero_()
+        self.starts.zero_()
+
+    def narrow(self, batch_size: int) -> "KVCache":
+        """
+        返回只包含前 batch_size 行的缓存视图（与原缓存共享存储，不拷贝数据）
+
+        连续批处理时把活跃序列集中在前几行，解码时只对这几行做前向
+        """
+        view = KVCache.__new__(KVCache)
+        view.keys = self.keys[:, :batch_size]
+        view.values = self.values[:, :batch_size]
+        # 切片是视图，advance 中的原地加法会同步修改原缓存的长度
+        view.lengths = self.lengths[:batch_size]
+        view.starts = self.starts[:batch_size]
+        view.max_len = self.max_len
+        return view
+
+    def copy_row(self, dst: int, src_cache: "KVCache", src: int = 0) -> None:
+        """
+        把 src_cache 第 src 行的缓存内容（按其长度）拷贝到本缓存的第 dst 行
+
+        用途：单独预填充新请求后放入批次的空闲行；或在批次内移动一行
+        """
+        n = int(src_cache.lengths[src])
+        self.keys[:, dst, :, :n] = src_cache.keys[:, src, :, :n]
+        self.values[:, dst, :, :n] = src_cache.values[:, src, :, :n]
+        self.lengths[dst] = n
+        self.starts[dst] = src_cache.starts[src]
+
+    def write(self, layer: int, keys: torch.Tensor, values: torch.Tensor, window: Optional[int] = None):
+        """
+        把第 layer 层新 token 的 K/V 写入缓存，返回注意力需要的全部 K/V 和掩码
+
+        参数:
+            layer (int): 层号
+            keys, values (Tensor): 新 token 的 K/V，形状 (batch_size, n_heads, T_new, head_dim)
+            window (int): 注意力层的滑动窗口大小，None 表示看到全部历史；返回的掩码会同时套用窗口
+
+        返回:
+            tuple: (keys_all, values_all, attn_mask)
+                keys_all / values_all: 形状 (batch_size, n_heads, L, head_dim)，L = 写入后的最大长度
+                attn_mask: 布尔掩码 (batch_size, 1, T_new, L)，True 表示可见；
+                           各行长度相同时可能为 None（由注意力层套用标准规则）
+        """
+        num_new = keys.shape[2]
+        lengths = self.lengths
+        start = int(lengths.min())
+        end = int(lengths.max()) + num_new
+        if end > self.max_len:
+            raise ValueError(f"KV 缓存已满：需要 {end} 个位置，最多 {self.max_len}")
+
+        if start + num_new == end:
+            # 快速路径：所有行长度相同，直接切片写入
+            self.keys[layer, :, :, start:end] = keys
+            self.values[layer, :, :, start:end] = values
+            # 没有历史（首次预填充）时用标准因果掩码；只有 1 个新 token 时历史全部可见；
+            # 有左填充时必须用掩码屏蔽填充的槽位
+            if (start == 0 or num_new == 1) and not bool(self.starts.any()):
+                attn_mask = None
+            else:
+                attn_mask = self._visibility_mask(num_new, end, window)
+        else:
+            # 各行长度不同：用高级索引把第 b 行写到 lengths[b] 开始的位置
+            # 索引结果的形状是 (b, T_new, H, head_dim)，所以需要先交换 H 和 T 维
+            rows = torch.arange(self.batch_size, device=lengths.device)[:, None]
+            cols = self.slots(num_new)
+            self.keys[layer][rows, :, cols] = keys.transpose(1, 2)
+            self.values[layer][rows, :, cols] = values.transpose(1, 2)
+            attn_mask = self._visibility_mask(num_new, end, window)
+
+        return self.keys[layer, :, :, :end], self.values[layer, :, :, :end], attn_mask
+
+    def _visibility_mask(self, num_new: int, total: int, window: Optional[int] = None) -> torch.Tensor:
+        """
+        可见性掩码：槽位 p 的 query 只能看到槽位 <= p、且不是左填充的 key；
+        有滑动窗口时还要求槽位 > p - window（真实 token 的槽位差就是位置差）
+
+        返回:
+            Tensor: (batch_size, 1, num_new, total) 的布尔张量
+
+        注意:
+            - 填充 token 自己的 query 只看到它自己，避免整行都被屏蔽导致 softmax 得到 NaN
+              （NaN 会通过 0 × NaN 污染其他行读取的 V）
+        """
+        query_slot = self.slots(num_new)[:, :, None]  # (b, T_new, 1)
+        key_slot = torch.arange(total, device=self.lengths.device)[None, None, :]  # (1, 1, L)
+        visible = (key_slot <= query_slot) & ((key_slot >= self.starts[:, None, None]) | (key_slot == query_slot))
+        if window is not None:
+            visible &= key_slot > query_slot - window
+        return visible[:, None]
+
+
+class LayerKVCache:
+    """某一层的缓存视图：注意力层只需要调用 update"""
+
+    __slots__ = ("cache", "index")
+
+    def __init__(self, cache: KVCache, index: int):
+        """
+        参数:
+            cache: 所属的 KVCache
+            index (int): 层号
+        """
+        self.cache = cache
+        self.index = index
+
+    def update(self, keys: torch.Tensor, values: torch.Tensor, window: Optional[int] = None):
+        """
+        写入这一层新 token 的 K/V，返回注意力需要的全部 K/V 和掩码（见 KVCache.write）
+
+        参数:
+            keys, values (Tensor): (batch_size, n_heads, T_new, head_dim)
+            window (int): 注意力层的滑动窗口大小，None 表示看到全部历史
+
+        返回:
+            tuple: (keys_all, values_all, attn_mask)
+        """
+        return self.cache.write(self.index, keys, values, window)
+
+
+class PrefixCache:
+    """
+    共享前缀的 K/V 缓存（LRU）
+
+    多次生成共享同一个前缀（例如相同的系统提示词）时，
+    前缀部分的 K/V 只需计算一次，之后直接拷贝进新的 KVCache。
+
+    属性:
+        capacity: 最多保存的前缀数，超出时淘汰最久未使用的
+    """
+
+    def __init__(self, capacity: int = 8):
+        """
+        参数:
+            capacity (int): 最多保存的前缀数
+        """
+        self.capacity = capacity
+        # {前缀 token 元组: (keys, values)}，keys 形状 (n_layers, n_heads, P, head_dim)
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        """当前保存的前缀数"""
+        return len(self._entries)
+
+    def store(self, prefix_ids, cache: KVCache, row: int = 0) -> None:
+        """
+        从 cache 的第 row 行保存前缀的 K/V（前缀必须已经写入该行）
+
+        参数:
+            prefix_ids: 前缀 token ID 序列
+            cache: 已完成预填充的 KVCache
+            row (int): 从哪一行拷贝
+        """
+        key = tuple(int(t) for t in prefix_ids)
+        n = len(key)
+        if n == 0 or key in self._entries:
+            return
+        self._entries[key] = (
+            cache.keys[:, row, :, :n].clone(),
+            cache.values[:, row, :, :n].clone(),
+        )
+        if len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def load_longest(self, idx: torch.Tensor, cache: KVCache, max_len: int) -> int:
+        """
+        找到 idx 所有行共同拥有的最长已缓存前缀，拷贝进 cache 的每一行
+
+        参数:
+            idx (Tensor): 提示词 token，形状 (batch_size, n_tokens)
+            cache: 空的 KVCache
+            max_len (int): 最多复用多少个 token（至少要留 1 个 token 做预填充来得到 logits）
+
+        返回:
+            int: 复用的前缀长度（0 表示没有命中）
+        """
+        best = None
+        for key in self._entries:
+            n = len(key)
+            if n <= max_len and (best is None or n > len(best)):
+                prefix = torch.tensor(key, device=idx.device)
+                if torch.equal(idx[:, :n], prefix.expand(idx.shape[0], n)):
+                    best = key
+        if best is None:
+            return 0
+
+        self._entries.move_to_end(best)  # 标记为最近使用
+        keys, values = self._entries[best]
+        n = len(best)
+        # (n_layers, H, P, hd) -> 广播到每一行 (n_layers, b, H, P, hd)
+        cache.keys[:, :, :, :n] = keys[:, None]
+        cache.values[:, :, :, :n] = values[:, None]
+        cache.truncate(n)
+        return n
+
+
+def _common_prefix_len(idx: torch.Tensor) -> int:
+    """batch 中所有行共同前缀的长度"""
+    same = (idx == idx[:1]).all(dim=0)  # (n_tokens,) 每个位置是否所有行都相同
+    mismatch = (~same).nonzero()
+    return int(mismatch[0]) if len(mismatch) else idx.shape[1]
+
+
+@torch.no_grad()
+def generate_with_cache(model: GPTModel, idx: torch.Tensor, max_new_tokens: int,
+                        prefix_cache: Optional[PrefixCache] = None,
+                        prefix_len: Optional[int] = None) -> torch.Tensor:
+    """
+    使用 KV 缓存的贪心生成（结果与 generate_text_simple 一致）
+
+    流程:
+        1. 预填充（prefill）：一次前向处理整个提示词，把 K/V 写入缓存
+           （如果提供了 prefix_cache，命中的前缀直接拷贝，只预填充剩余部分）
+        2. 解码（decode）：每步只把上一步生成的 1 个 token 送入模型
+
+    参数:
+        model: GPT 模型
+        idx (Tensor): 提示词 token，形状 (batch_size, n_tokens)
+        max_new_tokens (int): 生成的新 token 数
+        prefix_cache (PrefixCache): 可选，跨调用复用共享前缀的 K/V
+        prefix_len (int): 可选，要保存到 prefix_cache 的前缀长度（例如系统提示词的 token 数）；
+                          默认保存 batch 内所有行的最长公共前缀
+
+    返回:
+        Tensor: 形状 (batch_size, n_tokens + max_new_tokens)
+
+    注意:
+        - 提示词长度 + max_new_tokens 不能超过模型的 ctx_len
+          （缓存版本不做滑动窗口截断）
+    """
+    batch_size, n_prompt = idx.shape
+    total = n_prompt + max_new_tokens
+    if total > model.cfg.ctx_len:
+        raise ValueError(
+            f"提示词长度 {n_prompt} + 生成长度 {max_new_tokens} 超过上下文长度 {model.cfg.ctx_len}"
+        )
+
+    cache = KVCache.for_model(model, batch_size, max_len=total)
+
+    # Step 1: 预填充（至少留 1 个提示词 token 走前向，才能拿到最后位置的 logits）
+    reused = 0
+    if prefix_cache is not None:
+        reused = prefix_cache.load_longest(idx, cache, max_len=n_prompt - 1)
+    logits = model(idx[:, reused:], kv_cache=cache)
+
+    if prefix_cache is not None:
+        # 只能保存所有行都相同的那部分前缀
+        n_shared = _common_prefix_len(idx)
+        if prefix_len is not None:
+            n_shared = min(n_shared, prefix_len)
+        prefix_cache.store(idx[0, :n_shared], cache)
+
+    # Step 2: 逐个解码，每步只输入 1 个新 token
+    # 预先分配输出张量，避免每步 torch.cat
+    out = torch.empty(batch_size, total, dtype=idx.dtype, device=idx.device)
+    out[:, :n_prompt] = idx
+    for step in range(max_new_tokens):
+        idx_next = torch.argmax(logits[:, -1, :], dim=-1, keepdim=True)  # (b, 1)
+        out[:, n_prompt + step] = idx_next[:, 0]
+        if step + 1 < max_new_tokens:
+            logits = model(idx_next, kv_cache=cache)
+    return out
+
+
+if __name__ == "__main__":
+    from ch04.main.gpt_model import GPTConfig, generate_text_simple
+
+    torch.manual_seed(123)
+    cfg = GPTConfig(ctx_len=256, emb_dim=256, n_heads=4, n_layers=4)
+    model = GPTModel(cfg).eval()
+
+    prompt = torch.randint(0, cfg.vocab_size, (2, 16))
+    expected = generate_text_simple(model, prompt, max_new_tokens=32, context_size=cfg.ctx_len)
+    actual = generate_with_cache(model, prompt, max_new_tokens=32)
+    print(f"{'✅' if torch.equal(expected, actual) else '❌'} KV 缓存生成结果与无缓存版本一致")
+
+    # 共享前缀：第二次调用命中前缀缓存
+    prefix_cache = PrefixCache()
+    system = torch.randint(0, cfg.vocab_size, (1, 32))
+    first = torch.cat([system, torch.randint(0, cfg.vocab_size, (1, 4))], dim=1)
+    second = torch.cat([system, torch.randint(0, cfg.vocab_size, (1, 4))], dim=1)
+    generate_with_cache(model, first, 8, prefix_cache=prefix_cache, prefix_len=system.shape[1])
+    reused_out = generate_with_cache(model, second, 8, prefix_cache=prefix_cache)
+    fresh_out = generate_with_cache(model, second, 8)
+    print(f"{'✅' if torch.equal(reused_out, fresh_out) else '❌'} 复用前缀后的生成结果与完整预填充一致")
@@ -0,0 +1,275 @@
+"""
+第4章扩展：投机解码（Speculative Decoding）
+
+在 CPU 上，大模型每生成一个 token 就要完整地前向一次，延迟几乎全部花在这里。
+投机解码用一个小的草稿模型（draft）先连续猜 k 个 token，
+再让大模型（target）一次前向同时验证这 k 个 token：
+验证 k+1 个位置的成本和生成 1 个位置相差不大（都受权重读取带宽限制），
+只要草稿猜得足够准，每次大模型前向就能产出多个 token。
+
+核心概念：
+    - 草稿（draft）：小模型自回归生成 k 个候选 token，并记录每步的分布 q
+    - 验证（verify）：大模型对 [上一个 token, d1, ..., dk] 做一次前向，得到 k+1 个分布 p
+    - 拒绝采样：以 min(1, p(d)/q(d)) 的概率接受草稿 token；第一次拒绝时
+      从 norm(max(0, p - q)) 中重新采样。这样得到的序列与只用大模型采样的分布完全相同
+    - 贪心解码时退化为：草稿 token 等于大模型 argmax 就接受，结果与大模型贪心解码逐 token 一致
+    - 回滚：被拒绝的 token 已经写进了 KV 缓存，只需用 KVCache.truncate 把长度改回去
+
+草稿模型：
+    可以是单独训练的小 GPT（同一个 GPTConfig 类，词表必须相同），
+    也可以用 make_layer_skip_draft 从大模型截取前几层得到（共享嵌入和输出头，无需额外训练）
+
+依赖：
+    - torch: PyTorch 深度学习框架
+"""
+
+import copy
+import os
+import sys
+from dataclasses import dataclass, replace
+from typing import Optional
+
+import torch
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch04.main.gpt_model import GPTModel
+from ch04.main.kv_cache import KVCache
+
+
+@dataclass
+class SpeculativeStats:
+    """
+    投机解码的统计信息
+
+    属性:
+        proposed: 草稿模型提出的 token 总数
+        accepted: 被大模型接受的草稿 token 数
+        target_forwards: 大模型前向次数（不含预填充）
+        draft_forwards: 草稿模型前向次数（不含预填充）
+        generated: 生成的新 token 总数
+    """
+
+    proposed: int = 0
+    accepted: int = 0
+    target_forwards: int = 0
+    draft_forwards: int = 0
+    generated: int = 0
+
+    @property
+    def acceptance_rate(self) -> float:
+        """草稿 token 被接受的比例（还没有提出草稿时为 0）"""
+        return self.accepted / self.proposed if self.proposed else 0.0
+
+    @property
+    def tokens_per_target_forward(self) -> float:
+        """每次大模型前向平均产出的 token 数（不用投机解码时为 1）"""
+        return self.generated / self.target_forwards if self.target_forwards else 0.0
+
+
+def make_layer_skip_draft(target: GPTModel, n_layers: int) -> GPTModel:
+    """
+    截取大模型的前 n_layers 层作为草稿模型
+
+    嵌入、最终层归一化和输出头直接复用大模型的权重（拷贝一份），
+    不需要额外训练，适合没有现成小模型时使用。
+
+    参数:
+        target: 大模型
+        n_layers (int): 草稿模型保留的层数
+
+    返回:
+        GPTModel: 草稿模型（eval 模式）
+    """
+    if not 0 < n_layers < target.cfg.n_layers:
+        raise ValueError(f"n_layers 必须在 1 到 {target.cfg.n_layers - 1} 之间")
+    draft = GPTModel(replace(target.cfg, n_layers=n_layers))
+    state = {k: v for k, v in target.state_dict().items()
+             if not k.startswith("trf_blocks.") or int(k.split(".")[1]) < n_layers}
+    draft.load_state_dict(copy.deepcopy(state))
+    param = next(target.parameters())
+    return draft.to(device=param.device, dtype=param.dtype).eval()
+
+
+def _probs(logits: torch.Tensor, temperature: float) -> torch.Tensor:
+    """logits -> 概率分布（temperature 只在采样时使用）"""
+    return torch.softmax(logits.float() / temperature, dim=-1)
+
+
+def _pick(logits: torch.Tensor, temperature: float, generator) -> int:
+    """从一个位置的 logits 中选出 token：温度为 0 时贪心，否则采样"""
+    if temperature == 0.0:
+        return int(torch.argmax(logits))
+    return int(torch.multinomial(_probs(logits, temperature), 1, generator=generator))
+
+
+@torch.no_grad()
+def sample_with_cache(model: GPTModel, idx: torch.Tensor, max_new_tokens: int,
+                      temperature: float = 0.0,
+                      generator: Optional[torch.Generator] = None) -> torch.Tensor:
+    """
+    普通的逐 token 生成（使用 KV 缓存），作为投机解码的对照
+
+    参数:
+        model: GPT 模型
+        idx (Tensor): 提示词，形状 (1, n_tokens)
+        max_new_tokens (int): 生成的新 token 数
+        temperature (float): 采样温度，0 表示贪心
+        generator: 可选的随机数生成器
+
+    返回:
+        Tensor: 形状 (1, n_tokens + max_new_tokens)
+    """
+    total = idx.shape[1] + max_new_tokens
+    cache = KVCache.for_model(model, 1, max_len=total)
+    out = idx[0].tolist()
+    logits = model(idx, kv_cache=cache)[0, -1]
+    for step in range(max_new_tokens):
+        out.append(_pick(logits, temperature, generator))
+        if step + 1 < max_new_tokens:
+            logits = model(torch.tensor([[out[-1]]], device=idx.device), kv_cache=cache)[0, -1]
+    return torch.tensor([out], dtype=idx.dtype, device=idx.device)
+
+
+@torch.no_grad()
+def speculative_generate(target: GPTModel, draft: GPTModel, idx: torch.Tensor,
+                         max_new_tokens: int, draft_len: int = 4, temperature: float = 0.0,
+                         generator: Optional[torch.Generator] = None):
+    """
+    投机解码生成
+
+    流程（每一轮）:
+        1. 草稿模型从上一个 token 开始自回归生成 k 个候选 d1..dk，记录分布 q1..qk
+        2. 大模型一次前向处理 [上一个 token, d1, ..., dk]，得到分布 p1..p(k+1)
+        3. 依次以 min(1, p_i(d_i) / q_i(d_i)) 的概率接受 d_i；
+           第一次拒绝时从 norm(max(0, p_i - q_i)) 采样一个修正 token，本轮结束；
+           全部接受时再从 p(k+1) 多采样一个 token
+        4. 两个模型的 KV 缓存回滚到已确认的长度
+
+    参数:
+        target: 大模型
+        draft: 草稿模型（词表必须与大模型相同）
+        idx (Tensor): 提示词，形状 (1, n_tokens)
+        max_new_tokens (int): 生成的新 token 数
+        draft_len (int): 每轮草稿长度 k
+        temperature (float): 采样温度；0 表示贪心，此时结果与大模型贪心解码一致
+        generator: 可选的随机数生成器（只影响采样模式）
+
+    返回:
+        tuple[Tensor, SpeculativeStats]: 形状 (1, n_tokens + max_new_tokens) 的结果和统计信息
+
+    注意:
+        - 只支持 batch_size=1：不同行每轮接受的 token 数不同，批处理收益有限
+        - 提示词长度 + max_new_tokens 不能超过两个模型中较小的 ctx_len
+    """
+    if idx.shape[0] != 1:
+        raise ValueError("投机解码只支持 batch_size=1")
+    if target.cfg.vocab_size != draft.cfg.vocab_size:
+        raise ValueError("草稿模型和大模型的词表大小必须相同")
+    if draft_len < 1:
+        raise ValueError("draft_len 至少为 1")
+
+    n_prompt = idx.shape[1]
+    total = n_prompt + max_new_tokens
+    ctx_len = min(target.cfg.ctx_len, draft.cfg.ctx_len)
+    if total > ctx_len:
+        raise ValueError(f"提示词长度 {n_prompt} + 生成长度 {max_new_tokens} 超过上下文长度 {ctx_len}")
+    device = idx.device
+    stats = SpeculativeStats()
+
+    # 验证时大模型一次会多写入 k 个尚未确认的 token，所以缓存要留出余量
+    target_cache = KVCache.for_model(target, 1, max_len=min(total + draft_len, target.cfg.ctx_len))
+    draft_cache = KVCache.for_model(draft, 1, max_len=min(total + draft_len, draft.cfg.ctx_len))
+
+    # 约定：两个缓存都包含除最后一个 token 以外的全部已确认 token，
+    # 最后一个 token 在下一轮作为两个模型的第一个输入
+    out = idx[0].tolist()
+    if n_prompt > 1:
+        target(idx[:, :-1], kv_cache=target_cache)
+        draft(idx[:, :-1], kv_cache=draft_cache)
+
+    while len(out) < total:
+        # 最后一轮不需要猜超过剩余数量的 token
+        k = min(draft_len, total - len(out))
+        confirmed = len(out) - 1  # 两个缓存中已确认的长度
+
+        # Step 1: 草稿模型自回归提出 k 个候选
+        proposals, draft_logits = [], []
+        token = out[-1]
+        for _ in range(k):
+            logits = draft(torch.tensor([[token]], device=device), kv_cache=draft_cache)[0, -1]
+            token = _pick(logits, temperature, generator)
+            proposals.append(token)
+            draft_logits.append(logits)
+        stats.draft_forwards += k
+        stats.proposed += k
+
+        # Step 2: 大模型一次前向验证所有候选
+        verify_ids = torch.tensor([[out[-1]] + proposals], device=device)
+        target_logits = target(verify_ids, kv_cache=target_cache)[0]  # (k+1, vocab)
+        stats.target_forwards += 1
+
+        # Step 3: 逐个接受或拒绝
+        n_accepted = 0
+        correction = None
+        for i, proposed in enumerate(proposals):
+            if temperature == 0.0:
+                best = int(torch.argmax(target_logits[i]))
+                if best == proposed:
+                    n_accepted += 1
+                    continue
+                correction = best
+                break
+
+            p = _probs(target_logits[i], temperature)
+            q = _probs(draft_logits[i], temperature)
+            accept_prob = torch.clamp(p[proposed] / q[proposed], max=1.0)
+            if torch.rand((), generator=generator, device=accept_prob.device) < accept_prob:
+                n_accepted += 1
+                continue
+            # 被拒绝：从残差分布 max(0, p - q) 中采样，保证整体分布等于 p
+            residual = torch.clamp(p - q, min=0.0)
+            if residual.sum() <= 0:
+                residual = p
+            correction = int(torch.multinomial(residual / residual.sum(), 1, generator=generator))
+            break
+
+        if correction is None:
+            # 全部接受：大模型在最后一个位置的预测"免费"多给一个 token
+            correction = _pick(target_logits[k], temperature, generator)
+
+        new_tokens = proposals[:n_accepted] + [correction]
+        new_tokens = new_tokens[:total - len(out)]
+        out.extend(new_tokens)
+        stats.accepted += n_accepted
+        stats.generated += len(new_tokens)
+
+        # Step 4: 回滚到 "除最后一个 token 外全部已确认" 的状态
+        # 大模型写入了 上一个 token + k 个候选，保留 上一个 token + 接受的部分
+        target_cache.truncate(confirmed + 1 + n_accepted)
+        if n_accepted == k:
+            # 草稿模型只写入了 上一个 token + d1..d(k-1)，还差 dk
+            if len(out) < total:
+                draft(torch.tensor([[proposals[-1]]], device=device), kv_cache=draft_cache)
+                stats.draft_forwards += 1
+        else:
+            draft_cache.truncate(confirmed + 1 + n_accepted)
+
+    return torch.tensor([out], dtype=idx.dtype, device=device), stats
+
+
+if __name__ == "__main__":
+    from ch04.main.gpt_model import GPTConfig
+
+    torch.manual_seed(123)
+    cfg = GPTConfig(ctx_len=256, emb_dim=256, n_heads=4, n_layers=6, drop_prob=0.0)
+    target = GPTModel(cfg).eval()
+    draft = make_layer_skip_draft(target, n_layers=1)
+
+    prompt = torch.randint(0, cfg.vocab_size, (1, 16))
+    expected = sample_with_cache(target, prompt, max_new_tokens=48)
+    actual, stats = speculative_generate(target, draft, prompt, max_new_tokens=48, draft_len=4)
+    print(f"{'✅' if torch.equal(expected, actual) else '❌'} 贪心投机解码结果与大模型贪心解码一致")
+    print(f"接受率: {stats.acceptance_rate:.1%}, 每次大模型前向产出 {stats.tokens_per_target_forward:.2f} 个 token")
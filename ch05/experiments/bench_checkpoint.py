@@ -0,0 +1,171 @@
+"""
+实验：torch.save / torch.load 与 扁平张量 + JSON 索引 检查点的对比
+
+报告三组数字：
+    1. 保存：训练线程被阻塞的时间
+       - torch.save（同步，pickle）
+       - save_checkpoint（同步，直接写原始字节）
+       - AsyncCheckpointer（只阻塞快照的时间；第一次需要分配快照缓冲区，之后复用）
+    2. 恢复：从文件到模型和优化器可以继续训练的时间
+       - torch.load + load_state_dict
+       - load_checkpoint（内存映射）+ load_state_dict
+       - load_checkpoint（内存映射）+ load_state_dict(assign=True)（只恢复模型，参数直接指向映射）
+    3. 训练中保存：每隔 save_freq 步异步保存一次时，每步耗时相对不保存时的增加
+
+注意：刚写完的文件还在操作系统的页缓存里，这里测到的加载时间是"热缓存"下的结果；
+冷启动时内存映射的优势更大（只读需要的页）。
+
+运行方式：
+    python ch05/experiments/bench_checkpoint.py                                        # GPT-2 124M
+    python ch05/experiments/bench_checkpoint.py --emb-dim 256 --n-layers 4 --n-heads 4
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import torch
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch04.main.gpt_model import GPTConfig, GPTModel
+from ch05.main.checkpoint import AsyncCheckpointer, load_checkpoint, save_checkpoint
+from ch05.main.train import TrainConfig, Trainer
+
+
+def timed_ms(fn):
+    """
+    调用一次 fn 并计时
+
+    返回:
+        tuple[float, Any]: (耗时毫秒, fn 的返回值)
+    """
+    start = time.perf_counter()
+    result = fn()
+    return (time.perf_counter() - start) * 1e3, result
+
+
+def random_batch(model_cfg: GPTConfig, batch_size: int):
+    """随机 token 组成的一个 batch，目标是输入左移一位"""
+    inputs = torch.randint(0, model_cfg.vocab_size, (batch_size, model_cfg.ctx_len))
+    return inputs, torch.roll(inputs, -1, dims=1)
+
+
+def make_trainer(model_cfg: GPTConfig) -> Trainer:
+    """固定种子新建模型和 Trainer（关闭评估），各组对比从相同的权重开始"""
+    torch.manual_seed(123)
+    return Trainer(GPTModel(model_cfg), TrainConfig(eval_freq=0))
+
+
+def bench_save(trainer: Trainer, tmp: str) -> None:
+    """对比 torch.save、同步 save_checkpoint 和 AsyncCheckpointer（首次 / 复用缓冲区）阻塞训练线程的时间"""
+    state = trainer.state_dict()
+    nbytes = sum(t.numel() * t.element_size() for t in trainer.model.parameters()) * 3
+    print(f"\n保存（模型 + AdamW 状态，约 {nbytes / 1e6:.0f} MB），训练线程阻塞时间:")
+
+    ms, _ = timed_ms(lambda: torch.save(state, os.path.join(tmp, "torch.pt")))
+    print(f"  torch.save                      {ms:9.1f} ms")
+    ms, _ = timed_ms(lambda: save_checkpoint(state, os.path.join(tmp, "sync")))
+    print(f"  save_checkpoint（同步）          {ms:9.1f} ms")
+
+    with AsyncCheckpointer() as checkpointer:
+        for i in range(3):
+            stats = checkpointer.save(state, os.path.join(tmp, f"async-{i}"))
+            checkpointer.wait()
+            label = "首次，分配缓冲区" if i == 0 else "复用缓冲区"
+            print(f"  AsyncCheckpointer（{label}）{stats.stall_ms:9.1f} ms"
+                  f"   后台写入 {stats.write_ms:.1f} ms")
+
+
+def bench_resume(model_cfg: GPTConfig, tmp: str) -> None:
+    """对比从 torch.save 文件、内存映射检查点以及 assign=True 恢复到可以继续训练的耗时"""
+    print("\n恢复（到模型和优化器可以继续训练）:")
+
+    def torch_resume():
+        """torch.load 读入整个文件后 load_state_dict"""
+        trainer = make_trainer(model_cfg)
+        trainer.load_state_dict(torch.load(os.path.join(tmp, "torch.pt"), weights_only=False))
+
+    def mmap_resume():
+        """Trainer.resume：内存映射读取检查点后 load_state_dict"""
+        trainer = make_trainer(model_cfg)
+        trainer.resume(os.path.join(tmp, "sync"))
+
+    def assign_model_only():
+        """只恢复模型，load_state_dict(assign=True) 让参数直接指向内存映射"""
+        model = GPTModel(model_cfg)
+        state, _ = load_checkpoint(os.path.join(tmp, "sync"))
+        model.load_state_dict(state["model"], assign=True)
+
+    # 三者都包含建模型的时间，单独列出作为基准
+    build_ms, _ = timed_ms(lambda: make_trainer(model_cfg))
+    for name, fn in (("torch.load + load_state_dict", torch_resume),
+                     ("load_checkpoint（mmap）", mmap_resume),
+                     ("load_checkpoint + assign（仅模型）", assign_model_only)):
+        ms, _ = timed_ms(fn)
+        print(f"  {name:<34} {ms:9.1f} ms")
+    print(f"  （其中新建模型和优化器约 {build_ms:.1f} ms）")
+    load_ms, _ = timed_ms(lambda: load_checkpoint(os.path.join(tmp, "sync")))
+    print(f"  仅 load_checkpoint 建立映射        {load_ms:9.1f} ms")
+
+
+def bench_training_stall(model_cfg: GPTConfig, batch_size: int, steps: int, save_freq: int,
+                         tmp: str) -> None:
+    """训练 steps 步，对比不保存和每 save_freq 步异步保存一次时的平均每步耗时"""
+    print(f"\n训练中保存（{steps} 步，每 {save_freq} 步异步保存一次）:")
+    results = {}
+    for label, save_dir in (("不保存", None), ("异步保存", os.path.join(tmp, "train"))):
+        trainer = make_trainer(model_cfg)
+        batch = random_batch(model_cfg, batch_size)
+        trainer.train_step(*batch)  # 预热，不计入
+        trainer.history.step_times_ms.clear()
+        for _ in range(steps):
+            trainer.train_step(*batch)
+            if save_dir and trainer.global_step % save_freq == 0:
+                trainer.save_checkpoint(os.path.join(save_dir, f"step-{trainer.global_step:06d}"))
+        if trainer.checkpointer is not None:
+            trainer.checkpointer.close()
+        times = trainer.history.step_times_ms
+        results[label] = sum(times) / len(times)
+        if trainer.checkpointer is not None:
+            stalls = [s.stall_ms for s in trainer.checkpointer.history]
+            print(f"  每次保存的阻塞: {', '.join(f'{s:.0f}' for s in stalls)} ms")
+    base = results["不保存"]
+    print(f"  平均每步: 不保存 {base:.0f} ms，异步保存 {results['异步保存']:.0f} ms"
+          f"（+{(results['异步保存'] / base - 1):.1%}，后台写文件与训练争用 CPU 和内存带宽）")
+
+
+def main():
+    """在临时目录中依次运行保存、恢复和训练中保存三组对比，结束后删除临时文件"""
+    parser = argparse.ArgumentParser(description="检查点保存 / 恢复耗时对比")
+    parser.add_argument("--emb-dim", type=int, default=768)
+    parser.add_argument("--n-layers", type=int, default=12)
+    parser.add_argument("--n-heads", type=int, default=12)
+    parser.add_argument("--ctx-len", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--steps", type=int, default=6, help="训练中保存实验的步数")
+    parser.add_argument("--save-freq", type=int, default=2)
+    parser.add_argument("--tmp-dir", default=None, help="检查点写到这个目录（默认系统临时目录）")
+    args = parser.parse_args()
+
+    model_cfg = GPTConfig(ctx_len=args.ctx_len, emb_dim=args.emb_dim, n_layers=args.n_layers,
+                          n_heads=args.n_heads)
+    tmp = tempfile.mkdtemp(dir=args.tmp_dir)
+    try:
+        trainer = make_trainer(model_cfg)
+        trainer.train_step(*random_batch(model_cfg, args.batch_size))  # 让 AdamW 状态存在
+        bench_save(trainer, tmp)
+        del trainer
+        bench_resume(model_cfg, tmp)
+        bench_training_stall(model_cfg, args.batch_size, args.steps, args.save_freq, tmp)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+实验：评估引擎 vs 书中的逐 batch 评估循环
+
+在同一个验证集上比较：
+    - 书中写法（开启 autograd）：逐 batch 前向，会为反向传播保存中间结果
+    - calc_loss_loader（no_grad）：训练时的 batch 大小，每次评估都重新经过 DataLoader
+    - Evaluator 完整评估：inference_mode、更大的 batch、缓存窗口、按 token 加权累积
+    - Evaluator 固定子集：训练中每 eval_freq 步执行的评估
+报告耗时、常驻内存峰值（独立子进程），以及按 eval_freq 步评估一次时评估占训练时间的比例。
+
+运行方式：
+    python ch05/experiments/bench_evaluation.py
+    python ch05/experiments/bench_evaluation.py --n-windows 128 --eval-batch-size 16 --eval-freq 100
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch02.main.dataloader import create_token_dataloader
+from ch04.main.gpt_model import GPTConfig, GPTModel
+from ch05.main.evaluation import EvalWindows, Evaluator
+from ch05.main.train import TrainConfig, Trainer, calc_loss_batch, calc_loss_loader
+from setup.benchmark import measure_peak_memory_mb
+
+METHODS = ("autograd", "no_grad", "evaluator", "subset")
+METHOD_NAMES = {
+    "autograd": "书中写法（开启 autograd）",
+    "no_grad": "calc_loss_loader（no_grad）",
+    "evaluator": "Evaluator 完整评估",
+    "subset": "Evaluator 固定子集",
+}
+
+
+def build(model_cfg: GPTConfig, n_windows: int, seed: int = 123):
+    """同样的模型和验证数据（随机 token）"""
+    torch.manual_seed(seed)
+    model = GPTModel(model_cfg)
+    token_ids = torch.randint(0, model_cfg.vocab_size, (n_windows * model_cfg.ctx_len + 1,))
+    return model, token_ids
+
+
+def run_method(method: str, model, token_ids, ctx_len: int, train_batch_size: int,
+               eval_batch_size: int, subset_windows: int, evaluator=None) -> float:
+    """执行一次评估，返回损失"""
+    if method in ("autograd", "no_grad"):
+        loader = create_token_dataloader(token_ids, batch_size=train_batch_size, max_length=ctx_len,
+                                         shuffle=False, drop_last=False)
+        model.eval()
+        if method == "no_grad":
+            return calc_loss_loader(loader, model, "cpu")
+        total = 0.0
+        for input_batch, target_batch in loader:
+            total += calc_loss_batch(input_batch, target_batch, model, "cpu").item()
+        return total / len(loader)
+
+    if evaluator is None:
+        evaluator = Evaluator(EvalWindows.from_token_ids(token_ids, ctx_len), batch_size=eval_batch_size)
+    windows = evaluator.windows.subset(subset_windows) if method == "subset" else None
+    return evaluator.evaluate(model, windows).loss
+
+
+def _memory_worker(method, model_cfg, n_windows, train_batch_size, eval_batch_size, subset_windows):
+    """子进程中执行（measure_peak_memory_mb 要求是模块顶层函数）"""
+    model, token_ids = build(model_cfg, n_windows)
+    run_method(method, model, token_ids, model_cfg.ctx_len, train_batch_size, eval_batch_size,
+               subset_windows)
+
+
+def main():
+    """对比各评估方法的损失、耗时和内存峰值，再按训练每步耗时换算评估占训练时间的比例"""
+    parser = argparse.ArgumentParser(description="评估引擎 vs 逐 batch 评估")
+    parser.add_argument("--n-windows", type=int, default=64, help="验证集窗口数")
+    parser.add_argument("--ctx-len", type=int, default=256)
+    parser.add_argument("--emb-dim", type=int, default=384)
+    parser.add_argument("--n-layers", type=int, default=6)
+    parser.add_argument("--n-heads", type=int, default=6)
+    parser.add_argument("--train-batch-size", type=int, default=2)
+    parser.add_argument("--eval-batch-size", type=int, default=8)
+    parser.add_argument("--subset-windows", type=int, default=16, help="定期评估的固定子集大小")
+    parser.add_argument("--eval-freq", type=int, default=50, help="每隔多少个训练步评估一次")
+    args = parser.parse_args()
+
+    model_cfg = GPTConfig(ctx_len=args.ctx_len, emb_dim=args.emb_dim, n_layers=args.n_layers,
+                          n_heads=args.n_heads, drop_prob=0.0)
+    model, token_ids = build(model_cfg, args.n_windows)
+    start = time.perf_counter()
+    evaluator = Evaluator(EvalWindows.from_token_ids(token_ids, args.ctx_len), batch_size=args.eval_batch_size)
+    build_ms = (time.perf_counter() - start) * 1e3
+    print(f"验证集 {args.n_windows} 个窗口 × {args.ctx_len} token；构建窗口缓存 {build_ms:.1f} ms（只需一次）")
+
+    print(f"\n{'方法':<28} {'损失':>8} {'耗时 s':>8} {'峰值 MB':>9}")
+    seconds = {}
+    for method in METHODS:
+        start = time.perf_counter()
+        loss = run_method(method, model, token_ids, args.ctx_len, args.train_batch_size,
+                          args.eval_batch_size, args.subset_windows, evaluator)
+        seconds[method] = time.perf_counter() - start
+        peak_mb = measure_peak_memory_mb(_memory_worker, method, model_cfg, args.n_windows,
+                                         args.train_batch_size, args.eval_batch_size, args.subset_windows)
+        print(f"{METHOD_NAMES[method]:<28} {loss:>8.4f} {seconds[method]:>8.2f} {peak_mb:>9.0f}")
+
+    # 训练步耗时：与评估用同样的模型和训练 batch
+    trainer = Trainer(model, TrainConfig(eval_freq=0))
+    batch = next(iter(create_token_dataloader(token_ids, batch_size=args.train_batch_size,
+                                              max_length=args.ctx_len)))
+    for _ in range(3):
+        trainer.train_step(*batch)
+    step_s = sorted(trainer.history.step_times_ms[1:])[0] / 1e3
+    train_s = args.eval_freq * step_s
+    print(f"\n训练每步 {step_s:.2f} s；每 {args.eval_freq} 步评估一次时，评估占训练时间:")
+    for method in ("autograd", "no_grad", "evaluator"):
+        print(f"  每次都完整评估（{METHOD_NAMES[method]}）: {seconds[method] / train_s:.1%}")
+    print(f"  固定子集 {args.subset_windows} 个窗口: {seconds['subset'] / train_s:.1%}"
+          f"（训练结束再做一次完整评估）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+实验：数据并行训练的扩展效率（1 / 2 / 4 / 8 个进程）
+
+依次用 torchrun 启动 train_ddp.py，每个进程的 batch 大小固定（弱扩展），
+读取 rank 0 写出的吞吐统计，报告：
+    - 全局吞吐（tokens/s）
+    - 加速比 = 吞吐 / 单进程吞吐
+    - 扩展效率 = 加速比 / 进程数（100% 表示线性扩展）
+
+默认每个进程分到 可用核心数 / 进程数 个线程（至少 1 个），总核心数不变，
+比较的是"一个进程用全部核心"和"多个进程各用一部分核心"；
+--threads 固定每个进程的线程数时，比较的是加核心时的扩展性。
+
+运行方式：
+    python ch05/experiments/ddp_scaling.py
+    python ch05/experiments/ddp_scaling.py --procs 1 2 4 --threads 2 --bind-cores
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch02.main.dataloader import write_token_file
+from setup.cpu_tuning import available_cores
+
+TRAIN_SCRIPT = os.path.join(ROOT_DIR, "ch05", "main", "train_ddp.py")
+
+
+def prepare_corpus(path: str) -> None:
+    """the-verdict.txt 分词后写成 token 文件；没有 GPT-2 分词器文件时退回到 UTF-8 字节"""
+    with open(os.path.join(ROOT_DIR, "ch02", "main", "the-verdict.txt"), "r", encoding="utf-8") as f:
+        text = f.read()
+    try:
+        import tiktoken
+
+        token_ids = tiktoken.get_encoding("gpt2").encode(text)
+    except Exception as exc:  # 离线环境下 tiktoken 下载词表会失败
+        print(f"⚠️  无法加载 GPT-2 分词器（{type(exc).__name__}），改用 UTF-8 字节作为 token")
+        token_ids = list(text.encode("utf-8"))
+    write_token_file(token_ids, path)
+
+
+def run(n_procs: int, threads: int, data_path: str, args, report_path: str) -> dict:
+    """用 torchrun 启动 n_procs 个进程训练，返回 rank 0 的吞吐统计"""
+    cmd = [sys.executable, "-m", "torch.distributed.run", "--standalone", f"--nproc_per_node={n_procs}",
+           TRAIN_SCRIPT, "--data", data_path, "--threads", str(threads),
+           "--batch-size", str(args.batch_size), "--ctx-len", str(args.ctx_len),
+           "--emb-dim", str(args.emb_dim), "--n-layers", str(args.n_layers), "--n-heads", str(args.n_heads),
+           "--max-steps", str(args.steps), "--epochs", "1000", "--log-every", "0",
+           "--report", report_path]
+    if args.bind_cores:
+        cmd.append("--bind-cores")
+    # torchrun 默认会把 OMP_NUM_THREADS 设为 1；线程数由 --threads 显式控制
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads))
+    subprocess.run(cmd, check=True, env=env, stdout=subprocess.DEVNULL if args.quiet else None)
+    with open(report_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main():
+    """依次用不同进程数启动 DDP 训练，汇总每步耗时、吞吐以及相对单进程的加速比和扩展效率"""
+    parser = argparse.ArgumentParser(description="DDP（gloo）扩展效率")
+    parser.add_argument("--procs", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--threads", type=int, default=None, help="每个进程的线程数，默认平分可用核心")
+    parser.add_argument("--bind-cores", action="store_true")
+    parser.add_argument("--data", default=None, help="token 文件，默认用 the-verdict.txt 生成")
+    parser.add_argument("--steps", type=int, default=6)
+    parser.add_argument("--batch-size", type=int, default=2, help="每个进程的 batch 大小")
+    parser.add_argument("--ctx-len", type=int, default=128)
+    parser.add_argument("--emb-dim", type=int, default=256)
+    parser.add_argument("--n-layers", type=int, default=4)
+    parser.add_argument("--n-heads", type=int, default=4)
+    parser.add_argument("--quiet", action="store_true", help="不显示训练进程的输出")
+    args = parser.parse_args()
+
+    cores = available_cores()
+    with tempfile.TemporaryDirectory() as tmp:
+        data_path = args.data
+        if data_path is None:
+            data_path = os.path.join(tmp, "corpus.bin")
+            prepare_corpus(data_path)
+
+        results = []
+        for n_procs in args.procs:
+            threads = args.threads or max(1, cores // n_procs)
+            if n_procs * threads > cores:
+                print(f"⚠️  {n_procs} 进程 × {threads} 线程超过可用核心数 {cores}，结果会受超额订阅影响")
+            report = run(n_procs, threads, data_path, args, os.path.join(tmp, f"report_{n_procs}.json"))
+            results.append(report)
+
+    base = results[0]["tokens_per_sec"] / results[0]["world_size"]
+    print(f"\n可用核心 {cores}，每进程 batch {args.batch_size} × {args.ctx_len} token")
+    print(f"{'进程数':>6} {'线程/进程':>9} {'每步 ms':>9} {'tokens/s':>10} {'加速比':>7} {'扩展效率':>8}")
+    for r in results:
+        speedup = r["tokens_per_sec"] / base
+        print(f"{r['world_size']:>6} {r['threads']:>9} {r['step_ms']:>9.1f} {r['tokens_per_sec']:>10.0f} "
+              f"{speedup:>7.2f} {speedup / r['world_size']:>8.1%}")
+
+
+if __name__ == "__main__":
+    main()
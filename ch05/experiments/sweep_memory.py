@@ -0,0 +1,132 @@
+"""
+实验：梯度累积 × 激活检查点的内存 / 速度权衡
+
+固定有效 batch（默认 8 × 256 token），对每种组合测量：
+    - 一个训练步的常驻内存峰值（独立子进程，包含权重、梯度和优化器状态）
+    - 每个优化器步的耗时
+梯度累积减小激活值占用（按微批次大小计算），激活检查点进一步只保留每层的输入，
+代价分别是更小的矩阵乘法和额外一次前向。给定 --budget-mb 时，
+报告能放进预算的组合中最快的一个。
+
+运行方式：
+    python ch05/experiments/sweep_memory.py                                  # GPT-2 124M
+    python ch05/experiments/sweep_memory.py --budget-mb 3000
+    python ch05/experiments/sweep_memory.py --emb-dim 256 --n-layers 4 --n-heads 4 --accum 1 4
+"""
+
+import argparse
+import os
+import sys
+
+import torch
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch04.main.gpt_model import GPTConfig, GPTModel
+from ch05.main.train import TrainConfig, Trainer
+from setup.benchmark import measure_peak_memory_mb
+
+# 激活检查点方案名称 -> 给定层数时开启的层
+CHECKPOINT_SCHEMES = {
+    "none": lambda n_layers: None,
+    "half": lambda n_layers: list(range(0, n_layers, 2)),
+    "all": lambda n_layers: "all",
+}
+
+
+def build_trainer(model_cfg: GPTConfig, precision: str, accum: int, scheme: str) -> Trainer:
+    """
+    固定种子创建模型和 Trainer（关闭评估）
+
+    参数:
+        model_cfg: 模型配置
+        precision (str): 精度模式
+        accum (int): 梯度累积步数
+        scheme (str): CHECKPOINT_SCHEMES 中的激活检查点方案
+
+    返回:
+        Trainer
+    """
+    torch.manual_seed(123)
+    train_cfg = TrainConfig(eval_freq=0, precision=precision, grad_accum_steps=accum,
+                            checkpoint_layers=CHECKPOINT_SCHEMES[scheme](model_cfg.n_layers))
+    return Trainer(GPTModel(model_cfg), train_cfg)
+
+
+def random_batch(model_cfg: GPTConfig, batch_size: int):
+    """
+    随机 token 组成的一个 batch，目标是输入左移一位
+
+    返回:
+        tuple[Tensor, Tensor]: (输入, 目标)，形状都是 (batch_size, ctx_len)
+    """
+    inputs = torch.randint(0, model_cfg.vocab_size, (batch_size, model_cfg.ctx_len))
+    return inputs, torch.roll(inputs, -1, dims=1)
+
+
+def _one_step(model_cfg, precision, accum, scheme, batch_size) -> None:
+    """子进程中执行：建模型 + 一个训练步（measure_peak_memory_mb 要求是模块顶层函数）"""
+    trainer = build_trainer(model_cfg, precision, accum, scheme)
+    trainer.train_step(*random_batch(model_cfg, batch_size))
+
+
+def time_steps(model_cfg: GPTConfig, precision: str, accum: int, scheme: str, batch_size: int,
+               steps: int) -> float:
+    """每个优化器步的耗时中位数（秒）；第一步包含内存分配和优化器状态初始化，不计入"""
+    trainer = build_trainer(model_cfg, precision, accum, scheme)
+    for _ in range(steps + 1):
+        trainer.train_step(*random_batch(model_cfg, batch_size))
+    times = sorted(trainer.history.step_times_ms[1:])
+    return times[len(times) // 2] / 1e3
+
+
+def main():
+    """遍历梯度累积步数 × 激活检查点方案，测量内存峰值和每步耗时；给出 --budget-mb 时选出预算内最快的组合"""
+    parser = argparse.ArgumentParser(description="梯度累积 × 激活检查点：内存峰值 vs 每步耗时")
+    parser.add_argument("--batch-size", type=int, default=8, help="有效 batch（每个优化器步的样本数）")
+    parser.add_argument("--ctx-len", type=int, default=256)
+    parser.add_argument("--emb-dim", type=int, default=768)
+    parser.add_argument("--n-layers", type=int, default=12)
+    parser.add_argument("--n-heads", type=int, default=12)
+    parser.add_argument("--precision", default="fp32")
+    parser.add_argument("--accum", type=int, nargs="+", default=[1, 2, 4, 8], help="梯度累积步数")
+    parser.add_argument("--checkpoint", nargs="+", choices=list(CHECKPOINT_SCHEMES),
+                        default=list(CHECKPOINT_SCHEMES), help="激活检查点方案")
+    parser.add_argument("--steps", type=int, default=2, help="计时的优化器步数")
+    parser.add_argument("--budget-mb", type=float, default=None, help="内存预算（MB）")
+    args = parser.parse_args()
+
+    model_cfg = GPTConfig(ctx_len=args.ctx_len, emb_dim=args.emb_dim, n_layers=args.n_layers,
+                          n_heads=args.n_heads)
+    n_params = sum(p.numel() for p in GPTModel(model_cfg).parameters())
+    print(f"模型参数 {n_params / 1e6:.0f}M，有效 batch {args.batch_size} × {args.ctx_len} token，"
+          f"精度 {args.precision}")
+    print(f"\n{'累积步数':>8} {'微批次':>6} {'检查点':>6} {'峰值 MB':>9} {'每步 s':>8} {'tokens/s':>9}")
+
+    results = []
+    for accum in args.accum:
+        if accum > args.batch_size:
+            continue
+        for scheme in args.checkpoint:
+            peak_mb = measure_peak_memory_mb(_one_step, model_cfg, args.precision, accum, scheme,
+                                             args.batch_size)
+            step_s = time_steps(model_cfg, args.precision, accum, scheme, args.batch_size, args.steps)
+            tokens_per_sec = args.batch_size * args.ctx_len / step_s
+            results.append((accum, scheme, peak_mb, step_s))
+            micro = -(-args.batch_size // accum)
+            print(f"{accum:>8} {micro:>6} {scheme:>6} {peak_mb:>9.0f} {step_s:>8.2f} {tokens_per_sec:>9.0f}")
+
+    if args.budget_mb is not None:
+        fitting = [r for r in results if r[2] <= args.budget_mb]
+        if fitting:
+            accum, scheme, peak_mb, step_s = min(fitting, key=lambda r: r[3])
+            print(f"\n✅ 预算 {args.budget_mb:.0f} MB 内最快的组合: 累积 {accum} 步, 检查点 {scheme} "
+                  f"（峰值 {peak_mb:.0f} MB, 每步 {step_s:.2f} s）")
+        else:
+            print(f"\n❌ 没有组合能放进 {args.budget_mb:.0f} MB，考虑 bf16-pure 或更短的上下文")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+"""
+第5章扩展：检查点（扁平张量文件 + JSON 索引，异步保存，内存映射加载）
+
+torch.save 把整个 state_dict pickle 成一个文件：保存期间训练被阻塞，
+加载时所有张量都要反序列化进内存，模型越大越慢。
+
+这里的格式是一个目录：
+    index.json          元数据 + 每个张量的 (分片文件, 偏移, dtype, 形状)
+    shard-00000.bin     张量的原始字节，首尾相接（每个张量按 64 字节对齐）
+    shard-00001.bin     超过 max_shard_bytes 时切到下一个分片
+    ...
+
+核心概念：
+    - 异步保存：训练线程只做一次快照（把张量拷进预先分配、反复使用的缓冲区，纯内存拷贝），
+      写文件交给后台线程；写文件时 Python 会释放 GIL，训练可以继续。
+      后台写的是快照，训练线程随后对参数的原地更新不会影响正在写的数据
+    - 内存映射加载：用 torch.from_file 把分片映射进地址空间，张量只是映射上的视图，
+      真正读到某个张量时操作系统才从磁盘调页；没有反序列化，加载几乎是瞬间完成的
+    - 原子性：index.json 最后写入（先写临时文件再重命名），
+      没有 index.json 的目录就是没写完的检查点，不会被误加载
+    - 嵌套结构：优化器的 state_dict 里既有张量也有数字、元组和整数键，
+      张量存进分片，其余部分连同张量的引用一起写进 index.json
+
+依赖：
+    - torch: PyTorch 深度学习框架
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+import torch
+
+INDEX_FILE = "index.json"
+FORMAT_VERSION = 1
+
+# 每个张量的起始偏移按 64 字节对齐（缓存行大小），映射后的视图访问更快
+ALIGNMENT = 64
+
+# 默认分片大小：1GB
+DEFAULT_SHARD_BYTES = 1 << 30
+
+_DTYPES = {str(dtype).removeprefix("torch."): dtype for dtype in (
+    torch.float64, torch.float32, torch.float16, torch.bfloat16,
+    torch.int64, torch.int32, torch.int16, torch.int8, torch.uint8, torch.bool,
+)}
+
+
+def _flatten(obj, prefix: str, tensors: dict):
+    """
+    把嵌套结构中的张量取出来放进 tensors，返回可以写进 JSON 的骨架
+
+    JSON 只支持字符串键，不区分列表和元组，所以：
+        - 张量 -> {"__tensor__": 名字}
+        - 元组 -> {"__tuple__": [...]}
+        - 键不全是字符串的字典 -> {"__items__": [[键, 值], ...]}
+    """
+    if isinstance(obj, torch.Tensor):
+        tensors[prefix] = obj
+        return {"__tensor__": prefix}
+    if isinstance(obj, dict):
+        if all(isinstance(k, str) for k in obj):
+            return {k: _flatten(v, f"{prefix}.{k}" if prefix else k, tensors) for k, v in obj.items()}
+        return {"__items__": [[k, _flatten(v, f"{prefix}.{k}", tensors)] for k, v in obj.items()]}
+    if isinstance(obj, (list, tuple)):
+        items = [_flatten(v, f"{prefix}.{i}", tensors) for i, v in enumerate(obj)]
+        return {"__tuple__": items} if isinstance(obj, tuple) else items
+    return obj
+
+
+def _unflatten(skeleton, tensors: dict):
+    """_flatten 的逆操作"""
+    if isinstance(skeleton, dict):
+        if "__tensor__" in skeleton:
+            return tensors[skeleton["__tensor__"]]
+        if "__tuple__" in skeleton:
+            return tuple(_unflatten(v, tensors) for v in skeleton["__tuple__"])
+        if "__items__" in skeleton:
+            return {k: _unflatten(v, tensors) for k, v in skeleton["__items__"]}
+        return {k: _unflatten(v, tensors) for k, v in skeleton.items()}
+    if isinstance(skeleton, list):
+        return [_unflatten(v, tensors) for v in skeleton]
+    return skeleton
+
+
+def _raw_bytes(tensor: torch.Tensor):
+    """张量的原始字节（不复制），可以直接传给 file.write"""
+    flat = tensor.detach().contiguous().reshape(-1)
+    return memoryview(flat.view(torch.uint8).numpy())
+
+
+def save_checkpoint(state, path: str, metadata: Optional[dict] = None,
+                    max_shard_bytes: int = DEFAULT_SHARD_BYTES) -> int:
+    """
+    把嵌套的 state（通常是 state_dict）保存成 扁平张量分片 + JSON 索引
+
+    参数:
+        state: 张量、字典、列表、元组和 JSON 可表示的标量组成的嵌套结构
+        path (str): 检查点目录（不存在时自动创建）
+        metadata (dict): 额外写进索引的信息，例如步数、模型配置
+        max_shard_bytes (int): 单个分片文件的最大字节数（单个张量超过它时独占一个分片）
+
+    返回:
+        int: 写入的张量字节总数
+
+    示例:
+        >>> save_checkpoint({"model": model.state_dict(), "step": 100}, "ckpt/step-100")
+    """
+    tensors = {}
+    skeleton = _flatten(state, "", tensors)
+    return _write_flat(skeleton, tensors, path, metadata, max_shard_bytes)
+
+
+def _write_flat(skeleton, tensors: dict, path: str, metadata: Optional[dict],
+                max_shard_bytes: int) -> int:
+    """把已经拆开的 (骨架, 张量) 写进检查点目录，返回张量字节总数"""
+    os.makedirs(path, exist_ok=True)
+    entries, shards = {}, []
+    shard_file, shard_size, total = None, 0, 0
+    try:
+        for name, tensor in tensors.items():
+            nbytes = tensor.numel() * tensor.element_size()
+            offset = -shard_size % ALIGNMENT + shard_size
+            if shard_file is None or (shard_size > 0 and offset + nbytes > max_shard_bytes):
+                if shard_file is not None:
+                    shard_file.close()
+                shards.append(f"shard-{len(shards):05d}.bin")
+                shard_file = open(os.path.join(path, shards[-1]), "wb")
+                shard_size, offset = 0, 0
+            if offset > shard_size:
+                shard_file.write(b"\0" * (offset - shard_size))
+            shard_file.write(_raw_bytes(tensor))
+            shard_size = offset + nbytes
+            total += nbytes
+            entries[name] = {"shard": len(shards) - 1, "offset": offset,
+                             "dtype": str(tensor.dtype).removeprefix("torch."),
+                             "shape": list(tensor.shape)}
+    finally:
+        if shard_file is not None:
+            shard_file.close()
+
+    index = {"format_version": FORMAT_VERSION, "metadata": metadata or {}, "shards": shards,
+             "tensors": entries, "state": skeleton}
+    tmp_path = os.path.join(path, INDEX_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    # 索引最后就位：有 index.json 的目录一定是完整的检查点
+    os.replace(tmp_path, os.path.join(path, INDEX_FILE))
+    return total
+
+
+def read_index(path: str) -> dict:
+    """读取检查点目录的索引"""
+    index_path = os.path.join(path, INDEX_FILE)
+    if not os.path.exists(index_path):
+        raise FileNotFoundError(f"{path} 不是完整的检查点（缺少 {INDEX_FILE}）")
+    with open(index_path, "r", encoding="utf-8") as f:
+        index = json.load(f)
+    if index.get("format_version") != FORMAT_VERSION:
+        raise ValueError(f"不支持的检查点格式版本: {index.get('format_version')}")
+    return index
+
+
+def load_checkpoint(path: str, mmap: bool = True):
+    """
+    加载检查点
+
+    参数:
+        path (str): 检查点目录
+        mmap (bool): True 时张量是只读映射上的视图，读到时才从磁盘调页；
+                     False 时把所有分片完整读进内存
+
+    返回:
+        tuple[object, dict]: (与保存时结构相同的 state, metadata)
+
+    注意:
+        - 映射是写时复制（MAP_PRIVATE）的：原地修改加载出的张量不会写回文件
+        - 用 model.load_state_dict(state) 会把数据拷进模型已有的参数（此时才真正读盘）；
+          用 load_state_dict(state, assign=True) 则直接让参数指向映射，只有用到的部分才会读入
+    """
+    index = read_index(path)
+    buffers = []
+    for shard in index["shards"]:
+        shard_path = os.path.join(path, shard)
+        size = os.path.getsize(shard_path)
+        if mmap:
+            buffers.append(torch.from_file(shard_path, shared=False, size=size, dtype=torch.uint8))
+        else:
+            with open(shard_path, "rb") as f:
+                buffers.append(torch.frombuffer(bytearray(f.read()), dtype=torch.uint8))
+
+    tensors = {}
+    for name, entry in index["tensors"].items():
+        dtype = _DTYPES[entry["dtype"]]
+        numel = 1
+        for dim in entry["shape"]:
+            numel *= dim
+        nbytes = numel * torch.empty((), dtype=dtype).element_size()
+        raw = buffers[entry["shard"]][entry["offset"]:entry["offset"] + nbytes]
+        tensors[name] = raw.view(dtype).reshape(entry["shape"])
+    return _unflatten(index["state"], tensors), index["metadata"]
+
+
+@dataclass
+class SaveStats:
+    """
+    一次保存的耗时统计
+
+    属性:
+        path: 检查点目录
+        stall_ms: 训练线程被阻塞的时间（等待上一次保存 + 做快照）
+        write_ms: 后台线程写文件的时间
+        nbytes: 写入的张量字节数
+    """
+
+    path: str
+    stall_ms: float
+    write_ms: float = 0.0
+    nbytes: int = 0
+
+
+class AsyncCheckpointer:
+    """
+    后台线程保存检查点
+
+    save() 在调用线程里做快照后立即返回，写文件在后台线程进行；
+    同一时间只有一个保存在进行，上一次还没写完时下一次 save() 会先等待（计入阻塞时间），
+    避免快照在内存里越积越多。
+
+    快照缓冲区在多次保存之间复用：第一次保存需要分配内存（缺页中断占了大部分时间），
+    之后形状不变的张量直接 copy_ 进已有的缓冲区，阻塞时间只剩一次内存拷贝。
+
+    示例:
+        >>> checkpointer = AsyncCheckpointer()
+        >>> checkpointer.save(trainer.state_dict(), f"ckpt/step-{step}", metadata={"step": step})
+        >>> ...                  # 继续训练
+        >>> checkpointer.wait()  # 程序退出前等待最后一次保存完成
+    """
+
+    def __init__(self, max_shard_bytes: int = DEFAULT_SHARD_BYTES):
+        """
+        参数:
+            max_shard_bytes (int): 每个张量分片文件的最大字节数
+        """
+        self.max_shard_bytes = max_shard_bytes
+        self.history = []
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+        self._pending: Optional[Future] = None
+        self._lock = threading.Lock()
+        self._buffers = {}
+
+    def save(self, state, path: str, metadata: Optional[dict] = None) -> SaveStats:
+        """
+        异步保存
+
+        参数:
+            state: 要保存的嵌套结构（会先做快照，调用返回后可以立即修改原始张量）
+            path (str): 检查点目录
+            metadata (dict): 写进索引的额外信息
+
+        返回:
+            SaveStats: 其中 write_ms / nbytes 在后台写完后才会填上
+        """
+        start = time.perf_counter()
+        # 必须先等上一次写完，才能复用它的快照缓冲区
+        self.wait()
+        tensors = {}
+        skeleton = _flatten(state, "", tensors)
+        tensors = {name: self._snapshot_tensor(name, t) for name, t in tensors.items()}
+        stats = SaveStats(path=path, stall_ms=(time.perf_counter() - start) * 1e3)
+        with self._lock:
+            self.history.append(stats)
+            self._pending = self._executor.submit(self._write, skeleton, tensors, path, metadata, stats)
+        return stats
+
+    @torch.no_grad()
+    def _snapshot_tensor(self, name: str, tensor: torch.Tensor) -> torch.Tensor:
+        """
+        把张量拷贝进名为 name 的快照缓冲区
+
+        形状和 dtype 与上次相同时复用已有缓冲区，否则重新分配（连续内存）
+
+        返回:
+            Tensor: 快照缓冲区，后台线程写文件期间训练可以继续修改原张量
+        """
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+            buffer = self._buffers[name] = torch.empty_like(tensor, memory_format=torch.contiguous_format)
+        return buffer.copy_(tensor)
+
+    def _write(self, skeleton, tensors: dict, path: str, metadata: Optional[dict],
+               stats: SaveStats) -> None:
+        """在后台线程中把快照写成扁平张量 + JSON 索引，并把写入耗时和字节数填进 stats"""
+        start = time.perf_counter()
+        stats.nbytes = _write_flat(skeleton, tensors, path, metadata, self.max_shard_bytes)
+        stats.write_ms = (time.perf_counter() - start) * 1e3
+
+    def wait(self) -> None:
+        """等待正在进行的保存完成；后台写文件出错时在这里抛出"""
+        with self._lock:
+            pending, self._pending = self._pending, None
+        if pending is not None:
+            pending.result()
+
+    def close(self) -> None:
+        """等待最后一次保存完成，关闭后台线程并释放快照缓冲区"""
+        self.wait()
+        self._executor.shutdown()
+        self._buffers.clear()
+
+    def __enter__(self):
+        """返回自身，用于 with 语句"""
+        return self
+
+    def __exit__(self, *exc):
+        """退出 with 语句时调用 close()，保证最后一次保存已经写完"""
+        self.close()
+
+
+def latest_checkpoint(root: str) -> Optional[str]:
+    """
+    root 下最近写完的检查点目录（按 index.json 的修改时间），没有时返回 None
+
+    没有 index.json 的目录（保存到一半就中断的）会被跳过
+    """
+    if not os.path.isdir(root):
+        return None
+    candidates = [os.path.join(root, d) for d in os.listdir(root)
+                  if os.path.exists(os.path.join(root, d, INDEX_FILE))]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda d: os.path.getmtime(os.path.join(d, INDEX_FILE)))
+
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+
+    ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+    sys.path.insert(0, ROOT_DIR)
+    from ch04.main.gpt_model import GPTConfig, GPTModel
+
+    torch.manual_seed(123)
+    model = GPTModel(GPTConfig(ctx_len=128, emb_dim=256, n_heads=4, n_layers=4))
+    optimizer = torch.optim.AdamW(model.parameters(), lr=4e-4)
+    model(torch.randint(0, 50257, (2, 16))).sum().backward()
+    optimizer.step()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with AsyncCheckpointer(max_shard_bytes=64 << 20) as checkpointer:
+            stats = checkpointer.save({"model": model.state_dict(), "optimizer": optimizer.state_dict()},
+                                      os.path.join(tmp, "step-1"), metadata={"step": 1})
+        print(f"保存: 训练阻塞 {stats.stall_ms:.1f} ms，后台写入 {stats.write_ms:.1f} ms，"
+              f"{stats.nbytes / 1e6:.0f} MB，{len(read_index(stats.path)['shards'])} 个分片")
+
+        start = time.perf_counter()
+        state, metadata = load_checkpoint(latest_checkpoint(tmp))
+        print(f"加载（内存映射）: {(time.perf_counter() - start) * 1e3:.1f} ms，metadata={metadata}")
+
+        restored = GPTModel(GPTConfig(ctx_len=128, emb_dim=256, n_heads=4, n_layers=4))
+        restored.load_state_dict(state["model"])
+        new_optimizer = torch.optim.AdamW(restored.parameters(), lr=4e-4)
+        new_optimizer.load_state_dict(state["optimizer"])
+        same = all(torch.equal(a, b) for a, b in zip(model.state_dict().values(),
+                                                     restored.state_dict().values()))
+        print(f"{'✅' if same else '❌'} 模型权重与保存前一致")
@@ -0,0 +1,231 @@
+"""
+第5章：评估引擎（损失与困惑度）
+
+训练中的评估只需要前向传播，书中的写法（对 DataLoader 逐 batch 计算平均损失再求平均）有几处浪费：
+每次评估都重新切片、拼 batch；没有关闭 autograd 时还会为反向传播保存中间结果；
+最后一个不完整的 batch 与完整 batch 权重相同，平均值有偏差。
+
+核心概念：
+    - 缓存评估窗口：评估集的 (输入, 目标) 窗口只构建一次，存成两个 (n_windows, T) 的张量，
+      之后每次评估直接按下标取 batch
+    - inference_mode：比 no_grad 更彻底，不记录版本计数和视图信息，没有任何反向传播开销
+    - 按 token 加权的流式累积：每个 batch 用 reduction="sum" 得到损失总和，
+      只累加一个标量和 token 数，不保留任何 batch 的张量；最终损失 = 总和 / token 总数
+    - 固定随机子集：训练中每 N 步只评估同一批随机抽取的窗口（每次都相同，曲线可比），
+      训练结束时再做一次完整评估，评估开销是训练时间中可预测的一小部分
+    - 困惑度（perplexity）= exp(平均交叉熵)，可以理解为模型在每个位置上"等效的候选 token 数"
+
+依赖：
+    - torch: PyTorch 深度学习框架
+"""
+
+import math
+import os
+import sys
+import time
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch05.main.precision import PrecisionPolicy
+
+# 目标中被忽略的位置（不足一个窗口的尾部用它填充），与 F.cross_entropy 的默认值一致
+IGNORE_INDEX = -100
+
+
+@dataclass
+class EvalResult:
+    """
+    一次评估的结果
+
+    属性:
+        loss: 按 token 加权的平均交叉熵
+        n_tokens: 参与计算的目标 token 数
+        n_windows: 评估的窗口数
+        seconds: 耗时（秒）
+    """
+
+    loss: float
+    n_tokens: int
+    n_windows: int
+    seconds: float
+
+    @property
+    def perplexity(self) -> float:
+        """困惑度 exp(loss)；损失过大（exp 会溢出）时返回 inf"""
+        return math.exp(self.loss) if self.loss < 700 else float("inf")
+
+
+class EvalWindows:
+    """
+    缓存的评估窗口
+
+    属性:
+        inputs (Tensor): (n_windows, T) 的输入 token
+        targets (Tensor): (n_windows, T) 的目标 token，IGNORE_INDEX 表示不计入损失
+    """
+
+    def __init__(self, inputs: torch.Tensor, targets: torch.Tensor):
+        """
+        参数:
+            inputs (Tensor): (n_windows, T) 的输入 token
+            targets (Tensor): 与 inputs 形状相同的目标 token，形状不一致时抛出 ValueError
+        """
+        if inputs.shape != targets.shape:
+            raise ValueError(f"输入形状 {tuple(inputs.shape)} 与目标形状 {tuple(targets.shape)} 不一致")
+        self.inputs = inputs
+        self.targets = targets
+
+    def __len__(self) -> int:
+        """窗口个数"""
+        return self.inputs.shape[0]
+
+    @classmethod
+    def from_dataset(cls, dataset, indices: Optional[Sequence[int]] = None) -> "EvalWindows":
+        """
+        从返回 (inputs, targets) 的数据集构建（例如 TokenWindowDataset、MemmapTokenDataset）
+
+        参数:
+            dataset: 数据集
+            indices: 可选，只取这些下标的窗口（例如 subset_indices 的结果）；默认取全部
+
+        注意:
+            - 只在构建时遍历一次数据集，窗口全部复制进内存；
+              大语料（memmap）只需要一个子集时传入 indices，不要先构建全部窗口再取 subset
+        """
+        if len(dataset) == 0:
+            raise ValueError("数据集为空")
+        indices = range(len(dataset)) if indices is None else indices
+        pairs = [dataset[int(i)] for i in indices]
+        return cls(torch.stack([p[0] for p in pairs]), torch.stack([p[1] for p in pairs]))
+
+    @classmethod
+    def from_token_ids(cls, token_ids, max_length: int) -> "EvalWindows":
+        """
+        把 token 序列切成互不重叠的窗口，每个目标 token 恰好被评估一次
+
+        最后不足一个窗口的部分也保留：输入用 0 补齐，目标用 IGNORE_INDEX 补齐，补齐的位置不计入损失
+        """
+        ids = torch.as_tensor(token_ids, dtype=torch.long)
+        n_targets = len(ids) - 1
+        if n_targets < 1:
+            raise ValueError("至少需要 2 个 token")
+        n_windows = math.ceil(n_targets / max_length)
+        pad = n_windows * max_length - n_targets
+        inputs = torch.cat([ids[:-1], ids.new_zeros(pad)]).view(n_windows, max_length)
+        targets = torch.cat([ids[1:], ids.new_full((pad,), IGNORE_INDEX)]).view(n_windows, max_length)
+        return cls(inputs, targets)
+
+    def subset(self, n_windows: int, seed: int = 0) -> "EvalWindows":
+        """固定的随机子集：同样的 seed 每次得到同样的窗口"""
+        if n_windows >= len(self):
+            return self
+        index = subset_indices(len(self), n_windows, seed)
+        return EvalWindows(self.inputs[index], self.targets[index])
+
+
+def subset_indices(n_total: int, n_windows: int, seed: int = 0) -> torch.Tensor:
+    """
+    固定随机子集的下标（升序）
+
+    参数:
+        n_total (int): 全部窗口数
+        n_windows (int): 子集大小，不小于 n_total 时返回全部下标
+        seed (int): 随机种子，同样的 seed 每次得到同样的下标
+
+    返回:
+        Tensor: (min(n_windows, n_total),) 的 int64 下标
+    """
+    if n_windows >= n_total:
+        return torch.arange(n_total)
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randperm(n_total, generator=generator)[:n_windows].sort().values
+
+
+class Evaluator:
+    """
+    流式评估器
+
+    示例:
+        >>> evaluator = Evaluator(EvalWindows.from_dataset(val_loader.dataset), batch_size=8)
+        >>> result = evaluator.evaluate(model)
+        >>> print(result.loss, result.perplexity)
+
+    注意:
+        - 评估时的内存主要是 logits：batch_size × T × vocab_size × 4 字节
+          （GPT-2 词表、T=256 时每个窗口约 51MB），据此选择 batch_size
+    """
+
+    def __init__(self, windows: EvalWindows, batch_size: int = 8,
+                 policy: Optional[PrecisionPolicy] = None, device="cpu"):
+        """
+        参数:
+            windows: 缓存的评估窗口
+            batch_size (int): 评估用的 batch 大小（没有反向传播，可以比训练时大）
+            policy: 精度策略（与训练一致），默认 fp32
+            device: 计算设备
+        """
+        self.windows = windows
+        self.batch_size = batch_size
+        self.policy = policy or PrecisionPolicy()
+        self.device = torch.device(device)
+
+    def evaluate(self, model: nn.Module, windows: Optional[EvalWindows] = None) -> EvalResult:
+        """
+        计算按 token 加权的平均损失
+
+        参数:
+            model: 待评估的模型（评估后恢复原来的 train/eval 模式）
+            windows: 可选，评估这些窗口而不是构造时给定的全部窗口（例如 subset 的结果）
+
+        返回:
+            EvalResult
+        """
+        windows = self.windows if windows is None else windows
+        was_training = model.training
+        model.eval()
+        start = time.perf_counter()
+        loss_sum = torch.zeros((), dtype=torch.float64)
+        n_tokens = 0
+        try:
+            with torch.inference_mode(), self.policy.autocast():
+                for lo in range(0, len(windows), self.batch_size):
+                    inputs = windows.inputs[lo:lo + self.batch_size].to(self.device)
+                    targets = windows.targets[lo:lo + self.batch_size].to(self.device)
+                    logits = model(inputs)
+                    loss_sum += F.cross_entropy(logits.flatten(0, 1).float(), targets.flatten(),
+                                                ignore_index=IGNORE_INDEX, reduction="sum").double().cpu()
+                    n_tokens += int((targets != IGNORE_INDEX).sum())
+        finally:
+            model.train(was_training)
+        loss = loss_sum.item() / n_tokens if n_tokens else float("nan")
+        return EvalResult(loss=loss, n_tokens=n_tokens, n_windows=len(windows),
+                          seconds=time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    from ch02.main.dataloader import create_token_dataloader
+    from ch04.main.gpt_model import GPTConfig, GPTModel
+    from ch05.main.train import calc_loss_loader
+
+    torch.manual_seed(123)
+    cfg = GPTConfig(vocab_size=1000, ctx_len=64, emb_dim=128, n_heads=4, n_layers=2)
+    model = GPTModel(cfg).eval()
+    token_ids = torch.randint(0, cfg.vocab_size, (64 * 40 + 1,)).tolist()
+
+    loader = create_token_dataloader(token_ids, batch_size=4, max_length=64, shuffle=False, drop_last=False)
+    expected = calc_loss_loader(loader, model, "cpu")
+    result = Evaluator(EvalWindows.from_dataset(loader.dataset), batch_size=16).evaluate(model)
+    status = "✅" if abs(result.loss - expected) < 1e-4 else "❌"
+    print(f"{status} 与 calc_loss_loader 一致: {result.loss:.4f} vs {expected:.4f}，"
+          f"困惑度 {result.perplexity:.1f}（随机模型约等于词表大小 {cfg.vocab_size}）")
+
+    windows = EvalWindows.from_token_ids(token_ids[:1000], max_length=64)
+    print(f"不重叠窗口: {len(windows)} 个，计入损失的 token {Evaluator(windows).evaluate(model).n_tokens} 个")
@@ -0,0 +1,308 @@
+"""
+第5章：精度策略（fp32 / bf16 自动混合精度 / 纯 bf16 + fp32 主权重）
+
+较新的 x86 CPU（支持 AVX512-BF16 或 AMX）可以直接做 bf16 矩阵乘法，
+bf16 每个元素只占 2 字节，权重和激活值的内存带宽减半。
+
+三种模式：
+    - fp32：全部使用 float32（默认，最稳妥）
+    - bf16-autocast：权重保持 fp32，前向时矩阵乘法等算子自动转成 bf16 计算；
+      优化器和梯度仍是 fp32，改动最小
+    - bf16-pure：模型权重直接存成 bf16（内存减半），优化器维护一份 fp32 主权重（master weights），
+      每步把 bf16 梯度拷进 fp32 主权重更新，再写回 bf16 模型
+
+核心概念：
+    - bf16 与 fp16：bf16 的指数位和 fp32 一样多（8 位），表示范围相同，
+      所以不会出现 fp16 那样的梯度下溢，一般不需要损失缩放（loss scaling）；
+      它的尾数只有 7 位，精度低，微小的权重更新直接加到 bf16 权重上会被舍入掉，
+      这正是纯 bf16 训练需要 fp32 主权重的原因
+    - 数值敏感的算子保持 fp32：层归一化的均值/方差、softmax、交叉熵损失
+      （模型中的 LayerNorm 和注意力已经在内部升到 fp32 计算）
+
+依赖：
+    - torch: PyTorch 深度学习框架（CPU 上的 bf16 autocast 需要 1.10+）
+"""
+
+import contextlib
+import os
+import sys
+from typing import Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch02.main.embedding import SparseAwareOptimizer, sparse_parameters
+
+PRECISION_MODES = ("fp32", "bf16-autocast", "bf16-pure")
+
+
+class MasterWeightOptimizer:
+    """
+    为 bf16 模型维护 fp32 主权重的优化器包装
+
+    模型参数是 bf16，真正被优化器更新的是一份 fp32 副本：
+        1. 反向传播得到 bf16 梯度
+        2. step：梯度转成 fp32 放到主权重上，用内部优化器更新主权重
+        3. 把更新后的主权重舍入回 bf16，写回模型
+
+    属性:
+        optimizer: 作用在 fp32 主权重上的实际优化器
+        param_groups: 同 optimizer.param_groups（学习率调度器可以直接修改）
+    """
+
+    def __init__(self, params, optimizer_cls=torch.optim.AdamW, **optimizer_kwargs):
+        """
+        参数:
+            params: 模型参数（bf16）
+            optimizer_cls: 优化器类，默认 AdamW
+            **optimizer_kwargs: 传给优化器的参数（lr、weight_decay 等）
+        """
+        self.model_params = [p for p in params if p.requires_grad]
+        self.master_params = [p.detach().float().clone().requires_grad_(True) for p in self.model_params]
+        self.optimizer = optimizer_cls(self.master_params, **optimizer_kwargs)
+
+    @property
+    def param_groups(self):
+        """
+        内部优化器的参数组
+
+        返回:
+            list[dict]: 其中的 "params" 是 fp32 主权重而不是模型参数；
+                        修改 lr 等超参数会直接作用到内部优化器
+        """
+        return self.optimizer.param_groups
+
+    @property
+    def state(self):
+        """
+        内部优化器的状态
+
+        返回:
+            dict: {fp32 主权重: 状态 dict}（AdamW 的一阶/二阶矩都是 fp32），键不是模型参数
+        """
+        return self.optimizer.state
+
+    def zero_grad(self, set_to_none: bool = True) -> None:
+        """
+        清空模型参数（bf16）上的梯度
+
+        参数:
+            set_to_none (bool): True 时设为 None，False 时原地清零
+
+        注意:
+            - 主权重的梯度不需要清：step 每次都用模型参数的梯度重新赋值
+        """
+        for p in self.model_params:
+            if set_to_none:
+                p.grad = None
+            elif p.grad is not None:
+                p.grad.zero_()
+
+    @torch.no_grad()
+    def step(self) -> None:
+        """
+        用 bf16 梯度更新 fp32 主权重，再把结果写回 bf16 模型参数
+
+        顺序：
+            1. 把每个模型参数的 bf16 梯度转成 fp32，赋给对应主权重的 .grad
+               （没有梯度的参数，主权重的 .grad 设为 None，内部优化器会跳过它）
+            2. 内部优化器在 fp32 主权重上执行一步（小的更新量不会被 bf16 舍入吃掉）
+            3. 把主权重复制回模型参数（此时才舍入到 bf16），下一次前向使用更新后的权重
+
+        注意:
+            - 梯度裁剪、损失缩放的反缩放要在调用 step 之前对模型参数的梯度完成
+        """
+        for model_p, master_p in zip(self.model_params, self.master_params):
+            master_p.grad = None if model_p.grad is None else model_p.grad.float()
+        self.optimizer.step()
+        for model_p, master_p in zip(self.model_params, self.master_params):
+            model_p.copy_(master_p)
+
+    def state_dict(self) -> dict:
+        """
+        保存内部优化器状态和 fp32 主权重
+
+        返回:
+            dict: {"optimizer": 内部优化器的 state_dict, "master_params": 主权重列表（与 model_params 顺序一致）}
+
+        注意:
+            - 主权重必须保存：只从 bf16 模型参数恢复会丢掉低位，继续训练的轨迹与不中断时不同
+        """
+        return {"optimizer": self.optimizer.state_dict(),
+                "master_params": [p.detach() for p in self.master_params]}
+
+    def load_state_dict(self, state: dict) -> None:
+        """
+        恢复 state_dict 保存的状态
+
+        顺序：先恢复内部优化器的状态，再把保存的主权重复制到当前的主权重，
+        最后把同一份主权重写回 bf16 模型参数，使模型权重与主权重一致
+        （即使模型的 state_dict 在此之前已经单独加载过）
+
+        参数:
+            state (dict): state_dict 的返回值；参数的个数和顺序必须与保存时相同
+        """
+        self.optimizer.load_state_dict(state["optimizer"])
+        with torch.no_grad():
+            for master_p, saved, model_p in zip(self.master_params, state["master_params"], self.model_params):
+                master_p.copy_(saved)
+                model_p.copy_(saved)
+
+
+class PrecisionPolicy:
+    """
+    精度策略：统一决定模型、优化器、数据和损失使用的数据类型
+
+    方法:
+        prepare_model: 按策略转换模型权重
+        build_optimizer: 创建优化器（纯 bf16 时带 fp32 主权重）
+        autocast: 前向传播使用的上下文
+        prepare_batch: 把 batch 中的浮点张量转成计算精度（token ID 不变）
+        loss: fp32 交叉熵损失
+        backward / step: 反向传播和参数更新（启用损失缩放时会缩放和反缩放）
+
+    示例:
+        >>> policy = PrecisionPolicy("bf16-autocast")
+        >>> model = policy.prepare_model(model)
+        >>> optimizer = policy.build_optimizer(model, lr=4e-4)
+        >>> with policy.autocast():
+        ...     loss = policy.loss(model(inputs), targets)
+        >>> policy.backward(loss)
+        >>> policy.step(optimizer, model, max_grad_norm=1.0)
+    """
+
+    def __init__(self, mode: str = "fp32", loss_scaling: bool = False):
+        """
+        参数:
+            mode (str): "fp32"、"bf16-autocast" 或 "bf16-pure"
+            loss_scaling (bool): 是否启用动态损失缩放。bf16 的表示范围与 fp32 相同，
+                                 通常不需要；梯度中出现大量下溢为 0 的情况时再打开
+        """
+        if mode not in PRECISION_MODES:
+            raise ValueError(f"未知的精度模式: {mode}，可选 {PRECISION_MODES}")
+        self.mode = mode
+        self.loss_scaling = loss_scaling
+        self.scaler = torch.amp.GradScaler("cpu", enabled=loss_scaling) if loss_scaling else None
+
+    def __repr__(self) -> str:
+        """打印时显示精度模式和是否启用损失缩放"""
+        return f"PrecisionPolicy(mode={self.mode!r}, loss_scaling={self.loss_scaling})"
+
+    @property
+    def param_dtype(self) -> torch.dtype:
+        """模型权重的数据类型"""
+        return torch.bfloat16 if self.mode == "bf16-pure" else torch.float32
+
+    @property
+    def compute_dtype(self) -> torch.dtype:
+        """矩阵乘法等主要计算使用的数据类型"""
+        return torch.float32 if self.mode == "fp32" else torch.bfloat16
+
+    def prepare_model(self, model: nn.Module) -> nn.Module:
+        """纯 bf16 模式把模型权重转成 bf16，其他模式保持 fp32"""
+        return model.to(dtype=self.param_dtype)
+
+    def build_optimizer(self, model: nn.Module, optimizer_cls=torch.optim.AdamW, **kwargs):
+        """
+        创建优化器
+
+        参数:
+            model: 已经调用过 prepare_model 的模型
+            optimizer_cls: 优化器类
+            **kwargs: 传给优化器的参数
+
+        返回:
+            纯 bf16 模式返回 MasterWeightOptimizer；模型有稀疏梯度的嵌入层时返回
+            SparseAwareOptimizer（嵌入层用 SparseAdam，其余参数用 optimizer_cls）；否则返回普通优化器
+
+        注意:
+            - 只包含 requires_grad=True 的参数：冻结的参数（例如 LoRA 微调时的基础权重）
+              不会有优化器状态，也不会有 fp32 主权重
+            - 稀疏梯度的嵌入层不支持纯 bf16 和损失缩放
+        """
+        params = [p for p in model.parameters() if p.requires_grad]
+        sparse = sparse_parameters(model)
+        if sparse:
+            if self.mode == "bf16-pure" or self.scaler is not None:
+                raise ValueError("稀疏梯度的嵌入层不支持 bf16-pure 模式和损失缩放")
+            return SparseAwareOptimizer(params, sparse, optimizer_cls, **kwargs)
+        if self.mode == "bf16-pure":
+            return MasterWeightOptimizer(params, optimizer_cls, **kwargs)
+        return optimizer_cls(params, **kwargs)
+
+    def autocast(self):
+        """前向传播的上下文：bf16-autocast 模式下开启 CPU 自动混合精度"""
+        if self.mode == "bf16-autocast":
+            return torch.autocast(device_type="cpu", dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def prepare_batch(self, batch):
+        """把 batch 中的浮点张量转成计算精度；整数张量（token ID）保持不变"""
+        if isinstance(batch, torch.Tensor):
+            return batch.to(self.compute_dtype) if batch.is_floating_point() else batch
+        if isinstance(batch, (list, tuple)):
+            return type(batch)(self.prepare_batch(b) for b in batch)
+        if isinstance(batch, dict):
+            return {k: self.prepare_batch(v) for k, v in batch.items()}
+        return batch
+
+    @staticmethod
+    def loss(logits: torch.Tensor, targets: torch.Tensor) -> torch.Tensor:
+        """
+        交叉熵损失，始终在 fp32 下计算
+
+        log-softmax 要对 5 万多个 logit 求和，bf16 的 7 位尾数会带来明显误差
+        """
+        return F.cross_entropy(logits.flatten(0, 1).float(), targets.flatten())
+
+    def backward(self, loss: torch.Tensor) -> None:
+        """反向传播；启用损失缩放时先把损失乘以缩放系数"""
+        if self.scaler is not None:
+            loss = self.scaler.scale(loss)
+        loss.backward()
+
+    def step(self, optimizer, model: Optional[nn.Module] = None,
+             max_grad_norm: Optional[float] = None) -> Optional[float]:
+        """
+        梯度裁剪 + 参数更新
+
+        参数:
+            optimizer: build_optimizer 返回的优化器
+            model: 需要梯度裁剪时提供
+            max_grad_norm (float): 梯度裁剪阈值，None 表示不裁剪
+
+        返回:
+            float: 裁剪前的梯度范数（不裁剪时为 None）
+        """
+        if isinstance(optimizer, MasterWeightOptimizer) and self.scaler is not None:
+            # 缩放器检查的是内部优化器上的梯度，所以先把梯度搬到主权重上
+            for model_p, master_p in zip(optimizer.model_params, optimizer.master_params):
+                master_p.grad = None if model_p.grad is None else model_p.grad.float()
+            params = optimizer.master_params
+            target = optimizer.optimizer
+        else:
+            params = model.parameters() if model is not None else None
+            target = optimizer
+
+        grad_norm = None
+        if self.scaler is not None:
+            self.scaler.unscale_(target)
+        if max_grad_norm is not None and params is not None:
+            grad_norm = float(torch.nn.utils.clip_grad_norm_(params, max_grad_norm))
+
+        if self.scaler is not None:
+            # 梯度中出现 inf/nan 时跳过这一步并减小缩放系数
+            self.scaler.step(target)
+            self.scaler.update()
+            if target is not optimizer:
+                with torch.no_grad():
+                    for model_p, master_p in zip(optimizer.model_params, optimizer.master_params):
+                        model_p.copy_(master_p)
+        else:
+            optimizer.step()
+        return grad_norm
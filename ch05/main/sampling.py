@@ -0,0 +1,408 @@
+"""
+第5章：批量采样（温度、top-k、top-p、min-p、重复惩罚）
+
+逐条序列、在词表上用 Python 循环做采样的写法，在 GPT-2 的 50257 词表和批量生成时
+会成为明显的瓶颈。这里把所有采样策略都写成整个 batch 上的张量运算，
+每一行可以有各自的参数，不需要按行循环。
+
+核心概念：
+    - 温度（temperature）：logits / T，T < 1 分布更尖锐，T > 1 更平坦，T = 0 退化为贪心
+    - top-k：只在概率最高的 k 个 token 中采样
+    - top-p（nucleus）：只在累计概率达到 p 的最小 token 集合中采样
+    - min-p：去掉概率小于 min_p × 最大概率 的 token（阈值随分布的尖锐程度自适应）
+    - 重复惩罚（repetition penalty）：已出现过的 token，正 logit 除以 penalty、负 logit 乘以 penalty
+    - 频率惩罚（frequency penalty）：logit 减去 penalty × 该 token 已出现的次数
+
+实现要点：
+    - 每行参数不同时，把参数组成 (batch,) 张量，用广播和掩码一次处理整个 batch
+    - top-k / top-p 只需要前 max(k) 个 token，用 torch.topk 求出每行的截断阈值，
+      不对整个词表排序
+    - 采样用逆 CDF：每行只需要一个均匀随机数 u，取累积概率第一次超过 u 的 token。
+      每行的随机数可以来自各自的 Generator，结果与 batch 中其他行无关，
+      同一个 seed 的请求在任意 batch 组合下都能复现（torch.multinomial 做不到这一点）
+
+依赖：
+    - torch: PyTorch 深度学习框架
+"""
+
+import os
+import sys
+from dataclasses import dataclass
+from typing import Optional
+
+import torch
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+
+@dataclass
+class SamplingParams:
+    """
+    单个请求的采样参数
+
+    默认值表示"不做任何处理"：温度 1、不截断、不惩罚。
+    """
+
+    # 温度：0 表示贪心（直接取 argmax）
+    temperature: float = 1.0
+
+    # top-k：0 表示不限制
+    top_k: int = 0
+
+    # top-p：1.0 表示不限制
+    top_p: float = 1.0
+
+    # min-p：0.0 表示不限制
+    min_p: float = 0.0
+
+    # 重复惩罚：1.0 表示不惩罚，常用 1.1 ~ 1.3
+    repetition_penalty: float = 1.0
+
+    # 频率惩罚：0.0 表示不惩罚
+    frequency_penalty: float = 0.0
+
+    # 随机种子：提供时该请求使用独立的 Generator，结果可复现
+    seed: Optional[int] = None
+
+
+def apply_penalties(logits: torch.Tensor, token_ids: torch.Tensor, counts: torch.Tensor,
+                    repetition_penalty: torch.Tensor, frequency_penalty: torch.Tensor) -> torch.Tensor:
+    """
+    对已出现过的 token 施加重复惩罚和频率惩罚
+
+    只收集、修改、写回已出现过的那些位置，不在整个词表上做逐元素运算
+    （已出现的 token 数通常只有几百，而词表有 50257 个）。
+
+    参数:
+        logits (Tensor): (batch_size, vocab_size)
+        token_ids (Tensor): (batch_size, n)，已出现过的 token（可以有重复）
+        counts (Tensor): (batch_size, vocab_size)，每个 token 已出现的次数
+        repetition_penalty (Tensor): (batch_size,)
+        frequency_penalty (Tensor): (batch_size,)
+
+    返回:
+        Tensor: 惩罚后的 logits（新张量）
+    """
+    current = logits.gather(1, token_ids)
+    rep = repetition_penalty[:, None]
+    # 正 logit 除以 penalty、负 logit 乘以 penalty：两种情况都让这个 token 的概率变小
+    penalized = torch.where(current > 0, current / rep, current * rep)
+    penalized = penalized - frequency_penalty[:, None] * counts.gather(1, token_ids)
+    # 同一个 token 出现多次时，重复写入的是同一个值
+    return logits.scatter(1, token_ids, penalized)
+
+
+# 纯 top-p 的行依次只看概率最高的这么多个 token，累计概率不到 p 时再扩大范围；
+# torch.topk 的耗时随 k 增长，对整行（50257）排序比取前 1024 个慢约 10 倍
+TOP_P_CANDIDATES = (1024, 8192)
+
+
+def _top_k_top_p_thresholds(logits: torch.Tensor, top_k: torch.Tensor, top_p: torch.Tensor,
+                            width: int) -> tuple:
+    """在前 width 个候选中计算每行保留的最小 logit，同时返回候选范围不够的行"""
+    vocab_size = logits.shape[-1]
+    values = torch.topk(logits, width, dim=-1).values  # 降序
+    ranks = torch.arange(width, device=logits.device)
+    keep = ranks[None, :] < top_k[:, None]
+    incomplete = torch.zeros_like(keep[:, 0])
+
+    if (top_p < 1.0).any():
+        masked = values.masked_fill(~keep, float("-inf"))
+        # 设置了 top-k 的行在 top-k 集合内归一化；纯 top-p 的行要按整个词表归一化
+        pure_top_p = top_k == vocab_size
+        normalizer = torch.logsumexp(masked, dim=-1)
+        if pure_top_p.any():
+            normalizer = torch.where(pure_top_p, torch.logsumexp(logits, dim=-1), normalizer)
+        probs = torch.exp(masked - normalizer[:, None])
+        # 某个 token 之前的累计概率已经达到 p，就把它去掉；第一个 token 总会保留
+        cum_before = probs.cumsum(dim=-1) - probs
+        keep &= cum_before < top_p[:, None]
+        if width < vocab_size:
+            incomplete = pure_top_p & (probs.sum(dim=-1) < top_p)
+
+    n_keep = keep.sum(dim=-1).clamp(min=1)
+    return values.gather(1, (n_keep - 1)[:, None])[:, 0], incomplete
+
+
+def truncation_thresholds(logits: torch.Tensor, top_k: torch.Tensor, top_p: torch.Tensor,
+                          min_p: torch.Tensor) -> torch.Tensor:
+    """
+    每行保留的最小 logit：top-k、top-p、min-p 三个条件中最严格的那个
+
+    对整个词表排序太慢（50257 个元素，每行约几毫秒），这里只对需要截断的行用 torch.topk
+    取前 max(k) 个（纯 top-p 的行先取前 1024 个）求阈值；候选的累计概率还不到 p 的行
+    才扩大候选范围，最后才整行排序。
+
+    参数:
+        logits (Tensor): (batch_size, vocab_size)，已除以温度
+        top_k (Tensor): (batch_size,) long，0 表示不限制
+        top_p (Tensor): (batch_size,) float，1.0 表示不限制
+        min_p (Tensor): (batch_size,) float，0.0 表示不限制
+
+    返回:
+        Tensor: (batch_size,)，不截断的行为 -inf
+    """
+    batch_size, vocab_size = logits.shape
+    top_k = torch.where(top_k > 0, top_k, vocab_size).clamp(max=vocab_size)
+    thresholds = torch.full((batch_size,), float("-inf"), device=logits.device)
+
+    truncated = (top_k < vocab_size) | (top_p < 1.0)
+    if truncated.any():
+        rows = truncated.nonzero()[:, 0]
+        sub_logits, sub_k, sub_p = logits[rows], top_k[rows], top_p[rows]
+        widths = [w for w in TOP_P_CANDIDATES if w < vocab_size] + [vocab_size]
+        width = int(torch.where(sub_k < vocab_size, sub_k, widths[0]).clamp(max=vocab_size).max())
+
+        sub_thresholds, incomplete = _top_k_top_p_thresholds(sub_logits, sub_k, sub_p, width)
+        for wider in widths[1:]:
+            if not incomplete.any():
+                break
+            retry = incomplete.nonzero()[:, 0]
+            sub_thresholds[retry], still = _top_k_top_p_thresholds(
+                sub_logits[retry], sub_k[retry], sub_p[retry], max(wider, width)
+            )
+            incomplete = torch.zeros_like(incomplete)
+            incomplete[retry] = still
+        thresholds[rows] = sub_thresholds
+
+    if (min_p > 0).any():
+        # p_i < min_p * p_max  <=>  logit_i < logit_max + log(min_p)，不需要先算 softmax
+        row_max = logits.max(dim=-1).values
+        thresholds = torch.maximum(thresholds, row_max + torch.log(min_p))
+    return thresholds
+
+
+class BatchedSampler:
+    """
+    批量采样器：每行使用自己的 SamplingParams
+
+    方法:
+        observe: 记录已出现的 token（提示词和新生成的 token），用于重复/频率惩罚
+        __call__: 对一步的 logits 采样，返回每行的新 token
+
+    示例:
+        >>> sampler = BatchedSampler([SamplingParams(temperature=0.8, top_k=50, seed=1),
+        ...                           SamplingParams(temperature=0)], vocab_size=50257)
+        >>> sampler.observe(prompt_ids)           # (2, n_prompt)
+        >>> next_ids = sampler(logits[:, -1, :])  # (2,)
+    """
+
+    def __init__(self, params: list, vocab_size: int, device=None):
+        """
+        参数:
+            params (list[SamplingParams]): 每行的采样参数
+            vocab_size (int): 词表大小
+            device: logits 所在设备
+        """
+        self.params = list(params)
+        self.vocab_size = vocab_size
+        self.device = torch.device(device) if device is not None else torch.device("cpu")
+
+        def column(name, dtype=torch.float32):
+            """
+            把每行采样参数中的一个字段收集成一维张量
+
+            参数:
+                name (str): SamplingParams 的字段名
+                dtype: 张量类型
+
+            返回:
+                Tensor: (batch_size,)
+            """
+            return torch.tensor([getattr(p, name) for p in self.params], dtype=dtype, device=self.device)
+
+        self.temperature = column("temperature")
+        self.top_k = column("top_k", torch.long)
+        self.top_p = column("top_p")
+        self.min_p = column("min_p")
+        self.repetition_penalty = column("repetition_penalty")
+        self.frequency_penalty = column("frequency_penalty")
+
+        # 只在需要时才做对应的处理，全部是默认值的 batch 不付出额外开销
+        self._greedy = self.temperature == 0
+        self._any_greedy = bool(self._greedy.any())
+        self._all_greedy = bool(self._greedy.all())
+        # 贪心行用 1 代替避免除零，最后再用 argmax 的结果覆盖
+        self._safe_temperature = torch.where(self._greedy, torch.ones_like(self.temperature), self.temperature)
+        self._use_temperature = bool((self._safe_temperature != 1.0).any())
+        self._use_penalty = bool((self.repetition_penalty != 1.0).any() or (self.frequency_penalty != 0).any())
+        self._use_truncation = bool((self.top_k > 0).any() or (self.top_p < 1.0).any() or (self.min_p > 0).any())
+
+        # 已出现的 token：counts 用于频率惩罚，_seen 记录出现过的位置（按容量倍增的缓冲区）
+        self.counts = None
+        self._seen = torch.empty(len(self.params), 0, dtype=torch.long, device=self.device)
+        self._n_seen = 0
+        if self._use_penalty:
+            self.counts = torch.zeros(len(self.params), vocab_size, device=self.device)
+        self.generators = [None if p.seed is None else self._make_generator(p.seed) for p in self.params]
+
+    def _make_generator(self, seed: int) -> torch.Generator:
+        """
+        为设置了 seed 的行创建独立的随机数生成器（与 logits 在同一设备上）
+
+        参数:
+            seed (int): 这一行的随机种子
+
+        返回:
+            torch.Generator: 同一 seed 每次得到相同的采样序列，与 batch 中其他行无关
+        """
+        generator = torch.Generator(device=self.device)
+        generator.manual_seed(seed)
+        return generator
+
+    @property
+    def batch_size(self) -> int:
+        """采样器的行数（与 params 的长度相同）"""
+        return len(self.params)
+
+    def observe(self, token_ids: torch.Tensor, mask: Optional[torch.Tensor] = None) -> None:
+        """
+        记录已出现的 token
+
+        参数:
+            token_ids (Tensor): (batch_size,) 或 (batch_size, n)
+            mask (Tensor): 可选，与 token_ids 同形状的布尔张量，False 的位置（例如左填充）不计入
+        """
+        if self.counts is None:
+            return
+        if token_ids.dim() == 1:
+            token_ids = token_ids[:, None]
+        token_ids = token_ids.to(self.device)
+        n = token_ids.shape[1]
+        ones = torch.ones(token_ids.shape, dtype=self.counts.dtype, device=self.device)
+        if mask is not None:
+            mask = mask.to(self.device)
+            # 被屏蔽的位置换成该行最后一个 token（一定是真实 token）：重复出现不影响惩罚的结果，
+            # 而且它在 counts 中的计数为 0
+            token_ids = torch.where(mask, token_ids, token_ids[:, -1:])
+            ones = ones * mask
+
+        if self._n_seen + n > self._seen.shape[1]:
+            grown = torch.empty(self.batch_size, max(2 * self._seen.shape[1], self._n_seen + n),
+                                dtype=torch.long, device=self.device)
+            grown[:, :self._n_seen] = self._seen[:, :self._n_seen]
+            self._seen = grown
+        self._seen[:, self._n_seen:self._n_seen + n] = token_ids
+        self._n_seen += n
+        self.counts.scatter_add_(1, token_ids, ones)
+
+    def _uniform(self) -> torch.Tensor:
+        """
+        每行一个 [0, 1) 均匀随机数，有 seed 的行用各自的 Generator
+
+        每行每步只消耗一个随机数，同一个 seed 的结果不受 batch 中其他行的影响
+        """
+        u = torch.rand(self.batch_size, device=self.device)
+        for row, generator in enumerate(self.generators):
+            if generator is not None:
+                u[row] = torch.rand((), generator=generator, device=self.device)
+        return u
+
+    @torch.no_grad()
+    def __call__(self, logits: torch.Tensor) -> torch.Tensor:
+        """
+        对一步的 logits 采样
+
+        参数:
+            logits (Tensor): (batch_size, vocab_size)，通常是 model(...)[:, -1, :]
+
+        返回:
+            Tensor: (batch_size,) 每行的新 token，同时自动记录到 counts 中
+        """
+        logits = logits.float()
+        if self._use_penalty and self._n_seen > 0:
+            logits = apply_penalties(logits, self._seen[:, :self._n_seen], self.counts,
+                                     self.repetition_penalty, self.frequency_penalty)
+
+        greedy_ids = torch.argmax(logits, dim=-1) if self._any_greedy else None
+        if self._all_greedy:
+            self.observe(greedy_ids)
+            return greedy_ids
+
+        if self._use_temperature:
+            logits = logits / self._safe_temperature[:, None]
+        if self._use_truncation:
+            thresholds = truncation_thresholds(logits, self.top_k, self.top_p, self.min_p)
+            logits = logits.masked_fill(logits < thresholds[:, None], float("-inf"))
+
+        # 逆 CDF 采样：累积概率第一次超过 u 的位置；被截掉的 token 概率为 0，不会被选中
+        cdf = torch.softmax(logits, dim=-1).cumsum(dim=-1)
+        u = self._uniform() * cdf[:, -1]
+        next_ids = torch.searchsorted(cdf, u[:, None], right=True)[:, 0].clamp(max=self.vocab_size - 1)
+
+        if greedy_ids is not None:
+            next_ids = torch.where(self._greedy, greedy_ids, next_ids)
+        self.observe(next_ids)
+        return next_ids
+
+
+@torch.no_grad()
+def generate(model, idx: torch.Tensor, max_new_tokens: int, params,
+             eos_id: Optional[int] = None, pad_lengths: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    使用 KV 缓存和批量采样器生成文本
+
+    参数:
+        model: GPT 模型（ch04.main.gpt_model.GPTModel）
+        idx (Tensor): 提示词，形状 (batch_size, n_tokens)
+        max_new_tokens (int): 最多生成的新 token 数
+        params: 一个 SamplingParams（所有行共用）或每行一个的列表
+        eos_id (int): 可选，生成该 token 的行之后只输出 eos_id；所有行都结束时提前停止
+        pad_lengths (Tensor): 可选，(batch_size,) 每行左填充的 token 数。长度不同的提示词左对齐补齐后
+                              一起预填充，所有行的新 token 写在同一列；填充部分不参与注意力和惩罚
+
+    返回:
+        Tensor: 形状 (batch_size, n_tokens + 实际生成数)
+    """
+    from ch04.main.kv_cache import KVCache
+
+    batch_size, n_prompt = idx.shape
+    if isinstance(params, SamplingParams):
+        params = [params] * batch_size
+    sampler = BatchedSampler(params, model.cfg.vocab_size, device=idx.device)
+    cache = KVCache.for_model(model, batch_size, max_len=n_prompt + max_new_tokens)
+    if pad_lengths is None:
+        sampler.observe(idx)
+    else:
+        pad_lengths = torch.as_tensor(pad_lengths, device=idx.device)
+        cache.set_left_padding(pad_lengths)
+        sampler.observe(idx, mask=torch.arange(n_prompt, device=idx.device) >= pad_lengths[:, None])
+    out = torch.empty(batch_size, n_prompt + max_new_tokens, dtype=idx.dtype, device=idx.device)
+    out[:, :n_prompt] = idx
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=idx.device)
+
+    logits = model(idx, kv_cache=cache)[:, -1, :]
+    for step in range(max_new_tokens):
+        next_ids = sampler(logits)
+        if eos_id is not None:
+            next_ids = next_ids.masked_fill(finished, eos_id)
+            finished |= next_ids == eos_id
+        out[:, n_prompt + step] = next_ids
+        if step + 1 == max_new_tokens or (eos_id is not None and bool(finished.all())):
+            return out[:, :n_prompt + step + 1]
+        logits = model(next_ids[:, None], kv_cache=cache)[:, -1, :]
+    return out
+
+
+if __name__ == "__main__":
+    torch.manual_seed(123)
+    vocab_size = 50257
+    logits = torch.randn(4, vocab_size) * 3
+
+    params = [
+        SamplingParams(temperature=0),
+        SamplingParams(temperature=0.7, top_k=50, seed=42),
+        SamplingParams(temperature=1.0, top_p=0.9, repetition_penalty=1.2, seed=7),
+        SamplingParams(temperature=1.0, min_p=0.1, frequency_penalty=0.5),
+    ]
+    sampler = BatchedSampler(params, vocab_size)
+    first = sampler(logits)
+    print(f"采样结果: {first.tolist()}")
+    print(f"{'✅' if first[0] == logits[0].argmax() else '❌'} 温度为 0 的行等于 argmax")
+    print(f"{'✅' if first[1] in logits[1].topk(50).indices else '❌'} top-k 行只从前 50 个 token 中采样")
+
+    # 同一个 seed 在不同 batch 组合下结果相同
+    alone = BatchedSampler([params[1]], vocab_size)(logits[1:2])
+    print(f"{'✅' if alone[0] == first[1] else '❌'} 带 seed 的请求在不同 batch 中结果可复现")
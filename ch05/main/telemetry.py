@@ -0,0 +1,317 @@
+"""
+第5章：训练吞吐遥测（tokens/s、MFU、每步耗时分解）
+
+只看"每步多少毫秒"无法知道时间花在了哪里：数据加载慢、前向慢、反向慢、优化器慢、
+还是评估和保存检查点占了太多时间，优化方向完全不同。
+
+核心概念：
+    - 耗时分解：每一步的墙钟时间被拆成 data（等待 DataLoader 给出 batch）、forward、backward、
+      optimizer（梯度裁剪 + 参数更新）、eval、checkpoint 几段，剩下的记为 other
+      （zero_grad、loss.item()、Python 开销等）
+    - tokens/s：这一步处理的 token 数 / 这一步的墙钟时间（包含数据等待和评估）
+    - MFU（Model FLOPs Utilization）：模型"理论上需要"的浮点运算量 / (耗时 × 硬件峰值算力)
+        · 每个 token 的训练运算量 ≈ 6N + 12·L·T·d（N 为矩阵乘法中的参数量，
+          前向 2N、反向 4N；后一项是注意力分数和加权求和，L 层、上下文 T、维度 d）
+        · 激活检查点的重算不计入（否则开启检查点反而显得利用率更高）
+        · 峰值算力用本机实测的大矩阵乘法 GFLOP/s 代替厂商标称值，CPU 上更有参考意义
+    - 按需 profiler：指定步数开启，或者训练中在日志目录下创建 PROFILE 文件触发，
+      用 torch.profiler 记录接下来若干步并导出 Chrome trace（chrome://tracing 或 Perfetto 打开）
+    - JSONL 日志：每步一行 JSON，追加写入并立即 flush，训练中途也能用 tail / jq 查看，
+      不同版本的日志直接对比就能发现性能回退
+
+依赖：
+    - torch: PyTorch 深度学习框架（torch.profiler）
+"""
+
+import contextlib
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Optional
+
+import torch
+import torch.nn as nn
+from torch.profiler import ProfilerActivity, profile, record_function
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from setup.benchmark import DTYPES, summarize, time_fn
+
+# 每步耗时分解的各个阶段（other 由墙钟时间减去其余各段得到）
+PHASES = ("data", "forward", "backward", "optimizer", "eval", "checkpoint")
+
+# 训练中创建这个文件即可触发一次 profiler 窗口（文件会被删除）
+PROFILE_TRIGGER = "PROFILE"
+
+
+def estimate_flops_per_token(model: nn.Module, ctx_len: Optional[int] = None) -> float:
+    """
+    估计训练时每个 token 的浮点运算量（前向 + 反向）
+
+    参数:
+        model: GPTModel（或被 DDP 包装的 GPTModel）
+        ctx_len (int): 训练时的序列长度，默认取 model.cfg.ctx_len
+
+    返回:
+        float: 每个 token 的 FLOPs
+
+    注意:
+        - 嵌入层只是查表，不计入 N；输出层 out_head 是矩阵乘法，计入 N
+    """
+    model = getattr(model, "module", model)
+    cfg = model.cfg
+    ctx_len = ctx_len or cfg.ctx_len
+    embedding_params = sum(p.numel() for m in model.modules() if isinstance(m, nn.Embedding)
+                           for p in m.parameters(recurse=False))
+    n_params = sum(p.numel() for p in model.parameters()) - embedding_params
+    return 6 * n_params + 12 * cfg.n_layers * ctx_len * cfg.emb_dim
+
+
+def measure_peak_gflops(dtype: str = "fp32", size: int = 1024, repeats: int = 10) -> float:
+    """
+    实测本机的矩阵乘法峰值算力，作为 MFU 的分母
+
+    参数:
+        dtype (str): "fp32" 或 "bf16"
+        size (int): 方阵边长
+        repeats (int): 计时次数，取最快的一次
+
+    返回:
+        float: GFLOP/s
+    """
+    a = torch.randn(size, size, dtype=DTYPES[dtype])
+    b = torch.randn(size, size, dtype=DTYPES[dtype])
+    stats = summarize(time_fn(lambda: a @ b, torch.device("cpu"), warmup=3, repeats=repeats))
+    return 2 * size ** 3 / (stats["min_ms"] * 1e6)
+
+
+class Telemetry:
+    """
+    训练遥测：记录每一步各阶段的耗时、吞吐和 MFU，写入 JSONL，按需导出 profiler trace
+
+    示例:
+        >>> telemetry = Telemetry("runs/log.jsonl", flops_per_token=estimate_flops_per_token(model),
+        ...                       peak_gflops=measure_peak_gflops())
+        >>> trainer.telemetry = telemetry
+        >>> trainer.fit(train_loader, val_loader)
+        >>> telemetry.print_summary()
+
+    注意:
+        - 阶段计时只在 phase() 包住的代码上生效；CPU 上算子同步执行，墙钟时间就是计算时间
+    """
+
+    def __init__(self, log_path: Optional[str] = None, flops_per_token: float = 0.0,
+                 peak_gflops: float = 0.0, profile_at: Optional[int] = None, profile_steps: int = 3,
+                 trace_dir: Optional[str] = None):
+        """
+        参数:
+            log_path (str): JSONL 日志路径，None 表示只在内存中记录
+            flops_per_token (float): 每个 token 的训练 FLOPs（见 estimate_flops_per_token），0 表示不计算 MFU
+            peak_gflops (float): 硬件峰值 GFLOP/s（见 measure_peak_gflops）
+            profile_at (int): 在这一步开始 profiler 窗口，None 表示只靠触发文件开启
+            profile_steps (int): 每个 profiler 窗口记录的步数
+            trace_dir (str): Chrome trace 输出目录，默认是日志所在目录
+        """
+        self.log_path = log_path
+        self.flops_per_token = flops_per_token
+        self.peak_gflops = peak_gflops
+        self.profile_at = profile_at
+        self.profile_steps = profile_steps
+        self.trace_dir = trace_dir or (os.path.dirname(os.path.abspath(log_path)) if log_path else ".")
+        self.records = []
+        self.traces = []
+
+        self._log = None
+        if log_path:
+            os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+            self._log = open(log_path, "a", encoding="utf-8")
+        self._phases = dict.fromkeys(PHASES, 0.0)
+        self._step_start = None
+        self._profiler = None
+        self._profile_until = None
+
+    def start(self) -> None:
+        """标记第一步的开始（之后每步从上一步结束时算起）"""
+        self._step_start = time.perf_counter()
+        self._phases = dict.fromkeys(PHASES, 0.0)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """把代码块的耗时计入当前步的 name 阶段；profiler 开启时同时在 trace 中标出"""
+        scope = record_function(name) if self._profiler is not None else contextlib.nullcontext()
+        start = time.perf_counter()
+        try:
+            with scope:
+                yield
+        finally:
+            self._phases[name] += time.perf_counter() - start
+
+    def timed_batches(self, loader):
+        """包装数据加载器：每次取 batch 的等待时间计入 data 阶段"""
+        iterator = iter(loader)
+        while True:
+            with self.phase("data"):
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+            yield batch
+
+    def request_profile(self, step: int) -> None:
+        """从下一步开始记录 profile_steps 步"""
+        if self._profiler is not None:
+            return
+        self._profiler = profile(activities=[ProfilerActivity.CPU])
+        self._profiler.__enter__()
+        self._profile_until = step + self.profile_steps
+
+    def end_step(self, step: int, tokens: int, loss: float) -> dict:
+        """
+        结束一步：计算吞吐和 MFU、写日志、处理 profiler 窗口
+
+        参数:
+            step (int): 刚完成的步数（global_step）
+            tokens (int): 这一步处理的 token 数
+            loss (float): 这一步的训练损失
+
+        返回:
+            dict: 这一步的记录
+        """
+        now = time.perf_counter()
+        if self._step_start is None:
+            self._step_start = now - sum(self._phases.values())
+        wall = max(now - self._step_start, 1e-9)
+        record = {"step": step, "loss": loss, "tokens": tokens, "step_ms": wall * 1e3,
+                  "tokens_per_sec": tokens / wall}
+        if self.flops_per_token and self.peak_gflops:
+            record["mfu"] = self.flops_per_token * tokens / wall / (self.peak_gflops * 1e9)
+        phases_ms = {name: seconds * 1e3 for name, seconds in self._phases.items()}
+        phases_ms["other"] = max(wall * 1e3 - sum(phases_ms.values()), 0.0)
+        record["phases_ms"] = phases_ms
+        self.records.append(record)
+        if self._log is not None:
+            self._log.write(json.dumps(record) + "\n")
+            self._log.flush()
+
+        self._update_profiler(step)
+        self._phases = dict.fromkeys(PHASES, 0.0)
+        # 下一步从现在开始计时（写日志的时间算入下一步的 other）
+        self._step_start = now
+        return record
+
+    def _update_profiler(self, step: int) -> None:
+        """
+        每步结束时管理 profiler 窗口
+
+        采集窗口结束时导出 Chrome trace；到达 profile_at 或 trace_dir 下出现触发文件时开始新的采集
+        （触发文件随即删除，训练中途 touch 一下就能采集接下来几步）
+        """
+        if self._profiler is not None and step >= self._profile_until:
+            self._profiler.__exit__(None, None, None)
+            path = os.path.join(self.trace_dir, f"trace-step{step:06d}.json")
+            os.makedirs(self.trace_dir, exist_ok=True)
+            self._profiler.export_chrome_trace(path)
+            self.traces.append(path)
+            self._profiler = None
+            print(f"✅ profiler trace 已写入: {path}")
+            return
+        trigger = os.path.join(self.trace_dir, PROFILE_TRIGGER)
+        if step == self.profile_at:
+            self.request_profile(step)
+        elif os.path.exists(trigger):
+            os.remove(trigger)
+            self.request_profile(step)
+
+    def summary(self, skip: int = 1) -> dict:
+        """
+        汇总各步的中位数
+
+        参数:
+            skip (int): 跳过的前几步（第一步包含内存分配等一次性开销）
+
+        返回:
+            dict: step_ms / tokens_per_sec / mfu 的中位数，以及各阶段的中位耗时和占比
+        """
+        records = self.records[skip:] or self.records
+        if not records:
+            return {}
+        result = {"steps": len(records),
+                  "step_ms": statistics.median(r["step_ms"] for r in records),
+                  "tokens_per_sec": statistics.median(r["tokens_per_sec"] for r in records)}
+        if "mfu" in records[0]:
+            result["mfu"] = statistics.median(r["mfu"] for r in records)
+        # 占比按总耗时计算：评估和保存只在个别步发生，中位数会把它们抹掉
+        total_ms = sum(r["step_ms"] for r in records)
+        result["phases"] = {
+            name: {"median_ms": statistics.median(r["phases_ms"][name] for r in records),
+                   "fraction": sum(r["phases_ms"][name] for r in records) / total_ms}
+            for name in records[0]["phases_ms"]
+        }
+        return result
+
+    def print_summary(self, skip: int = 1) -> None:
+        """
+        打印 summary 的结果：每步中位数耗时、吞吐、MFU，以及各阶段的中位数耗时和占比
+
+        参数:
+            skip (int): 跳过的前几步
+        """
+        summary = self.summary(skip)
+        if not summary:
+            print("⚠️  没有记录到训练步")
+            return
+        mfu = f"，MFU {summary['mfu']:.1%}" if "mfu" in summary else ""
+        print(f"每步中位数 {summary['step_ms']:.1f} ms，{summary['tokens_per_sec']:.0f} tokens/s{mfu}"
+              f"（{summary['steps']} 步）")
+        print(f"  {'阶段':<12} {'中位数 ms':>10} {'占比':>8}")
+        for name, stats in summary["phases"].items():
+            print(f"  {name:<12} {stats['median_ms']:>10.1f} {stats['fraction']:>8.1%}")
+
+    def close(self) -> None:
+        """结束未完成的 profiler 窗口并关闭日志"""
+        if self._profiler is not None:
+            self._profile_until = -1
+            self._update_profiler(self.records[-1]["step"] if self.records else 0)
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def __enter__(self):
+        """返回自身，用于 with 语句"""
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        """退出 with 语句时调用 close()"""
+        self.close()
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    from ch04.main.gpt_model import GPTConfig, GPTModel
+    from ch05.main.train import TrainConfig, Trainer
+
+    torch.manual_seed(123)
+    cfg = GPTConfig(vocab_size=1000, ctx_len=64, emb_dim=128, n_heads=4, n_layers=2)
+    model = GPTModel(cfg)
+    peak = measure_peak_gflops()
+    print(f"本机 fp32 矩阵乘法峰值: {peak:.1f} GFLOP/s，"
+          f"每 token 训练运算量 {estimate_flops_per_token(model) / 1e6:.1f} MFLOPs")
+
+    inputs = torch.randint(0, cfg.vocab_size, (8, cfg.ctx_len))
+    batches = [(inputs, torch.roll(inputs, -1, dims=1))] * 6
+    with tempfile.TemporaryDirectory() as tmp:
+        trainer = Trainer(model, TrainConfig(num_epochs=1, eval_freq=0, final_eval=False))
+        trainer.telemetry = Telemetry(os.path.join(tmp, "telemetry.jsonl"),
+                                      estimate_flops_per_token(model), peak, profile_at=2, profile_steps=2)
+        with trainer.telemetry:
+            trainer.fit(batches, verbose=False)
+        trainer.telemetry.print_summary()
+        with open(os.path.join(tmp, "telemetry.jsonl"), encoding="utf-8") as f:
+            n_lines = sum(1 for _ in f)
+        status = "✅" if n_lines == 6 and trainer.telemetry.traces else "❌"
+        print(f"{status} JSONL 日志 {n_lines} 行，trace 文件 {len(trainer.telemetry.traces)} 个")
@@ -0,0 +1,518 @@
+"""
+第5章：GPT 预训练循环
+
+在滑动窗口采样的 token 数据上用"预测下一个 token"的交叉熵损失训练 GPT。
+
+核心概念：
+    - 训练步：前向 -> 交叉熵损失 -> 反向传播 -> 梯度裁剪 -> 优化器更新
+    - 定期评估：每 eval_freq 步在训练集和验证集固定的随机子集上估计损失（见 evaluation.py），
+      用来观察是否过拟合；训练结束时在完整的验证集上再评估一次
+    - 精度策略：fp32 / bf16-autocast / bf16-pure 三种模式由 PrecisionPolicy 统一处理，
+      训练循环本身不关心数据类型
+    - 梯度累积：把一个 batch 切成 grad_accum_steps 个微批次依次前向/反向，梯度在参数上累加，
+      最后只更新一次参数。结果与整个 batch 一次计算相同，激活值内存只按微批次大小计算
+    - 激活检查点：选定的 Transformer Block 不保存中间激活值，反向时重新计算（见 GPTModel）
+    - 训练检查点：每 save_freq 步在后台线程保存模型、优化器和步数（见 checkpoint.py），
+      resume 从最近一次完整的检查点恢复
+    - 遥测：设置 telemetry_log 后，每步的 tokens/s、MFU 和各阶段耗时写入 JSONL（见 telemetry.py）
+
+依赖：
+    - torch: PyTorch 深度学习框架
+    - tiktoken: GPT-2 分词器（仅命令行入口使用）
+"""
+
+import argparse
+import contextlib
+import itertools
+import os
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Optional, Sequence, Union
+
+import torch
+import torch.nn as nn
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch05.main.checkpoint import INDEX_FILE, AsyncCheckpointer, latest_checkpoint, load_checkpoint
+from ch05.main.evaluation import EvalResult, EvalWindows, Evaluator, subset_indices
+from ch05.main.precision import PRECISION_MODES, PrecisionPolicy
+from ch05.main.telemetry import Telemetry, estimate_flops_per_token, measure_peak_gflops
+
+
+def calc_loss_batch(input_batch: torch.Tensor, target_batch: torch.Tensor, model: nn.Module,
+                    device, policy: Optional[PrecisionPolicy] = None) -> torch.Tensor:
+    """
+    计算一个 batch 的平均交叉熵损失
+
+    参数:
+        input_batch, target_batch (Tensor): 形状 (batch_size, seq_len) 的 token ID
+        model: GPT 模型
+        device: 计算设备
+        policy: 精度策略，默认 fp32
+
+    返回:
+        Tensor: 标量损失（fp32）
+    """
+    policy = policy or PrecisionPolicy()
+    input_batch, target_batch = input_batch.to(device), target_batch.to(device)
+    with policy.autocast():
+        logits = model(input_batch)
+    return policy.loss(logits, target_batch)
+
+
+@torch.no_grad()
+def calc_loss_loader(data_loader, model: nn.Module, device, num_batches: Optional[int] = None,
+                     policy: Optional[PrecisionPolicy] = None) -> float:
+    """
+    计算数据加载器中前 num_batches 个 batch 的平均损失
+
+    参数:
+        num_batches (int): 最多使用的 batch 数，None 表示全部
+
+    返回:
+        float: 平均损失；数据加载器为空时返回 nan
+    """
+    if len(data_loader) == 0:
+        return float("nan")
+    num_batches = len(data_loader) if num_batches is None else min(num_batches, len(data_loader))
+    total = 0.0
+    for i, (input_batch, target_batch) in enumerate(data_loader):
+        if i >= num_batches:
+            break
+        total += calc_loss_batch(input_batch, target_batch, model, device, policy).item()
+    return total / num_batches
+
+
+@dataclass
+class TrainConfig:
+    """
+    训练超参数
+
+    默认值对应书中在 the-verdict.txt 上的小规模预训练
+    """
+
+    # AdamW 学习率和权重衰减
+    lr: float = 4e-4
+    weight_decay: float = 0.1
+
+    # 训练轮数
+    num_epochs: int = 10
+
+    # 每隔多少步评估一次，以及每次评估用多少个 batch（子集大小 = eval_iter × eval_batch_size 个窗口）
+    eval_freq: int = 5
+    eval_iter: int = 5
+
+    # 评估时的 batch 大小：没有反向传播，可以比训练时大
+    eval_batch_size: int = 8
+
+    # 训练结束时是否在完整验证集上评估一次
+    final_eval: bool = True
+
+    # 梯度裁剪阈值，None 表示不裁剪
+    max_grad_norm: Optional[float] = 1.0
+
+    # 精度模式："fp32"、"bf16-autocast" 或 "bf16-pure"
+    precision: str = "fp32"
+
+    # 动态损失缩放（bf16 一般不需要）
+    loss_scaling: bool = False
+
+    # 梯度累积：每个 batch 切成多少个微批次（1 表示不切分）
+    grad_accum_steps: int = 1
+
+    # 开启激活检查点的层："all"、层编号列表，None 表示关闭
+    checkpoint_layers: Optional[Union[str, Sequence[int]]] = None
+
+    # 训练检查点：每隔 save_freq 步异步保存到 save_dir/step-XXXXXX（0 或 None 表示不保存）
+    save_dir: Optional[str] = None
+    save_freq: int = 0
+
+    # 遥测日志（JSONL），None 表示不记录；profile_at 指定在哪一步开启 profiler 窗口
+    telemetry_log: Optional[str] = None
+    profile_at: Optional[int] = None
+
+
+@dataclass
+class TrainHistory:
+    """
+    训练过程记录
+
+    属性:
+        train_losses: 每一步的训练损失
+        step_times_ms: 每一步的耗时（毫秒）
+        eval_steps: 做评估时的步数
+        eval_train_losses / eval_val_losses: 对应评估时的训练集 / 验证集损失
+        tokens_seen: 对应评估时已经处理的 token 数
+        eval_seconds: 评估累计耗时（秒），与 step_times_ms 之和对比可知评估的开销占比
+        final_eval: 训练结束时完整验证集的评估结果
+    """
+
+    train_losses: list = field(default_factory=list)
+    step_times_ms: list = field(default_factory=list)
+    eval_steps: list = field(default_factory=list)
+    eval_train_losses: list = field(default_factory=list)
+    eval_val_losses: list = field(default_factory=list)
+    tokens_seen: list = field(default_factory=list)
+    eval_seconds: float = 0.0
+    final_eval: Optional[EvalResult] = None
+
+
+class Trainer:
+    """
+    GPT 训练器
+
+    属性:
+        model: 按精度策略转换后的模型
+        optimizer: AdamW（纯 bf16 模式下带 fp32 主权重）
+        policy: 精度策略
+        global_step: 已完成的优化器步数
+        tokens_seen: 已训练的 token 数
+        history: TrainHistory
+        telemetry: 遥测（cfg.telemetry_log 非空时创建，也可以直接赋值），None 表示不记录
+
+    示例:
+        >>> trainer = Trainer(GPTModel(cfg), TrainConfig(precision="bf16-autocast"))
+        >>> history = trainer.fit(train_loader, val_loader)
+    """
+
+    def __init__(self, model: nn.Module, cfg: TrainConfig, device="cpu"):
+        """
+        参数:
+            model: 待训练的模型
+            cfg: 训练超参数
+            device: 训练设备
+        """
+        self.cfg = cfg
+        self.device = torch.device(device)
+        self.policy = PrecisionPolicy(cfg.precision, loss_scaling=cfg.loss_scaling)
+        self.model = self.policy.prepare_model(model.to(self.device))
+        if cfg.checkpoint_layers:
+            self.model.set_activation_checkpointing(cfg.checkpoint_layers)
+        self.optimizer = self.policy.build_optimizer(self.model, lr=cfg.lr,
+                                                     weight_decay=cfg.weight_decay)
+        self.global_step = 0
+        self.tokens_seen = 0
+        self.history = TrainHistory()
+        self.checkpointer: Optional[AsyncCheckpointer] = None
+        self.telemetry: Optional[Telemetry] = None
+        if cfg.telemetry_log:
+            peak_dtype = "fp32" if cfg.precision == "fp32" else "bf16"
+            self.telemetry = Telemetry(cfg.telemetry_log, estimate_flops_per_token(self.model),
+                                       measure_peak_gflops(peak_dtype), profile_at=cfg.profile_at)
+        # 每个评估数据集对应的 {"dataset": 数据集, "subset"/"full": 评估器}，窗口只构建一次
+        self._eval_cache = {}
+
+    def state_dict(self) -> dict:
+        """恢复训练所需的全部状态：模型、优化器、损失缩放器和计数器"""
+        # DistributedDataParallel 包装后，真正的模型在 .module 里
+        model = getattr(self.model, "module", self.model)
+        scaler = self.policy.scaler
+        return {
+            "model": model.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "scaler": scaler.state_dict() if scaler is not None else None,
+            "global_step": self.global_step,
+            "tokens_seen": self.tokens_seen,
+        }
+
+    def load_state_dict(self, state: dict) -> None:
+        """
+        恢复 state_dict 保存的状态
+
+        参数:
+            state (dict): state_dict 的返回值（torch.load 或 load_checkpoint 读出的都可以）
+
+        注意:
+            - DDP 包装后加载到 .module 中的原始模型
+            - 当前精度策略没有损失缩放器时忽略 state["scaler"]
+        """
+        model = getattr(self.model, "module", self.model)
+        model.load_state_dict(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        if self.policy.scaler is not None and state.get("scaler"):
+            self.policy.scaler.load_state_dict(state["scaler"])
+        self.global_step = state["global_step"]
+        self.tokens_seen = state["tokens_seen"]
+
+    def _phase(self, name: str):
+        """遥测开启时把代码块的耗时计入 name 阶段"""
+        return self.telemetry.phase(name) if self.telemetry is not None else contextlib.nullcontext()
+
+    def save_checkpoint(self, path: str) -> None:
+        """在后台线程保存检查点，训练线程只等待快照完成"""
+        if self.checkpointer is None:
+            self.checkpointer = AsyncCheckpointer()
+        with self._phase("checkpoint"):
+            self.checkpointer.save(self.state_dict(), path,
+                                   metadata={"global_step": self.global_step,
+                                             "precision": self.cfg.precision})
+
+    def resume(self, path: str) -> bool:
+        """
+        从检查点恢复
+
+        参数:
+            path (str): 检查点目录，或包含多个检查点的上级目录（取最近的一个）
+
+        返回:
+            bool: 是否找到并加载了检查点
+
+        注意:
+            - 恢复后 fit 按 global_step 接着原来的进度训练：跳过已经完成的轮，
+              当前轮中已经训练过的 batch 也跳过，总步数与不中断时相同
+            - 打乱顺序的数据加载器在新进程中的顺序不同，跳过的是"前若干个 batch"而不是原来那些样本；
+              需要逐样本复现时给 DataLoader 传入固定种子的 generator
+        """
+        if not os.path.exists(os.path.join(path, INDEX_FILE)):
+            path = latest_checkpoint(path)
+            if path is None:
+                return False
+        state, _ = load_checkpoint(path)
+        self.load_state_dict(state)
+        return True
+
+    def train_step(self, input_batch: torch.Tensor, target_batch: torch.Tensor) -> float:
+        """
+        执行一个优化器步
+
+        batch 会被切成 grad_accum_steps 个微批次（不能整除时最后一个较小），
+        每个微批次的损失按它占整个 batch 的比例加权后反向传播，累加的梯度等于整个 batch 的梯度。
+
+        返回:
+            float: 这一步的训练损失（整个 batch 的平均值）
+        """
+        start = time.perf_counter()
+        self.model.train()
+        self.optimizer.zero_grad(set_to_none=True)
+
+        n_samples = input_batch.shape[0]
+        n_micro = min(self.cfg.grad_accum_steps, n_samples)
+        micro_batches = list(zip(input_batch.chunk(n_micro), target_batch.chunk(n_micro)))
+        loss_value = 0.0
+        for i, (micro_inputs, micro_targets) in enumerate(micro_batches):
+            weight = micro_inputs.shape[0] / n_samples
+            # DistributedDataParallel：只在最后一个微批次反向传播时同步梯度
+            is_last = i == len(micro_batches) - 1
+            no_sync = getattr(self.model, "no_sync", None)
+            with contextlib.nullcontext() if is_last or no_sync is None else no_sync():
+                with self._phase("forward"):
+                    loss = calc_loss_batch(micro_inputs, micro_targets, self.model, self.device, self.policy)
+                with self._phase("backward"):
+                    self.policy.backward(loss * weight)
+            loss_value += loss.item() * weight
+        with self._phase("optimizer"):
+            self.policy.step(self.optimizer, self.model, max_grad_norm=self.cfg.max_grad_norm)
+
+        self.global_step += 1
+        self.tokens_seen += input_batch.numel()
+        self.history.train_losses.append(loss_value)
+        self.history.step_times_ms.append((time.perf_counter() - start) * 1e3)
+        return loss_value
+
+    def _evaluator(self, loader, full: bool = False) -> Evaluator:
+        """
+        数据加载器 -> 评估器（窗口只构建一次并缓存）
+
+        固定随机子集只构建被抽中的 eval_iter × eval_batch_size 个窗口，
+        不会把整个训练语料复制进内存；全部窗口只在 full=True（最终的完整评估）时才构建
+        """
+        dataset = loader.dataset
+        cached = self._eval_cache.get(id(dataset))
+        if cached is None or cached["dataset"] is not dataset:
+            cached = self._eval_cache[id(dataset)] = {"dataset": dataset}
+        key = "full" if full else "subset"
+        if key not in cached:
+            indices = None
+            if not full:
+                indices = subset_indices(len(dataset), self.cfg.eval_iter * self.cfg.eval_batch_size)
+            cached[key] = Evaluator(EvalWindows.from_dataset(dataset, indices), self.cfg.eval_batch_size,
+                                    self.policy, self.device)
+        return cached[key]
+
+    def evaluate_loader(self, loader, full: bool = False) -> EvalResult:
+        """
+        在一个数据加载器的数据上评估
+
+        参数:
+            full (bool): True 时评估全部窗口，否则只评估固定的随机子集
+        """
+        evaluator = self._evaluator(loader, full)
+        model = getattr(self.model, "module", self.model)
+        with self._phase("eval"):
+            result = evaluator.evaluate(model)
+        self.history.eval_seconds += result.seconds
+        return result
+
+    def evaluate(self, train_loader, val_loader=None):
+        """
+        在训练集和验证集的固定随机子集上估计损失
+
+        返回:
+            tuple[float, float]: (训练集损失, 验证集损失)；没有验证集时验证集损失为 nan
+        """
+        train_loss = self.evaluate_loader(train_loader).loss
+        val_loss = float("nan")
+        if val_loader is not None:
+            val_loss = self.evaluate_loader(val_loader).loss
+        return train_loss, val_loss
+
+    def fit(self, train_loader, val_loader=None, max_steps: Optional[int] = None,
+            verbose: bool = True) -> TrainHistory:
+        """
+        完整的训练循环
+
+        参数:
+            train_loader: 训练数据加载器
+            val_loader: 可选，验证数据加载器
+            max_steps (int): 最多训练的步数，None 表示跑完 num_epochs 轮
+            verbose (bool): 是否打印评估结果
+
+        返回:
+            TrainHistory: 训练记录
+        """
+        if self.telemetry is not None:
+            self.telemetry.start()
+        try:
+            self._fit_epochs(train_loader, val_loader, max_steps, verbose)
+        finally:
+            # 保证最后一次保存写完再返回
+            if self.checkpointer is not None:
+                self.checkpointer.wait()
+
+        if self.cfg.final_eval and val_loader is not None and len(val_loader.dataset) > 0:
+            self.history.final_eval = self.evaluate_loader(val_loader, full=True)
+            if verbose:
+                result = self.history.final_eval
+                print(f"完整验证集: loss {result.loss:.3f}, perplexity {result.perplexity:.1f} "
+                      f"（{result.n_tokens} 个 token，{result.seconds:.1f} s）")
+        return self.history
+
+    def _fit_epochs(self, train_loader, val_loader, max_steps: Optional[int], verbose: bool) -> None:
+        """
+        fit 的训练循环：逐轮逐 batch 训练，按 save_freq 保存检查点、按 eval_freq 评估
+
+        从检查点恢复时跳过已完成的轮和当前轮已训练过的 batch；达到 max_steps 时提前返回
+        """
+        # 从检查点恢复时 global_step > 0：跳过已完成的轮和当前轮已训练的 batch
+        try:
+            start_epoch, skip = divmod(self.global_step, len(train_loader))
+        except (TypeError, ZeroDivisionError):
+            # 没有长度的加载器（IterableDataset）或空加载器：无法定位，从头开始
+            start_epoch, skip = 0, 0
+        for epoch in range(start_epoch, self.cfg.num_epochs):
+            batches = iter(train_loader)
+            if epoch == start_epoch and skip:
+                # 只取出并丢弃 batch，不做前向和反向
+                batches = itertools.islice(batches, skip, None)
+            if self.telemetry is not None:
+                batches = self.telemetry.timed_batches(batches)
+            for input_batch, target_batch in batches:
+                if max_steps is not None and self.global_step >= max_steps:
+                    return
+                loss = self.train_step(input_batch, target_batch)
+
+                if self.cfg.save_dir and self.cfg.save_freq and self.global_step % self.cfg.save_freq == 0:
+                    self.save_checkpoint(os.path.join(self.cfg.save_dir, f"step-{self.global_step:06d}"))
+
+                if self.cfg.eval_freq and self.global_step % self.cfg.eval_freq == 0:
+                    train_loss, val_loss = self.evaluate(train_loader, val_loader)
+                    self.history.eval_steps.append(self.global_step)
+                    self.history.eval_train_losses.append(train_loss)
+                    self.history.eval_val_losses.append(val_loss)
+                    self.history.tokens_seen.append(self.tokens_seen)
+                    if verbose:
+                        print(f"Ep {epoch + 1} (Step {self.global_step:06d}): "
+                              f"Train loss {train_loss:.3f}, Val loss {val_loss:.3f}")
+
+                # 评估和保存计入这一步的耗时
+                if self.telemetry is not None:
+                    self.telemetry.end_step(self.global_step, input_batch.numel(), loss)
+
+
+def parse_checkpoint_layers(values: Optional[list]):
+    """命令行参数 -> TrainConfig.checkpoint_layers：["all"] 表示全部层，其余按层编号解析"""
+    if not values:
+        return None
+    if values == ["all"]:
+        return "all"
+    return [int(v) for v in values]
+
+
+def main():
+    """在 the-verdict.txt 上按命令行指定的精度、梯度累积和激活检查点设置训练，结束后打印吞吐和评估耗时"""
+    import tiktoken
+
+    from ch02.main.dataloader import create_dataloader_v1
+    from ch04.main.gpt_model import GPTConfig, GPTModel
+
+    parser = argparse.ArgumentParser(description="在 the-verdict.txt 上预训练一个小 GPT")
+    parser.add_argument("--precision", choices=PRECISION_MODES, default="fp32")
+    parser.add_argument("--loss-scaling", action="store_true", help="启用动态损失缩放")
+    parser.add_argument("--grad-accum-steps", type=int, default=1, help="每个 batch 切成的微批次数")
+    parser.add_argument("--checkpoint-layers", nargs="*", default=None,
+                        help='开启激活检查点的层编号，或 "all"')
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--ctx-len", type=int, default=256)
+    parser.add_argument("--emb-dim", type=int, default=768)
+    parser.add_argument("--n-layers", type=int, default=12)
+    parser.add_argument("--n-heads", type=int, default=12)
+    parser.add_argument("--lr", type=float, default=4e-4)
+    parser.add_argument("--sparse-embedding", action="store_true",
+                        help="token 嵌入使用稀疏梯度（嵌入层由 SparseAdam 更新）")
+    parser.add_argument("--seed", type=int, default=123)
+    parser.add_argument("--eval-batch-size", type=int, default=8, help="评估时的 batch 大小")
+    parser.add_argument("--telemetry-log", default=None, help="每步的吞吐和耗时分解写入这个 JSONL 文件")
+    parser.add_argument("--profile-at", type=int, default=None,
+                        help="在这一步开启 profiler 窗口（也可在日志目录下创建 PROFILE 文件触发）")
+    parser.add_argument("--save-dir", default=None, help="检查点目录；已有检查点时从最近的一个恢复")
+    parser.add_argument("--save-freq", type=int, default=50, help="每隔多少步保存一次检查点")
+    args = parser.parse_args()
+
+    text_path = os.path.join(ROOT_DIR, "ch02", "main", "the-verdict.txt")
+    with open(text_path, "r", encoding="utf-8") as f:
+        text = f.read()
+    split = int(0.9 * len(text))
+
+    torch.manual_seed(args.seed)
+    tokenizer = tiktoken.get_encoding("gpt2")
+    train_loader = create_dataloader_v1(text[:split], batch_size=args.batch_size,
+                                        max_length=args.ctx_len, stride=args.ctx_len,
+                                        tokenizer=tokenizer)
+    val_loader = create_dataloader_v1(text[split:], batch_size=args.batch_size,
+                                      max_length=args.ctx_len, stride=args.ctx_len,
+                                      shuffle=False, drop_last=False, tokenizer=tokenizer)
+
+    model_cfg = GPTConfig(ctx_len=args.ctx_len, emb_dim=args.emb_dim, n_layers=args.n_layers,
+                          n_heads=args.n_heads, sparse_embedding=args.sparse_embedding)
+    train_cfg = TrainConfig(lr=args.lr, num_epochs=args.epochs, precision=args.precision,
+                            loss_scaling=args.loss_scaling, grad_accum_steps=args.grad_accum_steps,
+                            checkpoint_layers=parse_checkpoint_layers(args.checkpoint_layers),
+                            eval_batch_size=args.eval_batch_size, save_dir=args.save_dir,
+                            save_freq=args.save_freq, telemetry_log=args.telemetry_log,
+                            profile_at=args.profile_at)
+    trainer = Trainer(GPTModel(model_cfg), train_cfg)
+    print(f"精度策略: {trainer.policy}")
+    if args.save_dir and trainer.resume(args.save_dir):
+        print(f"✅ 从检查点恢复到第 {trainer.global_step} 步")
+    history = trainer.fit(train_loader, val_loader)
+
+    step_times = sorted(history.step_times_ms)
+    median_ms = step_times[len(step_times) // 2]
+    tokens_per_step = args.batch_size * args.ctx_len
+    print(f"✅ 训练完成: {trainer.global_step} 步, 每步中位数 {median_ms:.1f} ms, "
+          f"{tokens_per_step / median_ms * 1e3:.0f} tokens/s")
+    train_seconds = sum(history.step_times_ms) / 1e3
+    print(f"评估耗时 {history.eval_seconds:.1f} s，占训练时间的 "
+          f"{history.eval_seconds / max(train_seconds, 1e-9):.1%}")
+    if trainer.telemetry is not None:
+        trainer.telemetry.close()
+        trainer.telemetry.print_summary()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+第5章扩展：多进程数据并行训练（DistributedDataParallel + gloo）
+
+单个进程里，PyTorch 的 CPU 算子用到十几个线程以后就很难再加速（同步开销、跨 NUMA 访存）。
+数据并行改为启动多个进程，每个进程只用一组核心、持有一份完整的模型副本、
+处理不同的数据分片，反向传播时把梯度求平均，所有副本始终保持一致。
+
+核心概念：
+    - 进程组：torchrun 为每个进程设置 RANK / WORLD_SIZE / MASTER_ADDR 等环境变量，
+      init_process_group("gloo") 据此建立通信；gloo 是 PyTorch 自带的 CPU 通信后端
+    - 分片采样：DistributedSampler 把样本下标均匀分给各进程，每轮用 set_epoch 换一种打乱顺序，
+      所有进程打乱的方式一致，分到的样本互不重叠
+    - 梯度分桶（bucketing）：DDP 把梯度按反向传播的顺序装进约 bucket_cap_mb 大小的桶，
+      一个桶装满就立即发起 allreduce，通信与剩余的反向计算重叠
+    - 梯度累积：非最后一个微批次在 no_sync() 中反向传播，只做本地累加，不通信
+    - 核心绑定：--bind-cores 把第 local_rank 个进程绑定到第 local_rank 组核心上，
+      避免进程之间抢占同一个核心；跨 NUMA 节点时也可以用 numactl 启动
+
+运行方式：
+    # 单机 4 个进程，每个进程 2 个线程
+    torchrun --standalone --nproc_per_node=4 ch05/main/train_ddp.py --data corpus.bin --threads 2
+
+    # 两台机器（每台分别执行，node_rank 分别为 0 和 1）
+    torchrun --nnodes=2 --node_rank=0 --nproc_per_node=4 \\
+        --rdzv_backend=c10d --rdzv_endpoint=HOST0:29500 ch05/main/train_ddp.py --data corpus.bin
+
+依赖：
+    - torch: PyTorch 深度学习框架（torch.distributed，gloo 后端）
+    - numpy: 内存映射的 token 文件
+    - tiktoken: 用 --text 即时分词时需要
+"""
+
+import argparse
+import inspect
+import json
+import os
+import sys
+from typing import Optional
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader, DistributedSampler
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch02.main.dataloader import MemmapTokenDataset, write_token_file
+from ch04.main.gpt_model import GPTConfig, GPTModel
+from ch05.main.precision import PRECISION_MODES
+from ch05.main.train import TrainConfig, Trainer
+from setup.cpu_tuning import apply_thread_config
+
+
+def setup_process(threads: int, bind_cores: bool = False):
+    """
+    初始化进程组并设置本进程的线程数
+
+    参数:
+        threads (int): 本进程使用的 intra-op 线程数
+        bind_cores (bool): 是否把进程绑定到 [local_rank * threads, (local_rank + 1) * threads) 号核心
+
+    返回:
+        tuple[int, int, int]: (rank, world_size, local_rank)
+
+    注意:
+        - 必须在任何张量计算之前调用（inter-op 线程数只能设置一次）
+        - 不是由 torchrun 启动时（没有 RANK 环境变量），按单进程运行
+    """
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if bind_cores and hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        group = cores[local_rank * threads:(local_rank + 1) * threads]
+        if len(group) == threads:
+            os.sched_setaffinity(0, group)
+        else:
+            print(f"⚠️  rank {local_rank}: 可用核心不足 {threads} 个，不做绑定")
+    apply_thread_config(threads, 1)
+
+    if "RANK" not in os.environ:
+        return 0, 1, 0
+    dist.init_process_group(backend="gloo")
+    return dist.get_rank(), dist.get_world_size(), local_rank
+
+
+def build_sharded_loader(dataset, batch_size: int, rank: int, world_size: int, seed: int,
+                         shuffle: bool = True) -> DataLoader:
+    """
+    为当前进程创建只包含自己那一份样本的数据加载器
+
+    参数:
+        batch_size (int): 每个进程的 batch 大小（全局 batch = batch_size × world_size）
+        seed (int): 所有进程必须相同，保证打乱后的分片互不重叠
+
+    返回:
+        DataLoader: 它的 sampler 是 DistributedSampler，每轮开始前需要调用 sampler.set_epoch
+    """
+    sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=shuffle,
+                                 seed=seed, drop_last=True)
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, drop_last=True)
+
+
+def wrap_ddp(trainer: Trainer, bucket_cap_mb: float = 25.0) -> Trainer:
+    """
+    把 Trainer 中的模型包装成 DistributedDataParallel
+
+    在 Trainer 完成精度转换、激活检查点设置和优化器创建之后调用；
+    CPU 上 DDP 直接使用原模型的参数，优化器不需要重建。
+
+    参数:
+        trainer: 单进程 Trainer
+        bucket_cap_mb (float): 梯度桶大小（MB）。桶越小通信开始得越早，但 allreduce 次数越多
+
+    注意:
+        - 不在每次前向时同步缓冲区：模型里的缓冲区只有因果掩码，各进程相同
+          （新版 PyTorch 的参数名是 forward_sync_buffers，旧版是 broadcast_buffers）
+        - gradient_as_bucket_view=True：梯度直接存放在通信桶里，省掉一份梯度大小的拷贝
+    """
+    if dist.is_initialized():
+        if "forward_sync_buffers" in inspect.signature(DDP.__init__).parameters:
+            no_buffer_sync = {"forward_sync_buffers": False}
+        else:
+            no_buffer_sync = {"broadcast_buffers": False}
+        trainer.model = DDP(trainer.model, bucket_cap_mb=bucket_cap_mb, gradient_as_bucket_view=True,
+                            **no_buffer_sync)
+    return trainer
+
+
+def all_reduce_mean(value: float) -> float:
+    """所有进程上的标量求平均（单进程时原样返回）"""
+    if not dist.is_initialized():
+        return value
+    tensor = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.item() / dist.get_world_size()
+
+
+def prepare_token_file(text_path: str, rank: int) -> str:
+    """
+    把文本分词成 <text_path>.bin（只由 rank 0 执行，其余进程等待）
+
+    返回:
+        str: token 文件路径
+    """
+    bin_path = os.path.splitext(text_path)[0] + ".bin"
+    if rank == 0 and not os.path.exists(bin_path):
+        import tiktoken
+
+        with open(text_path, "r", encoding="utf-8") as f:
+            token_ids = tiktoken.get_encoding("gpt2").encode(f.read(), allowed_special={"<|endoftext|>"})
+        write_token_file(token_ids, bin_path)
+    if dist.is_initialized():
+        dist.barrier()
+    return bin_path
+
+
+def train(trainer: Trainer, loader: DataLoader, num_epochs: int, max_steps: Optional[int],
+          log_every: int, rank: int) -> list:
+    """
+    数据并行训练循环
+
+    返回:
+        list: 每一步在所有进程上平均后的训练损失
+    """
+    losses = []
+    for epoch in range(num_epochs):
+        loader.sampler.set_epoch(epoch)
+        for input_batch, target_batch in loader:
+            if max_steps is not None and trainer.global_step >= max_steps:
+                return losses
+            # 每个进程的损失只反映自己的分片，记录时取平均
+            losses.append(all_reduce_mean(trainer.train_step(input_batch, target_batch)))
+            if rank == 0 and log_every and trainer.global_step % log_every == 0:
+                print(f"Ep {epoch + 1} (Step {trainer.global_step:06d}): Train loss {losses[-1]:.3f}")
+    return losses
+
+
+def main():
+    """解析命令行参数，初始化进程组，按 rank 切分数据并用 DDP 训练；rank 0 打印吞吐并可写出 JSON 报告"""
+    parser = argparse.ArgumentParser(description="DDP（gloo）数据并行预训练，用 torchrun 启动")
+    data = parser.add_mutually_exclusive_group(required=True)
+    data.add_argument("--data", help="write_token_file 写出的 uint16 token 文件")
+    data.add_argument("--text", help="原始文本，rank 0 先分词成同名 .bin 文件")
+    parser.add_argument("--threads", type=int, default=1, help="每个进程的线程数")
+    parser.add_argument("--bind-cores", action="store_true", help="把每个进程绑定到一组独占核心")
+    parser.add_argument("--bucket-cap-mb", type=float, default=25.0)
+    parser.add_argument("--batch-size", type=int, default=4, help="每个进程的 batch 大小")
+    parser.add_argument("--grad-accum-steps", type=int, default=1)
+    parser.add_argument("--precision", choices=PRECISION_MODES, default="fp32")
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--max-steps", type=int, default=None)
+    parser.add_argument("--ctx-len", type=int, default=256)
+    parser.add_argument("--emb-dim", type=int, default=768)
+    parser.add_argument("--n-layers", type=int, default=12)
+    parser.add_argument("--n-heads", type=int, default=12)
+    parser.add_argument("--lr", type=float, default=4e-4)
+    parser.add_argument("--seed", type=int, default=123)
+    parser.add_argument("--log-every", type=int, default=10)
+    parser.add_argument("--report", default=None, help="rank 0 把吞吐统计写入这个 JSON 文件")
+    args = parser.parse_args()
+
+    rank, world_size, _ = setup_process(args.threads, args.bind_cores)
+    data_path = args.data or prepare_token_file(args.text, rank)
+    dataset = MemmapTokenDataset(data_path, max_length=args.ctx_len)
+    loader = build_sharded_loader(dataset, args.batch_size, rank, world_size, args.seed)
+
+    # 所有进程用同一个种子初始化，DDP 构造时还会再从 rank 0 广播一次参数
+    torch.manual_seed(args.seed)
+    model_cfg = GPTConfig(ctx_len=args.ctx_len, emb_dim=args.emb_dim, n_layers=args.n_layers,
+                          n_heads=args.n_heads)
+    train_cfg = TrainConfig(lr=args.lr, eval_freq=0, precision=args.precision,
+                            grad_accum_steps=args.grad_accum_steps)
+    trainer = wrap_ddp(Trainer(GPTModel(model_cfg), train_cfg), args.bucket_cap_mb)
+    if rank == 0:
+        print(f"进程数 {world_size}，每进程 {args.threads} 线程，每进程 {len(loader)} 个 batch，"
+              f"全局 batch {args.batch_size * world_size} × {args.ctx_len} token")
+
+    losses = train(trainer, loader, args.epochs, args.max_steps, args.log_every, rank)
+
+    # 第一步包含内存分配和 DDP 的桶重建，不计入
+    step_times = sorted(trainer.history.step_times_ms[1:] or trainer.history.step_times_ms)
+    step_ms = all_reduce_mean(step_times[len(step_times) // 2]) if step_times else float("nan")
+    tokens_per_sec = args.batch_size * args.ctx_len * world_size / step_ms * 1e3
+    if rank == 0:
+        print(f"✅ {trainer.global_step} 步，每步 {step_ms:.1f} ms，全局 {tokens_per_sec:.0f} tokens/s")
+        if args.report:
+            with open(args.report, "w", encoding="utf-8") as f:
+                json.dump({"world_size": world_size, "threads": args.threads, "steps": trainer.global_step,
+                           "step_ms": step_ms, "tokens_per_sec": tokens_per_sec,
+                           "final_loss": losses[-1] if losses else None}, f, indent=2)
+
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+实验：冻结骨干网络时，每轮重新前向 vs 特征缓存
+
+数据：the-verdict.txt 按句子切开作为样本，标签是句子里是否出现逗号（只为了有一个可学习的二分类任务）。
+骨干网络是随机初始化的 GPT（只关心耗时），分类头是 nn.Linear(emb_dim, 2)。
+
+报告：
+    - 每轮重新前向：每一轮都让骨干网络处理全部样本，再训练一轮分类头
+    - 特征缓存：第一轮构建缓存 + 训练分类头，之后每一轮只训练分类头
+    - 再次运行时命中缓存的耗时（主要是计算骨干网络权重的指纹）
+    - 骨干网络权重改变后缓存是否自动失效
+
+运行方式：
+    python ch06/experiments/bench_feature_cache.py
+    python ch06/experiments/bench_feature_cache.py --emb-dim 256 --n-layers 4 --n-heads 4 --epochs 5
+"""
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch04.main.gpt_model import GPTConfig, GPTModel
+from ch06.main.feature_cache import FeatureCache, evaluate_head, extract_features, train_head
+
+
+class ByteTokenizer:
+    """没有 GPT-2 分词器文件时使用的 UTF-8 字节分词器"""
+
+    name = "utf8-bytes"
+    n_vocab = 256
+
+    def encode(self, text):
+        """文本的 UTF-8 字节即 token ID"""
+        return list(text.encode("utf-8"))
+
+
+def load_tokenizer():
+    """GPT-2 分词器；离线无法加载时退回到 ByteTokenizer"""
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("gpt2")
+    except Exception as exc:  # 离线环境下 tiktoken 下载词表会失败
+        print(f"⚠️  无法加载 GPT-2 分词器（{type(exc).__name__}），改用 UTF-8 字节作为 token")
+        return ByteTokenizer()
+
+
+def load_samples(n_samples: int) -> tuple:
+    """
+    把 the-verdict.txt 切成句子，循环取出 n_samples 个样本（玩具任务：句子是否包含逗号）
+
+    返回:
+        tuple[list, list]: (文本, 标签)
+    """
+    with open(os.path.join(ROOT_DIR, "ch02", "main", "the-verdict.txt"), "r", encoding="utf-8") as f:
+        sentences = [s.strip() for s in re.split(r"(?<=[.!?])\s+", f.read()) if len(s.strip()) > 10]
+    texts = [sentences[i % len(sentences)] for i in range(n_samples)]
+    return texts, [int("," in text) for text in texts]
+
+
+def main():
+    """对比冻结骨干网络时每轮重新前向与特征缓存的训练耗时，并检查缓存命中以及权重改变后的自动失效"""
+    parser = argparse.ArgumentParser(description="冻结骨干网络：每轮重新前向 vs 特征缓存")
+    parser.add_argument("--emb-dim", type=int, default=768)
+    parser.add_argument("--n-layers", type=int, default=12)
+    parser.add_argument("--n-heads", type=int, default=12)
+    parser.add_argument("--ctx-len", type=int, default=256)
+    parser.add_argument("--n-samples", type=int, default=256)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--pooling", choices=("last", "mean"), default="last")
+    args = parser.parse_args()
+
+    tokenizer = load_tokenizer()
+    texts, labels = load_samples(args.n_samples)
+    torch.manual_seed(123)
+    model_cfg = GPTConfig(vocab_size=getattr(tokenizer, "n_vocab", 50257), ctx_len=args.ctx_len,
+                          emb_dim=args.emb_dim, n_layers=args.n_layers, n_heads=args.n_heads, drop_prob=0.0)
+    model = GPTModel(model_cfg).requires_grad_(False)
+    pad_token_id = model_cfg.vocab_size - 1
+    token_ids = [tokenizer.encode(text)[:args.ctx_len] for text in texts]
+    print(f"{len(texts)} 个样本，平均 {np.mean([len(t) for t in token_ids]):.0f} 个 token，"
+          f"{args.epochs} 轮，池化方式 {args.pooling}")
+
+    # 每轮重新前向：骨干网络的计算每一轮都重复一次
+    torch.manual_seed(0)
+    head = nn.Linear(model_cfg.emb_dim, 2)
+    uncached = []
+    for epoch in range(args.epochs):
+        start = time.perf_counter()
+        features = np.empty((len(texts), model_cfg.emb_dim), dtype=np.float32)
+        extract_features(model, token_ids, features, args.pooling, args.batch_size, pad_token_id)
+        train_head(head, features, np.asarray(labels), num_epochs=1, seed=epoch)
+        uncached.append(time.perf_counter() - start)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        cache = FeatureCache(os.path.join(tmp, "train"), pooling=args.pooling, batch_size=args.batch_size,
+                             pad_token_id=pad_token_id)
+        torch.manual_seed(0)
+        head = nn.Linear(model_cfg.emb_dim, 2)
+        cached = []
+        for epoch in range(args.epochs):
+            start = time.perf_counter()
+            data = cache.get(model, texts, labels, tokenizer, verbose=epoch == 0)
+            train_head(head, data.features, data.labels, num_epochs=1, seed=epoch)
+            cached.append(time.perf_counter() - start)
+        accuracy = evaluate_head(head, data.features, data.labels)
+
+        print(f"\n{'轮次':<6} {'每轮重新前向 s':>16} {'特征缓存 s':>12}")
+        for epoch, (a, b) in enumerate(zip(uncached, cached)):
+            print(f"{epoch + 1:<6} {a:>16.2f} {b:>12.3f}")
+        print(f"{'合计':<6} {sum(uncached):>16.2f} {sum(cached):>12.2f}"
+              f"（{sum(uncached) / sum(cached):.1f}x）")
+        print(f"分类头训练集准确率 {accuracy:.0%}")
+
+        fresh = FeatureCache(os.path.join(tmp, "train"), pooling=args.pooling, batch_size=args.batch_size,
+                             pad_token_id=pad_token_id)
+        hit = fresh.get(model, texts, labels, tokenizer, verbose=False)
+        size_mb = os.path.getsize(os.path.join(tmp, "train", "features.npy")) / 1e6
+        print(f"\n再次运行命中缓存: {hit.seconds * 1e3:.0f} ms（含骨干网络权重指纹），特征文件 {size_mb:.1f} MB")
+
+        with torch.no_grad():
+            model.trf_blocks[-1].ff.layers[2].weight.mul_(1.01)
+        rebuilt = fresh.get(model, texts, labels, tokenizer, verbose=False)
+        print(f"{'✅' if rebuilt.built else '❌'} 修改骨干网络权重后缓存自动失效并重建（{rebuilt.seconds:.2f} s）")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
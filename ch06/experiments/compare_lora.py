@@ -0,0 +1,180 @@
+"""
+实验：LoRA 微调 vs 全参数微调，以及多适配器批量推理
+
+报告两组数字：
+    1. 训练：可训练参数量、优化器状态大小、每个任务需要保存的权重大小、
+       常驻内存峰值（独立子进程）和每步耗时
+    2. 推理：n 个任务的请求混在一个 batch 里
+       - 共享基础模型 + adapter_batch：一次前向，每行用自己的适配器
+       - 逐个适配器：按任务分组，每组切换 active_adapter 后单独前向
+       - 每个任务一份合并后的模型：按任务分组前向，没有适配器开销，但要常驻 n 份权重
+
+运行方式：
+    python ch06/experiments/compare_lora.py                                  # GPT-2 124M
+    python ch06/experiments/compare_lora.py --emb-dim 256 --n-layers 4 --n-heads 4 --rank 16
+"""
+
+import argparse
+import copy
+import os
+import statistics
+import sys
+import time
+
+import torch
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch04.main.gpt_model import GPTConfig, GPTModel
+from ch05.main.train import TrainConfig, Trainer
+from ch06.main.lora import (LoRAConfig, adapter_batch, count_parameters, inject_lora, lora_modules,
+                            lora_state_dict, merge_lora, set_active_adapter)
+from setup.benchmark import measure_peak_memory_mb
+
+
+def tensor_mb(tensors) -> float:
+    """一组张量占用的内存（MB）"""
+    return sum(t.numel() * t.element_size() for t in tensors) / 1e6
+
+
+def build_trainer(model_cfg: GPTConfig, rank: int) -> Trainer:
+    """rank=0 表示全参数微调"""
+    torch.manual_seed(123)
+    model = GPTModel(model_cfg)
+    if rank:
+        inject_lora(model, LoRAConfig(r=rank, alpha=2 * rank))
+    return Trainer(model, TrainConfig(eval_freq=0, final_eval=False))
+
+
+def random_batch(model_cfg: GPTConfig, batch_size: int):
+    """随机 token 组成的一个 batch，目标是输入左移一位"""
+    inputs = torch.randint(0, model_cfg.vocab_size, (batch_size, model_cfg.ctx_len))
+    return inputs, torch.roll(inputs, -1, dims=1)
+
+
+def train_steps(model_cfg: GPTConfig, rank: int, batch_size: int, steps: int) -> list:
+    """返回每步耗时（ms）；也在子进程中执行以测量内存峰值"""
+    trainer = build_trainer(model_cfg, rank)
+    batch = random_batch(model_cfg, batch_size)
+    for _ in range(steps):
+        trainer.train_step(*batch)
+    return trainer.history.step_times_ms
+
+
+def bench_training(model_cfg: GPTConfig, rank: int, batch_size: int, steps: int) -> None:
+    """对比全参数微调和 LoRA 的可训练参数量、优化器状态、每任务保存大小、内存峰值和每步耗时"""
+    print(f"\n训练（batch {batch_size} × {model_cfg.ctx_len} token，{steps} 步）:")
+    print(f"  {'方法':<16} {'可训练参数':>12} {'优化器状态 MB':>14} {'每任务保存 MB':>14}"
+          f" {'内存峰值 MB':>12} {'每步 ms':>9}")
+    for label, rank in (("全参数微调", 0), (f"LoRA r={rank}", rank)):
+        trainer = build_trainer(model_cfg, rank)
+        trainer.train_step(*random_batch(model_cfg, batch_size))
+        trainable, _ = count_parameters(trainer.model)
+        state_mb = tensor_mb(t for s in trainer.optimizer.state.values() for t in s.values()
+                             if isinstance(t, torch.Tensor))
+        if rank:
+            saved_mb = tensor_mb(lora_state_dict(trainer.model)["weights"].values())
+        else:
+            saved_mb = tensor_mb(trainer.model.state_dict().values())
+        del trainer
+        times = train_steps(model_cfg, rank, batch_size, steps)
+        step_ms = statistics.median(times[1:] or times)
+        peak_mb = measure_peak_memory_mb(train_steps, model_cfg, rank, batch_size, steps)
+        print(f"  {label:<16} {trainable:>12,} {state_mb:>14.1f} {saved_mb:>14.1f}"
+              f" {peak_mb:>12.0f} {step_ms:>9.1f}")
+
+
+def median_ms(fn, repeats: int) -> float:
+    """预热一次后调用 fn repeats 次，返回耗时中位数（ms）"""
+    fn()
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e3)
+    return statistics.median(samples)
+
+
+@torch.inference_mode()
+def bench_serving(model_cfg: GPTConfig, rank: int, n_adapters: int, batch_size: int, seq_len: int,
+                  repeats: int) -> None:
+    """
+    多适配器推理：共享基础模型 + adapter_batch、共享基础模型逐个切换适配器、每任务一份合并后的模型
+
+    batch 中每行轮流使用不同的适配器；打印耗时、常驻权重大小，以及批量推理与合并后模型的最大差异
+    """
+    torch.manual_seed(123)
+    model = GPTModel(model_cfg).eval()
+    names = [f"task{i}" for i in range(n_adapters)]
+    for name in names:
+        inject_lora(model, LoRAConfig(r=rank, alpha=2 * rank), name=name)
+    for module in lora_modules(model).values():
+        for p in module.lora_B.values():
+            p.normal_(std=0.02)
+    merged = {}
+    for name in names:
+        merged[name] = copy.deepcopy(model)
+        set_active_adapter(merged[name], name)
+        merge_lora(merged[name])
+
+    inputs = torch.randint(0, model_cfg.vocab_size, (batch_size, seq_len))
+    row_adapters = [names[i % n_adapters] for i in range(batch_size)]
+    groups = {name: [i for i, a in enumerate(row_adapters) if a == name] for name in names}
+
+    def batched():
+        """一次前向，每行通过 adapter_batch 使用自己的适配器"""
+        with adapter_batch(model, row_adapters):
+            return model(inputs)
+
+    def per_adapter():
+        """按适配器分组，切换激活的适配器后分别前向"""
+        for name, rows in groups.items():
+            set_active_adapter(model, name)
+            model(inputs[rows])
+
+    def per_merged_model():
+        """按适配器分组，各自交给合并了该适配器的模型副本"""
+        for name, rows in groups.items():
+            merged[name](inputs[rows])
+
+    base_mb = tensor_mb(merged[names[0]].parameters())
+    adapters_mb = tensor_mb(p for m in lora_modules(model).values() for p in m.parameters()
+                            if p is not m.weight and p is not m.bias)
+    print(f"\n推理（{n_adapters} 个适配器，batch {batch_size} × {seq_len} token，每行轮流使用不同适配器）:")
+    print(f"  {'方法':<28} {'耗时 ms':>9} {'常驻权重 MB':>12}")
+    rows = (("共享基础模型 + adapter_batch", batched, base_mb + adapters_mb),
+            ("共享基础模型，逐个适配器", per_adapter, base_mb + adapters_mb),
+            ("每任务一份合并后的模型", per_merged_model, base_mb * n_adapters))
+    for label, fn, mb in rows:
+        print(f"  {label:<28} {median_ms(fn, repeats):>9.1f} {mb:>12.0f}")
+    with torch.no_grad():
+        expected = torch.cat([merged[a](inputs[i:i + 1]) for i, a in enumerate(row_adapters)])
+    max_diff = (batched() - expected).abs().max().item()
+    print(f"  批量推理与合并后模型的最大差异: {max_diff:.2e}")
+
+
+def main():
+    """解析命令行参数，依次运行训练对比和多适配器推理对比"""
+    parser = argparse.ArgumentParser(description="LoRA vs 全参数微调；多适配器批量推理")
+    parser.add_argument("--emb-dim", type=int, default=768)
+    parser.add_argument("--n-layers", type=int, default=12)
+    parser.add_argument("--n-heads", type=int, default=12)
+    parser.add_argument("--ctx-len", type=int, default=128)
+    parser.add_argument("--rank", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--n-adapters", type=int, default=4)
+    parser.add_argument("--serve-batch-size", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    model_cfg = GPTConfig(ctx_len=args.ctx_len, emb_dim=args.emb_dim, n_layers=args.n_layers,
+                          n_heads=args.n_heads, drop_prob=0.0)
+    bench_training(model_cfg, args.rank, args.batch_size, args.steps)
+    bench_serving(model_cfg, args.rank, args.n_adapters, args.serve_batch_size, args.ctx_len, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+"""
+第6章：冻结骨干网络的特征缓存
+
+只训练分类头（骨干网络全部冻结）时，每个样本经过骨干网络得到的隐藏状态在每一轮都完全相同，
+书中的写法却在每一轮把所有样本重新前向一遍，99% 以上的计算都是重复的。
+
+核心概念：
+    - 特征缓存：骨干网络在整个数据集上只前向一次，把每个样本的特征
+      （最后一个 token 的隐藏状态，或所有 token 的平均）写入 .npy 文件，
+      之后每一轮训练直接用内存映射读取，只剩分类头的计算
+    - 按长度分桶：样本按 token 数排序后再组 batch，同一 batch 的长度接近，填充浪费最少；
+      模型是因果的，右侧填充不影响前面位置的隐藏状态
+    - 自动失效：缓存的 meta.json 记录骨干网络权重、分词器和数据（文本 + 标签）的指纹，
+      以及池化方式和截断长度，任何一项变化都会重新计算；meta.json 最后写入，
+      中断的构建不会被当成有效缓存
+    - 内存映射：特征文件由操作系统按需调页，数据集比内存大时也能训练分类头
+
+依赖：
+    - torch: PyTorch 深度学习框架
+    - numpy: .npy 文件的内存映射
+"""
+
+import hashlib
+import json
+import os
+import sys
+import time
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+POOLINGS = ("last", "mean")
+META_FILE = "meta.json"
+FEATURES_FILE = "features.npy"
+LABELS_FILE = "labels.npy"
+
+# 分词器指纹用的探测文本：覆盖 ASCII、标点、数字、中文、emoji 和特殊 token
+_TOKENIZER_PROBE = "Hello, world! 12345 The quick brown fox. 你好，世界 🙂 <|endoftext|>"
+
+
+def fingerprint_model(model: nn.Module) -> str:
+    """
+    骨干网络权重的指纹（state_dict 中所有张量的名称、形状、类型和字节内容的 SHA-256）
+
+    注意:
+        - 124M 模型约需 1 秒；权重有任何改动（换检查点、继续预训练）指纹都会变化
+    """
+    digest = hashlib.sha256()
+    for name, tensor in sorted(model.state_dict().items()):
+        tensor = tensor.detach().cpu().contiguous()
+        digest.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+        digest.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+def fingerprint_tokenizer(tokenizer) -> str:
+    """分词器的指纹：名称 + 词表大小 + 探测文本的分词结果"""
+    try:
+        probe = tokenizer.encode(_TOKENIZER_PROBE, allowed_special="all")
+    except TypeError:
+        probe = tokenizer.encode(_TOKENIZER_PROBE)
+    identity = [getattr(tokenizer, "name", type(tokenizer).__name__),
+                getattr(tokenizer, "n_vocab", None), list(probe)]
+    return hashlib.sha256(json.dumps(identity).encode()).hexdigest()
+
+
+def fingerprint_data(texts: Sequence[str], labels: Sequence[int]) -> str:
+    """文本和标签的 SHA-256 摘要（每条带上字节长度和标签，避免拼接产生歧义）"""
+    digest = hashlib.sha256()
+    for text, label in zip(texts, labels):
+        encoded = text.encode("utf-8")
+        digest.update(f"{len(encoded)}:{int(label)}:".encode())
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+@dataclass
+class CachedFeatures:
+    """
+    缓存中的特征
+
+    属性:
+        features: (n_samples, emb_dim) 的只读内存映射
+        labels: (n_samples,) 的标签
+        path: 缓存目录
+        built: 本次是否重新计算了特征（False 表示直接命中缓存）
+        seconds: 本次计算或加载的耗时（秒）
+    """
+
+    features: np.ndarray
+    labels: np.ndarray
+    path: str
+    built: bool
+    seconds: float
+
+    def __len__(self) -> int:
+        """样本个数"""
+        return len(self.labels)
+
+
+@torch.inference_mode()
+def extract_features(model: nn.Module, token_ids: Sequence[Sequence[int]], out: np.ndarray,
+                     pooling: str = "last", batch_size: int = 16, pad_token_id: int = 50256) -> None:
+    """
+    骨干网络前向，把每个样本的特征写入 out
+
+    参数:
+        model: 带 hidden_states 方法的模型（GPTModel）
+        token_ids: 每个样本的 token ID（已截断，非空）
+        out: (n_samples, emb_dim) 的输出数组（可以是内存映射）
+        pooling (str): "last" 取最后一个真实 token，"mean" 对所有真实 token 取平均
+        batch_size (int): 前向的 batch 大小
+        pad_token_id (int): 填充 token
+    """
+    if pooling not in POOLINGS:
+        raise ValueError(f"未知的池化方式 {pooling!r}，可选: {POOLINGS}")
+    was_training = model.training
+    model.eval()
+    try:
+        order = sorted(range(len(token_ids)), key=lambda i: len(token_ids[i]))
+        for lo in range(0, len(order), batch_size):
+            index = order[lo:lo + batch_size]
+            lengths = torch.tensor([len(token_ids[i]) for i in index])
+            inputs = torch.full((len(index), int(lengths.max())), pad_token_id, dtype=torch.long)
+            for row, i in enumerate(index):
+                inputs[row, :lengths[row]] = torch.as_tensor(token_ids[i])
+            hidden = model.hidden_states(inputs).float()
+            if pooling == "last":
+                features = hidden[torch.arange(len(index)), lengths - 1]
+            else:
+                mask = torch.arange(inputs.shape[1]) < lengths[:, None]
+                features = (hidden * mask[..., None]).sum(1) / lengths[:, None]
+            out[index] = features.numpy()
+    finally:
+        model.train(was_training)
+
+
+class FeatureCache:
+    """
+    冻结骨干网络的特征缓存
+
+    示例:
+        >>> cache = FeatureCache("cache/sms_spam", pooling="last")
+        >>> train = cache.get(model, train_texts, train_labels, tokenizer)  # 第一次：前向一遍
+        >>> head = nn.Linear(model.cfg.emb_dim, 2)
+        >>> train_head(head, train.features, train.labels, num_epochs=10)   # 每轮只计算分类头
+    """
+
+    def __init__(self, path: str, pooling: str = "last", max_length: Optional[int] = None,
+                 batch_size: int = 16, pad_token_id: int = 50256, dtype=np.float32):
+        """
+        参数:
+            path (str): 缓存目录（每个数据集一个目录，例如 train / val 分开）
+            pooling (str): "last" 或 "mean"
+            max_length (int): 截断长度，默认取模型的上下文长度
+            batch_size (int): 构建缓存时前向的 batch 大小
+            pad_token_id (int): 填充 token（GPT-2 的 <|endoftext|>）
+            dtype: 特征的存储类型，np.float16 可以把文件减半
+        """
+        if pooling not in POOLINGS:
+            raise ValueError(f"未知的池化方式 {pooling!r}，可选: {POOLINGS}")
+        self.path = path
+        self.pooling = pooling
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.pad_token_id = pad_token_id
+        self.dtype = np.dtype(dtype)
+
+    def _meta(self, model: nn.Module, texts, labels, tokenizer, backbone_fingerprint) -> dict:
+        """
+        当前骨干网络、分词器、数据和缓存配置的指纹，与 meta.json 完全相同才算命中缓存
+
+        参数:
+            backbone_fingerprint (str): 调用方给出的骨干网络标识，None 时对权重求哈希
+        """
+        return {
+            "backbone": backbone_fingerprint or fingerprint_model(model),
+            "tokenizer": fingerprint_tokenizer(tokenizer),
+            "data": fingerprint_data(texts, labels),
+            "pooling": self.pooling,
+            "max_length": self.max_length or model.cfg.ctx_len,
+            "dtype": self.dtype.name,
+        }
+
+    def read_meta(self) -> Optional[dict]:
+        """读取缓存目录中的 meta.json，还没有构建过（或构建未完成）时返回 None"""
+        meta_path = os.path.join(self.path, META_FILE)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def get(self, model: nn.Module, texts: Sequence[str], labels: Sequence[int], tokenizer,
+            backbone_fingerprint: Optional[str] = None, verbose: bool = True) -> CachedFeatures:
+        """
+        读取缓存；缓存不存在或已失效时重新计算
+
+        参数:
+            model: 冻结的骨干网络
+            texts: 文本
+            labels: 标签（整数）
+            tokenizer: 有 encode 方法的分词器
+            backbone_fingerprint (str): 可选，直接给出骨干网络的标识（例如检查点路径 + 步数），
+                                        省去对权重求哈希
+            verbose (bool): 是否打印缓存状态
+
+        返回:
+            CachedFeatures
+        """
+        if len(texts) != len(labels):
+            raise ValueError(f"文本数 {len(texts)} 与标签数 {len(labels)} 不一致")
+        start = time.perf_counter()
+        meta = self._meta(model, texts, labels, tokenizer, backbone_fingerprint)
+        cached = self.read_meta()
+        stale = [key for key in meta if cached is not None and cached.get(key) != meta[key]]
+        if cached is not None and not stale:
+            result = self._load(built=False, start=start)
+            if verbose:
+                print(f"✅ 命中特征缓存: {self.path}（{len(result)} 个样本）")
+            return result
+
+        if verbose:
+            reason = f"（{', '.join(stale)} 已变化）" if stale else "不存在"
+            print(f"⚠️  特征缓存{reason}，骨干网络前向计算 {len(texts)} 个样本")
+        self._build(model, texts, labels, tokenizer, meta)
+        return self._load(built=True, start=start)
+
+    def _load(self, built: bool, start: float) -> CachedFeatures:
+        """
+        以内存映射方式打开特征文件，读入标签
+
+        参数:
+            built (bool): 本次是否重新构建了特征
+            start (float): get 开始时的 perf_counter，用于计算耗时
+        """
+        features = np.load(os.path.join(self.path, FEATURES_FILE), mmap_mode="r")
+        labels = np.load(os.path.join(self.path, LABELS_FILE))
+        return CachedFeatures(features, labels, self.path, built, time.perf_counter() - start)
+
+    def _build(self, model: nn.Module, texts, labels, tokenizer, meta: dict) -> None:
+        """
+        分词、骨干网络前向，把特征和标签写入缓存目录，最后写入 meta.json
+
+        文件都先写到临时文件再原子替换；meta.json 最后写入，它存在就说明特征文件完整
+        """
+        os.makedirs(self.path, exist_ok=True)
+        # 先删除旧的 meta.json：构建中途失败时，旧特征不会和新指纹配对
+        meta_path = os.path.join(self.path, META_FILE)
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        max_length = meta["max_length"]
+        token_ids = [tokenizer.encode(text)[:max_length] or [self.pad_token_id] for text in texts]
+        # 写到临时文件再原子替换：之前返回的 CachedFeatures 还在内存映射旧文件，
+        # 原地截断重写会让它们读到被改写的数据，数据集变小时甚至触发 SIGBUS；
+        # 替换后旧映射仍指向旧文件（已解除链接）的内容，直到被释放
+        features_path = os.path.join(self.path, FEATURES_FILE)
+        tmp_features = features_path + ".tmp.npy"
+        features = np.lib.format.open_memmap(tmp_features, mode="w+",
+                                             dtype=self.dtype, shape=(len(texts), model.cfg.emb_dim))
+        extract_features(model, token_ids, features, self.pooling, self.batch_size, self.pad_token_id)
+        features.flush()
+        del features
+        os.replace(tmp_features, features_path)
+        labels_path = os.path.join(self.path, LABELS_FILE)
+        tmp_labels = labels_path + ".tmp.npy"
+        np.save(tmp_labels, np.asarray(labels, dtype=np.int64))
+        os.replace(tmp_labels, labels_path)
+
+        tmp_path = meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({**meta, "n_samples": len(texts), "emb_dim": model.cfg.emb_dim}, f, indent=2)
+        os.replace(tmp_path, meta_path)
+
+
+def _feature_batches(features: np.ndarray, labels: np.ndarray, batch_size: int,
+                     generator: Optional[torch.Generator] = None):
+    """按 batch 从（内存映射的）特征中读取；给定 generator 时打乱顺序"""
+    n = len(labels)
+    order = torch.randperm(n, generator=generator).numpy() if generator is not None else np.arange(n)
+    for lo in range(0, n, batch_size):
+        # 排序后的下标读内存映射更接近顺序访问
+        index = np.sort(order[lo:lo + batch_size])
+        yield (torch.from_numpy(np.asarray(features[index], dtype=np.float32)),
+               torch.from_numpy(np.asarray(labels[index])))
+
+
+def train_head(head: nn.Module, features: np.ndarray, labels: np.ndarray, num_epochs: int = 10,
+               batch_size: int = 64, lr: float = 1e-3, weight_decay: float = 0.0,
+               seed: int = 123) -> list:
+    """
+    在缓存的特征上训练分类头
+
+    返回:
+        list[float]: 每一轮的平均训练损失
+    """
+    optimizer = torch.optim.AdamW(head.parameters(), lr=lr, weight_decay=weight_decay)
+    generator = torch.Generator().manual_seed(seed)
+    head.train()
+    epoch_losses = []
+    for _ in range(num_epochs):
+        total, count = 0.0, 0
+        for x, y in _feature_batches(features, labels, batch_size, generator):
+            loss = F.cross_entropy(head(x), y)
+            optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            optimizer.step()
+            total += loss.item() * len(y)
+            count += len(y)
+        epoch_losses.append(total / count)
+    return epoch_losses
+
+
+@torch.inference_mode()
+def evaluate_head(head: nn.Module, features: np.ndarray, labels: np.ndarray, batch_size: int = 256) -> float:
+    """分类头在缓存特征上的准确率"""
+    head.eval()
+    correct = 0
+    for x, y in _feature_batches(features, labels, batch_size):
+        correct += (head(x).argmax(-1) == y).sum().item()
+    return correct / len(labels)
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    from ch04.main.gpt_model import GPTConfig, GPTModel
+
+    class ByteTokenizer:
+        """UTF-8 字节作为 token（离线演示用）"""
+
+        name = "utf8-bytes"
+        n_vocab = 256
+
+        def encode(self, text):
+            """文本的 UTF-8 字节即 token ID"""
+            return list(text.encode("utf-8"))
+
+    torch.manual_seed(123)
+    cfg = GPTConfig(vocab_size=256, ctx_len=64, emb_dim=64, n_heads=4, n_layers=2, drop_prob=0.0)
+    model = GPTModel(cfg)
+    texts = ["win a free prize now!!!", "are we still on for lunch?", "URGENT: claim your cash",
+             "see you at 7", "free entry, text WIN", "thanks for the notes"] * 20
+    labels = [1, 0, 1, 0, 1, 0] * 20
+    tokenizer = ByteTokenizer()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = FeatureCache(os.path.join(tmp, "train"), pad_token_id=0)
+        first = cache.get(model, texts, labels, tokenizer)
+        second = cache.get(model, texts, labels, tokenizer)
+        print(f"首次构建 {first.seconds * 1e3:.1f} ms，命中缓存 {second.seconds * 1e3:.1f} ms")
+
+        with torch.no_grad():
+            hidden = model.eval().hidden_states(torch.tensor([tokenizer.encode(texts[1])]))[0, -1]
+        status = "✅" if np.allclose(second.features[1], hidden.numpy(), atol=1e-5) else "❌"
+        print(f"{status} 缓存特征与直接前向（最后一个 token）一致")
+
+        head = nn.Linear(cfg.emb_dim, 2)
+        losses = train_head(head, second.features, second.labels, num_epochs=20, lr=1e-2)
+        accuracy = evaluate_head(head, second.features, second.labels)
+        print(f"分类头训练损失 {losses[0]:.3f} -> {losses[-1]:.3f}，训练集准确率 {accuracy:.0%}")
+
+        with torch.no_grad():
+            model.trf_blocks[0].ff.layers[0].weight.add_(0.01)
+        rebuilt = cache.get(model, texts, labels, tokenizer)
+        print(f"{'✅' if rebuilt.built else '❌'} 骨干网络权重改变后缓存自动失效")
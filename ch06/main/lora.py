@@ -0,0 +1,416 @@
+"""
+第6章：LoRA 低秩适配器（Low-Rank Adaptation）
+
+全参数微调要为每个参数保存梯度和两份 AdamW 状态，每个任务还要保存一整份模型权重。
+LoRA 冻结预训练权重 W，只训练一个低秩增量：
+
+    y = x Wᵀ + b + (alpha / r) · x Aᵀ Bᵀ        A: (r, d_in)，B: (d_out, r)，r ≪ d_in, d_out
+
+核心概念：
+    - 注入：把注意力（W_qkv、out_proj）和前馈层（ff.layers.0、ff.layers.2）的 nn.Linear
+      替换成 LoRALinear，基础权重原样保留并冻结
+    - 初始化：A 用与 nn.Linear 相同的 Kaiming 均匀分布，B 全零，所以注入后模型输出不变
+    - 只训练适配器：优化器状态只占 LoRA 参数的两倍（r=8 时约为全模型的 1%），
+      每个任务只需保存几 MB 的适配器权重（lora_state_dict）
+    - 合并：W' = W + (alpha / r) · B A，合并后换回普通 nn.Linear，推理时没有任何额外开销
+    - 多适配器批量推理：同一个基础模型上挂多个适配器，batch 中每一行指定自己的适配器，
+      基础权重的矩阵乘法整个 batch 共享，适配器部分用按行取出的 A、B 做一次批量矩阵乘法
+
+依赖：
+    - torch: PyTorch 深度学习框架
+"""
+
+import contextlib
+import math
+import os
+import sys
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+import torch
+import torch.nn as nn
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+
+@dataclass
+class LoRAConfig:
+    """
+    LoRA 超参数
+    """
+
+    # 秩：增量矩阵 B A 的秩，越大表达能力越强，参数越多
+    r: int = 8
+
+    # 缩放系数：增量乘以 alpha / r，换不同的 r 时不必重新调学习率
+    alpha: float = 16.0
+
+    # 适配器输入上的 dropout（只在训练时生效）
+    dropout: float = 0.0
+
+    # 注入适配器的线性层（按模块名的后缀匹配）
+    target_modules: Sequence[str] = ("att.W_qkv", "att.out_proj", "ff.layers.0", "ff.layers.2")
+
+    # 除适配器外仍然参与训练的模块（按模块名前缀匹配，例如分类任务新加的输出头 "out_head"）
+    trainable_modules: Sequence[str] = ()
+
+
+class LoRALinear(nn.Module):
+    """
+    带若干个 LoRA 适配器的线性层
+
+    属性:
+        base: 冻结的原始 nn.Linear
+        lora_A / lora_B: 各适配器的 A (r, d_in) 和 B (d_out, r)
+        scaling: 各适配器的 alpha / r
+        active_adapter: 当前使用的适配器名称，None 表示只用基础权重
+        adapter_rows: 批量推理时每一行使用的适配器下标（由 adapter_batch 设置）
+    """
+
+    def __init__(self, base: nn.Linear):
+        """
+        参数:
+            base: 被包装的线性层，原样保留（不复制权重）；创建时没有适配器，输出与 base 完全相同
+        """
+        super().__init__()
+        self.base = base
+        self.lora_A = nn.ParameterDict()
+        self.lora_B = nn.ParameterDict()
+        self.lora_dropout = nn.ModuleDict()
+        self.scaling = {}
+        self.active_adapter: Optional[str] = None
+        self.adapter_rows: Optional[torch.Tensor] = None
+        self._stacked = None
+
+    # 与 nn.Linear 相同的属性，直接读写 .weight 的代码（例如加载预训练权重）不需要修改
+    @property
+    def weight(self) -> nn.Parameter:
+        """基础权重 base.weight（不含适配器增量），形状 (out_features, in_features)"""
+        return self.base.weight
+
+    @property
+    def bias(self) -> Optional[nn.Parameter]:
+        """基础偏置 base.bias，没有偏置时为 None"""
+        return self.base.bias
+
+    @property
+    def in_features(self) -> int:
+        """输入维度，与 base 相同"""
+        return self.base.in_features
+
+    @property
+    def out_features(self) -> int:
+        """输出维度，与 base 相同"""
+        return self.base.out_features
+
+    def add_adapter(self, name: str, r: int, alpha: float, dropout: float = 0.0) -> None:
+        """新增一个适配器（B 为零，加入后输出不变）"""
+        if name in self.lora_A:
+            raise ValueError(f"适配器 {name!r} 已存在")
+        weight = self.base.weight
+        A = torch.empty(r, self.in_features, dtype=weight.dtype, device=weight.device)
+        nn.init.kaiming_uniform_(A, a=math.sqrt(5))
+        self.lora_A[name] = nn.Parameter(A)
+        self.lora_B[name] = nn.Parameter(torch.zeros(self.out_features, r, dtype=weight.dtype,
+                                                     device=weight.device))
+        self.lora_dropout[name] = nn.Dropout(dropout) if dropout > 0 else nn.Identity()
+        self.scaling[name] = alpha / r
+
+    def delta_weight(self, name: str) -> torch.Tensor:
+        """适配器对应的权重增量 (alpha / r) · B A，形状与 base.weight 相同"""
+        return (self.lora_B[name] @ self.lora_A[name]) * self.scaling[name]
+
+    def set_adapter_rows(self, rows: Optional[torch.Tensor]) -> None:
+        """
+        设置批量推理时每一行使用的适配器
+
+        参数:
+            rows: (batch_size,) 的适配器下标（对应 lora_A 中的顺序），-1 表示只用基础权重；
+                  None 表示恢复为 active_adapter
+
+        注意:
+            - 各适配器的 A、B 在这里补零到相同的秩并堆叠（缩放系数并入 B），
+              之后每次前向（例如逐 token 生成）直接使用，不再重复堆叠
+        """
+        self.adapter_rows = rows
+        if rows is None:
+            self._stacked = None
+            return
+        names = list(self.lora_A.keys())
+        r_max = max(self.lora_A[n].shape[0] for n in names)
+        weight = self.base.weight
+        # 最后一个位置全零，对应 -1（只用基础权重）
+        A = weight.new_zeros(len(names) + 1, r_max, self.in_features)
+        B = weight.new_zeros(len(names) + 1, self.out_features, r_max)
+        with torch.no_grad():
+            for i, n in enumerate(names):
+                r = self.lora_A[n].shape[0]
+                A[i, :r] = self.lora_A[n]
+                B[i, :, :r] = self.lora_B[n] * self.scaling[n]
+        self._stacked = (A, B)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        基础线性层的输出加上适配器增量
+
+        两条路径：
+            - 批量多适配器（adapter_rows 不为 None，由 adapter_batch 设置）：第 i 行加上
+              x[i] Aᵀ Bᵀ，A、B 取自 set_adapter_rows 预先堆叠好的第 adapter_rows[i] 个适配器
+              （缩放已并入 B；-1 对应全零，即只用基础权重）。用于推理，不经过 dropout
+            - 当前适配器（active_adapter）：所有行加上 (alpha / r) · dropout(x) Aᵀ Bᵀ，
+              dropout 只作用于适配器的输入，基础权重的输入不受影响；active_adapter 为 None 时只用基础权重
+
+        参数:
+            x (Tensor): 形状 (..., in_features)；批量多适配器路径要求 (batch_size, seq_len, in_features)
+
+        返回:
+            Tensor: 形状 (..., out_features)
+        """
+        y = self.base(x)
+        if self.adapter_rows is not None:
+            A, B = self._stacked
+            rows = self.adapter_rows
+            # (b, T, d_in) @ (b, d_in, r) @ (b, r, d_out)
+            delta = torch.bmm(torch.bmm(x, A[rows].transpose(1, 2).to(x.dtype)),
+                              B[rows].transpose(1, 2).to(x.dtype))
+            return y + delta.to(y.dtype)
+        if self.active_adapter is None:
+            return y
+        name = self.active_adapter
+        x = self.lora_dropout[name](x)
+        return y + (x @ self.lora_A[name].t() @ self.lora_B[name].t()) * self.scaling[name]
+
+    def extra_repr(self) -> str:
+        """print(model) 时显示的信息：各适配器的秩和当前适配器"""
+        adapters = ", ".join(f"{n}(r={self.lora_A[n].shape[0]})" for n in self.lora_A)
+        return f"adapters=[{adapters}], active={self.active_adapter}"
+
+
+def lora_modules(model: nn.Module) -> dict:
+    """模型中所有的 LoRALinear：{模块名: LoRALinear}"""
+    return {name: m for name, m in model.named_modules() if isinstance(m, LoRALinear)}
+
+
+def inject_lora(model: nn.Module, cfg: Optional[LoRAConfig] = None, name: str = "default") -> list:
+    """
+    在目标线性层上注入适配器，冻结其余参数，并把新适配器设为当前适配器
+
+    参数:
+        model: 例如 GPTModel
+        cfg: LoRA 超参数
+        name (str): 适配器名称；对同一个模型多次调用（不同名称）即可挂上多个适配器
+
+    返回:
+        list[str]: 注入了适配器的模块名
+
+    示例:
+        >>> inject_lora(model, LoRAConfig(r=8))
+        >>> trainer = Trainer(model, TrainConfig())   # 优化器只包含适配器参数
+    """
+    cfg = cfg or LoRAConfig()
+    targets = [(module_name, module) for module_name, module in model.named_modules()
+               if isinstance(module, (nn.Linear, LoRALinear))
+               and any(module_name.endswith(t) for t in cfg.target_modules)]
+    if not targets:
+        raise ValueError(f"模型中没有与 {tuple(cfg.target_modules)} 匹配的线性层")
+    # 先检查再修改，避免重名时模型只被改了一半
+    if any(name in module.lora_A for module in lora_modules(model).values()):
+        raise ValueError(f"适配器 {name!r} 已存在")
+
+    for module_name, module in targets:
+        if isinstance(module, nn.Linear):
+            parent_name, _, child = module_name.rpartition(".")
+            parent = model.get_submodule(parent_name) if parent_name else model
+            module = LoRALinear(module)
+            setattr(parent, child, module)
+        module.add_adapter(name, cfg.r, cfg.alpha, cfg.dropout)
+
+    for param_name, param in model.named_parameters():
+        param.requires_grad = (f".lora_A.{name}" in param_name or f".lora_B.{name}" in param_name
+                               or any(param_name.startswith(m) for m in cfg.trainable_modules))
+    set_active_adapter(model, name)
+    return [module_name for module_name, _ in targets]
+
+
+def _check_adapters(modules, names) -> None:
+    """names 中每个适配器至少要在一个 LoRALinear 中存在（None 表示基础权重，不检查），否则抛出 KeyError"""
+    known = {n for module in modules for n in module.lora_A}
+    unknown = [n for n in names if n is not None and n not in known]
+    if unknown:
+        raise KeyError(f"适配器 {unknown[0]!r} 不存在")
+
+
+def set_active_adapter(model: nn.Module, name: Optional[str]) -> None:
+    """
+    切换所有 LoRALinear 的当前适配器（None 表示只用基础权重）
+
+    注意:
+        - 不同适配器的 target_modules 可以不同：没有这个适配器的层只用基础权重
+        - 只有所有层都没有这个适配器时才抛出 KeyError
+    """
+    modules = lora_modules(model).values()
+    _check_adapters(modules, [name])
+    for module in modules:
+        module.active_adapter = name if name in module.lora_A else None
+
+
+@contextlib.contextmanager
+def adapter_batch(model: nn.Module, row_adapters: Sequence[Optional[str]]):
+    """
+    多适配器批量推理：batch 的第 i 行使用适配器 row_adapters[i]（None 表示只用基础权重）
+
+    示例:
+        >>> with adapter_batch(model, ["spam", "sentiment", None]):
+        ...     logits = model(input_ids)        # input_ids 有 3 行
+
+    注意:
+        - 某一层没有某行的适配器时（适配器的 target_modules 不同），这一行在该层只用基础权重
+    """
+    modules = lora_modules(model).values()
+    _check_adapters(modules, row_adapters)
+    for module in modules:
+        index = {n: i for i, n in enumerate(module.lora_A.keys())}
+        rows = torch.tensor([index.get(a, -1) for a in row_adapters], device=module.weight.device)
+        module.set_adapter_rows(rows)
+    try:
+        yield model
+    finally:
+        for module in modules:
+            module.set_adapter_rows(None)
+
+
+def lora_state_dict(model: nn.Module, name: str = "default") -> dict:
+    """
+    只包含一个适配器的权重，每个任务单独保存
+
+    返回:
+        dict: {"scaling": {模块名: alpha / r}, "weights": {"<模块名>.A": A, "<模块名>.B": B}}
+    """
+    state = {"scaling": {}, "weights": {}}
+    for module_name, module in lora_modules(model).items():
+        if name in module.lora_A:
+            state["scaling"][module_name] = module.scaling[name]
+            state["weights"][f"{module_name}.A"] = module.lora_A[name].detach().clone()
+            state["weights"][f"{module_name}.B"] = module.lora_B[name].detach().clone()
+    return state
+
+
+def load_lora_state_dict(model: nn.Module, state: dict, name: str = "default") -> None:
+    """
+    把 lora_state_dict 保存的适配器以 name 加载到模型上（没有的 LoRALinear 会自动创建）
+
+    加载后不改变当前适配器，也不改变参数的 requires_grad
+    """
+    for module_name, scaling in state["scaling"].items():
+        module = model.get_submodule(module_name)
+        if isinstance(module, nn.Linear):
+            parent_name, _, child = module_name.rpartition(".")
+            parent = model.get_submodule(parent_name) if parent_name else model
+            module = LoRALinear(module)
+            setattr(parent, child, module)
+        A = state["weights"][f"{module_name}.A"]
+        B = state["weights"][f"{module_name}.B"]
+        if name not in module.lora_A:
+            module.add_adapter(name, A.shape[0], alpha=scaling * A.shape[0])
+        with torch.no_grad():
+            module.lora_A[name].copy_(A)
+            module.lora_B[name].copy_(B)
+        module.scaling[name] = scaling
+        module.lora_A[name].requires_grad = False
+        module.lora_B[name].requires_grad = False
+
+
+@torch.no_grad()
+def merge_lora(model: nn.Module, name: Optional[str] = None) -> nn.Module:
+    """
+    把适配器合并进基础权重，并把 LoRALinear 换回普通 nn.Linear（推理零额外开销）
+
+    参数:
+        name (str): 要合并的适配器，默认是每层的当前适配器；None 且没有当前适配器时只去掉 LoRA。
+                    没有这个适配器的层只去掉 LoRA；所有层都没有时抛出 KeyError
+
+    返回:
+        nn.Module: 原地修改后的 model（其余适配器被丢弃）
+    """
+    modules = lora_modules(model)
+    _check_adapters(modules.values(), [name])
+    for module_name, module in modules.items():
+        adapter = name or module.active_adapter
+        base = module.base
+        if adapter is not None and adapter in module.lora_A:
+            base.weight += module.delta_weight(adapter).to(base.weight.dtype)
+        parent_name, _, child = module_name.rpartition(".")
+        parent = model.get_submodule(parent_name) if parent_name else model
+        setattr(parent, child, base)
+    return model
+
+
+def count_parameters(model: nn.Module) -> tuple:
+    """返回 (可训练参数量, 总参数量)"""
+    trainable = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    return trainable, sum(p.numel() for p in model.parameters())
+
+
+if __name__ == "__main__":
+    import copy
+
+    from ch04.main.gpt_model import GPTConfig, GPTModel
+
+    torch.manual_seed(123)
+    cfg = GPTConfig(vocab_size=1000, ctx_len=32, emb_dim=64, n_heads=4, n_layers=2, drop_prob=0.0)
+    model = GPTModel(cfg).eval()
+    inputs = torch.randint(0, cfg.vocab_size, (3, 16))
+    with torch.no_grad():
+        base_logits = model(inputs)
+
+    targets = inject_lora(model, LoRAConfig(r=4), name="task_a")
+    inject_lora(model, LoRAConfig(r=8, alpha=8), name="task_b")
+    trainable, total = count_parameters(model)
+    print(f"注入 {len(targets)} 个线性层，可训练参数 {trainable:,} / {total:,}（{trainable / total:.2%}）")
+
+    with torch.no_grad():
+        status = "✅" if torch.allclose(model(inputs), base_logits) else "❌"
+        print(f"{status} B 初始化为零，注入后输出不变")
+        # 模拟训练后的适配器
+        for module in lora_modules(model).values():
+            for p in module.lora_B.values():
+                p.normal_(std=0.02)
+
+        expected = {}
+        for name in ("task_a", "task_b"):
+            set_active_adapter(model, name)
+            expected[name] = model(inputs)
+        expected[None] = base_logits
+
+        rows = ["task_a", "task_b", None]
+        with adapter_batch(model, rows):
+            batched = model(inputs)
+        ok = all(torch.allclose(batched[i], expected[a][i], atol=1e-5) for i, a in enumerate(rows))
+        print(f"{'✅' if ok else '❌'} 多适配器批量推理与逐个适配器的结果一致")
+
+        # 只注入注意力 W_qkv 的适配器可以和覆盖全部线性层的适配器共存，批量推理时其余层只用基础权重
+        inject_lora(model, LoRAConfig(r=2, target_modules=("att.W_qkv",)), name="task_c")
+        for module in lora_modules(model).values():
+            if "task_c" in module.lora_B:
+                module.lora_B["task_c"].normal_(std=0.02)
+        expected["task_c"] = model(inputs)
+        rows = ["task_c", "task_a", "task_c"]
+        with adapter_batch(model, rows):
+            batched = model(inputs)
+        ok = all(torch.allclose(batched[i], expected[a][i], atol=1e-5) for i, a in enumerate(rows))
+        print(f"{'✅' if ok else '❌'} target_modules 不同的适配器可以混在同一个 batch 里")
+
+        merged = merge_lora(copy.deepcopy(model), "task_b")
+        ok = not lora_modules(merged) and torch.allclose(merged(inputs), expected["task_b"], atol=1e-5)
+        print(f"{'✅' if ok else '❌'} 合并 task_b 后换回 nn.Linear，输出一致")
+
+        state = lora_state_dict(model, "task_a")
+        restored = copy.deepcopy(model)
+        set_active_adapter(restored, None)
+        merge_lora(restored)  # 没有当前适配器：只去掉 LoRA，得到基础模型
+        load_lora_state_dict(restored, state, "task_a")
+        set_active_adapter(restored, "task_a")
+        ok = torch.allclose(restored(inputs), expected["task_a"], atol=1e-5)
+        print(f"{'✅' if ok else '❌'} 单独保存 / 加载适配器: {sum(t.numel() for t in state['weights'].values()):,} 个参数")
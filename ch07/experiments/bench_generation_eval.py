@@ -0,0 +1,152 @@
+"""
+实验：逐条生成 vs 排序 + 左填充批量生成 vs 响应缓存
+
+提示词：the-verdict.txt 中长度不同的句子，用 format_input 包装成指令。
+模型是随机初始化的 GPT（只关心耗时），随机模型几乎不会生成 <|endoftext|>，每行都生成到 max_new_tokens。
+
+报告：
+    - 逐条生成（书中的写法，batch 大小为 1）
+    - generate_responses：按长度排序、左填充、批量生成（不使用缓存）
+    - 两者的回答是否完全一致（贪心解码）
+    - 模拟中断：删掉缓存文件的后半部分并留下一行写了一半的记录，再次运行只补齐缺失的回答
+    - 再次评估：全部命中缓存
+
+运行方式：
+    python ch07/experiments/bench_generation_eval.py
+    python ch07/experiments/bench_generation_eval.py --emb-dim 256 --n-layers 4 --n-heads 4 --n-prompts 16
+"""
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import torch
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch04.main.generation_server import EOS_TOKEN_ID
+from ch04.main.gpt_model import GPTConfig, GPTModel
+from ch05.main.sampling import SamplingParams
+from ch07.main.generation_eval import ResponseCache, format_input, generate_batch, generate_responses
+
+
+class ByteTokenizer:
+    """没有 GPT-2 分词器文件时使用：UTF-8 字节作为 token，256 是 <|endoftext|>"""
+
+    name = "utf8-bytes"
+    n_vocab = 257
+    eot_token = 256
+
+    def encode(self, text):
+        """文本的 UTF-8 字节即 token ID"""
+        return list(text.encode("utf-8"))
+
+    def decode(self, ids):
+        """忽略 <|endoftext|>，其余 token 按 UTF-8 字节解码（不完整的字节用替换字符）"""
+        return bytes(i for i in ids if i < 256).decode("utf-8", errors="replace")
+
+
+def load_tokenizer():
+    """GPT-2 分词器；离线无法加载时退回到 ByteTokenizer"""
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("gpt2")
+    except Exception as exc:  # 离线环境下 tiktoken 下载词表会失败
+        print(f"⚠️  无法加载 GPT-2 分词器（{type(exc).__name__}），改用 UTF-8 字节作为 token")
+        return ByteTokenizer()
+
+
+def load_prompts(n_prompts: int) -> list:
+    """从 the-verdict.txt 按长度均匀取 n_prompts 个句子，包装成指令格式的提示词"""
+    with open(os.path.join(ROOT_DIR, "ch02", "main", "the-verdict.txt"), "r", encoding="utf-8") as f:
+        sentences = [s.strip() for s in re.split(r"(?<=[.!?])\s+", f.read()) if len(s.strip()) > 10]
+    # 取长短交错的句子，让提示词长度分布更分散
+    sentences = sorted(sentences, key=len)
+    step = max(1, len(sentences) // n_prompts)
+    return [format_input({"instruction": "Rewrite the sentence in plain English.", "input": s})
+            for s in sentences[::step][:n_prompts]]
+
+
+def main():
+    """对比逐条生成、排序 + 左填充批量生成的耗时和结果，再模拟中断检查缓存的断点续跑"""
+    parser = argparse.ArgumentParser(description="基于生成的评估：逐条 vs 批量 vs 缓存")
+    parser.add_argument("--emb-dim", type=int, default=768)
+    parser.add_argument("--n-layers", type=int, default=12)
+    parser.add_argument("--n-heads", type=int, default=12)
+    parser.add_argument("--ctx-len", type=int, default=1024)
+    parser.add_argument("--n-prompts", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    args = parser.parse_args()
+
+    tokenizer = load_tokenizer()
+    eos_id = getattr(tokenizer, "eot_token", EOS_TOKEN_ID)
+    torch.manual_seed(123)
+    model = GPTModel(GPTConfig(vocab_size=tokenizer.n_vocab, ctx_len=args.ctx_len, emb_dim=args.emb_dim,
+                               n_layers=args.n_layers, n_heads=args.n_heads, drop_prob=0.0)).eval()
+    prompts = load_prompts(args.n_prompts)
+    lengths = [len(tokenizer.encode(p)) for p in prompts]
+    print(f"{len(prompts)} 个提示词，{min(lengths)}~{max(lengths)} 个 token，每条最多生成 {args.max_new_tokens} 个")
+    params = SamplingParams(temperature=0.0)
+
+    start = time.perf_counter()
+    sequential = []
+    for prompt in prompts:
+        (token_ids, _), = generate_batch(model, [tokenizer.encode(prompt)], args.max_new_tokens, params, eos_id)
+        sequential.append(tokenizer.decode(token_ids))
+    sequential_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = generate_responses(model, tokenizer, prompts, None, params, args.max_new_tokens,
+                                 args.batch_size, model_hash="bench", eos_id=eos_id, verbose=False)
+    batched_s = time.perf_counter() - start
+
+    print(f"\n{'方法':<30} {'耗时 s':>8}")
+    print(f"{'逐条生成':<30} {sequential_s:>8.2f}")
+    print(f"{f'排序 + 左填充，batch {args.batch_size}':<30} {batched_s:>8.2f}（{sequential_s / batched_s:.1f}x）")
+    print(f"{'✅' if batched == sequential else '❌'} 批量生成的回答与逐条生成完全一致")
+
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, "responses.jsonl")
+        cache = ResponseCache(path)
+        generate_responses(model, tokenizer, prompts, cache, params, args.max_new_tokens, args.batch_size,
+                           model_hash="bench", eos_id=eos_id, verbose=False)
+        cache.close()
+
+        # 模拟中断：只保留前一半记录，末尾再留一行写了一半的 JSON
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines(lines[:len(lines) // 2])
+            f.write(lines[-1][:20])
+
+        print("\n中断后继续:")
+        cache = ResponseCache(path)
+        start = time.perf_counter()
+        resumed = generate_responses(model, tokenizer, prompts, cache, params, args.max_new_tokens,
+                                     args.batch_size, model_hash="bench", eos_id=eos_id)
+        print(f"  耗时 {time.perf_counter() - start:.2f} s，"
+              f"{'✅ 回答与完整运行一致' if resumed == sequential else '❌ 回答不一致'}")
+        cache.close()
+
+        print("\n再次评估（例如只修改了打分方式）:")
+        cache = ResponseCache(path)
+        start = time.perf_counter()
+        generate_responses(model, tokenizer, prompts, cache, params, args.max_new_tokens, args.batch_size,
+                           model_hash="bench", eos_id=eos_id)
+        print(f"  耗时 {(time.perf_counter() - start) * 1e3:.1f} ms")
+        cache.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
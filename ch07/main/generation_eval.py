@@ -0,0 +1,283 @@
+"""
+第7章：基于生成的批量评估（响应缓存 + 断点续跑）
+
+评估指令微调后的模型需要为测试集的每条指令生成回答，书中逐条生成，是本章最慢的一步；
+而且每次修改打分方式（例如换一个评分提示词）都要把所有回答重新生成一遍。
+
+核心概念：
+    - 按长度排序分批：提示词按 token 数排序后组 batch，同一 batch 的长度接近，左填充最少
+    - 左填充：提示词右对齐，所有行的新 token 写在同一列，一次前向同时为整个 batch 解码一步；
+      KV 缓存记录每行填充的长度，填充部分不参与注意力，位置编号从真实内容开始
+    - 按行停止：生成 <|endoftext|> 的行之后的输出被忽略，所有行都结束时提前停止
+    - 响应缓存：每条回答以 (模型权重指纹, 提示词, 采样参数, 最大生成长度) 的哈希为键，
+      追加写入 JSONL。再次评估时命中的回答直接读取，修改打分后重新评估不需要任何生成
+    - 断点续跑：每个 batch 生成完立即写入并 flush，中断后重新运行只生成还没有缓存的提示词；
+      被截断的最后一行在读取时跳过
+
+依赖：
+    - torch: PyTorch 深度学习框架
+    - tiktoken: GPT-2 分词器（仅命令行入口使用）
+"""
+
+import argparse
+import dataclasses
+import hashlib
+import json
+import os
+import sys
+import time
+from typing import Optional, Sequence
+
+import torch
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from ch04.main.generation_server import EOS_TOKEN_ID
+from ch05.main.sampling import SamplingParams, generate
+from ch06.main.feature_cache import fingerprint_model
+
+
+def format_input(entry: dict) -> str:
+    """
+    Alpaca 格式的提示词（与书中第7章相同），以 "### Response:" 结尾，模型接着生成回答
+
+    参数:
+        entry (dict): 包含 instruction 和可选的 input
+    """
+    text = ("Below is an instruction that describes a task. "
+            "Write a response that appropriately completes the request."
+            f"\n\n### Instruction:\n{entry['instruction']}")
+    if entry.get("input"):
+        text += f"\n\n### Input:\n{entry['input']}"
+    return text + "\n\n### Response:\n"
+
+
+def response_key(model_hash: str, prompt: str, params: SamplingParams, max_new_tokens: int) -> str:
+    """缓存键：模型、提示词、采样参数或生成长度任何一项不同，都是不同的回答"""
+    payload = json.dumps([model_hash, prompt, dataclasses.asdict(params), max_new_tokens],
+                         ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    追加写入的 JSONL 响应缓存
+
+    每行一个 JSON 对象：{"key", "prompt", "response", "n_tokens", "finished"}；
+    同一个键出现多次时以最后一次为准。
+
+    示例:
+        >>> cache = ResponseCache("eval/responses.jsonl")
+        >>> responses = generate_responses(model, tokenizer, prompts, cache)
+    """
+
+    def __init__(self, path: str):
+        """
+        读入已有的缓存文件（不存在时为空缓存）；写到一半的行直接跳过
+
+        参数:
+            path (str): JSONL 文件路径，第一次 put_many 时才以追加方式打开
+        """
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 写到一半被中断的行
+                        continue
+                    self.records[record["key"]] = record
+        self._file = None
+
+    def __contains__(self, key: str) -> bool:
+        """键是否已有缓存的回答"""
+        return key in self.records
+
+    def __len__(self) -> int:
+        """缓存的记录数（同一个键只算一次）"""
+        return len(self.records)
+
+    def get(self, key: str) -> Optional[dict]:
+        """键对应的记录，没有时返回 None"""
+        return self.records.get(key)
+
+    def put_many(self, records: list) -> None:
+        """追加一批记录并立即写入磁盘"""
+        if self._file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+            if self._file.tell() > 0 and not self._ends_with_newline():
+                # 上次中断时留下了写到一半的行：另起一行，不让新记录接在它后面
+                self._file.write("\n")
+        for record in records:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.records[record["key"]] = record
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _ends_with_newline(self) -> bool:
+        """文件是否以换行结尾（否则最后一行是上次中断时写了一半的记录）"""
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def close(self) -> None:
+        """关闭追加写入的文件；之后再 put_many 会重新打开"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+@torch.inference_mode()
+def generate_batch(model, prompt_ids: Sequence[Sequence[int]], max_new_tokens: int,
+                   params: SamplingParams, eos_id: int = EOS_TOKEN_ID) -> list:
+    """
+    左填充后一起生成
+
+    参数:
+        model: GPT 模型
+        prompt_ids: 每行的提示词 token（长度可以不同）
+        max_new_tokens (int): 每行最多生成的 token 数
+        params: 所有行共用的采样参数
+        eos_id (int): 结束 token，同时用作填充 token
+
+    返回:
+        list[tuple[list[int], bool]]: 每行生成的 token（不含 eos）以及是否因 eos 结束
+    """
+    lengths = [len(ids) for ids in prompt_ids]
+    width = max(lengths)
+    idx = torch.full((len(prompt_ids), width), eos_id, dtype=torch.long)
+    for row, ids in enumerate(prompt_ids):
+        idx[row, width - len(ids):] = torch.as_tensor(ids, dtype=torch.long)
+    pad_lengths = torch.tensor([width - n for n in lengths])
+
+    out = generate(model, idx, max_new_tokens, params, eos_id=eos_id, pad_lengths=pad_lengths)
+    results = []
+    for row in out[:, width:].tolist():
+        finished = eos_id in row
+        results.append((row[:row.index(eos_id)] if finished else row, finished))
+    return results
+
+
+def generate_responses(model, tokenizer, prompts: Sequence[str], cache: Optional[ResponseCache] = None,
+                       params: Optional[SamplingParams] = None, max_new_tokens: int = 256,
+                       batch_size: int = 8, model_hash: Optional[str] = None,
+                       eos_id: int = EOS_TOKEN_ID, verbose: bool = True) -> list:
+    """
+    为每个提示词生成回答；已缓存的直接读取，其余按长度排序分批生成，每批生成完立即写入缓存
+
+    参数:
+        model: GPT 模型
+        tokenizer: 有 encode / decode 方法的分词器
+        prompts: 提示词（例如 format_input 的结果）
+        cache: 响应缓存，None 表示不缓存
+        params: 采样参数，默认贪心
+        max_new_tokens (int): 最多生成的 token 数
+        batch_size (int): 每批的提示词数
+        model_hash (str): 模型标识，默认对权重求 SHA-256
+        eos_id (int): 结束 / 填充 token
+        verbose (bool): 是否打印进度
+
+    返回:
+        list[str]: 与 prompts 顺序一致的回答
+
+    注意:
+        - 提示词超过 ctx_len - max_new_tokens 时保留最后的部分
+        - 带 seed 的采样结果与 batch 的组合无关（见 BatchedSampler），所以缓存的回答可以复现
+    """
+    params = params or SamplingParams(temperature=0.0)
+    model_hash = model_hash or fingerprint_model(model)
+    keys = [response_key(model_hash, prompt, params, max_new_tokens) for prompt in prompts]
+    pending = sorted({key: i for i, key in enumerate(keys) if cache is None or key not in cache}.values())
+    responses = {}
+
+    max_prompt = model.cfg.ctx_len - max_new_tokens
+    if max_prompt < 1:
+        raise ValueError(f"max_new_tokens={max_new_tokens} 不小于上下文长度 {model.cfg.ctx_len}")
+    encoded = {i: tokenizer.encode(prompts[i])[-max_prompt:] for i in pending}
+    # 从长到短：最耗内存的 batch 最先运行，内存不足时立即暴露
+    order = sorted(pending, key=lambda i: len(encoded[i]), reverse=True)
+    if verbose:
+        print(f"{len(prompts)} 个提示词：缓存命中 {len(prompts) - len(pending)}，需要生成 {len(pending)}")
+
+    model.eval()
+    start = time.perf_counter()
+    n_tokens = 0
+    for lo in range(0, len(order), batch_size):
+        batch = order[lo:lo + batch_size]
+        results = generate_batch(model, [encoded[i] for i in batch], max_new_tokens, params, eos_id)
+        records = []
+        for i, (token_ids, finished) in zip(batch, results):
+            records.append({"key": keys[i], "prompt": prompts[i], "response": tokenizer.decode(token_ids),
+                            "n_tokens": len(token_ids), "finished": finished})
+            n_tokens += len(token_ids)
+        if cache is not None:
+            cache.put_many(records)
+        for i, record in zip(batch, records):
+            responses[keys[i]] = record["response"]
+        if verbose:
+            elapsed = time.perf_counter() - start
+            print(f"  {min(lo + batch_size, len(order))}/{len(order)}，{n_tokens / max(elapsed, 1e-9):.1f} tokens/s")
+
+    return [responses[key] if key in responses else cache.get(key)["response"] for key in keys]
+
+
+def main():
+    """加载测试集和模型（可从检查点恢复），批量生成回答并缓存到 JSONL，可选写出带 model_response 的 JSON"""
+    import tiktoken
+
+    from ch04.main.gpt_model import GPTConfig, GPTModel
+    from ch05.main.checkpoint import latest_checkpoint, load_checkpoint
+
+    parser = argparse.ArgumentParser(description="批量生成测试集回答，结果缓存到 JSONL（可断点续跑）")
+    parser.add_argument("--data", required=True, help="测试集 JSON：[{instruction, input, output}, ...]")
+    parser.add_argument("--checkpoint", default=None, help="ch05 检查点目录（或包含多个检查点的上级目录）")
+    parser.add_argument("--cache", default="eval/responses.jsonl", help="响应缓存文件")
+    parser.add_argument("--output", default=None, help="把带 model_response 字段的测试集写入这个 JSON 文件")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--top-k", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--ctx-len", type=int, default=1024)
+    parser.add_argument("--emb-dim", type=int, default=768)
+    parser.add_argument("--n-layers", type=int, default=12)
+    parser.add_argument("--n-heads", type=int, default=12)
+    args = parser.parse_args()
+
+    with open(args.data, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    model = GPTModel(GPTConfig(ctx_len=args.ctx_len, emb_dim=args.emb_dim, n_layers=args.n_layers,
+                               n_heads=args.n_heads, drop_prob=0.0))
+    if args.checkpoint:
+        path = args.checkpoint if os.path.exists(os.path.join(args.checkpoint, "index.json")) \
+            else latest_checkpoint(args.checkpoint)
+        if path is None:
+            raise FileNotFoundError(f"{args.checkpoint} 中没有检查点")
+        state, _ = load_checkpoint(path)
+        model.load_state_dict(state["model"])
+        print(f"✅ 已加载检查点: {path}")
+    else:
+        print("⚠️  没有指定 --checkpoint，使用随机初始化的模型")
+
+    cache = ResponseCache(args.cache)
+    params = SamplingParams(temperature=args.temperature, top_k=args.top_k, seed=args.seed)
+    try:
+        responses = generate_responses(model, tiktoken.get_encoding("gpt2"),
+                                       [format_input(entry) for entry in entries], cache, params,
+                                       args.max_new_tokens, args.batch_size)
+    finally:
+        cache.close()
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump([{**entry, "model_response": response.strip()} for entry, response in zip(entries, responses)],
+                      f, ensure_ascii=False, indent=2)
+        print(f"✅ 已写入: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,404 @@
+"""
+模块名称：benchmark
+用途：可复现的计算微基准测试（替代 print_device_info 里单次 matmul 计时）
+
+核心概念：
+    - 预热（warmup）：前几次调用会触发内存分配、线程池启动、内核选择等一次性开销，
+      不计入结果
+    - 重复（repeats）：单次计时受调度抖动影响很大，多次测量后报告中位数和 p95
+    - 同步（synchronize）：GPU/MPS 上的算子是异步提交的，
+      计时前后必须等待设备完成，否则测到的只是"提交"耗时
+    - GFLOP/s：每秒完成的十亿次浮点运算，用来和硬件理论峰值对比
+    - GB/s：对 embedding 查表这类几乎没有计算的算子，用内存带宽衡量更合适
+
+依赖：
+    - torch: PyTorch 深度学习框架
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import statistics
+import sys
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import torch
+
+
+# 命令行 / JSON 中使用的 dtype 名称
+DTYPES = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+}
+
+
+@dataclass
+class BenchmarkCase:
+    """
+    一个基准测试用例
+
+    属性:
+        name: 用例名称，例如 "gemm_1024x768x3072"
+        dtype: 数据类型名称（"fp32" / "bf16"）
+        fn: 无参函数，每次调用执行一次被测算子
+        flops: 每次调用的浮点运算次数（0 表示不按算力衡量）
+        bytes_moved: 每次调用读写的字节数（用于计算带宽，0 表示不统计）
+    """
+
+    name: str
+    dtype: str
+    fn: Callable[[], object]
+    flops: float = 0.0
+    bytes_moved: float = 0.0
+
+
+def synchronize(device: torch.device) -> None:
+    """
+    等待设备上已提交的计算全部完成
+
+    CPU 算子是同步执行的，不需要等待；MPS / CUDA 是异步的，必须显式同步。
+    """
+    if device.type == "mps":
+        torch.mps.synchronize()
+    elif device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_fn(
+    fn: Callable[[], object],
+    device: torch.device,
+    warmup: int = 5,
+    repeats: int = 20,
+) -> list[int]:
+    """
+    测量函数的单次执行耗时
+
+    参数:
+        fn: 无参函数
+        device: 计算所在设备（决定是否需要同步）
+        warmup (int): 预热次数，不计时
+        repeats (int): 计时次数
+
+    返回:
+        list[int]: 每次执行的耗时（纳秒）
+
+    注意:
+        - 使用 time.perf_counter_ns：单调时钟 + 整数纳秒，
+          不受系统时间调整影响，也没有浮点精度损失
+    """
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter_ns()
+        fn()
+        synchronize(device)
+        samples.append(time.perf_counter_ns() - start)
+    return samples
+
+
+def percentile(samples: list, q: float) -> float:
+    """
+    计算百分位数（最近秩法）
+
+    参数:
+        samples: 样本列表
+        q (float): 百分位，取值 0-100，例如 95
+
+    返回:
+        float: 第 q 百分位的样本值
+    """
+    ordered = sorted(samples)
+    # 最近秩法：第 ceil(q/100 * n) 个样本（从 1 开始计数）
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(samples_ns: list, flops: float = 0.0, bytes_moved: float = 0.0) -> dict:
+    """
+    把原始耗时样本汇总为统计量
+
+    参数:
+        samples_ns: time_fn 返回的耗时列表（纳秒）
+        flops (float): 每次调用的浮点运算次数
+        bytes_moved (float): 每次调用读写的字节数
+
+    返回:
+        dict: 中位数 / p95 / 最小值（毫秒），以及按中位数计算的 GFLOP/s、GB/s
+    """
+    median_ns = statistics.median(samples_ns)
+    result = {
+        "median_ms": median_ns / 1e6,
+        "p95_ms": percentile(samples_ns, 95) / 1e6,
+        "min_ms": min(samples_ns) / 1e6,
+        "repeats": len(samples_ns),
+    }
+    # 用中位数而不是最小值计算吞吐：更接近实际训练中持续运行的表现
+    if flops:
+        result["gflops"] = flops / median_ns  # FLOP/ns == GFLOP/s
+    if bytes_moved:
+        result["gbps"] = bytes_moved / median_ns  # B/ns == GB/s
+    return result
+
+
+def _max_rss_bytes() -> int:
+    """当前进程到目前为止的常驻内存峰值（字节）；Linux 上单位是 KB，macOS 上是字节"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _read_proc_status_kb(field: str) -> int:
+    """读取 /proc/self/status 中的某个字段（单位 KB），例如 VmRSS、VmHWM"""
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise ValueError(f"/proc/self/status 中没有字段 {field}")
+
+
+def _peak_memory_worker(fn, args, queue) -> None:
+    """
+    子进程入口：执行 fn(*args)，汇报执行期间常驻内存峰值相对执行前的增量
+
+    Linux 上向 /proc/self/clear_refs 写入 "5" 可以把峰值（VmHWM）重置为当前值，
+    这样导入 torch 时的瞬时峰值不会掩盖 fn 本身的峰值；
+    其他平台只能退回到 ru_maxrss（基线包含导入阶段的峰值，结果会偏小）
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        baseline = _read_proc_status_kb("VmRSS") * 1024
+        fn(*args)
+        peak = _read_proc_status_kb("VmHWM") * 1024
+    except (OSError, ValueError):
+        baseline = _max_rss_bytes()
+        fn(*args)
+        peak = _max_rss_bytes()
+    queue.put(peak - baseline)
+
+
+def measure_peak_memory_mb(fn, *args) -> float:
+    """
+    在独立子进程中执行 fn(*args)，返回执行期间常驻内存（RSS）峰值的增量（MB）
+
+    参数:
+        fn: 模块顶层定义的函数（需要能被 pickle 传给子进程），
+            应在函数内部创建输入张量，这样输入占用的内存也被计入
+        *args: 传给 fn 的参数
+
+    返回:
+        float: 峰值增量（MB）
+
+    说明:
+        - CPU 上没有类似 torch.cuda.max_memory_allocated 的统计接口，
+          而进程的 RSS 峰值无法重置，所以每次测量都启动一个全新的子进程
+        - 使用 spawn 启动方式，子进程不会继承父进程已分配的内存
+    """
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_peak_memory_worker, args=(fn, args, queue))
+    proc.start()
+    delta = queue.get()
+    proc.join()
+    return delta / 1e6
+
+
+def build_cases(device: torch.device, dtype_name: str, quick: bool = False) -> list:
+    """
+    构造一组覆盖 GPT 主要算子的测试用例
+
+    参数:
+        device: 计算设备
+        dtype_name (str): "fp32" 或 "bf16"
+        quick (bool): 使用更小的形状，适合 print_device_info 这类快速检查
+
+    返回:
+        list[BenchmarkCase]: 测试用例列表
+
+    说明:
+        形状取自 GPT-2 small（emb_dim=768, n_heads=12, vocab=50257）：
+        - gemm: 前馈层 (B*T, 768) x (768, 3072)
+        - bmm: 注意力分数 (B*H, T, 64) x (B*H, 64, T)
+        - softmax: 注意力权重 (B, H, T, T) 最后一维归一化
+        - layernorm: (B, T, 768)
+        - embedding: 从 50257 x 768 的词表中查 B*T 个 token
+    """
+    dtype = DTYPES[dtype_name]
+    elem_size = torch.tensor([], dtype=dtype).element_size()
+
+    # B: batch_size, T: 序列长度
+    B, T = (2, 128) if quick else (4, 256)
+    emb_dim, n_heads, vocab_size = 768, 12, 50257
+    head_dim = emb_dim // n_heads
+
+    # 固定随机种子，保证不同机器上输入数据一致
+    gen = torch.Generator().manual_seed(123)
+
+    def rand(*shape):
+        """指定形状的标准正态随机张量，放到被测设备上并转成被测的数据类型"""
+        # 先在 CPU 上用固定种子生成再搬运，不同设备之间数据一致
+        return torch.randn(*shape, generator=gen).to(device=device, dtype=dtype)
+
+    cases = []
+
+    # 1. GEMM：2*M*N*K 次浮点运算（每个乘加算 2 次）
+    M, K, N = B * T, emb_dim, 4 * emb_dim
+    a, b = rand(M, K), rand(K, N)
+    cases.append(BenchmarkCase(
+        f"gemm_{M}x{K}x{N}", dtype_name, lambda: torch.matmul(a, b),
+        flops=2 * M * N * K,
+    ))
+
+    # 2. 批量 GEMM：注意力里的 Q @ K^T
+    q, kt = rand(B * n_heads, T, head_dim), rand(B * n_heads, head_dim, T)
+    cases.append(BenchmarkCase(
+        f"bmm_{B * n_heads}x{T}x{head_dim}x{T}", dtype_name, lambda: torch.bmm(q, kt),
+        flops=2 * B * n_heads * T * T * head_dim,
+    ))
+
+    # 3. softmax：每个元素约 5 次运算（求 max、相减、exp、求和、相除），
+    #    属于访存密集型算子，所以同时统计带宽（读一次 + 写一次）
+    scores = rand(B, n_heads, T, T)
+    cases.append(BenchmarkCase(
+        f"softmax_{B}x{n_heads}x{T}x{T}", dtype_name, lambda: torch.softmax(scores, dim=-1),
+        flops=5 * scores.numel(), bytes_moved=2 * scores.numel() * elem_size,
+    ))
+
+    # 4. LayerNorm：每个元素约 8 次运算（均值、方差、归一化、缩放、平移）
+    x = rand(B, T, emb_dim)
+    ln = torch.nn.LayerNorm(emb_dim).to(device=device, dtype=dtype)
+    cases.append(BenchmarkCase(
+        f"layernorm_{B}x{T}x{emb_dim}", dtype_name, lambda: ln(x),
+        flops=8 * x.numel(), bytes_moved=2 * x.numel() * elem_size,
+    ))
+
+    # 5. Embedding 查表：没有浮点运算，只衡量带宽（读出 B*T 行 + 写出 B*T 行）
+    emb = torch.nn.Embedding(vocab_size, emb_dim).to(device=device, dtype=dtype)
+    ids = torch.randint(0, vocab_size, (B, T), generator=gen).to(device)
+    cases.append(BenchmarkCase(
+        f"embedding_{vocab_size}x{emb_dim}[{B}x{T}]", dtype_name, lambda: emb(ids),
+        bytes_moved=2 * B * T * emb_dim * elem_size,
+    ))
+
+    return cases
+
+
+def system_info(device: torch.device) -> dict:
+    """
+    收集机器和运行时信息，写入 JSON 便于跨机器对比
+    """
+    return {
+        "host": socket.gethostname(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "device": str(device),
+        "num_threads": torch.get_num_threads(),
+        "num_interop_threads": torch.get_num_interop_threads(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def run_benchmarks(
+    device: Optional[torch.device] = None,
+    dtypes: tuple = ("fp32", "bf16"),
+    warmup: int = 5,
+    repeats: int = 20,
+    quick: bool = False,
+    verbose: bool = True,
+) -> dict:
+    """
+    运行全部基准测试
+
+    参数:
+        device: 计算设备，None 表示 CPU（保证在纯 CPU 机器上也能运行）
+        dtypes: 要测试的数据类型名称
+        warmup (int): 每个用例的预热次数
+        repeats (int): 每个用例的计时次数
+        quick (bool): 使用较小形状
+        verbose (bool): 是否打印结果表格
+
+    返回:
+        dict: {"system": ..., "results": [每个用例的统计结果]}，可直接 json.dump
+    """
+    if device is None:
+        device = torch.device("cpu")
+
+    results = []
+    for dtype_name in dtypes:
+        try:
+            cases = build_cases(device, dtype_name, quick=quick)
+        except (RuntimeError, TypeError) as e:
+            # 某些设备 / PyTorch 版本不支持 bf16，跳过而不是中断整个测试
+            if verbose:
+                print(f"⚠️  跳过 {dtype_name}: {e}")
+            continue
+
+        for case in cases:
+            try:
+                samples = time_fn(case.fn, device, warmup=warmup, repeats=repeats)
+            except RuntimeError as e:
+                if verbose:
+                    print(f"⚠️  跳过 {case.name} ({case.dtype}): {e}")
+                continue
+            stats = summarize(samples, flops=case.flops, bytes_moved=case.bytes_moved)
+            results.append({"name": case.name, "dtype": case.dtype, **stats})
+
+    report = {"system": system_info(device), "results": results}
+    if verbose:
+        print_report(report)
+    return report
+
+
+def print_report(report: dict) -> None:
+    """以表格形式打印基准测试结果"""
+    print(f"{'用例':<34} {'dtype':<5} {'中位数(ms)':>11} {'p95(ms)':>9} {'GFLOP/s':>9} {'GB/s':>7}")
+    print("-" * 80)
+    for r in report["results"]:
+        gflops = f"{r['gflops']:.1f}" if "gflops" in r else "-"
+        gbps = f"{r['gbps']:.1f}" if "gbps" in r else "-"
+        print(
+            f"{r['name']:<34} {r['dtype']:<5} {r['median_ms']:>11.3f} "
+            f"{r['p95_ms']:>9.3f} {gflops:>9} {gbps:>7}"
+        )
+
+
+def save_report(report: dict, path: str) -> None:
+    """把基准测试结果保存为 JSON 文件"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="计算微基准测试")
+    parser.add_argument("--device", default="cpu", help="计算设备，例如 cpu / mps")
+    parser.add_argument(
+        "--dtypes", nargs="+", default=["fp32", "bf16"], choices=sorted(DTYPES),
+        help="要测试的数据类型",
+    )
+    parser.add_argument("--warmup", type=int, default=5, help="每个用例的预热次数")
+    parser.add_argument("--repeats", type=int, default=20, help="每个用例的计时次数")
+    parser.add_argument("--quick", action="store_true", help="使用较小的形状")
+    parser.add_argument("--json", dest="json_path", help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    report = run_benchmarks(
+        torch.device(args.device), dtypes=tuple(args.dtypes),
+        warmup=args.warmup, repeats=args.repeats, quick=args.quick,
+    )
+    if args.json_path:
+        save_report(report, args.json_path)
+        print(f"\n✅ 结果已保存到: {args.json_path}")
+    sys.exit(0 if report["results"] else 1)
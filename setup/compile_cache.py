@@ -0,0 +1,219 @@
+"""
+模块名称：compile_cache
+用途：可选的编译模式（torch.compile / TorchScript），编译产物缓存在磁盘上
+
+核心概念：
+    - 即时执行（eager）：PyTorch 默认模式，每个算子单独调度，Python 开销和中间张量较多
+    - torch.compile + inductor：把模型捕获为计算图，融合相邻算子并生成 C++/OpenMP 内核；
+      第一次前向需要编译（秒级到分钟级），之后每次前向更快
+    - 编译缓存：inductor 会把生成的内核写入 TORCHINDUCTOR_CACHE_DIR，
+      第二个进程启动时命中缓存，跳过大部分编译时间
+    - TorchScript trace（回退方案）：记录一次前向执行的算子序列，
+      保存为 .pt 文件；inductor 不可用（例如没有 C++ 编译器）时使用
+    - 是否值得编译：比较 一次性编译耗时 与 每次前向节省的时间，
+      模型越小、调用次数越少，越不划算
+
+依赖：
+    - torch: PyTorch 深度学习框架（torch.compile 需要 PyTorch 2.0+）
+"""
+
+import hashlib
+import os
+import statistics
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from setup.benchmark import time_fn
+
+
+# 编译产物缓存目录：inductor 内核放在 inductor/，TorchScript 文件放在 torchscript/
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "0-1-llm", "compile")
+
+
+def _as_args(example_inputs) -> tuple:
+    """把单个张量或张量元组统一成位置参数元组"""
+    return example_inputs if isinstance(example_inputs, tuple) else (example_inputs,)
+
+
+def model_signature(model: nn.Module, args: tuple) -> str:
+    """
+    计算"模型结构 + 输入形状 + PyTorch 版本"的哈希，作为 TorchScript 缓存键
+
+    注意:
+        - 不包含权重数值：加载缓存后会把当前模型的权重拷贝进去，
+          所以重新训练后的同结构模型也能命中缓存
+        - trace 结果和输入形状绑定，形状不同必须重新 trace
+    """
+    h = hashlib.sha256()
+    h.update(torch.__version__.encode())
+    h.update(repr(model).encode())
+    for name, tensor in model.state_dict().items():
+        h.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+    for a in args:
+        h.update(f"input:{tuple(a.shape)}:{a.dtype}".encode())
+    return h.hexdigest()[:16]
+
+
+def _median_ms(fn, warmup: int, repeats: int) -> float:
+    """CPU 上单次调用的中位耗时（毫秒）"""
+    return statistics.median(time_fn(fn, torch.device("cpu"), warmup, repeats)) / 1e6
+
+
+def _compile_inductor(model: nn.Module, args: tuple, cache_dir: str):
+    """
+    用 torch.compile(backend="inductor") 编译模型，并触发第一次编译
+
+    返回:
+        tuple[callable, float, bool]: (编译后的模型, 编译耗时秒, 是否命中磁盘缓存)
+    """
+    # inductor 每次查找缓存时都会读取这个环境变量，所以在编译前设置即可生效
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.join(cache_dir, "inductor")
+
+    from torch._dynamo.utils import counters
+
+    hits_before = counters["inductor"].get("fxgraph_cache_hit", 0)
+
+    compiled = torch.compile(model, backend="inductor")
+    # torch.compile 是惰性的：第一次前向才真正捕获计算图并生成内核
+    start = time.perf_counter()
+    with torch.inference_mode():
+        compiled(*args)
+    compile_time = time.perf_counter() - start
+
+    cache_hit = counters["inductor"].get("fxgraph_cache_hit", 0) > hits_before
+    return compiled, compile_time, cache_hit
+
+
+def _compile_torchscript(model: nn.Module, args: tuple, cache_dir: str):
+    """
+    用 TorchScript trace 编译模型；已有缓存文件时直接加载
+
+    返回:
+        tuple[callable, float, bool]: (编译后的模型, 编译或加载耗时秒, 是否命中磁盘缓存)
+    """
+    path = os.path.join(cache_dir, "torchscript", f"{model_signature(model, args)}.pt")
+
+    start = time.perf_counter()
+    if os.path.exists(path):
+        traced = torch.jit.load(path)
+        # 缓存里存的是 trace 时的权重，换成当前模型的权重
+        traced.load_state_dict(model.state_dict())
+        cache_hit = True
+    else:
+        with torch.inference_mode():
+            traced = torch.jit.trace(model, args)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        torch.jit.save(traced, path)
+        cache_hit = False
+    traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+    # 冻结后的第一次调用还会做一次图优化，算入编译耗时
+    with torch.inference_mode():
+        traced(*args)
+    compile_time = time.perf_counter() - start
+    return traced, compile_time, cache_hit
+
+
+def compile_model(
+    model: nn.Module,
+    example_inputs,
+    backend: str = "auto",
+    cache_dir: str = DEFAULT_CACHE_DIR,
+    warmup: int = 3,
+    repeats: int = 20,
+    verbose: bool = True,
+):
+    """
+    编译模型（用于 CPU 推理），并报告编译耗时与前向延迟
+
+    参数:
+        model (nn.Module): 要编译的模型（会被切换为 eval 模式）
+        example_inputs: 样例输入，单个张量或位置参数元组
+        backend (str): "inductor"、"torchscript" 或 "auto"（先试 inductor，失败回退 TorchScript）
+        cache_dir (str): 编译产物的磁盘缓存目录
+        warmup (int): 测速预热次数
+        repeats (int): 测速计时次数
+        verbose (bool): 是否打印报告
+
+    返回:
+        tuple[callable, dict]: (编译后的模型, 报告)
+            报告包含 backend、compile_time_s、cache_hit、eager_ms、compiled_ms、
+            以及 break_even_calls（多少次前向后编译开销能回本）
+
+    示例:
+        >>> compiled, report = compile_model(model, (x,))
+        >>> y = compiled(x)
+
+    注意:
+        - inductor 在 CPU 上需要 C++ 编译器（Linux: g++，macOS: Xcode Command Line Tools）
+        - 第二个进程启动时命中缓存，compile_time_s 会显著下降
+    """
+    args = _as_args(example_inputs)
+    model = model.eval()
+
+    if backend not in ("auto", "inductor", "torchscript"):
+        raise ValueError(f"未知的编译后端: {backend}")
+
+    compiled = None
+    if backend in ("auto", "inductor"):
+        try:
+            compiled, compile_time, cache_hit = _compile_inductor(model, args, cache_dir)
+            used = "inductor"
+        except Exception as e:
+            # inductor 失败的原因多种多样（缺少编译器、不支持的算子等），auto 模式统一回退
+            if backend == "inductor":
+                raise
+            if verbose:
+                print(f"⚠️  inductor 编译失败，回退到 TorchScript: {type(e).__name__}: {e}")
+    if compiled is None:
+        compiled, compile_time, cache_hit = _compile_torchscript(model, args, cache_dir)
+        used = "torchscript"
+
+    with torch.inference_mode():
+        eager_ms = _median_ms(lambda: model(*args), warmup, repeats)
+        compiled_ms = _median_ms(lambda: compiled(*args), warmup, repeats)
+
+    saved_ms = eager_ms - compiled_ms
+    report = {
+        "backend": used,
+        "compile_time_s": compile_time,
+        "cache_hit": cache_hit,
+        "eager_ms": eager_ms,
+        "compiled_ms": compiled_ms,
+        # 每次前向省下 saved_ms，调用多少次才能抵消一次性的编译耗时；不更快则永远不回本
+        "break_even_calls": compile_time * 1000 / saved_ms if saved_ms > 0 else None,
+    }
+
+    if verbose:
+        print_compile_report(report)
+    return compiled, report
+
+
+def print_compile_report(report: dict) -> None:
+    """打印编译报告"""
+    cache = "命中磁盘缓存" if report["cache_hit"] else "未命中缓存"
+    print(f"编译后端: {report['backend']}（{cache}）")
+    print(f"  一次性编译耗时: {report['compile_time_s']:.2f} 秒")
+    print(f"  每次前向: eager {report['eager_ms']:.3f} ms -> 编译后 {report['compiled_ms']:.3f} ms")
+    if report["break_even_calls"] is None:
+        print("  编译后没有变快，不建议对该模型开启编译")
+    else:
+        print(f"  约 {report['break_even_calls']:.0f} 次前向后回本")
+
+
+if __name__ == "__main__":
+    torch.manual_seed(123)
+
+    demo_model = nn.Sequential(
+        nn.Linear(768, 3072),
+        nn.GELU(),
+        nn.Linear(3072, 768),
+    )
+    x = torch.randn(4, 128, 768)
+    compile_model(demo_model, (x,))
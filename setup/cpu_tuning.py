@@ -0,0 +1,300 @@
+"""
+模块名称：cpu_tuning
+用途：在 Linux CPU 节点上自动选择 PyTorch 的线程数配置
+
+核心概念：
+    - intra-op 线程：单个算子（如一次 matmul）内部并行使用的线程数，
+      由 torch.set_num_threads 控制
+    - inter-op 线程：多个互不依赖的算子之间并行使用的线程池，
+      由 torch.set_num_interop_threads 控制，且每个进程只能设置一次
+    - 超额订阅（oversubscription）：线程总数超过物理核心数，
+      线程之间互相抢占，反而变慢；同时跑 DataLoader worker 时尤其明显
+    - 按主机缓存：同一台机器的最优配置基本不变，
+      第一次探测后写入 JSON 文件，之后启动直接读取，跳过探测
+
+依赖：
+    - torch: PyTorch 深度学习框架
+"""
+
+import json
+import os
+import socket
+import statistics
+import sys
+
+import torch
+
+# 仓库根目录加入搜索路径，单独运行本文件时也能导入 setup.benchmark
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from setup.benchmark import time_fn
+
+
+# 调优结果的缓存文件：每台主机一条记录
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "0-1-llm", "cpu_threads.json"
+)
+
+
+def available_cores() -> int:
+    """
+    获取当前进程实际可用的 CPU 核心数
+
+    返回:
+        int: 可用核心数
+
+    注意:
+        - 在容器或 taskset 限制下，os.cpu_count() 会返回整机核心数，
+          而 sched_getaffinity 返回的才是本进程真正能用的核心
+        - macOS 没有 sched_getaffinity，回退到 os.cpu_count()
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def host_key(reserve_cores: int = 0) -> str:
+    """
+    生成当前主机的缓存键
+
+    主机名 + 可用核心数 + 预留核心数 + PyTorch 版本：
+    换机器、改了 CPU 配额、预留核心数不同或升级了 PyTorch，都应该重新探测。
+    """
+    return (f"{socket.gethostname()}|cores={available_cores()}|reserve={reserve_cores}"
+            f"|torch={torch.__version__}")
+
+
+def candidate_thread_counts(max_threads: int) -> list[int]:
+    """
+    生成待测试的 intra-op 线程数候选
+
+    参数:
+        max_threads (int): 允许使用的最大线程数
+
+    返回:
+        list[int]: 从小到大的候选线程数，例如 max_threads=12 -> [1, 2, 4, 8, 12]
+
+    说明:
+        按 2 的幂取样再补上最大值，既覆盖常见的最优点，又不需要把每个值都测一遍
+    """
+    counts = []
+    n = 1
+    while n < max_threads:
+        counts.append(n)
+        n *= 2
+    counts.append(max_threads)
+    return counts
+
+
+def _representative_workloads() -> list:
+    """
+    构造有代表性的计算负载（GPT 前向传播里最耗时的两类算子）
+
+    返回:
+        list[tuple[str, callable]]: (名称, 无参函数) 列表
+
+    说明:
+        - matmul：形状取自 GPT-2 small 前馈层，(B*T, 768) x (768, 3072)
+        - attention：多头因果注意力，(B, H, T, head_dim) = (4, 12, 256, 64)
+    """
+    # 固定随机种子，保证每次探测的输入一致
+    gen = torch.Generator().manual_seed(0)
+
+    a = torch.randn(4 * 256, 768, generator=gen)
+    b = torch.randn(768, 3072, generator=gen)
+
+    q = torch.randn(4, 12, 256, 64, generator=gen)
+    k = torch.randn(4, 12, 256, 64, generator=gen)
+    v = torch.randn(4, 12, 256, 64, generator=gen)
+
+    def matmul():
+        """前馈层形状的矩阵乘法（测 GEMM 的多线程扩展性）"""
+        torch.matmul(a, b)
+
+    def attention():
+        """因果注意力（SDPA 内部按 batch × 头并行）"""
+        torch.nn.functional.scaled_dot_product_attention(q, k, v, is_causal=True)
+
+    return [("matmul", matmul), ("attention", attention)]
+
+
+def _time_workloads(workloads: list, warmup: int, repeats: int) -> dict:
+    """
+    在当前线程配置下测量每个负载的中位耗时
+
+    参数:
+        workloads: _representative_workloads() 的返回值
+        warmup (int): 预热次数（不计时），让线程池和内存分配器进入稳定状态
+        repeats (int): 计时次数，取中位数以抵抗偶发的调度抖动
+
+    返回:
+        dict[str, float]: {负载名称: 中位耗时（秒）}
+    """
+    cpu = torch.device("cpu")
+    timings = {}
+    for name, fn in workloads:
+        samples = time_fn(fn, cpu, warmup=warmup, repeats=repeats)
+        timings[name] = statistics.median(samples) / 1e9
+    return timings
+
+
+def load_tuned_config(cache_path: str = DEFAULT_CACHE_PATH, reserve_cores: int = 0):
+    """
+    读取当前主机已缓存的线程配置
+
+    参数:
+        cache_path (str): 缓存文件路径
+        reserve_cores (int): 预留的核心数（不同的预留数分别缓存）
+
+    返回:
+        dict 或 None: 找到则返回 {"num_threads": ..., "num_interop_threads": ...}，否则 None
+    """
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        # 缓存文件损坏时当作没有缓存，重新探测即可
+        return None
+    return cache.get(host_key(reserve_cores))
+
+
+def save_tuned_config(config: dict, cache_path: str = DEFAULT_CACHE_PATH, reserve_cores: int = 0) -> None:
+    """
+    把调优结果写入缓存文件（保留其他主机的记录）
+
+    参数:
+        config (dict): tune_cpu_threads 选出的配置
+        cache_path (str): 缓存文件路径
+        reserve_cores (int): 探测时预留的核心数
+    """
+    cache = {}
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            cache = {}
+
+    cache[host_key(reserve_cores)] = config
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # 先写临时文件再原子替换，避免多个进程同时启动时读到写了一半的 JSON
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, cache_path)
+
+
+def apply_thread_config(num_threads: int, num_interop_threads: int) -> None:
+    """
+    把线程配置应用到当前进程
+
+    参数:
+        num_threads (int): intra-op 线程数
+        num_interop_threads (int): inter-op 线程数
+
+    注意:
+        - set_num_interop_threads 只能在进程里第一次并行计算之前调用一次，
+          之后再调用会抛出 RuntimeError；这时保留原有设置并给出提示
+        - 所以最好在程序一开始（任何计算之前）就调用 get_device(tune_cpu=True)
+    """
+    torch.set_num_threads(num_threads)
+
+    if torch.get_num_interop_threads() != num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            print(
+                f"⚠️  inter-op 线程数已被锁定为 {torch.get_num_interop_threads()}，"
+                f"无法改为 {num_interop_threads}（需在任何计算之前设置）"
+            )
+
+
+def tune_cpu_threads(
+    reserve_cores: int = 0,
+    num_interop_threads: int = 1,
+    cache_path: str = DEFAULT_CACHE_PATH,
+    force: bool = False,
+    warmup: int = 3,
+    repeats: int = 10,
+    verbose: bool = True,
+) -> dict:
+    """
+    为当前主机选出最快的 CPU 线程配置并应用
+
+    先查缓存；没有缓存（或 force=True）时，依次在每个候选线程数下
+    跑一遍代表性负载，取各负载耗时之和最小的配置，应用并写入缓存。
+
+    参数:
+        reserve_cores (int): 预留给 DataLoader worker 等其他进程的核心数，
+                             候选线程数不会超过 (可用核心数 - reserve_cores)
+        num_interop_threads (int): inter-op 线程数。本项目的模型是顺序执行的算子链，
+                                   几乎用不到 inter-op 并行，默认 1 以免空闲线程抢占核心
+        cache_path (str): 缓存文件路径
+        force (bool): 是否忽略缓存强制重新探测
+        warmup (int): 每个负载的预热次数
+        repeats (int): 每个负载的计时次数
+        verbose (bool): 是否打印探测过程
+
+    返回:
+        dict: {"num_threads", "num_interop_threads", "timings"}，
+              timings 为每个候选线程数下的各负载中位耗时（秒）
+
+    示例:
+        >>> config = tune_cpu_threads(reserve_cores=2)
+        >>> torch.get_num_threads() == config["num_threads"]
+        True
+    """
+    max_threads = max(1, available_cores() - reserve_cores)
+    if not force:
+        cached = load_tuned_config(cache_path, reserve_cores)
+        # 缓存键已包含预留核心数；超出上限的记录（例如手工编辑过的缓存）不使用，重新探测
+        if cached is not None and cached["num_threads"] <= max_threads:
+            apply_thread_config(cached["num_threads"], cached["num_interop_threads"])
+            if verbose:
+                print(
+                    f"✅ 使用缓存的 CPU 线程配置: intra-op={cached['num_threads']}, "
+                    f"inter-op={cached['num_interop_threads']}"
+                )
+            return cached
+
+    # inter-op 线程数必须在第一次计算之前设置，所以先于探测负载应用
+    apply_thread_config(max_threads, num_interop_threads)
+    workloads = _representative_workloads()
+
+    if verbose:
+        print(f"🔧 正在探测 CPU 线程配置（可用核心: {available_cores()}, 预留: {reserve_cores}）...")
+
+    # 探测时会反复修改线程数，结束后再统一应用最优值
+    timings = {}
+    for n in candidate_thread_counts(max_threads):
+        torch.set_num_threads(n)
+        timings[n] = _time_workloads(workloads, warmup, repeats)
+        if verbose:
+            detail = ", ".join(f"{k}={v * 1000:.2f}ms" for k, v in timings[n].items())
+            print(f"  threads={n:3d}: {detail}")
+
+    # 以所有负载的耗时之和作为评分；耗时相同时 min 会取先出现的（更少的线程）
+    best = min(timings, key=lambda n: sum(timings[n].values()))
+
+    config = {
+        "num_threads": best,
+        "num_interop_threads": num_interop_threads,
+        # JSON 的键只能是字符串
+        "timings": {str(n): t for n, t in timings.items()},
+    }
+    torch.set_num_threads(best)
+    save_tuned_config(config, cache_path, reserve_cores)
+
+    if verbose:
+        print(f"✅ 最优 CPU 线程配置: intra-op={best}, inter-op={num_interop_threads}")
+        print(f"   已缓存到: {cache_path}")
+    return config
+
+
+if __name__ == "__main__":
+    tune_cpu_threads(force=True)
@@ -3,13 +3,34 @@
 用于在 MacBook Pro 上自动检测并设置最佳的计算设备（MPS 或 CPU）
 """
 
+import argparse
+import os
+import sys
+
 import torch
 
+# 把仓库根目录加入模块搜索路径：
+# 直接运行 `python setup/device_check.py` 时也能以 `setup.xxx` 的形式导入同目录的工具模块
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from setup.benchmark import run_benchmarks, save_report
+from setup.cpu_tuning import tune_cpu_threads
+from setup.compile_cache import compile_model
+from setup.device_manager import get_device_manager
+from setup.quantization import quantize_dynamic_int8
+
 
-def get_device():
+def get_device(tune_cpu=False, reserve_cores=0):
     """
     获取最佳可用设备
 
+    参数:
+        tune_cpu (bool): 落到 CPU 时，是否自动调优 intra-op / inter-op 线程数
+                         （首次探测后按主机缓存，之后启动直接读取）
+        reserve_cores (int): 调优时预留给 DataLoader worker 的核心数
+
     返回:
         torch.device: MPS 设备（如果可用）或 CPU 设备
 
@@ -17,6 +38,8 @@ def get_device():
         - MPS (Metal Performance Shaders): Apple Silicon 的 GPU 加速技术
         - 在 M1/M2/M3 芯片上，MPS 可显著提升训练和推理速度
         - 如果 MPS 不可用，自动回退到 CPU
+        - inter-op 线程数只能在第一次计算前设置，
+          所以 tune_cpu=True 时应在程序开头、创建任何张量之前调用
     """
     if torch.backends.mps.is_available():
         if torch.backends.mps.is_built():
@@ -29,12 +52,21 @@ def get_device():
         device = torch.device("cpu")
         print("⚠️  MPS 不可用，使用 CPU")
 
+    # 在 CPU 上运行时，默认线程数可能与 DataLoader worker 抢占核心
+    if tune_cpu and device.type == "cpu":
+        tune_cpu_threads(reserve_cores=reserve_cores)
+
     print(f"当前设备: {device}")
     return device
 
 
-def print_device_info():
-    """打印详细的设备信息"""
+def print_device_info(json_path=None):
+    """
+    打印详细的设备信息并运行计算微基准
+
+    参数:
+        json_path (str): 如果提供，把基准测试结果写入该 JSON 文件，便于跨机器对比
+    """
     print("=" * 60)
     print("🖥️  系统信息")
     print("=" * 60)
@@ -45,56 +77,63 @@ def print_device_info():
     # 获取当前设备
     device = get_device()
 
-    # 测试张量创建
     print("\n" + "=" * 60)
     print("🧪 设备测试")
     print("=" * 60)
 
-    # 创建测试张量
-    x = torch.randn(1000, 1000).to(device)
-    y = torch.randn(1000, 1000).to(device)
-
-    # 执行矩阵乘法
-    print(f"执行矩阵乘法 (1000x1000) ...")
-    import time
-    start = time.time()
-    z = torch.matmul(x, y)
-    torch.mps.synchronize() if device.type == "mps" else None
-    elapsed = time.time() - start
+    # 计算微基准：覆盖 GEMM / 批量 GEMM / softmax / LayerNorm / embedding，
+    # 每个用例预热后重复计时，报告中位数、p95 和 GFLOP/s
+    report = run_benchmarks(device, quick=True)
+    if json_path:
+        save_report(report, json_path)
+        print(f"\n✅ 基准测试结果已保存到: {json_path}")
 
-    print(f"✅ 完成! 耗时: {elapsed:.4f} 秒")
-    print(f"结果张量形状: {z.shape}, 设备: {z.device}")
 
-
-def set_tensor_to_device(tensor, device=None):
+def set_tensor_to_device(tensor, device=None, non_blocking=False, pin_memory=False):
     """
-    将张量移动到指定设备
+    将张量（或嵌套的张量结构）移动到指定设备
 
     参数:
-        tensor: PyTorch 张量
-        device: 目标设备（如果为 None，使用自动检测的设备）
+        tensor: PyTorch 张量，或由 dict / list / tuple 嵌套组成的 batch
+        device: 目标设备（如果为 None，使用进程级设备管理器缓存的设备，不会重复探测）
+        non_blocking (bool): 是否异步拷贝
+        pin_memory (bool): 拷贝到加速器前是否先放入锁页内存
 
     返回:
-        移动到目标设备的张量
+        移动到目标设备的张量（结构与输入相同）
     """
-    if device is None:
-        device = get_device()
-    return tensor.to(device)
+    return get_device_manager().to_device(
+        tensor, device, non_blocking=non_blocking, pin_memory=pin_memory
+    )
 
 
-def set_model_to_device(model, device=None):
+def set_model_to_device(model, device=None, quantize=False, sample_inputs=None, tolerance=0.05):
     """
     将模型移动到指定设备
 
     参数:
         model: PyTorch 模型
-        device: 目标设备（如果为 None，使用自动检测的设备）
+        device: 目标设备（如果为 None，使用进程级设备管理器缓存的设备）
+        quantize (bool): 是否对 nn.Linear 做动态 int8 量化（仅 CPU 推理）
+        sample_inputs: quantize=True 时必需，用于检查量化误差和测速的样例输入
+        tolerance (float): 单层允许的最大相对误差，超过的层保留 fp32
 
     返回:
-        移动到目标设备的模型
+        移动到目标设备的模型（quantize=True 时为量化后的新模型）
     """
     if device is None:
-        device = get_device()
+        device = get_device_manager().device
+    device = torch.device(device)
+
+    if quantize:
+        # 动态量化的 int8 线性层只有 CPU 实现
+        if device.type != "cpu":
+            raise ValueError(f"动态 int8 量化只支持 CPU，当前目标设备: {device}")
+        if sample_inputs is None:
+            raise ValueError("quantize=True 时需要提供 sample_inputs 来检查量化误差")
+        model, _ = quantize_dynamic_int8(model.to(device), sample_inputs, tolerance=tolerance)
+        print(f"✅ 模型已量化为 int8 并移动到: {device}")
+        return model
 
     model = model.to(device)
     print(f"✅ 模型已移动到: {device}")
@@ -102,8 +141,35 @@ def set_model_to_device(model, device=None):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="设备检测和设置工具")
+    parser.add_argument(
+        "--tune-cpu", action="store_true",
+        help="在 CPU 上探测并应用最优线程数（结果按主机缓存）",
+    )
+    parser.add_argument(
+        "--reserve-cores", type=int, default=0,
+        help="调优时预留给 DataLoader worker 的核心数",
+    )
+    parser.add_argument(
+        "--quantize", action="store_true",
+        help="额外演示 CPU 上的动态 int8 量化推理",
+    )
+    parser.add_argument(
+        "--compile", action="store_true",
+        help="额外演示编译模式（torch.compile inductor，失败回退 TorchScript），编译产物缓存在磁盘",
+    )
+    parser.add_argument(
+        "--benchmark-json", metavar="PATH",
+        help="把计算微基准结果写入 JSON 文件",
+    )
+    args = parser.parse_args()
+
+    # 线程调优必须先于任何计算，所以放在最前面
+    if args.tune_cpu:
+        get_device(tune_cpu=True, reserve_cores=args.reserve_cores)
+
     # 打印设备信息
-    print_device_info()
+    print_device_info(json_path=args.benchmark_json)
 
     # 示例：创建模型并移动到 MPS
     print("\n" + "=" * 60)
@@ -127,3 +193,22 @@ if __name__ == "__main__":
     x = torch.randn(5, 10).to(device)
     output = simple_model(x)
     print(f"✅ 输入形状: {x.shape}, 输出形状: {output.shape}")
+
+    # 示例：CPU 推理时对线性层做动态 int8 量化
+    if args.quantize:
+        print("\n" + "=" * 60)
+        print("🗜️  动态 int8 量化示例")
+        print("=" * 60)
+        cpu_model = simple_model.to("cpu")
+        sample = torch.randn(64, 10)
+        q_model = set_model_to_device(cpu_model, "cpu", quantize=True, sample_inputs=(sample,))
+        print(f"✅ 量化模型输出形状: {q_model(sample).shape}")
+
+    # 示例：编译模式，比较 eager 与编译后的单次前向延迟
+    if args.compile:
+        print("\n" + "=" * 60)
+        print("⚙️  编译模式示例")
+        print("=" * 60)
+        sample = torch.randn(64, 10)
+        compiled_model, _ = compile_model(simple_model.to("cpu"), (sample,))
+        print(f"✅ 编译模型输出形状: {compiled_model(sample).shape}")
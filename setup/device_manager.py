@@ -0,0 +1,295 @@
+"""
+模块名称：device_manager
+用途：进程级的设备管理器——只探测一次设备，并把整批嵌套数据一次性搬到设备上
+
+核心概念：
+    - 记忆化（memoization）：get_device() 每次都会重新探测后端并打印信息，
+      训练循环里每个 batch 调一次就是纯粹的浪费；管理器只在第一次使用时探测，之后直接复用
+    - 嵌套批数据：DataLoader 返回的 batch 常常是 dict / list / tuple 套张量，
+      管理器递归地处理整个结构，调用方只需一次调用
+    - 合并传输（coalesce）：把同 dtype 的多个小张量拼成一块连续内存，
+      只做一次主机到设备的拷贝，再切分回原来的形状，省掉大量小拷贝的固定开销
+    - 锁页内存（pinned memory）：固定在物理内存中的页面，
+      GPU 可以直接 DMA 读取，配合 non_blocking=True 实现异步拷贝
+
+依赖：
+    - torch: PyTorch 深度学习框架
+"""
+
+import contextlib
+import os
+import sys
+from typing import Optional
+
+import torch
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+
+# 小于这个字节数的张量才参与合并传输：
+# 大张量本身就能跑满带宽，拼接反而多一次主机内存拷贝
+COALESCE_MAX_BYTES = 16 * 1024 * 1024
+
+
+def _flatten(obj, leaves: list):
+    """
+    把嵌套结构中的张量收集到 leaves 中，返回一个"结构模板"
+
+    参数:
+        obj: 任意嵌套的 dict / list / tuple / namedtuple / 张量 / 其他对象
+        leaves (list): 输出参数，按遍历顺序收集到的张量
+
+    返回:
+        模板对象：张量被替换为它在 leaves 中的下标（用 _Leaf 包装），其他内容原样保留
+    """
+    if isinstance(obj, torch.Tensor):
+        leaves.append(obj)
+        return _Leaf(len(leaves) - 1)
+    if isinstance(obj, dict):
+        return type(obj)((k, _flatten(v, leaves)) for k, v in obj.items())
+    if isinstance(obj, tuple) and hasattr(obj, "_fields"):
+        # namedtuple 的构造函数按位置接收字段
+        return type(obj)(*(_flatten(v, leaves) for v in obj))
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_flatten(v, leaves) for v in obj)
+    return obj
+
+
+def _unflatten(template, leaves: list):
+    """_flatten 的逆过程：按模板把 leaves 中的张量放回原来的位置"""
+    if isinstance(template, _Leaf):
+        return leaves[template.index]
+    if isinstance(template, dict):
+        return type(template)((k, _unflatten(v, leaves)) for k, v in template.items())
+    if isinstance(template, tuple) and hasattr(template, "_fields"):
+        return type(template)(*(_unflatten(v, leaves) for v in template))
+    if isinstance(template, (list, tuple)):
+        return type(template)(_unflatten(v, leaves) for v in template)
+    return template
+
+
+class _Leaf:
+    """结构模板中的占位符，记录张量在 leaves 列表中的下标"""
+
+    __slots__ = ("index",)
+
+    def __init__(self, index: int):
+        """
+        参数:
+            index (int): 张量在 leaves 列表中的下标
+        """
+        self.index = index
+
+
+def _same_device(a: torch.device, b: torch.device) -> bool:
+    """
+    两个设备是否相同
+
+    torch.device("mps") 与张量报告的 mps:0 直接比较不相等（cuda 同理），
+    所以比较类型，并把缺省的编号当作 0
+    """
+    return a.type == b.type and (a.index or 0) == (b.index or 0)
+
+
+def _maybe_pin(tensor: torch.Tensor, device: torch.device) -> torch.Tensor:
+    """
+    在需要时把 CPU 张量放入锁页内存
+
+    只有 CPU -> 加速器 的拷贝才能从锁页内存受益；
+    纯 CPU 环境或不支持锁页内存的后端直接返回原张量。
+    """
+    if device.type == "cpu" or tensor.device.type != "cpu" or tensor.is_pinned():
+        return tensor
+    try:
+        return tensor.pin_memory()
+    except RuntimeError:
+        return tensor
+
+
+class DeviceManager:
+    """
+    设备管理器：每个进程只探测一次设备，并提供批量搬运和默认放置
+
+    属性:
+        device: 当前的目标设备（第一次访问时才探测）
+
+    方法:
+        to_device: 把嵌套的张量结构一次性搬到目标设备
+        placement: 上下文管理器，临时切换默认设备
+    """
+
+    def __init__(self, device=None, tune_cpu: bool = False):
+        """
+        初始化设备管理器
+
+        参数:
+            device: 指定设备（字符串或 torch.device）；None 表示第一次使用时自动探测
+            tune_cpu (bool): 自动探测落到 CPU 时，是否同时调优线程数
+        """
+        self._device = torch.device(device) if device is not None else None
+        self._tune_cpu = tune_cpu
+
+    @property
+    def device(self) -> torch.device:
+        """目标设备；第一次访问时调用 get_device() 探测，之后直接返回缓存值"""
+        if self._device is None:
+            # 延迟导入：device_check 也会导入本模块，放在这里避免循环导入
+            from setup.device_check import get_device
+
+            self._device = get_device(tune_cpu=self._tune_cpu)
+        return self._device
+
+    def to_device(
+        self,
+        batch,
+        device=None,
+        non_blocking: bool = True,
+        pin_memory: bool = False,
+        coalesce: bool = True,
+    ):
+        """
+        把嵌套的张量结构（dict / list / tuple / namedtuple）整体搬到目标设备
+
+        参数:
+            batch: 单个张量或任意嵌套结构；非张量内容原样保留
+            device: 目标设备，None 表示使用管理器的设备
+            non_blocking (bool): 是否异步拷贝（源张量在锁页内存中时才真正异步）
+            pin_memory (bool): 拷贝到加速器之前是否先放入锁页内存
+            coalesce (bool): 是否把同 dtype 的小张量合并成一次传输
+
+        返回:
+            与 batch 结构相同、张量已在目标设备上的对象
+
+        示例:
+            >>> manager = get_device_manager()
+            >>> batch = {"input_ids": x, "targets": [y, mask]}
+            >>> batch = manager.to_device(batch)
+
+        注意:
+            - 已经在目标设备上的张量不会被拷贝
+            - 需要梯度的张量单独搬运，保留 autograd 关系
+        """
+        device = torch.device(device) if device is not None else self.device
+
+        leaves = []
+        template = _flatten(batch, leaves)
+
+        # 只搬运不在目标设备上的张量（按 _same_device 比较：mps 与 mps:0 是同一个设备）
+        pending = [i for i, t in enumerate(leaves) if not _same_device(t.device, device)]
+        if not pending:
+            return batch
+
+        moved = list(leaves)
+
+        # Step 1: 按 dtype 分组可以合并传输的小张量
+        groups = {}
+        singles = []
+        for i in pending:
+            t = leaves[i]
+            small = t.numel() * t.element_size() <= COALESCE_MAX_BYTES
+            if coalesce and small and not t.requires_grad:
+                groups.setdefault(t.dtype, []).append(i)
+            else:
+                singles.append(i)
+
+        # Step 2: 每组拼接成一块连续内存，一次拷贝后再按原形状切分
+        # 切分得到的是同一块设备内存上的视图，不会产生额外拷贝
+        for indices in groups.values():
+            if len(indices) == 1:
+                singles.extend(indices)
+                continue
+            flat = torch.cat([leaves[i].reshape(-1) for i in indices])
+            if pin_memory:
+                flat = _maybe_pin(flat, device)
+            flat = flat.to(device, non_blocking=non_blocking)
+            chunks = flat.split([leaves[i].numel() for i in indices])
+            for i, chunk in zip(indices, chunks):
+                moved[i] = chunk.view(leaves[i].shape)
+
+        # Step 3: 大张量和需要梯度的张量逐个搬运
+        for i in singles:
+            t = _maybe_pin(leaves[i], device) if pin_memory else leaves[i]
+            moved[i] = t.to(device, non_blocking=non_blocking)
+
+        return _unflatten(template, moved)
+
+    @contextlib.contextmanager
+    def placement(self, device):
+        """
+        临时切换默认设备的上下文管理器
+
+        在 with 块内：
+            - 管理器的 device 变为指定设备（to_device 默认搬到这里）
+            - torch.zeros / torch.randn / nn.Linear(...) 等工厂函数默认在该设备上创建张量
+
+        参数:
+            device: 目标设备（字符串或 torch.device）
+
+        示例:
+            >>> with get_device_manager().placement("cpu"):
+            ...     model = GPTModel(cfg)  # 参数直接创建在 CPU 上
+        """
+        previous = self._device
+        self._device = torch.device(device)
+        try:
+            # torch.device 本身就是上下文管理器，会设置工厂函数的默认设备
+            with self._device:
+                yield self._device
+        finally:
+            self._device = previous
+
+
+# 进程级单例
+_default_manager: Optional[DeviceManager] = None
+
+
+def get_device_manager(tune_cpu: bool = False) -> DeviceManager:
+    """
+    获取进程级的设备管理器（第一次调用时创建）
+
+    参数:
+        tune_cpu (bool): 第一次探测设备时是否调优 CPU 线程数；
+                         只在管理器尚未解析出设备时生效
+
+    返回:
+        DeviceManager: 全局共享的管理器实例
+    """
+    global _default_manager
+    if _default_manager is None:
+        _default_manager = DeviceManager(tune_cpu=tune_cpu)
+    return _default_manager
+
+
+def default_placement(device):
+    """全局管理器的 placement 的快捷方式"""
+    return get_device_manager().placement(device)
+
+
+if __name__ == "__main__":
+    import time
+    from collections import namedtuple
+
+    manager = get_device_manager()
+    print(f"第一次访问: {manager.device}")
+    # 第二次访问不会再探测和打印
+    print(f"第二次访问: {manager.device}")
+
+    Batch = namedtuple("Batch", ["input_ids", "targets"])
+    batch = {
+        "batch": Batch(torch.randint(0, 50257, (8, 256)), torch.randint(0, 50257, (8, 256))),
+        "mask": [torch.ones(8, 256, dtype=torch.bool), torch.zeros(8, dtype=torch.bool)],
+        "meta": "not a tensor",
+    }
+
+    start = time.perf_counter()
+    for _ in range(100):
+        moved = manager.to_device(batch, pin_memory=True)
+    elapsed = (time.perf_counter() - start) / 100
+    print(f"✅ 搬运整个 batch 平均耗时: {elapsed * 1e6:.1f} µs")
+    print(f"   input_ids 设备: {moved['batch'].input_ids.device}, meta: {moved['meta']}")
+
+    with default_placement("cpu"):
+        x = torch.zeros(2, 3)
+        print(f"✅ placement 内创建的张量设备: {x.device}")
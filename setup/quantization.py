@@ -0,0 +1,191 @@
+"""
+模块名称：quantization
+用途：CPU 推理用的动态 int8 量化，并验证输出误差、统计内存和延迟变化
+
+核心概念：
+    - 动态量化（dynamic quantization）：权重提前量化为 int8 存储；
+      激活值在每次前向时按当前 batch 的范围临时量化，不需要校准数据集
+    - 只量化 nn.Linear：GPT 的参数和计算量绝大部分都在线性层（注意力投影、前馈层、输出头），
+      LayerNorm / Embedding 保持 fp32
+    - 逐层误差检查：先单独量化每一层，在真实输入上比较它与 fp32 输出的相对误差，
+      误差超过阈值的层保留 fp32，其余层才真正量化
+    - 相对误差：||y_int8 - y_fp32|| / ||y_fp32||（L2 范数之比），与输出的数值尺度无关
+
+依赖：
+    - torch: PyTorch 深度学习框架（torch.ao.quantization）
+"""
+
+import copy
+import io
+import os
+import statistics
+import sys
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import default_dynamic_qconfig, quantize_dynamic
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from setup.benchmark import time_fn
+
+
+def model_size_bytes(model: nn.Module) -> int:
+    """
+    计算模型序列化后的字节数
+
+    量化后的线性层把权重打包成 int8 的 packed params，
+    直接统计 parameters() 会漏掉它们，所以用 state_dict 序列化后的大小来衡量。
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def _as_args(sample_inputs) -> tuple:
+    """把单个张量或张量元组统一成位置参数元组"""
+    return sample_inputs if isinstance(sample_inputs, tuple) else (sample_inputs,)
+
+
+def relative_error(actual: torch.Tensor, expected: torch.Tensor) -> float:
+    """
+    相对 L2 误差：||actual - expected|| / ||expected||
+
+    分母加一个极小值，防止 expected 全为 0 时除零
+    """
+    diff = (actual.float() - expected.float()).norm()
+    return (diff / (expected.float().norm() + 1e-12)).item()
+
+
+def _capture_linear_io(model: nn.Module, args: tuple) -> dict:
+    """
+    用前向钩子记录每个 nn.Linear 在样例输入上的输入和 fp32 输出
+
+    返回:
+        dict[str, tuple[Tensor, Tensor]]: {层名: (输入, 输出)}
+    """
+    records = {}
+    hooks = []
+    for name, module in model.named_modules():
+        if isinstance(module, nn.Linear):
+            def hook(mod, inputs, output, name=name):
+                """前向钩子：记录这一层的输入和输出（name 用默认参数绑定，避免闭包都取到最后一层的名字）"""
+                records[name] = (inputs[0].detach(), output.detach())
+            hooks.append(module.register_forward_hook(hook))
+
+    try:
+        with torch.inference_mode():
+            model(*args)
+    finally:
+        for h in hooks:
+            h.remove()
+    return records
+
+
+def _median_latency_ms(model: nn.Module, args: tuple, warmup: int, repeats: int) -> float:
+    """测量模型在 CPU 上单次前向的中位耗时（毫秒）"""
+    with torch.inference_mode():
+        samples = time_fn(lambda: model(*args), torch.device("cpu"), warmup, repeats)
+    return statistics.median(samples) / 1e6
+
+
+def quantize_dynamic_int8(
+    model: nn.Module,
+    sample_inputs,
+    tolerance: float = 0.05,
+    warmup: int = 3,
+    repeats: int = 20,
+    verbose: bool = True,
+):
+    """
+    对模型中的 nn.Linear 做动态 int8 量化，误差过大的层回退到 fp32
+
+    参数:
+        model (nn.Module): fp32 模型（需在 CPU 上；函数内部会复制，不修改原模型）
+        sample_inputs: 样例输入，单个张量或位置参数元组，用于误差检查和测速
+        tolerance (float): 单层允许的最大相对误差，超过则该层保留 fp32
+        warmup (int): 测速预热次数
+        repeats (int): 测速计时次数
+        verbose (bool): 是否打印报告
+
+    返回:
+        tuple[nn.Module, dict]: (量化后的模型, 报告)
+            报告包含每层误差、整体输出误差、序列化大小和前向延迟
+
+    示例:
+        >>> qmodel, report = quantize_dynamic_int8(model, (x,), tolerance=0.05)
+        >>> report["size_int8_mb"] < report["size_fp32_mb"]
+        True
+
+    注意:
+        - 动态量化的算子只有 CPU 实现
+        - 误差检查基于样例输入，样例应尽量接近真实数据分布
+    """
+    args = _as_args(sample_inputs)
+    model = model.eval()
+
+    # Step 1: 记录每个线性层在真实输入下的 fp32 输入 / 输出
+    records = _capture_linear_io(model, args)
+
+    # Step 2: 单独量化每一层并比较误差，决定哪些层可以量化
+    layers = {}
+    accepted = {}
+    for name, module in model.named_modules():
+        if name not in records:
+            continue
+        layer_input, fp32_output = records[name]
+        # 包一层 Sequential 是因为 quantize_dynamic 只替换子模块，不替换根模块本身
+        q_layer = quantize_dynamic(nn.Sequential(copy.deepcopy(module)), {nn.Linear}, dtype=torch.qint8)
+        with torch.inference_mode():
+            drift = relative_error(q_layer(layer_input), fp32_output)
+        quantized = drift <= tolerance
+        layers[name] = {"drift": drift, "quantized": quantized}
+        if quantized:
+            accepted[name] = default_dynamic_qconfig
+
+    # Step 3: 只量化通过检查的层（按层名指定 qconfig）
+    q_model = quantize_dynamic(model, accepted, dtype=torch.qint8, inplace=False)
+
+    # Step 4: 整体输出误差、内存和延迟对比
+    with torch.inference_mode():
+        output_drift = relative_error(q_model(*args), model(*args))
+
+    report = {
+        "tolerance": tolerance,
+        "layers": layers,
+        "output_drift": output_drift,
+        "size_fp32_mb": model_size_bytes(model) / 1e6,
+        "size_int8_mb": model_size_bytes(q_model) / 1e6,
+        "latency_fp32_ms": _median_latency_ms(model, args, warmup, repeats),
+        "latency_int8_ms": _median_latency_ms(q_model, args, warmup, repeats),
+    }
+
+    if verbose:
+        print_quantization_report(report)
+    return q_model, report
+
+
+def print_quantization_report(report: dict) -> None:
+    """打印量化报告"""
+    print(f"动态 int8 量化（单层误差阈值: {report['tolerance']:.3f}）")
+    for name, info in report["layers"].items():
+        status = "int8" if info["quantized"] else "fp32（误差超限，回退）"
+        print(f"  {name:<30} 相对误差={info['drift']:.4f} -> {status}")
+    print(f"  整体输出相对误差: {report['output_drift']:.4f}")
+    print(f"  模型大小: {report['size_fp32_mb']:.3f} MB -> {report['size_int8_mb']:.3f} MB")
+    print(f"  前向延迟: {report['latency_fp32_ms']:.3f} ms -> {report['latency_int8_ms']:.3f} ms")
+
+
+if __name__ == "__main__":
+    torch.manual_seed(123)
+
+    # GPT-2 small 前馈层大小的演示模型：768 -> 3072 -> 768
+    demo_model = nn.Sequential(
+        nn.Linear(768, 3072),
+        nn.GELU(),
+        nn.Linear(3072, 768),
+    )
+    x = torch.randn(8, 256, 768)
+    quantize_dynamic_int8(demo_model, (x,))